@@ -42,7 +42,7 @@ def get_per_channel_per_image_sizes_and_losses(model, dataloader: DataLoader, cu
 
         for data_idx in range(x.size(0)):
             losses_by_channel[image_idx, :] = component_loss[data_idx, :]
-            channel_sem_vals = assignments.sem_vals[data_idx, :]
+            channel_sem_vals = assignments.sem_values[data_idx, :]
             channel_inst_vals = assignments.assigned_gt_inst_vals[data_idx, :]
             pred_sem, pred_inst = instance_utils.decompose_semantic_and_instance_labels(label_pred[data_idx, ...],
                                                                                         channel_inst_vals,
@@ -4,9 +4,14 @@ import PIL.Image
 import numpy as np
 import os.path as osp
 
-from instanceseg.datasets.panoptic_dataset_base import PanopticDatasetBase, TransformedPanopticDataset
+from instanceseg.datasets import compiled_label_store, file_index_cache, precompute, resized_cache
+from instanceseg.datasets.panoptic_dataset_base import PanopticDatasetBase, TransformedPanopticDataset, \
+    get_transformer_identifier_tag
 from instanceseg.datasets.precomputed_file_transformations import \
-    GenericSequencePrecomputedDatasetFileTransformer
+    GenericSequencePrecomputedDatasetFileTransformer, precomputed_file_transformer_factory
+from instanceseg.datasets.runtime_transformations import GenericSequenceRuntimeDatasetTransformer, \
+    ResizeRuntimeDatasetTransformer
+from instanceseg.utils.datasets import get_transformation_tag
 from . import labels_table_cityscapes
 from .cityscapes_transformations import CityscapesMapRawtoTrainIdPrecomputedFileDatasetTransformer, \
     ConvertLblstoPModePILImages
@@ -37,7 +42,7 @@ class CityscapesWithOurBasicTrainIds(PanopticDatasetBase):
     # class names by id (not trainId)
     original_labels_table = [l for l in labels_table_cityscapes.CITYSCAPES_LABELS_TABLE]
 
-    def __init__(self, root, split):
+    def __init__(self, root, split, use_file_index_cache=True, file_index_cache_dir=None):
         """
         Root must have the following directory structure:
             leftImg8bit/
@@ -45,10 +50,17 @@ class CityscapesWithOurBasicTrainIds(PanopticDatasetBase):
                     *leftImg8bit.png
             gtFine/
                 <split>/
+        :param use_file_index_cache: reuse the file list from the last construction while the split's directories are
+        unchanged (see file_index_cache.py)
+        :param file_index_cache_dir: where to keep that file list (default: <root>/file_index_cache)
         """
         self.root = osp.expanduser(osp.realpath(root))
         self.split = split
-        self.files, self.id_list = self.get_files_and_identifiers()
+        self.file_index_cache_dir = file_index_cache_dir
+        if use_file_index_cache:
+            self.files, self.id_list = self.get_cached_files_and_identifiers()
+        else:
+            self.files, self.id_list = self.get_files_and_identifiers()
         self.idx_by_id = {
             self.id_list[idx]: idx for idx in range(len(self.files))
         }
@@ -79,6 +91,19 @@ class CityscapesWithOurBasicTrainIds(PanopticDatasetBase):
                                          'mapper to give us the labels_table'
         return labels_table
 
+    def get_cached_files_and_identifiers(self):
+        cache_file = file_index_cache.get_cache_file(self.root, self.split, self.precomputed_file_transformer,
+                                                     cache_dir=self.file_index_cache_dir)
+        cached_index = file_index_cache.load_file_index(cache_file)
+        if cached_index is not None:
+            return cached_index
+        watched_dirs = file_index_cache.get_watched_dirs([osp.join(self.root, d, self.split)
+                                                          for d in ('leftImg8bit', 'gtFine')])
+        dir_mtimes = file_index_cache.get_dir_mtimes(watched_dirs)
+        files, id_list = self.get_files_and_identifiers()
+        file_index_cache.save_file_index(cache_file, watched_dirs, dir_mtimes, files, id_list)
+        return files, id_list
+
     def get_files_and_identifiers(self):
         dataset_dir = self.root
         split = self.split
@@ -86,11 +111,18 @@ class CityscapesWithOurBasicTrainIds(PanopticDatasetBase):
         if self.precomputed_file_transformer is not None:
             file_list = []
             id_list = []
+            # Files generated by scripts/precompute.py are trusted without checking each of them
+            trusted_files = precompute.load_trusted_output_files(
+                dataset_dir, split, self.precomputed_file_transformer,
+                [(f['img'], f['sem_lbl'], f['inst_lbl']) for f in orig_file_list])
             for i, data_files in enumerate(orig_file_list):
-                img_file, sem_lbl_file, raw_inst_lbl_file = self.precomputed_file_transformer.transform(
-                    img_file=data_files['img'],
-                    sem_lbl_file=data_files['sem_lbl'],
-                    inst_lbl_file=data_files['inst_lbl'])
+                if trusted_files is not None:
+                    img_file, sem_lbl_file, raw_inst_lbl_file = trusted_files[i]
+                else:
+                    img_file, sem_lbl_file, raw_inst_lbl_file = self.precomputed_file_transformer.transform(
+                        img_file=data_files['img'],
+                        sem_lbl_file=data_files['sem_lbl'],
+                        inst_lbl_file=data_files['inst_lbl'])
                 file_list.append({
                     'img': img_file,
                     'sem_lbl': sem_lbl_file,
@@ -171,16 +203,118 @@ class TransformedCityscapes(TransformedPanopticDataset):
     """
 
     def __init__(self, root, split, precomputed_file_transformation=None,
-                 runtime_transformation=None):
-        raw_dataset = CityscapesWithOurBasicTrainIds(root, split=split)
+                 runtime_transformation=None, compiled_store_dir=None, resized_cache_dir=None,
+                 resized_cache_workers=None, use_file_index_cache=True, file_index_cache_dir=None):
+        """
+        :param compiled_store_dir: if set, the split is decoded once into a CompiledLabelStore under this directory
+        (recompiled when its source files or the precomputed file transformations change) and items are read from
+        it instead of the image files.
+        :param resized_cache_dir: if set and the runtime transformation starts with a resize, the split is resized
+        once into a ResizedDatasetCache under this directory (one copy per split, target size and interpolation;
+        built with resized_cache_workers processes, resuming any interrupted build) and items are read from it.
+        :param use_file_index_cache, file_index_cache_dir: see CityscapesWithOurBasicTrainIds
+        """
+        raw_dataset = CityscapesWithOurBasicTrainIds(root, split=split, use_file_index_cache=use_file_index_cache,
+                                                     file_index_cache_dir=file_index_cache_dir)
         super(TransformedCityscapes, self).__init__(
             raw_dataset=raw_dataset,
             raw_dataset_returns_images=False,
             precomputed_file_transformation=precomputed_file_transformation,
             runtime_transformation=runtime_transformation)
+        self.trusted_files_by_id = None
+        if precomputed_file_transformation is not None:
+            self.trusted_files_by_id = self.load_trusted_files()
+        self.label_store = None
+        if compiled_store_dir is not None:
+            self.label_store = self.open_label_store(compiled_store_dir)
+        self.resized_cache = None
+        if resized_cache_dir is not None and self.get_resize_transformer() is not None:
+            self.resized_cache = self.open_resized_cache(resized_cache_dir, resized_cache_workers)
 
     def get_image_id(self, index):
         return self.raw_dataset.get_image_id(index)
 
     def load_files(self, img_file, sem_lbl_file, inst_lbl_file):
         return load_cityscapes_files(img_file, sem_lbl_file, inst_lbl_file)
+
+    def load_trusted_files(self):
+        identifiers = self.raw_dataset.id_list
+        raw_files = [self.get_transformed_files(identifier, None) for identifier in identifiers]
+        trusted_files = precompute.load_trusted_output_files(self.raw_dataset.root, self.raw_dataset.split,
+                                                             self.precomputed_file_transformation, raw_files)
+        return dict(zip(identifiers, trusted_files)) if trusted_files is not None else None
+
+    def get_transformed_files(self, identifier, precomputed_file_transformation=None):
+        if self.trusted_files_by_id is not None and \
+                precomputed_file_transformation is self.precomputed_file_transformation:
+            return self.trusted_files_by_id[identifier]
+        return super(TransformedCityscapes, self).get_transformed_files(identifier, precomputed_file_transformation)
+
+    @property
+    def precomputed_transformation_tag(self):
+        # Both file transformation chains: the raw dataset's (train ids, mode P) and ours (e.g. - ordering)
+        return get_transformation_tag([self.raw_dataset.precomputed_file_transformer,
+                                       self.precomputed_file_transformation])
+
+    def open_label_store(self, compiled_store_dir):
+        tag = self.precomputed_transformation_tag
+        identifiers = self.raw_dataset.id_list
+        files = [self.get_transformed_files(identifier, self.precomputed_file_transformation)
+                 for identifier in identifiers]
+        store_dir = compiled_label_store.get_store_dir(compiled_store_dir, self.raw_dataset.root,
+                                                       self.raw_dataset.split, tag)
+        return compiled_label_store.CompiledLabelStore.open_or_compile(store_dir, identifiers, files,
+                                                                       self.load_files, tag)
+
+    def get_resize_transformer(self):
+        runtime_transformation = self.runtime_transformation
+        if isinstance(runtime_transformation, GenericSequenceRuntimeDatasetTransformer):
+            runtime_transformation = runtime_transformation.transformer_sequence[0]
+        if isinstance(runtime_transformation, ResizeRuntimeDatasetTransformer) and \
+                runtime_transformation.resize_size is not None:
+            return runtime_transformation
+        return None
+
+    def open_resized_cache(self, resized_cache_dir, n_workers=None):
+        resize_size = tuple(self.get_resize_transformer().resize_size)  # lists (e.g. - from a config file) too
+        tag = self.precomputed_transformation_tag + '__' + get_transformer_identifier_tag(
+            None, ResizeRuntimeDatasetTransformer(resize_size=resize_size))
+        identifiers = self.raw_dataset.id_list
+        files = [self.get_transformed_files(identifier, self.precomputed_file_transformation)
+                 for identifier in identifiers]
+        cache_dir = resized_cache.get_cache_dir(resized_cache_dir, self.raw_dataset.root, self.raw_dataset.split, tag)
+        return resized_cache.ResizedDatasetCache.open_or_build(cache_dir, identifiers, files, self.load_files,
+                                                               resize_size, tag, n_workers)
+
+    def get_item_from_files(self, identifier, precomputed_file_transformation=None):
+        # Items come resized only when the runtime transformation (which starts with that resize) will run on them
+        if self.resized_cache is not None and self.should_use_runtime_transform and \
+                precomputed_file_transformation is self.precomputed_file_transformation:
+            return self.resized_cache.get_datapoint_from_identifier(identifier)
+        # The store was compiled with self.precomputed_file_transformation; otherwise, go to the files.
+        if self.label_store is not None and precomputed_file_transformation is self.precomputed_file_transformation:
+            return self.label_store.get_datapoint_from_identifier(identifier)
+        return super(TransformedCityscapes, self).get_item_from_files(identifier, precomputed_file_transformation)
+
+
+def precompute_cityscapes_split(dataset_path, split, ordering=None, n_workers=None):
+    """
+    Generates the train id / mode P labels of CityscapesWithOurBasicTrainIds, then the files of the ordering
+    transformation (cfg['ordering']) of TransformedCityscapes, in parallel (see precompute.py)
+    """
+    dataset_path = osp.expanduser(osp.realpath(dataset_path))  # as CityscapesWithOurBasicTrainIds, so the inputs match
+    raw_files = [(f['img'], f['sem_lbl'], f['inst_lbl']) for f in get_raw_cityscapes_files(dataset_path, split)]
+    train_id_files = precompute.precompute_files(
+        dataset_path, split, CityscapesWithOurBasicTrainIds.precomputed_file_transformer, raw_files,
+        n_workers=n_workers)
+    file_transformer = precomputed_file_transformer_factory(ordering=ordering)
+    if file_transformer is not None:
+        precompute.precompute_files(dataset_path, split, file_transformer, train_id_files, n_workers=n_workers)
+
+
+def build_resized_cityscapes_split(dataset_path, split, resize_size, resized_cache_dir, ordering=None,
+                                   n_workers=None):
+    file_transformer = precomputed_file_transformer_factory(ordering=ordering)
+    TransformedCityscapes(dataset_path, split, precomputed_file_transformation=file_transformer,
+                          runtime_transformation=ResizeRuntimeDatasetTransformer(resize_size=resize_size),
+                          resized_cache_dir=resized_cache_dir, resized_cache_workers=n_workers)
@@ -22,13 +22,15 @@ def convert_to_p_mode_file(old_file, new_file, palette, assert_inside_palette_ra
                                                                                           max_palette_val)
 
     if im.mode == 'P':  # already mode p.  symlink so we dont go through this again.
-        os.symlink(old_file, new_file)
-    elif im.mode == 'I':
+        with misc.atomic_output_file(new_file) as tmp_file:
+            os.symlink(old_file, tmp_file)
+    elif im.mode in ('I', 'I;16'):
         arr = np.array(im)
         datasets.write_np_array_as_img_with_colormap_palette(arr, new_file, palette)
     else:  # if im.mode == 'RGB':
         converted = im.quantize(palette=palette)
-        converted.save(new_file)
+        with misc.atomic_output_file(new_file) as tmp_file:
+            converted.save(tmp_file)
 
 
 class ConvertLblstoPModePILImages(PrecomputedDatasetFileTransformerBase):
@@ -44,21 +46,22 @@ class ConvertLblstoPModePILImages(PrecomputedDatasetFileTransformerBase):
             labels_table_cityscapes.get_instance_palette_image()
 
     def transform(self, img_file, sem_lbl_file, inst_lbl_file):
+        self.generate_missing_files(img_file, sem_lbl_file, inst_lbl_file)
+        return self.get_output_files(img_file, sem_lbl_file, inst_lbl_file)
+
+    def get_output_files(self, img_file, sem_lbl_file, inst_lbl_file):
         assert self.old_sem_file_tag in sem_lbl_file and self.old_sem_file_tag in inst_lbl_file
         new_sem_lbl_file = sem_lbl_file.replace(self.old_sem_file_tag, self.new_sem_file_tag)
-        if not osp.isfile(new_sem_lbl_file):
-            assert osp.isfile(sem_lbl_file), '{} does not exist'.format(sem_lbl_file)
-            print('Creating {} from {}'.format(new_sem_lbl_file, sem_lbl_file))
-            convert_to_p_mode_file(sem_lbl_file, new_sem_lbl_file, palette=self.semantic_palette,
-                                   assert_inside_palette_range=True)
-        new_inst_lbl_file = inst_lbl_file.replace(self.old_inst_file_tag, self.new_inst_file_tag)
-        if not osp.isfile(new_inst_lbl_file):
-            assert osp.isfile(inst_lbl_file), '{} does not exist'.format(inst_lbl_file)
-            print('Creating {} from {}'.format(new_inst_lbl_file, inst_lbl_file))
-            convert_to_p_mode_file(inst_lbl_file, new_inst_lbl_file, palette=self.instance_palette,
-                                   assert_inside_palette_range=True)
         return img_file, new_sem_lbl_file, inst_lbl_file
 
+    def get_generation_jobs(self, img_file, sem_lbl_file, inst_lbl_file):
+        # The mode P instance file is generated too, though we keep reading the original one.
+        new_sem_lbl_file = sem_lbl_file.replace(self.old_sem_file_tag, self.new_sem_file_tag)
+        new_inst_lbl_file = inst_lbl_file.replace(self.old_inst_file_tag, self.new_inst_file_tag)
+        return [(new_sem_lbl_file, convert_to_p_mode_file, (sem_lbl_file, new_sem_lbl_file, self.semantic_palette)),
+                (new_inst_lbl_file, convert_to_p_mode_file,
+                 (inst_lbl_file, new_inst_lbl_file, self.instance_palette))]
+
     def untransform(self, img_file, sem_lbl_file, inst_lbl_file):
         old_sem_lbl_file = sem_lbl_file.replace(self.new_sem_file_tag, self.old_sem_file_tag)
         old_inst_lbl_file = inst_lbl_file.replace(self.new_inst_file_tag, self.old_inst_file_tag)
@@ -110,22 +113,20 @@ class CityscapesMapRawtoTrainIdPrecomputedFileDatasetTransformer(PrecomputedData
         return labels_table_cityscapes.CITYSCAPES_LABELS_TABLE
 
     def transform(self, img_file, sem_lbl_file, inst_lbl_file):
+        self.generate_missing_files(img_file, sem_lbl_file, inst_lbl_file)
+        return self.get_output_files(img_file, sem_lbl_file, inst_lbl_file)
+
+    def get_output_files(self, img_file, sem_lbl_file, inst_lbl_file):
         new_sem_lbl_file = sem_lbl_file.replace(self.old_sem_file_tag, self.new_sem_file_tag)
-        if not osp.isfile(new_sem_lbl_file):
-            print('Generating {}'.format(new_sem_lbl_file))
-            assert osp.isfile(sem_lbl_file), '{} does not exist'.format(sem_lbl_file)
-            self.generate_train_id_semantic_file(sem_lbl_file, new_sem_lbl_file)
         new_inst_lbl_file = inst_lbl_file.replace(self.old_inst_file_tag, self.new_inst_file_tag)
-        if not osp.isfile(new_inst_lbl_file):
-            print('Generating {}'.format(new_inst_lbl_file))
-            assert osp.isfile(inst_lbl_file), '{} does not exist'.format(inst_lbl_file)
-            self.generate_train_id_instance_file(inst_lbl_file, new_inst_lbl_file, sem_lbl_file)
-        if 1:
-            assert osp.isfile(new_inst_lbl_file)
-            assert osp.isfile(new_sem_lbl_file)
-
         return img_file, new_sem_lbl_file, new_inst_lbl_file
 
+    def get_generation_jobs(self, img_file, sem_lbl_file, inst_lbl_file):
+        _, new_sem_lbl_file, new_inst_lbl_file = self.get_output_files(img_file, sem_lbl_file, inst_lbl_file)
+        return [(new_sem_lbl_file, self.generate_train_id_semantic_file, (sem_lbl_file, new_sem_lbl_file)),
+                (new_inst_lbl_file, self.generate_train_id_instance_file,
+                 (inst_lbl_file, new_inst_lbl_file, sem_lbl_file))]
+
     def untransform(self, img_file, sem_lbl_file, inst_lbl_file):
         old_sem_lbl_file = sem_lbl_file.replace(self.new_sem_file_tag, self.old_sem_file_tag)
         old_inst_lbl_file = sem_lbl_file.replace(self.new_inst_file_tag, self.old_inst_file_tag)
@@ -157,11 +158,12 @@ class CityscapesMapRawtoTrainIdPrecomputedFileDatasetTransformer(PrecomputedData
         if orig_lbl.mode == 'P':
             datasets.write_np_array_as_img_with_borrowed_colormap_palette(
                 inst_lbl, new_format_inst_lbl_file, filename_for_colormap=raw_format_inst_lbl_file)
-        elif orig_lbl.mode == 'I':
+        elif orig_lbl.mode in ('I', 'I;16'):  # newer Pillow versions open 16-bit pngs as I;16
             new_img_data = PIL.Image.fromarray(inst_lbl, mode='I')
             new_lbl_img = orig_lbl.copy()
             new_lbl_img.paste(new_img_data)
-            new_lbl_img.save(new_format_inst_lbl_file)
+            with misc.atomic_output_file(new_format_inst_lbl_file) as tmp_file:
+                new_lbl_img.save(tmp_file)
         else:
             raise NotImplementedError
 
@@ -196,9 +198,7 @@ class CityscapesMapRawtoTrainIdPrecomputedFileDatasetTransformer(PrecomputedData
         so they 'remap' them onto actual training classes.  Leads to very silly remapping after
         loading...
 
-        WARNING: We map iteratively (less memory-intensive than copying sem_lbl or making masks).
-        For this to work, train_ids must be <= ids, background_value <= background_ids,
-        void_value <= void_ids.
+        In place, through one lookup table (see label_remap).
         """
         fast_remap(sem_lbl, list(self.id_to_train_id.keys()), list(self.id_to_train_id.values()))
         return sem_lbl
@@ -0,0 +1,242 @@
+"""
+Compiled label store: a split's images and labels, decoded once into flat memory-mapped arrays, so loading an item is
+a slice of the page cache instead of three PNG decodes.
+
+<store_dir>/
+    manifest.json: identifiers, source files (path, size, mtime, sha1), transformation tag and array dtypes
+    index.npy: (N, 7) int64 -- image offset, height, width, channels; label offset, height, width
+    images.bin: uint8
+    sem_lbl.bin, inst_lbl.bin: the smallest of LABEL_DTYPES that holds the split's values
+
+A store is compiled in a temporary directory (manifest last) that is renamed into place, so it is either complete or
+absent.  It is stale -- and recompiled by open_or_compile -- when the store version, transformation tag or
+identifiers differ, or when a source file's content changed (files whose mtime changed are re-hashed; only a
+different hash counts).
+"""
+import hashlib
+import json
+import os
+import os.path as osp
+import shutil
+import tempfile
+
+import numpy as np
+
+
+STORE_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+INDEX_FILE = 'index.npy'
+ARRAY_FILES = {'image': 'images.bin', 'sem_lbl': 'sem_lbl.bin', 'inst_lbl': 'inst_lbl.bin'}
+# int16 rather than uint16: torch.from_numpy cannot wrap uint16 arrays on older versions, and -1 (void) must fit.
+LABEL_DTYPES = (np.uint8, np.int16, np.int32)
+PROMOTION_CHUNK_SIZE = 2 ** 24
+
+
+def file_sha1(filename, block_size=2 ** 20):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_signature(filename):
+    st = os.stat(filename)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def smallest_label_dtype(min_val, max_val):
+    for dtype in LABEL_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= min_val and max_val <= info.max:
+            return np.dtype(dtype)
+    raise ValueError('Label values in [{}, {}] do not fit in any of {}'.format(min_val, max_val, LABEL_DTYPES))
+
+
+def get_store_dir(store_root, root, split, transformation_tag):
+    key = hashlib.md5('\n'.join([osp.realpath(root), split, transformation_tag]).encode()).hexdigest()[:12]
+    return osp.join(store_root, '{}_{}'.format(split, key))
+
+
+class _LabelArrayWriter(object):
+    """
+    Appends labels to a flat file in the smallest dtype needed so far.  When a later label needs a wider dtype, what
+    has been written is promoted (at most len(LABEL_DTYPES) - 1 times per split).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.dtype = np.dtype(LABEL_DTYPES[0])
+        self.min_val, self.max_val = 0, 0
+        self.n_written = 0
+        self.file = open(filename, 'wb')
+
+    def append(self, lbl):
+        if lbl.size > 0:
+            self.min_val, self.max_val = min(self.min_val, int(lbl.min())), max(self.max_val, int(lbl.max()))
+        dtype = smallest_label_dtype(self.min_val, self.max_val)
+        if dtype != self.dtype:
+            self.promote(dtype)
+        self.file.write(np.ascontiguousarray(lbl, dtype=self.dtype).tobytes())
+        self.n_written += lbl.size
+
+    def promote(self, dtype):
+        self.file.close()
+        if self.n_written > 0:
+            written = np.memmap(self.filename, dtype=self.dtype, mode='r', shape=(self.n_written,))
+            with open(self.filename + '.promoted', 'wb') as f:
+                for start in range(0, self.n_written, PROMOTION_CHUNK_SIZE):
+                    f.write(written[start:start + PROMOTION_CHUNK_SIZE].astype(dtype).tobytes())
+            del written
+            os.replace(self.filename + '.promoted', self.filename)
+        self.dtype = dtype
+        self.file = open(self.filename, 'ab')
+
+    def close(self):
+        self.file.close()
+
+
+def compile_store(store_dir, identifiers, files, load_files, transformation_tag=''):
+    """
+    :param files: [(img_file, sem_lbl_file, inst_lbl_file)], one per identifier
+    :param load_files: load_files(img_file, sem_lbl_file, inst_lbl_file) -> img (H, W, C), (sem_lbl, inst_lbl) (H, W)
+    """
+    assert len(identifiers) == len(files)
+    parent_dir = osp.dirname(osp.abspath(store_dir))
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix='.{}.'.format(osp.basename(store_dir)))
+    try:
+        index = np.zeros((len(files), 7), dtype=np.int64)
+        img_offset, lbl_offset = 0, 0
+        sources = []
+        sem_writer = _LabelArrayWriter(osp.join(tmp_dir, ARRAY_FILES['sem_lbl']))
+        inst_writer = _LabelArrayWriter(osp.join(tmp_dir, ARRAY_FILES['inst_lbl']))
+        with open(osp.join(tmp_dir, ARRAY_FILES['image']), 'wb') as img_f:
+            for i, data_files in enumerate(files):
+                img, (sem_lbl, inst_lbl) = load_files(*data_files)
+                assert img.ndim == 3 and sem_lbl.shape == inst_lbl.shape == img.shape[:2], \
+                    'Unexpected shapes loading {}'.format(data_files)
+                img_f.write(np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+                sem_writer.append(sem_lbl)
+                inst_writer.append(inst_lbl)
+                index[i, :] = (img_offset,) + img.shape + (lbl_offset,) + sem_lbl.shape
+                img_offset += img.size
+                lbl_offset += sem_lbl.size
+                sources.append([dict(file=f, sha1=file_sha1(f), **file_signature(f)) for f in data_files])
+        sem_writer.close()
+        inst_writer.close()
+        np.save(osp.join(tmp_dir, INDEX_FILE), index)
+        manifest = {
+            'version': STORE_VERSION,
+            'transformation_tag': transformation_tag,
+            'identifiers': list(identifiers),
+            'sources': sources,
+            'dtypes': {'image': 'uint8', 'sem_lbl': sem_writer.dtype.name, 'inst_lbl': inst_writer.dtype.name},
+        }
+        with open(osp.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f)
+        if osp.isdir(store_dir):
+            shutil.rmtree(store_dir)
+        os.rename(tmp_dir, store_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def load_manifest(store_dir):
+    manifest_file = osp.join(store_dir, MANIFEST_FILE)
+    if not osp.isfile(manifest_file):
+        return None
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(store_dir, manifest):
+    manifest_file = osp.join(store_dir, MANIFEST_FILE)
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def get_stale_reason(manifest, identifiers, files, transformation_tag=''):
+    """
+    Returns (stale_reason, manifest_changed): stale_reason is None if the store described by manifest is up to date.
+    Sources whose mtime changed but whose content did not get their new signature recorded in manifest, so they are
+    not re-hashed next time (manifest_changed).
+    """
+    if manifest.get('version') != STORE_VERSION:
+        return 'store version changed', False
+    if manifest['transformation_tag'] != transformation_tag:
+        return 'transformation tag changed', False
+    if manifest['identifiers'] != list(identifiers):
+        return 'identifiers changed', False
+    manifest_changed = False
+    for data_files, sources in zip(files, manifest['sources']):
+        for f, source in zip(data_files, sources):
+            if f != source['file']:
+                return 'source file changed from {} to {}'.format(source['file'], f), False
+            try:
+                signature = file_signature(f)
+            except OSError:
+                return '{} is missing'.format(f), False
+            if signature != {'size': source['size'], 'mtime_ns': source['mtime_ns']}:
+                if signature['size'] != source['size'] or file_sha1(f) != source['sha1']:
+                    return '{} changed'.format(f), False
+                source.update(signature)
+                manifest_changed = True
+    return None, manifest_changed
+
+
+class CompiledLabelStore(object):
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.manifest = load_manifest(store_dir)
+        assert self.manifest is not None, 'No compiled label store in {}'.format(store_dir)
+        self.index = np.load(osp.join(store_dir, INDEX_FILE))
+        self.idx_by_id = {identifier: idx for idx, identifier in enumerate(self.manifest['identifiers'])}
+        self._arrays = None
+
+    @classmethod
+    def open_or_compile(cls, store_dir, identifiers, files, load_files, transformation_tag=''):
+        manifest = load_manifest(store_dir)
+        if manifest is None:
+            stale_reason = 'not compiled yet'
+        else:
+            stale_reason, manifest_changed = get_stale_reason(manifest, identifiers, files, transformation_tag)
+            if stale_reason is None and manifest_changed:
+                write_manifest(store_dir, manifest)
+        if stale_reason is not None:
+            print('Compiling label store {} ({})'.format(store_dir, stale_reason))
+            compile_store(store_dir, identifiers, files, load_files, transformation_tag)
+        return cls(store_dir)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # Maps are not pickled; each DataLoader worker maps the files itself
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            # Copy-on-write: in-place edits by the transforms stay private to the process
+            self._arrays = {k: np.memmap(osp.join(self.store_dir, f), dtype=self.manifest['dtypes'][k], mode='c')
+                            for k, f in ARRAY_FILES.items()}
+        return self._arrays
+
+    def get_datapoint(self, idx):
+        """
+        Zero-copy views: img (H, W, C) uint8, (sem_lbl, inst_lbl) (H, W) in the store's label dtypes
+        """
+        img_offset, h, w, c, lbl_offset, lbl_h, lbl_w = self.index[idx].tolist()
+        arrays = self.arrays
+        img = arrays['image'][img_offset:img_offset + h * w * c].reshape(h, w, c)
+        sem_lbl, inst_lbl = (arrays[k][lbl_offset:lbl_offset + lbl_h * lbl_w].reshape(lbl_h, lbl_w)
+                             for k in ('sem_lbl', 'inst_lbl'))
+        return img.view(np.ndarray), (sem_lbl.view(np.ndarray), inst_lbl.view(np.ndarray))
+
+    def get_datapoint_from_identifier(self, identifier):
+        return self.get_datapoint(self.idx_by_id[identifier])
@@ -39,14 +39,21 @@ def get_dataset(dataset_type, cfg, split, transform=True):
         raise NotImplementedError
     elif dataset_type == 'cityscapes':
         dataset_path = cfg['dataset_path']
+        raw_dataset = cityscapes.CityscapesWithOurBasicTrainIds(
+            dataset_path, split=split, file_index_cache_dir=cfg.get('file_index_cache_dir', None))
         precomputed_file_transformation, runtime_transformation = get_transformations(
-            cfg, cityscapes.CityscapesWithOurBasicTrainIds(dataset_path, split=split).semantic_class_names)
+            cfg, raw_dataset.semantic_class_names,
+            thing_class_names=[l['name'] for l in raw_dataset.labels_table if l.isthing])
         dataset = get_cityscapes_dataset(dataset_path, precomputed_file_transformation, runtime_transformation,
-                                         split=split, transform=transform)
+                                         split=split, transform=transform,
+                                         compiled_store_dir=cfg.get('compiled_store_dir', None),
+                                         resized_cache_dir=cfg.get('resized_cache_dir', None),
+                                         file_index_cache_dir=cfg.get('file_index_cache_dir', None))
     elif dataset_type == 'synthetic':
         semantic_subset = cfg['semantic_subset']
         precomputed_file_transformation, runtime_transformation = get_transformations(
-            cfg, synthetic.ALL_BLOB_CLASS_NAMES)
+            cfg, synthetic.ALL_BLOB_CLASS_NAMES,
+            thing_class_names=[name for name in synthetic.ALL_BLOB_CLASS_NAMES if name != 'background'])
         ordering = cfg['ordering']
         intermediate_write_path = cfg['dataset_path']
         n_instances_per_img = cfg['synthetic_generator_n_instances_per_semantic_id']
@@ -70,7 +77,16 @@ def get_dataset(dataset_type, cfg, split, transform=True):
     return dataset
 
 
-def get_transformations(cfg, original_semantic_class_names=None):
+def get_instance_size_caps(semantic_class_names, thing_class_names, n_instances_per_class, map_to_semantic=False):
+    """
+    {semantic value: cap} for the thing classes: the number of channels the model allocates to each (the caps the
+    trainer applies, Trainer.n_instances_by_thing_sem_val)
+    """
+    return {sem_val: 1 if map_to_semantic else n_instances_per_class
+            for sem_val, name in enumerate(semantic_class_names) if name in thing_class_names}
+
+
+def get_transformations(cfg, original_semantic_class_names=None, thing_class_names=None):
     # Get transformation parameters
     semantic_subset = cfg['semantic_subset']
     if semantic_subset is not None:
@@ -78,8 +94,16 @@ def get_transformations(cfg, original_semantic_class_names=None):
         class_names, reduced_class_idxs = datasets.get_semantic_names_and_idxs(
             semantic_subset=semantic_subset, full_set=original_semantic_class_names)
     else:
+        class_names = original_semantic_class_names
         reduced_class_idxs = None
 
+    if cfg.get('cap_sizes_in_workers', False):
+        assert class_names is not None and thing_class_names is not None
+        n_inst_size_cap_per_class = get_instance_size_caps(class_names, thing_class_names, cfg['n_instances_per_class'],
+                                                           cfg['map_to_semantic'])
+    else:
+        n_inst_size_cap_per_class = None
+
     if cfg['dataset_instance_cap'] == 'match_model':
         n_inst_cap_per_class = cfg['n_instances_per_class']
     else:
@@ -105,18 +129,23 @@ def get_transformations(cfg, original_semantic_class_names=None):
         map_other_classes_to_bground=True, map_to_single_instance_problem=
         cfg['single_instance'] or cfg['map_to_semantic'],
         n_inst_cap_per_class=n_inst_cap_per_class,
-        instance_id_for_excluded_instances=cfg['instance_id_for_excluded_instances'])
+        instance_id_for_excluded_instances=cfg['instance_id_for_excluded_instances'],
+        n_inst_size_cap_per_class=n_inst_size_cap_per_class,
+        compact_transport=cfg.get('compact_transport', False))
 
     return precomputed_file_transformation, runtime_transformation
 
 
 def get_cityscapes_dataset(dataset_path, precomputed_file_transformation, runtime_transformation, split,
-                           transform=True):
+                           transform=True, compiled_store_dir=None, resized_cache_dir=None,
+                           file_index_cache_dir=None):
     # assert split in ['train', 'val']
     dataset = cityscapes.TransformedCityscapes(
         root=dataset_path, split=split,
         precomputed_file_transformation=precomputed_file_transformation,
-        runtime_transformation=runtime_transformation)
+        runtime_transformation=runtime_transformation, compiled_store_dir=compiled_store_dir,
+        resized_cache_dir=resized_cache_dir if transform else None,  # untransformed items aren't resized
+        file_index_cache_dir=file_index_cache_dir)
     if not transform:
         dataset.should_use_precompute_transform = False
         dataset.should_use_runtime_transform = False
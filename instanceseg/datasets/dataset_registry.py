@@ -4,6 +4,7 @@ import instanceseg.datasets.synthetic
 import scripts.configurations.synthetic_cfg
 from instanceseg.datasets import cityscapes
 from instanceseg.datasets import dataset_generator_registry
+from instanceseg.datasets import image_statistics_store
 from scripts.configurations import cityscapes_cfg
 
 PROJECT_ROOT = os.path.dirname(os.path.abspath(os.path.join(__file__, '..', '..')))
@@ -41,6 +42,10 @@ class RegisteredDataset(object):
         return os.path.join(self.cache_path, '{}_within_class_occlusion_counts_{}.npy'.format(
             split, transformer_tag))
 
+    def get_image_statistics_filename(self, transformer_tag):
+        # One per-image statistics store for all the splits
+        return image_statistics_store.get_store_file(self.cache_path, transformer_tag)
+
 
 REGISTRY = {
     'cityscapes': RegisteredDataset(
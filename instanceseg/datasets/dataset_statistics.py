@@ -6,6 +6,9 @@ import abc
 import logging
 import os, shutil
 from instanceseg.analysis import visualization_utils
+from instanceseg.datasets import image_statistics_store
+from instanceseg.datasets.loader_autotune import DEFAULT_NUM_WORKERS
+from instanceseg.utils import misc
 
 try:
     from tabulate import tabulate
@@ -31,6 +34,13 @@ class DatasetStatisticCacheInterface(object):
     def labels(self):
         raise NotImplementedError
 
+    @property
+    def store_column(self):
+        """
+        This statistic's column in an ImageStatisticsStore: must change with anything that changes its rows
+        """
+        return self.__class__.__name__
+
     @property
     def shape(self):
         return self.stat_tensor.shape
@@ -45,7 +55,8 @@ class DatasetStatisticCacheInterface(object):
 
     @staticmethod
     def save(statistics, stats_filename):
-        np.save(stats_filename, statistics)
+        with misc.atomic_output_file(stats_filename) as tmp_filename:
+            np.save(tmp_filename, statistics)
 
     @property
     def stat_tensor(self):
@@ -55,22 +66,38 @@ class DatasetStatisticCacheInterface(object):
                     self.__class__.__name__))
         return self._stat_tensor
 
+    @property
+    def is_cached(self):
+        return self.cache_file is not None and not self.override and os.path.exists(self.cache_file)
+
     def compute_or_retrieve(self, dataset):
-        if self.cache_file is None:
-            logger.info('Computing statistics without cache')
-            self._stat_tensor = self._compute(dataset)
-        elif self.override or not os.path.exists(self.cache_file):
-            logger.info('Computing statistics for file {}'.format(self.cache_file))
-            self._stat_tensor = self._compute(dataset)
-            self.save(self._stat_tensor, self.cache_file)
-        else:
+        if self.is_cached:
             logger.info('Loading statistics from file {}'.format(self.cache_file))
             self._stat_tensor = self.load(self.cache_file)
+        else:
+            logger.info('Computing statistics for file {}'.format(self.cache_file) if self.cache_file is not None
+                        else 'Computing statistics without cache')
+            self.store(self._compute(dataset))
+
+    def store(self, stat_tensor):
+        self._stat_tensor = stat_tensor
+        if self.cache_file is not None:
+            self.save(stat_tensor, self.cache_file)
 
     @abc.abstractmethod
     def _compute(self, dataset):
         raise NotImplementedError
 
+    def compute_image_statistic(self, sem_lbl, inst_lbl, label_histogram):
+        """
+        This statistic's row for one image, for FusedDatasetStatistics.
+        label_histogram: LabelHistogram of (sem_lbl, inst_lbl) (numpy arrays), shared by all the statistics
+        """
+        raise NotImplementedError
+
+    def stack_image_statistics(self, rows):
+        return torch.from_numpy(np.stack(rows))
+
     def print_stat_tensor_for_txt_storage(self, stat_tensor):
         print(stat_tensor)
 
@@ -96,6 +123,10 @@ class DatasetStatisticCacheInterface(object):
             print(tabulate(nested_list))
 
 
+def get_store_column(statistic_name, semantic_class_vals):
+    return '{}_{}'.format(statistic_name, '-'.join('{}'.format(v) for v in semantic_class_vals))
+
+
 class PixelsPerSemanticClass(DatasetStatisticCacheInterface):
 
     def __init__(self, semantic_class_vals, semantic_class_names=None, cache_file=None,
@@ -109,6 +140,10 @@ class PixelsPerSemanticClass(DatasetStatisticCacheInterface):
     def labels(self):
         return self.semantic_class_names
 
+    @property
+    def store_column(self):
+        return get_store_column(self.__class__.__name__, self.semantic_class_vals)
+
     def _compute(self, dataset):
         # semantic_classes = semantic_classes or range(dataset.n_semantic_classes)
         semantic_pixel_counts = self.compute_semantic_pixel_counts(dataset,
@@ -133,6 +168,9 @@ class PixelsPerSemanticClass(DatasetStatisticCacheInterface):
         semantic_pixel_counts = torch.IntTensor(semantic_pixel_counts_nested_list)
         return semantic_pixel_counts
 
+    def compute_image_statistic(self, sem_lbl, inst_lbl, label_histogram):
+        return label_histogram.get_semantic_pixel_counts(self.semantic_class_vals).astype(np.int32)
+
 
 class NumberofInstancesPerSemanticClass(DatasetStatisticCacheInterface):
     """
@@ -148,6 +186,10 @@ class NumberofInstancesPerSemanticClass(DatasetStatisticCacheInterface):
     def labels(self):
         return self.semantic_classes
 
+    @property
+    def store_column(self):
+        return get_store_column(self.__class__.__name__, self.semantic_classes)
+
     def _compute(self, dataset):
         # semantic_classes = semantic_classes or range(dataset.n_semantic_classes)
         instance_counts = self.compute_instance_counts(dataset, self.semantic_classes)
@@ -177,24 +219,117 @@ class NumberofInstancesPerSemanticClass(DatasetStatisticCacheInterface):
                     raise Exception('inst_lbl should be 0 wherever sem_lbl is 0')
         return instance_counts
 
+    def compute_image_statistic(self, sem_lbl, inst_lbl, label_histogram):
+        instance_counts = label_histogram.get_max_instance_values(self.semantic_classes).astype(np.float32)
+        if len(instance_counts) > 0 and instance_counts[0] > 0:
+            raise Exception('inst_lbl should be 0 wherever sem_lbl is 0')
+        return instance_counts
+
+
+class ImageSizes(DatasetStatisticCacheInterface):
+    """
+    Computes Nx2 nparray: the (height, width) of each of N images' labels, after the dataset's transformations
+    """
+
+    @property
+    def labels(self):
+        return ['height', 'width']
+
+    def _compute(self, dataset):
+        return FusedDatasetStatistics.compute(dataset, [self])[0]
+
+    def compute_image_statistic(self, sem_lbl, inst_lbl, label_histogram):
+        return np.array(sem_lbl.shape[-2:], dtype=np.int32)
+
+
+# (dy, dx) offsets from each pixel to the half of its 5x5 neighbourhood that comes after it: two instance masks overlap
+# once both are dilated with a 3x3 kernel iff they come within 2 pixels (chessboard distance) of each other.
+OCCLUSION_NEIGHBOUR_OFFSETS = [(dy, dx) for dy in range(3) for dx in range(-2, 3) if dy > 0 or dx > 0]
+
+
+def pack_instance_keys(sem_lbl, inst_lbl):
+    """
+    One key per (semantic value, instance value) pair, with instance values 1, 2, ... (< 1 is not an instance: -1).
+    Returns keys, sem_min, inst_range: key = (sem_val - sem_min) * inst_range + inst_val - 1
+    """
+    sem_lbl, inst_lbl = np.asarray(sem_lbl), np.asarray(inst_lbl)
+    is_instance = inst_lbl >= 1
+    if not np.any(is_instance):
+        return np.full(sem_lbl.shape, -1, dtype=np.int64), 0, 1
+    sem_min, inst_range = int(sem_lbl[is_instance].min()), int(inst_lbl.max())
+    n_keys = (int(sem_lbl[is_instance].max()) - sem_min + 1) * inst_range
+    keys = (sem_lbl.astype(np.int32 if n_keys < np.iinfo(np.int32).max else np.int64) - sem_min) * inst_range + \
+        inst_lbl - 1
+    keys[~is_instance] = -1
+    return keys, sem_min, inst_range
+
+
+def get_occlusion_pairings(sem_lbl, inst_lbl):
+    """
+    The pairs of instances of the same semantic class that occlude each other by OcclusionsOfSameClass' definition
+    (their dilated masks intersect), from one label-adjacency pass: the label image is compared with each of its
+    shifts in OCCLUSION_NEIGHBOUR_OFFSETS, and the neighbouring (instance, instance) keys are deduplicated with one
+    np.unique, rather than dilating and intersecting the masks of every pair of instances.
+    sem_lbl, inst_lbl: (H, W) numpy arrays
+    Returns the semantic value, lower instance value and higher instance value of each pair.
+    """
+    keys, sem_min, inst_range = pack_instance_keys(sem_lbl, inst_lbl)
+    n_keys = max(int(keys.max()) + 1, 1)
+    h, w = keys.shape
+    pair_keys = [np.zeros(0, dtype=np.int64)]
+    for dy, dx in OCCLUSION_NEIGHBOUR_OFFSETS:
+        key1, key2 = keys[:(h - dy), max(0, -dx):(w - max(0, dx))], keys[dy:, max(0, dx):(w - max(0, -dx))]
+        # Neighbours are mostly the same key: only the (few) boundary pixels go on to the semantic check
+        is_boundary = key1 != key2
+        key1, key2 = key1[is_boundary], key2[is_boundary]
+        is_pair = (key1 // inst_range == key2 // inst_range) & (key1 >= 0)
+        key1, key2 = key1[is_pair], key2[is_pair]
+        pair_keys.append(np.minimum(key1, key2).astype(np.int64) * n_keys + np.maximum(key1, key2))
+    pair_keys = np.unique(np.concatenate(pair_keys))
+    key1, key2 = pair_keys // n_keys, pair_keys % n_keys
+    return key1 // inst_range + sem_min, key1 % inst_range + 1, key2 % inst_range + 1
+
+
+def count_occlusions_per_semantic_class(sem_lbl, inst_lbl, semantic_class_vals):
+    """
+    Number of occluding pairs of instances (see get_occlusion_pairings) of each semantic class
+    """
+    pair_sem_vals, _, _ = get_occlusion_pairings(sem_lbl, inst_lbl)
+    return np.array([(pair_sem_vals == sem_val).sum() for sem_val in semantic_class_vals], dtype=int)
+
+
+def get_occlusion_locations(sem_lbl, inst_lbl, semantic_class_vals):
+    """
+    (h, w, S): at each pixel, the number of pairs of instances of each semantic class whose dilated masks both cover it
+    (the sum of the pairwise intersections of the dilated instance masks), i.e. - n * (n - 1) / 2 for the n instances
+    of the class in its 3x3 neighbourhood.
+    """
+    keys, sem_min, inst_range = pack_instance_keys(sem_lbl, inst_lbl)
+    h, w = keys.shape
+    n_classes = len(semantic_class_vals)
+    class_idxs = np.full(int(keys.max()) // inst_range + 1, -1, dtype=np.int64)
+    for class_idx, sem_val in enumerate(semantic_class_vals):
+        if 0 <= sem_val - sem_min < len(class_idxs):
+            class_idxs[sem_val - sem_min] = class_idx
+    padded_keys = np.pad(keys, 1, mode='constant', constant_values=-1)
+    neighbourhood_keys = np.sort(np.stack([padded_keys[dy:(dy + h), dx:(dx + w)]
+                                           for dy in range(3) for dx in range(3)], axis=2), axis=2)
+    is_first = neighbourhood_keys >= 0
+    is_first[:, :, 1:] &= neighbourhood_keys[:, :, 1:] != neighbourhood_keys[:, :, :-1]
+    ys, xs, ks = np.nonzero(is_first)
+    neighbour_class_idxs = class_idxs[neighbourhood_keys[ys, xs, ks] // inst_range]
+    in_classes = neighbour_class_idxs >= 0
+    n_instances = np.bincount(((ys * w + xs) * n_classes + neighbour_class_idxs)[in_classes],
+                              minlength=h * w * n_classes).reshape(h, w, n_classes)
+    return n_instances * (n_instances - 1) // 2
+
 
 def get_occlusions_hws_from_labels(sem_lbl_np, inst_lbl_np, semantic_class_vals):
     """
-    Returns (h,w,S) tensor where S is the number of semantic classes
+    Returns the (S,) occlusion counts and the (h,w,S) occlusion locations, where S is the number of semantic classes
     """
-    # Make into batch form to use more general functions
-    sem_lbl_np = sem_lbl_np[:, :, None]
-    inst_lbl_np = inst_lbl_np[:, :, None]
-    list_of_occlusion_locations_per_cls = []
-    n_occlusion_pairings_per_sem_cls = np.zeros(len(semantic_class_vals))
-    for sem_idx, sem_val in enumerate(semantic_class_vals):
-        n_occlusion_pairings, all_occlusion_locations = \
-            OcclusionsOfSameClass.compute_occlusions_from_batch_of_one_semantic_cls(
-                sem_lbl_np, inst_lbl_np, sem_val)
-        assert all_occlusion_locations.shape[2] == 1
-        list_of_occlusion_locations_per_cls.append(all_occlusion_locations[:, :, 0])
-        n_occlusion_pairings_per_sem_cls[sem_idx] = n_occlusion_pairings
-    return n_occlusion_pairings_per_sem_cls, np.stack(list_of_occlusion_locations_per_cls, axis=2)
+    return count_occlusions_per_semantic_class(sem_lbl_np, inst_lbl_np, semantic_class_vals), \
+        get_occlusion_locations(sem_lbl_np, inst_lbl_np, semantic_class_vals)
 
 
 class OcclusionsOfSameClass(DatasetStatisticCacheInterface):
@@ -214,6 +349,10 @@ class OcclusionsOfSameClass(DatasetStatisticCacheInterface):
     def labels(self):
         return [s.replace(' ', '_') for s in self.semantic_class_names]
 
+    @property
+    def store_column(self):
+        return get_store_column(self.__class__.__name__, self.semantic_class_vals)
+
     def _compute(self, dataset):
         # semantic_classes = semantic_classes or range(dataset.n_semantic_classes)
         occlusion_counts = self.compute_occlusion_counts(dataset, self.semantic_class_vals,
@@ -244,7 +383,7 @@ class OcclusionsOfSameClass(DatasetStatisticCacheInterface):
             len(dataset), len(semantic_class_vals)), dtype=torch.int)
         batch_size = compute_batch_size or self.default_compute_batch_sz
         dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False,
-                                                 sampler=None, num_workers=4)
+                                                 sampler=None, num_workers=DEFAULT_NUM_WORKERS)
         batch_img_idx = 0
         for batch_idx, data_dict in tqdm.tqdm(
                 enumerate(dataloader), total=len(dataloader),
@@ -260,6 +399,11 @@ class OcclusionsOfSameClass(DatasetStatisticCacheInterface):
             batch_img_idx += batch_sz
         return occlusion_counts
 
+    def compute_image_statistic(self, sem_lbl, inst_lbl, label_histogram):
+        # As compute_occlusions_from_batch: uint8 labels
+        return count_occlusions_per_semantic_class(sem_lbl.astype(np.uint8), inst_lbl.astype(np.uint8),
+                                                   self.semantic_class_vals).astype(np.int32)
+
     @staticmethod
     def torch_label_batch_to_np_batch_for_dilation(tensor):
         return tensor.numpy().astype(np.uint8).transpose(1, 2, 0)
@@ -267,31 +411,36 @@ class OcclusionsOfSameClass(DatasetStatisticCacheInterface):
     def compute_occlusions_from_batch(self, sem_lbl_batch, inst_lbl_batch, semantic_classes,
                                       start_img_idx=None, debug=False):
         batch_sz = sem_lbl_batch.size(0)
-        batch_occlusion_counts = np.zeros((batch_sz, len(semantic_classes)), dtype=int)
         # h x w x b (for dilation)
         inst_lbl_np = self.torch_label_batch_to_np_batch_for_dilation(inst_lbl_batch)
         sem_lbl_np = self.torch_label_batch_to_np_batch_for_dilation(sem_lbl_batch)
-
-        for sem_idx in semantic_classes:
-            n_occlusion_pairings, occlusion_locs = \
-                self.compute_occlusions_from_batch_of_one_semantic_cls(sem_lbl_np,
-                                                                       inst_lbl_np, sem_idx)
-            batch_occlusion_counts[:, sem_idx] = n_occlusion_pairings
-            if debug:
-                occlusion_and_sem_cls = self.dilate(occlusion_locs.astype('uint8'),
+        batch_occlusion_counts = np.stack([
+            count_occlusions_per_semantic_class(sem_lbl_np[:, :, i], inst_lbl_np[:, :, i], semantic_classes)
+            for i in range(batch_sz)])
+
+        if debug:
+            # h x w x S x b
+            occlusion_locs = np.stack([get_occlusion_locations(sem_lbl_np[:, :, i], inst_lbl_np[:, :, i],
+                                                               semantic_classes) for i in range(batch_sz)], axis=3)
+            for sem_idx, sem_val in enumerate(semantic_classes):
+                # dilate occlusion locations for visibility
+                occlusion_and_sem_cls = self.dilate(occlusion_locs[:, :, sem_idx, :].astype('uint8'),
                                                     iterations=4) + \
-                                        (sem_lbl_np == sem_idx).astype('uint8')
+                                        (sem_lbl_np == sem_val).astype('uint8')
                 self.export_debug_images_from_batch(
                     occlusion_and_sem_cls, ['occlusion_locations_{}_{}_n_occlusions_{}'.format(
                         start_img_idx + i, self.semantic_class_names[sem_idx],
-                        n_occlusion_pairings[i])
+                        batch_occlusion_counts[i, sem_idx])
                         for i in range(batch_sz)])
 
-        # dilate occlusion locations for visibility
         return batch_occlusion_counts
 
     @classmethod
     def compute_occlusions_from_batch_of_one_semantic_cls(cls, sem_lbl_np, inst_lbl_np, sem_idx):
+        """
+        Reference implementation of get_occlusion_pairings / get_occlusion_locations: dilates each instance mask and
+        intersects every pair of them.
+        """
         batch_sz = sem_lbl_np.shape[2]
         all_occlusion_locations = np.zeros_like(sem_lbl_np).astype(int)
         n_occlusion_pairings = np.zeros(batch_sz, dtype=int)
@@ -365,11 +514,155 @@ class OcclusionsOfSameClass(DatasetStatisticCacheInterface):
     def intersect_two_binary_masks(mask1: np.ndarray, mask2: np.ndarray):
         # would check that only int values are in (0,1), but too much computation.
         for mask in [mask1, mask2]:
-            assert mask.dtype in [np.bool, np.int, np.uint8], \
+            assert mask.dtype in [np.bool_, np.int_, np.uint8], \
                 'I didnt expect a boolean mask with dtype {}'.format(mask1.dtype)
         return mask1 * mask2
 
 
+class LabelHistogram(object):
+    """
+    Pixel counts of the (semantic value, instance value) pairs present in one image, from one bincount of packed keys
+    (np.unique when the key range is too wide, as in cap_instance_sizes).  Pixel counts, instance counts, etc. per
+    semantic class are all read off it.
+    """
+
+    def __init__(self, sem_lbl, inst_lbl):
+        sem_lbl, inst_lbl = np.asarray(sem_lbl).ravel(), np.asarray(inst_lbl).ravel()
+        if sem_lbl.size == 0:
+            self.sem_vals, self.inst_vals, self.counts = (np.zeros(0, dtype=np.int64),) * 3
+            return
+        sem_min, inst_min = int(sem_lbl.min()), int(inst_lbl.min())
+        inst_range = int(inst_lbl.max()) - inst_min + 1
+        keys = (sem_lbl.astype(np.int64) - sem_min) * inst_range + (inst_lbl.astype(np.int64) - inst_min)
+        n_bins = (int(sem_lbl.max()) - sem_min + 1) * inst_range
+        if n_bins <= MAX_KEY_BINS_PER_PIXEL * keys.size:
+            counts = np.bincount(keys, minlength=n_bins)
+            pair_keys = np.flatnonzero(counts)
+            counts = counts[pair_keys]
+        else:
+            pair_keys, counts = np.unique(keys, return_counts=True)
+        self.sem_vals = pair_keys // inst_range + sem_min
+        self.inst_vals = pair_keys % inst_range + inst_min
+        self.counts = counts
+
+    def get_semantic_pixel_counts(self, semantic_class_vals):
+        return np.array([self.counts[self.sem_vals == sem_val].sum() for sem_val in semantic_class_vals],
+                        dtype=np.int64)
+
+    def get_instance_values(self, semantic_class_vals):
+        """
+        The instance values present in each semantic class (sorted)
+        """
+        return [self.inst_vals[self.sem_vals == sem_val] for sem_val in semantic_class_vals]
+
+    def get_max_instance_values(self, semantic_class_vals):
+        """
+        The largest instance value of each semantic class (0 for classes not in the image)
+        """
+        return np.array([inst_vals[-1] if len(inst_vals) else 0
+                         for inst_vals in self.get_instance_values(semantic_class_vals)], dtype=np.int64)
+
+
+class ImageStatisticsDataset(torch.utils.data.Dataset):
+    """
+    Each item: the rows of the statistics for one image of dataset (computed in the DataLoader workers)
+    """
+
+    def __init__(self, dataset, statistics):
+        self.dataset = dataset
+        self.statistics = statistics
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        data_dict = self.dataset[index]
+        sem_lbl, inst_lbl = [lbl.numpy() if torch.is_tensor(lbl) else np.asarray(lbl)
+                             for lbl in (data_dict['sem_lbl'], data_dict['inst_lbl'])]
+        label_histogram = LabelHistogram(sem_lbl, inst_lbl)
+        return [statistic.compute_image_statistic(sem_lbl, inst_lbl, label_histogram)
+                for statistic in self.statistics]
+
+
+class FusedDatasetStatistics(object):
+    """
+    Computes several DatasetStatisticCacheInterface statistics in one (multi-worker) pass over a dataset: each image
+    is loaded and transformed once, and every statistic reads its row off the same LabelHistogram.  Statistics
+    with a cache file are loaded from it instead; the others are stored (atomically) once the pass is done.
+        statistics = FusedDatasetStatistics()
+        instance_counts = statistics.register(NumberofInstancesPerSemanticClass(..., cache_file=...))
+        statistics.compute_or_retrieve(dataset)
+        instance_counts.stat_tensor
+    With an ImageStatisticsStore (and a dataset loaded from files), the store is the cache instead: the pass only
+    covers the images whose rows are missing or stale, and the whole-split arrays (and their cache files) are
+    assembled from its rows.
+    """
+
+    def __init__(self, num_workers=None, image_statistics_store=None):
+        self.num_workers = num_workers if num_workers is not None else DEFAULT_NUM_WORKERS
+        self.image_statistics_store = image_statistics_store
+        self.statistics = []
+
+    def register(self, statistic):
+        self.statistics.append(statistic)
+        return statistic
+
+    def compute_or_retrieve(self, dataset):
+        if self.image_statistics_store is not None and len(self.statistics) > 0:
+            row_files = image_statistics_store.get_dataset_label_files(dataset)
+            if row_files is not None:
+                self.compute_or_retrieve_rows(dataset, row_files)
+                return
+        to_compute = []
+        for statistic in self.statistics:
+            if statistic.is_cached:
+                statistic.compute_or_retrieve(dataset)
+            else:
+                to_compute.append(statistic)
+        if len(to_compute) == 0:
+            return
+        logger.info('Computing {} in one pass'.format(', '.join(s.__class__.__name__ for s in to_compute)))
+        for statistic, stat_tensor in zip(to_compute, self.compute(dataset, to_compute, self.num_workers)):
+            statistic.store(stat_tensor)
+
+    def compute_or_retrieve_rows(self, dataset, row_files):
+        store = self.image_statistics_store
+        row_idxs = store.get_row_idxs(row_files)
+        is_missing = np.zeros(len(row_idxs), dtype=bool)
+        for statistic in self.statistics:
+            is_missing |= True if statistic.override else ~store.is_computed(row_idxs, statistic.store_column)
+        missing_idxs = np.flatnonzero(is_missing).tolist()
+        if len(missing_idxs) > 0:
+            logger.info('Computing {} for {} of {} images in one pass'.format(
+                ', '.join(s.__class__.__name__ for s in self.statistics), len(missing_idxs), len(row_idxs)))
+            missing_rows = self.compute_rows(torch.utils.data.Subset(dataset, missing_idxs), self.statistics,
+                                             self.num_workers)
+            for statistic, statistic_rows in zip(self.statistics, missing_rows):
+                store.set_values([row_idxs[i] for i in missing_idxs], statistic.store_column, statistic_rows)
+        if store.changed:
+            store.save()
+        for statistic in self.statistics:
+            statistic.store(statistic.stack_image_statistics(store.get_values(row_idxs, statistic.store_column)))
+
+    @classmethod
+    def compute(cls, dataset, statistics, num_workers=DEFAULT_NUM_WORKERS):
+        return [statistic.stack_image_statistics(statistic_rows)
+                for statistic, statistic_rows in zip(statistics, cls.compute_rows(dataset, statistics, num_workers))]
+
+    @staticmethod
+    def compute_rows(dataset, statistics, num_workers=DEFAULT_NUM_WORKERS):
+        """
+        Each statistic's rows, one per image of dataset
+        """
+        rows = [[] for _ in statistics]
+        dataloader = torch.utils.data.DataLoader(ImageStatisticsDataset(dataset, statistics), batch_size=None,
+                                                 shuffle=False, num_workers=num_workers)
+        for image_rows in tqdm.tqdm(dataloader, total=len(dataset), desc='Running dataset statistics', leave=True):
+            for statistic_rows, row in zip(rows, image_rows):
+                statistic_rows.append(np.asarray(row))
+        return rows
+
+
 def get_instance_sizes(sem_lbl, inst_lbl, sem_val, void_vals=(255,-1)):
     bool_sem_cls = sem_lbl == sem_val
     if bool_sem_cls.sum() == 0:
@@ -383,3 +676,68 @@ def get_instance_sizes(sem_lbl, inst_lbl, sem_val, void_vals=(255,-1)):
             raise Exception('Debug error..')
         gt_inst_sizes.append(inst_size)
     return gt_inst_vals, gt_inst_sizes
+
+
+# Dense (bincount) keys are used while the key range is at most this many times the number of pixels; beyond that
+# (e.g. - raw instance ids), torch.unique is cheaper than allocating the bins.
+MAX_KEY_BINS_PER_PIXEL = 4
+
+
+def cap_instance_sizes(sem_lbl, inst_lbl, n_instances_by_sem_val, void_value, void_vals=(255, -1)):
+    """
+    Vectorized instance size capping: keeps the n_instances_by_sem_val[sem_val] largest instances of each semantic
+    class in each image (ties go to the higher instance value, like sorting get_instance_sizes) and relabels the rest
+    to void_value.  The areas of all (image, semantic value, instance value) keys come from one bincount, and the
+    labels are relabeled with one lookup into a drop table.
+    sem_lbl, inst_lbl: (N, H, W) or (H, W) tensors
+    n_instances_by_sem_val: {sem_val: cap}; classes that are missing are not capped.  An int caps every class.
+    Returns the capped instance labels (inst_lbl itself if nothing was removed) and the image index, semantic value
+    and instance value tensors of the removed instances.
+    """
+    batch_sem_lbl, batch_inst_lbl = (sem_lbl, inst_lbl) if sem_lbl.dim() == 3 else (sem_lbl[None], inst_lbl[None])
+    n_images, device = batch_sem_lbl.size(0), batch_sem_lbl.device
+    sem_min, sem_max, inst_min, inst_max = torch.stack([
+        batch_sem_lbl.min().long(), batch_sem_lbl.max().long(), batch_inst_lbl.min().long(), batch_inst_lbl.max().long()
+    ]).tolist()
+    sem_range, inst_range = sem_max - sem_min + 1, inst_max - inst_min + 1
+    keys = ((torch.arange(n_images, device=device)[:, None, None] * sem_range + (batch_sem_lbl.long() - sem_min))
+            * inst_range + (batch_inst_lbl.long() - inst_min)).reshape(-1)
+    n_bins = n_images * sem_range * inst_range
+    if n_bins <= MAX_KEY_BINS_PER_PIXEL * keys.numel():
+        areas = torch.bincount(keys, minlength=n_bins)
+        segment_keys, pixel_table_idx = torch.arange(n_bins, device=device), keys
+    else:
+        segment_keys, pixel_table_idx, areas = torch.unique(keys, return_inverse=True, return_counts=True)
+    image_idxs = segment_keys // (sem_range * inst_range)
+    sem_vals = (segment_keys // inst_range) % sem_range + sem_min
+    inst_vals = segment_keys % inst_range + inst_min
+
+    # Cap of each segment's semantic class (-1: not capped)
+    caps = torch.full((sem_range,), -1, dtype=torch.long, device=device)
+    for sem_val in range(sem_min, sem_max + 1):
+        cap = n_instances_by_sem_val if isinstance(n_instances_by_sem_val, int) else \
+            n_instances_by_sem_val.get(sem_val, -1)
+        caps[sem_val - sem_min] = cap
+    segment_caps = caps[sem_vals - sem_min]
+    is_void = torch.zeros_like(inst_vals, dtype=torch.bool)
+    for void_val in void_vals:
+        is_void |= inst_vals == void_val
+    candidates = torch.nonzero((areas > 0) & (segment_caps >= 0) & ~is_void)[:, 0]
+
+    # Rank the instances of each (image, semantic class) by (area, instance value), both descending
+    group = image_idxs[candidates] * sem_range + sem_vals[candidates] - sem_min
+    order = torch.arange(len(candidates), device=device)
+    for sort_key, descending in ((inst_vals[candidates], True), (areas[candidates], True), (group, False)):
+        order = order[torch.sort(sort_key[order], descending=descending, stable=True)[1]]
+    sorted_group = group[order]
+    rank = torch.arange(len(order), device=device) - torch.searchsorted(sorted_group, sorted_group)
+    removed = candidates[order[rank >= segment_caps[candidates][order]]]
+
+    drop_table = torch.zeros(len(segment_keys), dtype=torch.bool, device=device)
+    drop_table[removed] = True
+    if len(removed) > 0:
+        capped_inst_lbl = torch.where(drop_table[pixel_table_idx].reshape(inst_lbl.shape),
+                                      torch.full_like(inst_lbl, void_value), inst_lbl)
+    else:
+        capped_inst_lbl = inst_lbl
+    return capped_inst_lbl, (image_idxs[removed], sem_vals[removed], inst_vals[removed])
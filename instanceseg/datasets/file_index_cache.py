@@ -0,0 +1,85 @@
+"""
+Persistent file index for dataset startup.  Building a split's file list globs its directories, checks every file
+exists and runs the precomputed file transformer's transform (more isfile checks, per image) -- minutes on a network
+filesystem with thousands of images, paid again by every process that constructs the dataset.
+
+The index (files and identifiers) is cached per (root, split, transformer tag), together with the mtimes of the
+directories it was built from, under <root>/file_index_cache or a cache directory outside the root (dataset roots are
+often shared or read-only).  A directory's mtime changes whenever an entry is added, removed or renamed in it, so
+if none of them changed the index is still valid; checking that is a handful of stats.
+"""
+import hashlib
+import json
+import os
+import os.path as osp
+
+from instanceseg.utils import misc
+from instanceseg.utils.datasets import get_transformation_tag
+
+CACHE_DIR = 'file_index_cache'
+CACHE_VERSION = 1
+
+
+def get_cache_file(root, split, file_transformer, cache_dir=None):
+    """
+    cache_dir: where to keep the index (default: <root>/file_index_cache); keyed by the real root, so one directory can
+    hold the indices of several datasets
+    """
+    tag = get_transformation_tag([file_transformer]) if file_transformer is not None else ''
+    key = hashlib.md5('\n'.join([osp.realpath(root), split, tag]).encode()).hexdigest()[:12]
+    return osp.join(cache_dir if cache_dir is not None else osp.join(root, CACHE_DIR), '{}_{}.json'.format(split, key))
+
+
+def get_watched_dirs(split_dirs):
+    """
+    The split directories and their immediate subdirectories (e.g. - leftImg8bit/train/aachen)
+    """
+    watched_dirs = []
+    for split_dir in split_dirs:
+        if not osp.isdir(split_dir):  # left for the index builder to complain about
+            continue
+        watched_dirs.append(split_dir)
+        watched_dirs += sorted(entry.path for entry in os.scandir(split_dir) if entry.is_dir())
+    return watched_dirs
+
+
+def get_dir_mtimes(dirs):
+    return {d: os.stat(d).st_mtime_ns for d in dirs}
+
+
+def load_file_index(cache_file):
+    """
+    (files, id_list) if the cache file exists and none of its directories changed since, else None
+    """
+    if not osp.isfile(cache_file):
+        return None
+    with open(cache_file, 'r') as f:
+        cache = json.load(f)
+    if cache.get('version') != CACHE_VERSION:
+        return None
+    try:
+        if get_dir_mtimes(cache['dir_mtimes'].keys()) != cache['dir_mtimes']:
+            return None
+    except OSError:  # a directory was removed
+        return None
+    return cache['files'], cache['id_list']
+
+
+def save_file_index(cache_file, watched_dirs, dir_mtimes, files, id_list):
+    """
+    :param dir_mtimes: mtimes of watched_dirs from *before* the index was built, so changes made while building it
+    invalidate the cache
+    """
+    cache = {
+        'version': CACHE_VERSION,
+        'dir_mtimes': {d: dir_mtimes[d] for d in watched_dirs},
+        'files': files,
+        'id_list': id_list,
+    }
+    try:
+        os.makedirs(osp.dirname(cache_file), exist_ok=True)
+        with misc.atomic_output_file(cache_file) as tmp_file:
+            with open(tmp_file, 'w') as f:
+                json.dump(cache, f)
+    except OSError as e:  # e.g. - a read-only dataset directory: just don't cache
+        misc.warn('Could not write file index cache {}: {}'.format(cache_file, e))
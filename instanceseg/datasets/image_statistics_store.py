@@ -0,0 +1,162 @@
+"""
+Per-image statistics store.  DatasetStatisticCacheInterface caches a statistic as one whole-split array, so adding
+images, taking a different subset of a split or changing the transformations meant recomputing it for every image.
+The store keeps one row per image instead, keyed by the image's label files, so only the rows that are missing or stale
+are computed and the whole-split arrays are assembled from the rows on demand.
+
+<store_file>.npz (one per transformer identifier tag; all splits share it):
+    files: (R, F) the label files each row was computed from
+    sizes, mtimes_ns: (R, F) their signatures; sha1s: (R,) the sha1 of their contents
+    values__<column>: (R, ...) one column per statistic (see DatasetStatisticCacheInterface.store_column)
+    computed__<column>: (R,) bool -- whether the row has been computed for that column
+
+A row is stale when the content of one of its files changed: files whose size or mtime changed are re-hashed, and only
+a different hash counts.  Stale rows lose all their columns.
+"""
+import hashlib
+import os
+import os.path as osp
+
+import numpy as np
+
+from instanceseg.datasets.compiled_label_store import file_sha1
+from instanceseg.utils import misc
+
+STORE_VERSION = 1
+VALUES_PREFIX = 'values__'
+COMPUTED_PREFIX = 'computed__'
+
+
+def get_store_file(cache_path, transformer_tag):
+    key = hashlib.md5(transformer_tag.encode()).hexdigest()[:12]
+    return osp.join(cache_path, 'image_statistics_{}.npz'.format(key))
+
+
+def get_dataset_label_files(dataset):
+    """
+    [(sem_lbl_file, inst_lbl_file)] of each item of dataset (what its labels are loaded from), or None if its items
+    don't come from files (e.g. - synthetic datasets)
+    """
+    if getattr(dataset, 'raw_dataset_returns_images', True):
+        return None
+    precomputed_file_transformation = dataset.precomputed_file_transformation \
+        if dataset.should_use_precompute_transform else None
+    return [tuple(dataset.get_transformed_files(dataset.get_image_id(index), precomputed_file_transformation)[1:])
+            for index in range(len(dataset))]
+
+
+def get_files_sha1(files):
+    h = hashlib.sha1()
+    for f in files:
+        h.update(file_sha1(f).encode())
+    return h.hexdigest()
+
+
+class ImageStatisticsStore(object):
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self.files, self.sizes, self.mtimes_ns, self.sha1s = [], [], [], []
+        self.values = {}  # column: (R, ...) array
+        self.computed = {}  # column: (R,) bool array
+        self.row_idx_by_files = {}
+        self.changed = False
+        if osp.isfile(store_file):
+            self.load()
+
+    def __len__(self):
+        return len(self.files)
+
+    def load(self):
+        with np.load(self.store_file) as data:
+            if int(data['version']) != STORE_VERSION:
+                return
+            self.files = [tuple(f) for f in data['files'].tolist()]
+            self.sizes, self.mtimes_ns = data['sizes'].tolist(), data['mtimes_ns'].tolist()
+            self.sha1s = data['sha1s'].tolist()
+            for key in data.files:
+                if key.startswith(VALUES_PREFIX):
+                    column = key[len(VALUES_PREFIX):]
+                    self.values[column] = data[key]
+                    self.computed[column] = data[COMPUTED_PREFIX + column]
+        self.row_idx_by_files = {files: row_idx for row_idx, files in enumerate(self.files)}
+
+    def save(self):
+        shape = (len(self.files), len(self.files[0]) if self.files else 0)
+        arrays = {
+            'version': np.array(STORE_VERSION),
+            'files': np.array(self.files, dtype=str).reshape(shape),
+            'sizes': np.array(self.sizes, dtype=np.int64).reshape(shape),
+            'mtimes_ns': np.array(self.mtimes_ns, dtype=np.int64).reshape(shape),
+            'sha1s': np.array(self.sha1s, dtype=str),
+        }
+        for column in self.values:
+            arrays[VALUES_PREFIX + column] = self.values[column]
+            arrays[COMPUTED_PREFIX + column] = self.computed[column]
+        os.makedirs(osp.dirname(osp.abspath(self.store_file)), exist_ok=True)
+        with misc.atomic_output_file(self.store_file) as tmp_file:
+            np.savez(tmp_file, **arrays)
+        self.changed = False
+
+    def get_row_idxs(self, row_files):
+        """
+        The row of each image (its label files), adding rows for new images and clearing the rows of images whose
+        files changed
+        """
+        row_idxs = []
+        for files in row_files:
+            files = tuple(files)
+            signatures = [os.stat(f) for f in files]
+            sizes, mtimes_ns = [st.st_size for st in signatures], [st.st_mtime_ns for st in signatures]
+            row_idx = self.row_idx_by_files.get(files)
+            if row_idx is None:
+                row_idx = self.add_row(files, sizes, mtimes_ns, get_files_sha1(files))
+            elif sizes != self.sizes[row_idx] or mtimes_ns != self.mtimes_ns[row_idx]:
+                sha1 = get_files_sha1(files) if sizes == self.sizes[row_idx] else None
+                if sha1 != self.sha1s[row_idx]:
+                    sha1 = sha1 or get_files_sha1(files)
+                    for computed in self.computed.values():
+                        computed[row_idx] = False
+                self.sizes[row_idx], self.mtimes_ns[row_idx], self.sha1s[row_idx] = sizes, mtimes_ns, sha1
+                self.changed = True
+            row_idxs.append(row_idx)
+        return row_idxs
+
+    def add_row(self, files, sizes, mtimes_ns, sha1):
+        row_idx = len(self.files)
+        self.files.append(files)
+        self.sizes.append(sizes)
+        self.mtimes_ns.append(mtimes_ns)
+        self.sha1s.append(sha1)
+        self.row_idx_by_files[files] = row_idx
+        for column in self.values:
+            self.grow_column(column)
+        self.changed = True
+        return row_idx
+
+    def grow_column(self, column):
+        values, computed = self.values[column], self.computed[column]
+        n_new_rows = len(self.files) - len(computed)
+        if n_new_rows > 0:
+            self.values[column] = np.concatenate([values, np.zeros((n_new_rows,) + values.shape[1:],
+                                                                   dtype=values.dtype)])
+            self.computed[column] = np.concatenate([computed, np.zeros(n_new_rows, dtype=bool)])
+
+    def is_computed(self, row_idxs, column):
+        if column not in self.computed:
+            return np.zeros(len(row_idxs), dtype=bool)
+        return self.computed[column][np.asarray(row_idxs, dtype=np.int64)]
+
+    def set_values(self, row_idxs, column, rows):
+        rows = np.stack(rows)
+        if column not in self.values or self.values[column].shape[1:] != rows.shape[1:]:
+            self.values[column] = np.zeros((len(self.files),) + rows.shape[1:], dtype=rows.dtype)
+            self.computed[column] = np.zeros(len(self.files), dtype=bool)
+        self.grow_column(column)
+        row_idxs = np.asarray(row_idxs, dtype=np.int64)
+        self.values[column][row_idxs] = rows
+        self.computed[column][row_idxs] = True
+        self.changed = True
+
+    def get_values(self, row_idxs, column):
+        assert self.is_computed(row_idxs, column).all(), 'Not all rows have been computed for {}'.format(column)
+        return list(self.values[column][np.asarray(row_idxs, dtype=np.int64)])
@@ -1,18 +1,178 @@
+import hashlib
+
 import numpy as np
 import torch
 import logging
 
 from instanceseg.datasets import sampler
-from instanceseg.utils.misc import pairwise_and, pairwise_or
 
 logger = logging.getLogger(__name__)
 
 
+class ImageStatisticsTable(object):
+    """
+    Columnar per-image dataset statistics: one (n_images, n_semantic_classes) numpy array per column (e.g. -
+    'instance_counts', 'semantic_pixel_counts', 'occlusion_counts').  Predicates (IndexPredicate) evaluate to a boolean
+    array over the images with a few vectorized operations on the columns; results are cached by predicate hash.
+    """
+
+    def __init__(self, n_images, **columns):
+        self.n_images = n_images
+        self.columns = {}
+        for name, column in columns.items():
+            if column is None:
+                continue
+            column = column.numpy() if torch.is_tensor(column) else np.asarray(column)
+            assert column.shape[0] == n_images, '{} has {} rows, not {}'.format(name, column.shape[0], n_images)
+            self.columns[name] = column
+        self._results_by_hash = {}
+
+    def __getitem__(self, name):
+        if name not in self.columns:
+            raise KeyError('{} must be precomputed to filter by it (have {})'.format(name, list(self.columns)))
+        return self.columns[name]
+
+    def query(self, predicate):
+        """
+        Boolean array: True for each image that satisfies predicate
+        """
+        if predicate.hash not in self._results_by_hash:
+            result = np.broadcast_to(np.asarray(predicate.evaluate(self), dtype=bool), (self.n_images,))
+            result.flags.writeable = False
+            self._results_by_hash[predicate.hash] = result
+        return self._results_by_hash[predicate.hash].copy()
+
+
+class IndexPredicate(object):
+    """
+    A condition on an image's statistics, combined with &, | and ~.  key describes it canonically (equal predicates
+    have equal keys), so results can be cached by its hash.
+    """
+
+    def evaluate(self, table: ImageStatisticsTable):
+        raise NotImplementedError
+
+    @property
+    def key(self):
+        raise NotImplementedError
+
+    @property
+    def hash(self):
+        return hashlib.md5(self.key.encode()).hexdigest()
+
+    def __and__(self, other):
+        return AllOf([self, other])
+
+    def __or__(self, other):
+        return AnyOf([self, other])
+
+    def __invert__(self):
+        return Not(self)
+
+    def __repr__(self):
+        return self.key
+
+
+class AllImages(IndexPredicate):
+    def evaluate(self, table):
+        return True
+
+    @property
+    def key(self):
+        return 'all'
+
+
+class InRange(IndexPredicate):
+    """
+    The image's values of column, summed over semantic_class_vals (None: all classes), are in valid_range: (min, max+1),
+    python "range" rules -- [n_min, n_max) -- where either end may be None (unbounded).
+    """
+
+    def __init__(self, column, semantic_class_vals, valid_range):
+        assert len(valid_range) == 2, ValueError('range must be a tuple of (min, max).  You can set None for '
+                                                 'either end of that range.')
+        self.column = column
+        self.semantic_class_vals = None if semantic_class_vals is None else [int(v) for v in semantic_class_vals]
+        self.valid_range = tuple(valid_range)
+
+    def evaluate(self, table):
+        column = table[self.column]
+        values = column.sum(axis=1) if self.semantic_class_vals is None else \
+            column[:, self.semantic_class_vals].sum(axis=1)
+        n_valid_min, n_valid_max = self.valid_range
+        is_valid = np.ones(len(values), dtype=bool)
+        if n_valid_min is not None:
+            is_valid &= values >= n_valid_min
+        if n_valid_max is not None:
+            is_valid &= values < n_valid_max
+        return is_valid
+
+    @property
+    def key(self):
+        return 'in_range({},{},{})'.format(self.column, self.semantic_class_vals, self.valid_range)
+
+
+def has_semantic_classes(semantic_class_vals):
+    """
+    The image has pixels of (any of) semantic_class_vals
+    """
+    return InRange('semantic_pixel_counts', semantic_class_vals, (1, None))
+
+
+class AllOf(IndexPredicate):
+    def __init__(self, predicates):
+        # Flattened, so (a & b) & c and a & (b & c) share a key
+        self.predicates = [p for predicate in predicates
+                           for p in (predicate.predicates if isinstance(predicate, AllOf) else [predicate])]
+
+    def evaluate(self, table):
+        is_valid = np.ones(table.n_images, dtype=bool)
+        for predicate in self.predicates:
+            is_valid &= table.query(predicate)
+        return is_valid
+
+    @property
+    def key(self):
+        return 'all_of({})'.format(','.join(p.key for p in self.predicates))
+
+
+class AnyOf(IndexPredicate):
+    def __init__(self, predicates):
+        self.predicates = [p for predicate in predicates
+                           for p in (predicate.predicates if isinstance(predicate, AnyOf) else [predicate])]
+
+    def evaluate(self, table):
+        is_valid = np.zeros(table.n_images, dtype=bool)
+        for predicate in self.predicates:
+            is_valid |= table.query(predicate)
+        return is_valid
+
+    @property
+    def key(self):
+        return 'any_of({})'.format(','.join(p.key for p in self.predicates))
+
+
+class Not(IndexPredicate):
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def evaluate(self, table):
+        return ~table.query(self.predicate)
+
+    @property
+    def key(self):
+        return 'not({})'.format(self.predicate.key)
+
+
 class ValidIndexFilter(object):
     """
     Filters image list (implied by size of stats array) based on dataset statistics.
     Caches valid_indices.
 
+    The statistics are held in an ImageStatisticsTable, and the sampler config is compiled to an IndexPredicate over
+    it (see predicate_from_stats_config), so filtering is a handful of vectorized operations however many images there
+    are.  valid_indices is a boolean numpy array.
+
     Note n_original_images is required, even though that information might be contained in
     instance_counts / semantic_class_pixel_counts.
     """
@@ -39,6 +199,9 @@ class ValidIndexFilter(object):
             assert occlusion_counts is not None, 'occlusion_counts must be precomputed to filter ' \
                                                  'by # instances'
 
+        self.table = ImageStatisticsTable(n_original_images, instance_counts=instance_counts,
+                                          semantic_pixel_counts=semantic_class_pixel_counts,
+                                          occlusion_counts=occlusion_counts)
         self._valid_indices = None
 
     def clear_cache(self):
@@ -55,6 +218,27 @@ class ValidIndexFilter(object):
                 sem_cls_filter, n_instance_ranges, n_occlusions_range, n_images)
         return self._valid_indices
 
+    def query(self, predicate: IndexPredicate):
+        return self.table.query(predicate)
+
+    @staticmethod
+    def predicate_from_stats_config(semantic_class_vals, n_instance_ranges, n_occlusions_range, union=False):
+        """
+        See valid_indices_from_stats_config
+        """
+        predicates = []
+        if n_instance_ranges is not None:
+            for sem_cls, n_instances_range in zip(semantic_class_vals, n_instance_ranges):
+                if n_instances_range is not None:
+                    predicates.append(InRange('instance_counts', [sem_cls], n_instances_range))
+                elif sem_cls is not None:
+                    predicates.append(has_semantic_classes([sem_cls]))
+        if n_occlusions_range is not None:
+            predicates.append(InRange('occlusion_counts', semantic_class_vals, n_occlusions_range))
+        if len(predicates) == 0:
+            return AllImages()
+        return AllOf(predicates) if not union else AnyOf(predicates)
+
     def valid_indices_from_stats_config(self, semantic_class_vals, n_instance_ranges,
                                         n_occlusions_range, n_images, union=False):
         """
@@ -68,55 +252,28 @@ class ValidIndexFilter(object):
 
                 If union = True, finds union of these images instead.
         """
-        pairwise_combine = pairwise_and if not union else pairwise_or
-
-        valid_indices = [True for _ in range(self.n_original_images)]
-
-        if n_instance_ranges is not None:
-            for sem_cls, n_instances_range in zip(semantic_class_vals, n_instance_ranges):
-                valid_indices_single_set = self.get_valid_indices_single_sem_cls_instances(
-                    single_sem_cls=sem_cls,
-                    n_instances_range=n_instances_range)
-                valid_indices = pairwise_combine(valid_indices, valid_indices_single_set)
-        if n_occlusions_range is not None:
-            valid_indices = pairwise_combine(
-                valid_indices, self.get_valid_indices_total_occlusions(
-                    sem_cls_vals=semantic_class_vals, valid_occlusion_range=n_occlusions_range))
+        valid_indices = self.query(self.predicate_from_stats_config(semantic_class_vals, n_instance_ranges,
+                                                                    n_occlusions_range, union=union))
         if n_images is not None:
             valid_indices = self.subsample_n_valid_images(valid_indices, n_images)
         return valid_indices
 
     def get_valid_indices_total_occlusions(self, sem_cls_vals, valid_occlusion_range):
-        counts = self.occlusion_counts
-        totals_per_img_for_select_classes = counts[:, sem_cls_vals].sum(dim=1)
-        valid_indices = self.get_valid_indices_from_scalar_stat(
-            totals_per_img_for_select_classes, valid_occlusion_range)
-        return valid_indices
+        return self.query(InRange('occlusion_counts', sem_cls_vals, valid_occlusion_range))
 
     def get_valid_indices_single_sem_cls_instances(self, single_sem_cls, n_instances_range):
-        valid_indices = [True for _ in range(self.n_original_images)]
-        counts = self.instance_counts
-        valid_range = n_instances_range
-        if valid_range is not None:
-            assert counts is not None
-            valid_indices = pairwise_and(valid_indices,
-                                         self.filter_images_by_range_from_counts2d(
-                                             counts, valid_range,
-                                             [single_sem_cls]))
+        if n_instances_range is not None:
+            return self.query(InRange('instance_counts', [single_sem_cls], n_instances_range))
         elif single_sem_cls is not None:
-            valid_indices = pairwise_and(valid_indices,
-                                         self.filter_images_by_semantic_classes(
-                                             self.semantic_class_pixel_counts,
-                                             [single_sem_cls]))
-        return valid_indices
+            return self.query(has_semantic_classes([single_sem_cls]))
+        return self.query(AllImages())
 
     @staticmethod
     def filter_images_by_semantic_classes(semantic_class_pixel_counts, semantic_classes):
-        valid_indices = []
-        for image_idx in range(semantic_class_pixel_counts.shape[0]):
-            is_valid = semantic_class_pixel_counts[:, semantic_classes].sum() > 0
-            valid_indices.append(bool(is_valid))
-        if sum(valid_indices) == 0:
+        valid_indices = ImageStatisticsTable(semantic_class_pixel_counts.shape[0],
+                                             semantic_pixel_counts=semantic_class_pixel_counts).query(
+            has_semantic_classes(semantic_classes))
+        if valid_indices.sum() == 0:
             logger.warning('Found no valid images')
         return valid_indices
 
@@ -125,47 +282,38 @@ class ValidIndexFilter(object):
         if n_images is None:
             return valid_indices
         else:
-            if sum(valid_indices) < n_images:
+            valid_indices = np.array(valid_indices, dtype=bool)
+            if valid_indices.sum() < n_images:
                 raise Exception('Too few images ({}) to sample {}.  Choose a smaller value for n_images '
                                 'in the sampler config, or change your filtering requirements for '
-                                'the sampler.'.format(sum(valid_indices), n_images))
-            # Subsample n_images
-            n_images_chosen = 0
-            for idx in np.random.permutation(len(valid_indices)):
-                if valid_indices[idx]:
-                    if n_images_chosen == n_images:
-                        valid_indices[idx] = False
-                    else:
-                        n_images_chosen += 1
-            assert sum(valid_indices) == n_images
+                                'the sampler.'.format(valid_indices.sum(), n_images))
+            # Subsample n_images: the first n_images valid indices of a random permutation
+            permutation = np.random.permutation(len(valid_indices))
+            chosen_indices = permutation[valid_indices[permutation]][:n_images]
+            valid_indices[:] = False
+            valid_indices[chosen_indices] = True
+            assert valid_indices.sum() == n_images
         return valid_indices
 
     @staticmethod
-    def filter_images_by_non_bground(dataset, bground_val=0, void_val=-1):
-        valid_indices = []
-        for index, (img, (sem_lbl, _)) in enumerate(dataset):
-            is_valid = (torch.sum(sem_lbl == bground_val) + torch.sum(
-                sem_lbl == void_val)) != torch.numel(sem_lbl)
-            if is_valid:
-                valid_indices.append(True)
-            else:
-                valid_indices.append(False)
-        if len(valid_indices) == 0:
-            import ipdb;
-            ipdb.set_trace()
+    def filter_images_by_non_bground(semantic_class_pixel_counts, bground_val=0):
+        """
+        Images with pixels of any semantic class other than bground_val, from the semantic pixel counts (see
+        PixelsPerSemanticClass; void pixels are not counted in it) rather than a pass over the dataset.
+        """
+        n_semantic_classes = semantic_class_pixel_counts.shape[1]
+        valid_indices = ValidIndexFilter.filter_images_by_semantic_classes(
+            semantic_class_pixel_counts, [v for v in range(n_semantic_classes) if v != bground_val])
+        if valid_indices.sum() == 0:
             raise Exception('Found no valid images')
         return valid_indices
 
     @staticmethod
     def get_valid_indices_from_scalar_stat(vec_stat_per_img, valid_range):
-        n_valid_min, n_valid_max = valid_range
-        has_at_least_n_min = (vec_stat_per_img >= n_valid_min) \
-            if n_valid_min is not None else torch.ByteTensor(vec_stat_per_img.size()).fill_(1)
-        has_at_most_n_max = (vec_stat_per_img < n_valid_max) \
-            if n_valid_max is not None else torch.ByteTensor(vec_stat_per_img.size()).fill_(1)
-        valid_indices_as_tensor = has_at_least_n_min * has_at_most_n_max
-        valid_indices = [x > 0 for x in valid_indices_as_tensor.tolist()]  # list of bool
-        return valid_indices
+        vec_stat_per_img = vec_stat_per_img.numpy() if torch.is_tensor(vec_stat_per_img) \
+            else np.asarray(vec_stat_per_img)
+        return ImageStatisticsTable(len(vec_stat_per_img), stat=vec_stat_per_img[:, None]).query(
+            InRange('stat', None, valid_range))
 
     @staticmethod
     def filter_images_by_range_from_counts2d(counts, valid_range=None, semantic_classes=None):
@@ -173,28 +321,14 @@ class ValidIndexFilter(object):
         valid_range: (min, max+1), where value is None if you don't want to bound that direction
             -- default None is equivalent to (None, None) (All indices are valid.)
         python "range" rules -- [n_min, n_max)
+        Each of semantic_classes (None: all of them) must be in range.
         """
+        table = ImageStatisticsTable(counts.shape[0], counts=counts)
         if valid_range is None:
-            return [True for _ in range(counts.size(0))]
-
-        assert len(valid_range) == 2, ValueError(
-            'range must be a tuple of (min, max).  You can set None for '
-            'either end of that range.')
-        n_valid_min, n_valid_max = valid_range
-        has_at_least_n_min = (counts >= n_valid_min) \
-            if n_valid_min is not None else torch.ByteTensor(counts.size()).fill_(1)
-        has_at_most_n_max = (counts < n_valid_max) \
-            if n_valid_max is not None else torch.ByteTensor(counts.size()).fill_(1)
-        if semantic_classes is None:
-            valid_indices_as_tensor = has_at_least_n_min.sum(
-                dim=1) * has_at_most_n_max.sum(dim=1)
-        else:
-            valid_indices_as_tensor = sum(
-                [has_at_least_n_min[:, sem_cls] for sem_cls in semantic_classes]) * \
-                                      sum([has_at_most_n_max[:, sem_cls] for sem_cls in
-                                           semantic_classes])
-        valid_indices = [x for x in valid_indices_as_tensor]
-        if len(valid_indices) == 0:
+            return table.query(AllImages())
+        semantic_classes = range(counts.shape[1]) if semantic_classes is None else semantic_classes
+        valid_indices = table.query(AllOf([InRange('counts', [sem_cls], valid_range)
+                                           for sem_cls in semantic_classes]))
+        if valid_indices.sum() == 0:
             logger.warning('Found no valid images')
-        assert len(valid_indices) == counts.size(0)
         return valid_indices
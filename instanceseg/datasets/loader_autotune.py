@@ -0,0 +1,175 @@
+"""
+DataLoader settings from measurements.  A short timed sweep over worker count, prefetch factor, persistent workers and
+batch size runs a few batches of the configured dataset through a DataLoader for each combination (two 'epochs', so
+worker startup is paid as it would be each epoch), prints the throughput table and caches the fastest settings for each
+batch size, keyed by host (name, cpus, gpu) and dataset tag.  Later runs on the same host type and dataset apply them
+without timing anything.
+
+<cache_path>/dataloader_settings.json:
+    {<host tag>__<dataset tag>: {'settings': {<batch size>: loader kwargs}, 'table': [[settings..., images/s]]}}
+
+Batch size is swept for the table only: it changes the optimization, so the settings applied are always the fastest for
+the configured batch size.
+
+With several processes (num_replicas > 1), only rank 0 sweeps (the others would compete with it for the cpus) and
+broadcasts its settings over the torch.distributed process group; without one, the defaults are used.
+"""
+import hashlib
+import itertools
+import json
+import logging
+import os
+import os.path as osp
+import platform
+import time
+
+import torch
+import torch.distributed
+import torch.utils.data
+
+from instanceseg.utils import misc
+
+try:
+    from tabulate import tabulate
+except ImportError:
+    tabulate = None
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+SETTINGS_FILE = 'dataloader_settings.json'
+DEFAULT_NUM_WORKERS = 4
+NUM_WORKERS_CANDIDATES = (0, 2, 4, 8, 16)
+PREFETCH_FACTOR_CANDIDATES = (2, 4)
+PERSISTENT_WORKERS_CANDIDATES = (False, True)
+TABLE_HEADINGS = ['batch_size', 'num_workers', 'prefetch_factor', 'persistent_workers', 'images/s']
+
+
+def get_default_loader_kwargs(cuda):
+    return {'num_workers': DEFAULT_NUM_WORKERS, 'pin_memory': True} if cuda else {}
+
+
+def get_host_tag():
+    gpu_name = torch.cuda.get_device_name(0) if torch.cuda.is_available() else 'cpu'
+    return '{}-{}cpus-{}'.format(platform.node(), os.cpu_count(), gpu_name).replace(' ', '_')
+
+
+def get_settings_key(host_tag, dataset_tag):
+    return '{}__{}'.format(host_tag, hashlib.md5(dataset_tag.encode()).hexdigest()[:12])
+
+
+def get_loader_kwargs_candidates(max_num_workers=None):
+    """
+    Each combination of the settings (prefetch and persistent workers only apply with workers)
+    """
+    max_num_workers = max_num_workers if max_num_workers is not None else os.cpu_count()
+    candidates = []
+    for num_workers in NUM_WORKERS_CANDIDATES:
+        if num_workers > max_num_workers:
+            continue
+        if num_workers == 0:
+            candidates.append({'num_workers': 0})
+            continue
+        for prefetch_factor, persistent_workers in itertools.product(PREFETCH_FACTOR_CANDIDATES,
+                                                                     PERSISTENT_WORKERS_CANDIDATES):
+            candidates.append({'num_workers': num_workers, 'prefetch_factor': prefetch_factor,
+                               'persistent_workers': persistent_workers})
+    return candidates
+
+
+def time_loader(dataset, batch_size, loader_kwargs, n_epochs=2):
+    """
+    Images / second through a DataLoader over all of dataset, n_epochs times
+    """
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, **loader_kwargs)
+    t_start = time.time()
+    for _ in range(n_epochs):
+        for _ in loader:
+            pass
+    seconds = time.time() - t_start
+    del loader  # shuts down persistent workers
+    return n_epochs * len(dataset) / seconds
+
+
+def sweep_loader_kwargs(dataset, batch_sizes, indices=None, n_batches=8, max_num_workers=None, pin_memory=False):
+    """
+    Times each candidate setting on the first n_batches batches of dataset (of indices, if given -- e.g. - the
+    sampler's) for each batch size.
+    Returns the fastest loader kwargs for each batch size, and the table of [batch size, settings..., images/s]
+    """
+    indices = list(indices if indices is not None else range(len(dataset)))
+    best_settings, table = {}, []
+    for batch_size in batch_sizes:
+        subset = torch.utils.data.Subset(dataset, indices[:n_batches * batch_size])
+        best_images_per_second = None
+        for loader_kwargs in get_loader_kwargs_candidates(max_num_workers):
+            loader_kwargs = dict(loader_kwargs, pin_memory=pin_memory)
+            images_per_second = time_loader(subset, batch_size, loader_kwargs)
+            table.append([batch_size, loader_kwargs['num_workers'], loader_kwargs.get('prefetch_factor'),
+                          loader_kwargs.get('persistent_workers', False), round(images_per_second, 1)])
+            if best_images_per_second is None or images_per_second > best_images_per_second:
+                best_settings[batch_size], best_images_per_second = loader_kwargs, images_per_second
+    return best_settings, table
+
+
+def print_table(table):
+    nested_list = [TABLE_HEADINGS] + table
+    if tabulate is None:
+        for l in nested_list:
+            print('\t'.join(['{}'.format(x) for x in l]))
+    else:
+        print(tabulate(nested_list, headers='firstrow'))
+
+
+def load_settings(settings_file):
+    if not osp.isfile(settings_file):
+        return {}
+    with open(settings_file, 'r') as f:
+        settings = json.load(f)
+    return settings if settings.get('version') == CACHE_VERSION else {}
+
+
+def write_settings(settings_file, settings):
+    os.makedirs(osp.dirname(osp.abspath(settings_file)), exist_ok=True)
+    with misc.atomic_output_file(settings_file) as tmp_file:
+        with open(tmp_file, 'w') as f:
+            json.dump(dict(settings, version=CACHE_VERSION), f, indent=2)
+
+
+def get_tuned_loader_kwargs(dataset, dataset_tag, batch_size, cache_path, cuda, indices=None, batch_sizes=None,
+                            override=False, num_replicas=None, rank=None, **sweep_kwargs):
+    """
+    The fastest loader kwargs for dataset at batch_size on this host: from cache_path, or from a sweep (over
+    batch_sizes, which always include batch_size), which is then cached.
+    num_replicas, rank: this process's rank of num_replicas; rank 0's settings are broadcast to the others (rank
+        defaults to the process group's)
+    """
+    if num_replicas is not None and num_replicas > 1:
+        if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+            logger.warning('No process group to share DataLoader settings over {} processes; using the defaults'.format(
+                num_replicas))
+            return get_default_loader_kwargs(cuda)
+        rank = rank if rank is not None else torch.distributed.get_rank()
+        shared_loader_kwargs = [get_tuned_loader_kwargs(dataset, dataset_tag, batch_size, cache_path, cuda, indices,
+                                                        batch_sizes, override, **sweep_kwargs) if rank == 0 else None]
+        torch.distributed.broadcast_object_list(shared_loader_kwargs, src=0)
+        return shared_loader_kwargs[0]
+
+    settings_file = osp.join(cache_path, SETTINGS_FILE)
+    settings = load_settings(settings_file)
+    key = get_settings_key(get_host_tag(), dataset_tag)
+    tuned = settings.get(key, {'settings': {}, 'table': []})
+    if override or str(batch_size) not in tuned['settings']:
+        batch_sizes = sorted(set(batch_sizes or []) | {batch_size})
+        logger.info('Timing DataLoader settings for {} (batch sizes {})'.format(dataset_tag, batch_sizes))
+        best_settings, table = sweep_loader_kwargs(dataset, batch_sizes, indices=indices, pin_memory=cuda,
+                                                   **sweep_kwargs)
+        print_table(table)
+        tuned['settings'].update({str(b): kwargs for b, kwargs in best_settings.items()})
+        tuned['table'] = [row for row in tuned['table'] if row[0] not in best_settings] + table
+        settings = load_settings(settings_file)  # Other runs may have written theirs meanwhile
+        settings[key] = tuned
+        write_settings(settings_file, settings)
+    loader_kwargs = tuned['settings'][str(batch_size)]
+    logger.info('DataLoader settings for {} (batch size {}): {}'.format(dataset_tag, batch_size, loader_kwargs))
+    return dict(loader_kwargs, pin_memory=cuda)
@@ -70,6 +70,7 @@ class TransformedPanopticDataset(PanopticDatasetBase):
         self.runtime_transformation = runtime_transformation
         self.should_use_precompute_transform = True
         self.should_use_runtime_transform = True
+        self._transformation_tag_cache = None  # (attribute items the tag was built from, tag)
 
     def __len__(self):  # explicit
         return len(self.raw_dataset)
@@ -130,7 +131,7 @@ class TransformedPanopticDataset(PanopticDatasetBase):
         # often self.raw_dataset.load_files(?)
         raise NotImplementedError
 
-    def get_item_from_files(self, identifier, precomputed_file_transformation=None):
+    def get_transformed_files(self, identifier, precomputed_file_transformation=None):
         data_file = self.raw_dataset.files[
             identifier]  # files populated when raw_dataset was instantiated
         img_file, sem_lbl_file, inst_lbl_file = data_file['img'], data_file['sem_lbl'], data_file[
@@ -142,6 +143,11 @@ class TransformedPanopticDataset(PanopticDatasetBase):
                 precomputed_file_transformation.transform(img_file=img_file,
                                                           sem_lbl_file=sem_lbl_file,
                                                           inst_lbl_file=inst_lbl_file)
+        return img_file, sem_lbl_file, inst_lbl_file
+
+    def get_item_from_files(self, identifier, precomputed_file_transformation=None):
+        img_file, sem_lbl_file, inst_lbl_file = self.get_transformed_files(identifier,
+                                                                           precomputed_file_transformation)
 
         # Run data through transformation
         img, lbl = self.load_files(img_file, sem_lbl_file, inst_lbl_file)
@@ -149,8 +155,16 @@ class TransformedPanopticDataset(PanopticDatasetBase):
 
     @property
     def transformation_tag(self):
-        return get_transformer_identifier_tag(self.precomputed_file_transformation,
-                                              self.runtime_transformation)
+        # The transformers cache their attribute items until one of their attributes is assigned, so the tag is only
+        # rebuilt (value_as_string of every attribute) when one of them changed
+        attribute_items = [item for tr in [self.precomputed_file_transformation, self.runtime_transformation]
+                           if tr is not None for item in tr.get_attribute_items()]
+        cached = getattr(self, '_transformation_tag_cache', None)
+        if cached is None or len(cached[0]) != len(attribute_items) or \
+                any(a is not b for a, b in zip(cached[0], attribute_items)):
+            self._transformation_tag_cache = (attribute_items, get_transformer_identifier_tag(
+                self.precomputed_file_transformation, self.runtime_transformation))
+        return self._transformation_tag_cache[1]
 
 
 def get_transformer_identifier_tag(precomputed_file_transformation, runtime_transformation):
@@ -0,0 +1,115 @@
+"""
+Eager, parallel generation of every file a precomputed file transformation chain needs.
+
+Without it, the files are generated on first access: serially while building the dataset, or inside __getitem__ (which
+stalls the DataLoader workers, and lets two of them generate the same file).  precompute_files plans the chain's
+generation jobs over a list of input files (get_generation_stages), runs the missing ones stage by stage in a process
+pool -- every writer renames its output into place, see misc.atomic_output_file -- and then writes a manifest.  A
+dataset that finds a manifest for its (root, split, chain) with the same inputs trusts it: it maps the inputs to their
+outputs by name (get_output_files) instead of checking/generating every file.
+
+python scripts/precompute.py --dataset_path data/cityscapes --splits train val --ordering lr --n_workers 8
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import os.path as osp
+
+from instanceseg.utils import misc
+from instanceseg.utils.datasets import get_transformation_tag
+
+MANIFEST_DIR = 'precomputed_manifests'
+MANIFEST_VERSION = 1
+
+
+def get_manifest_file(root, split, file_transformer):
+    key = hashlib.md5(get_transformation_tag([file_transformer]).encode()).hexdigest()[:12]
+    return osp.join(root, MANIFEST_DIR, '{}_{}.json'.format(split, key))
+
+
+def plan_generation_stages(file_transformer, files, skip_existing=True):
+    """
+    :param files: [(img_file, sem_lbl_file, inst_lbl_file)]
+    Returns [[(output_file, fcn, args)]]: stage s holds stage s of every input's jobs, deduplicated by output file.
+    """
+    stages, planned = [], set()
+    for data_files in files:
+        for s, jobs in enumerate(file_transformer.get_generation_stages(*data_files)):
+            if len(stages) <= s:
+                stages.append([])
+            for job in jobs:
+                output_file = job[0]
+                if output_file in planned or (skip_existing and osp.isfile(output_file)):
+                    continue
+                planned.add(output_file)
+                stages[s].append(job)
+    return stages
+
+
+def _run_job(job):
+    output_file, fcn, args = job
+    fcn(*args)
+    return output_file
+
+
+def run_generation_stages(stages, n_workers=None):
+    """
+    n_workers: processes (None: one per cpu; 0: serial, in this process)
+    """
+    pool = multiprocessing.Pool(processes=n_workers) if n_workers != 0 else None
+    try:
+        for s, jobs in enumerate(stages):
+            results = pool.imap_unordered(_run_job, jobs) if pool is not None else map(_run_job, jobs)
+            if misc.tqdm is not None:
+                results = misc.tqdm.tqdm(results, total=len(jobs), desc='Precomputing stage {}/{}'.format(
+                    s + 1, len(stages)))
+            for _ in results:
+                pass
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def write_manifest(manifest_file, file_transformer, files):
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'transformation_tag': get_transformation_tag([file_transformer]),
+        'inputs': [list(f) for f in files],
+        'outputs': [list(file_transformer.get_output_files(*f)) for f in files],
+    }
+    os.makedirs(osp.dirname(manifest_file), exist_ok=True)
+    with misc.atomic_output_file(manifest_file) as tmp_file:
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f)
+
+
+def precompute_files(root, split, file_transformer, files, n_workers=None):
+    """
+    Generates every missing file file_transformer needs for files, and records them in the (root, split) manifest.
+    Returns the output files, one (img_file, sem_lbl_file, inst_lbl_file) per input.
+    """
+    stages = plan_generation_stages(file_transformer, files)
+    n_jobs = sum(len(jobs) for jobs in stages)
+    print('Precomputing {} files for {} {} images'.format(n_jobs, len(files), split))
+    run_generation_stages(stages, n_workers)
+    write_manifest(get_manifest_file(root, split, file_transformer), file_transformer, files)
+    return [file_transformer.get_output_files(*f) for f in files]
+
+
+def load_trusted_output_files(root, split, file_transformer, files):
+    """
+    The output files recorded by precompute_files if its manifest covers exactly these inputs with this
+    transformer, else None (generate / check lazily, as before).
+    """
+    manifest_file = get_manifest_file(root, split, file_transformer)
+    if not osp.isfile(manifest_file):
+        return None
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION or \
+            manifest['transformation_tag'] != get_transformation_tag([file_transformer]) or \
+            manifest['inputs'] != [list(f) for f in files]:
+        return None
+    return [tuple(f) for f in manifest['outputs']]
@@ -24,11 +24,47 @@ class PrecomputedDatasetFileTransformerBase(object):
         # return img_file, old_sem_lbl_file, inst_lbl_file
         raise NotImplementedError
 
+    def __setattr__(self, name, value):
+        # Assigning any attribute invalidates the cached get_attribute_items (see RuntimeDatasetTransformerBase)
+        object.__setattr__(self, '_attribute_items', None)
+        object.__setattr__(self, name, value)
+
     def get_attribute_items(self):
+        if getattr(self, '_attribute_items', None) is None:
+            object.__setattr__(self, '_attribute_items', self.compute_attribute_items())
+        return self._attribute_items
+
+    def compute_attribute_items(self):
         attributes = inspect.getmembers(self, lambda a: not(inspect.isroutine(a)))
-        attributes = [a for a in attributes if not(a[0].startswith('__') and a[0].endswith('__')) and not callable(a)]
+        attributes = [a for a in attributes if not(a[0].startswith('__') and a[0].endswith('__')) and not callable(a)
+                      and a[0] != '_attribute_items']
         return attributes
 
+    def get_output_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        """
+        The files transform() returns, without touching the filesystem
+        """
+        raise NotImplementedError
+
+    def get_generation_jobs(self, img_file, sem_lbl_file, inst_lbl_file):
+        """
+        [(output_file, fcn, args)]: every file transform() needs, and fcn(*args) generates output_file (atomically).
+        """
+        return []
+
+    def get_generation_stages(self, img_file, sem_lbl_file, inst_lbl_file):
+        """
+        Jobs grouped into stages; a stage's jobs may read the files generated by earlier stages.
+        """
+        return [self.get_generation_jobs(img_file, sem_lbl_file, inst_lbl_file)]
+
+    def generate_missing_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        for jobs in self.get_generation_stages(img_file, sem_lbl_file, inst_lbl_file):
+            for output_file, fcn, args in jobs:
+                if not osp.isfile(output_file):
+                    print('Generating {}'.format(output_file))
+                    fcn(*args)
+
 
 def precomputed_file_transformer_factory(ordering=None):
     # Basic transformation (numpy array to torch tensor; resizing and centering)
@@ -61,25 +97,30 @@ class InstanceOrderingPrecomputedDatasetFileTransformation(PrecomputedDatasetFil
         self.ordering = ordering  # 'lr', 'big_to_small'
 
     def transform(self, img_file, sem_lbl_file, inst_lbl_file):
+        self.generate_missing_files(img_file, sem_lbl_file, inst_lbl_file)
+        return self.get_output_files(img_file, sem_lbl_file, inst_lbl_file)
+
+    def get_output_files(self, img_file, sem_lbl_file, inst_lbl_file):
         inst_lbl_file_unordered = inst_lbl_file
         if self.ordering is None:
             inst_lbl_file_ordered = inst_lbl_file_unordered
-        elif self.ordering.lower() == 'lr':
-            inst_lbl_file_ordered = inst_lbl_file_unordered.replace('.png', self.postfix + '.png')
-            if not osp.isfile(inst_lbl_file_ordered):
-                datasets.generate_ordered_instance_file(inst_lbl_file_unordered,
-                                                        sem_lbl_file, inst_lbl_file_ordered, ordering='lr',
-                                                        increasing='True')
-        elif self.ordering.lower() == 'big_to_small' or self.ordering.lower() == 'bigsmall':
+        elif self.ordering.lower() in ('lr', 'big_to_small', 'bigsmall'):
             inst_lbl_file_ordered = inst_lbl_file_unordered.replace('.png', self.postfix + '.png')
-            if not osp.isfile(inst_lbl_file_ordered):
-                datasets.generate_ordered_instance_file(inst_lbl_file_unordered,
-                                                        sem_lbl_file, inst_lbl_file_ordered,
-                                                        ordering='size', increasing=False)
         else:
             raise ValueError('ordering={} not recognized'.format(self.ordering))
         return img_file, sem_lbl_file, inst_lbl_file_ordered
 
+    def get_generation_jobs(self, img_file, sem_lbl_file, inst_lbl_file):
+        _, _, inst_lbl_file_ordered = self.get_output_files(img_file, sem_lbl_file, inst_lbl_file)
+        if self.ordering is None:
+            return []
+        elif self.ordering.lower() == 'lr':
+            ordering_args = ('lr', 'True')
+        else:  # big_to_small
+            ordering_args = ('size', False)
+        return [(inst_lbl_file_ordered, datasets.generate_ordered_instance_file,
+                 (inst_lbl_file, sem_lbl_file, inst_lbl_file_ordered) + ordering_args)]
+
     def untransform(self, img_file, sem_lbl_file, inst_lbl_file):
         inst_lbl_file_ordered = inst_lbl_file
         if self.ordering is None:
@@ -113,6 +154,20 @@ class GenericSequencePrecomputedDatasetFileTransformer(PrecomputedDatasetFileTra
                 img_file, sem_lbl_file, inst_lbl_file = transformer.transform(img_file, sem_lbl_file, inst_lbl_file)
         return img_file, sem_lbl_file, inst_lbl_file
 
+    def get_output_files(self, img_file, sem_lbl_file, inst_lbl_file):
+        for transformer in self.transformer_sequence:
+            img_file, sem_lbl_file, inst_lbl_file = transformer.get_output_files(img_file, sem_lbl_file,
+                                                                                 inst_lbl_file)
+        return img_file, sem_lbl_file, inst_lbl_file
+
+    def get_generation_stages(self, img_file, sem_lbl_file, inst_lbl_file):
+        stages = []
+        for transformer in self.transformer_sequence:
+            stages += transformer.get_generation_stages(img_file, sem_lbl_file, inst_lbl_file)
+            img_file, sem_lbl_file, inst_lbl_file = transformer.get_output_files(img_file, sem_lbl_file,
+                                                                                 inst_lbl_file)
+        return stages
+
     def untransform(self, img_file, sem_lbl_file, inst_lbl_file):
         assert all([isinstance(transformer, PrecomputedDatasetFileTransformerBase)
                     for transformer in self.transformer_sequence]), \
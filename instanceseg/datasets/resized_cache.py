@@ -0,0 +1,123 @@
+"""
+Pre-resized copies of a split.  With a resize configured, ResizeRuntimeDatasetTransformer resizes every full-resolution
+item (images bilinear; labels nearest, through float) every epoch.  A resized cache materializes each item at the target
+size once, as one uncompressed .npz per image, so training at reduced resolution only loads small arrays; the resize
+transformer then finds its input already at size and passes it through.
+
+The cache directory is keyed by (root, split, transformer identifier tag of the file transformations and the resize,
+interpolation modes).  Building it runs the missing items in a process pool (see precompute.run_generation_stages),
+each written atomically, so an interrupted build resumes where it stopped.  The manifest records each item's source file
+signatures; items whose sources changed are resized again.
+"""
+import hashlib
+import json
+import os
+import os.path as osp
+
+import numpy as np
+
+from instanceseg.datasets import precompute
+from instanceseg.datasets.compiled_label_store import file_signature, smallest_label_dtype
+from instanceseg.utils import datasets, misc
+
+CACHE_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+
+
+def get_cache_dir(cache_root, root, split, transformer_tag):
+    key = hashlib.md5('\n'.join([osp.realpath(root), split, transformer_tag, datasets.IMG_RESIZE_MODE,
+                                 datasets.LBL_RESIZE_MODE]).encode()).hexdigest()[:12]
+    return osp.join(cache_root, '{}_{}'.format(split, key))
+
+
+def get_datapoint_file(cache_dir, identifier):
+    return osp.join(cache_dir, '{}.npz'.format(identifier))
+
+
+def resize_datapoint(img, sem_lbl, inst_lbl, resize_size):
+    """
+    As ResizeRuntimeDatasetTransformer, with the labels stored in the smallest integer dtype that holds them
+    """
+    img = datasets.resize_img(img, resize_size)
+    lbls = []
+    for lbl in (sem_lbl, inst_lbl):
+        lbl = datasets.resize_lbl(lbl, resize_size)
+        lbls.append(lbl.astype(smallest_label_dtype(lbl.min(), lbl.max())) if lbl.size else lbl.astype(np.int32))
+    return img, lbls[0], lbls[1]
+
+
+def write_resized_datapoint(out_file, files, load_files, resize_size):
+    img, (sem_lbl, inst_lbl) = load_files(*files)
+    img, sem_lbl, inst_lbl = resize_datapoint(img, sem_lbl, inst_lbl, resize_size)
+    with misc.atomic_output_file(out_file) as tmp_file:
+        np.savez(tmp_file, img=img, sem_lbl=sem_lbl, inst_lbl=inst_lbl)
+
+
+def load_resized_datapoint(filename, lbl_dtype=np.int32):
+    """
+    img, (sem_lbl, inst_lbl), labels as lbl_dtype (what load_cityscapes_files returns)
+    """
+    with np.load(filename) as data:
+        return data['img'], (data['sem_lbl'].astype(lbl_dtype), data['inst_lbl'].astype(lbl_dtype))
+
+
+def load_manifest(cache_dir):
+    manifest_file = osp.join(cache_dir, MANIFEST_FILE)
+    if not osp.isfile(manifest_file):
+        return None
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    return manifest if manifest.get('version') == CACHE_VERSION else None
+
+
+def write_manifest(cache_dir, manifest):
+    with misc.atomic_output_file(osp.join(cache_dir, MANIFEST_FILE)) as tmp_file:
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f)
+
+
+def build_resized_cache(cache_dir, identifiers, files, load_files, resize_size, transformer_tag='', n_workers=None):
+    """
+    Resizes every item that isn't in the cache yet (or whose source files changed since), in parallel.
+    :param files: [(img_file, sem_lbl_file, inst_lbl_file)], one per identifier
+    :param n_workers: processes (None: one per cpu; 0: serial, in this process)
+    Returns the number of items resized.
+    """
+    assert len(identifiers) == len(files)
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = load_manifest(cache_dir)
+    recorded_sources = dict(zip(manifest['identifiers'], manifest['sources'])) if manifest is not None else {}
+    sources = [[file_signature(f) for f in data_files] for data_files in files]
+    jobs = []
+    for identifier, data_files, source in zip(identifiers, files, sources):
+        out_file = get_datapoint_file(cache_dir, identifier)
+        # Items on disk but not in the manifest were written by an interrupted build: kept
+        if osp.isfile(out_file) and recorded_sources.get(identifier, source) == source:
+            continue
+        jobs.append((out_file, write_resized_datapoint, (out_file, tuple(data_files), load_files, tuple(resize_size))))
+    if jobs:
+        print('Resizing {} of {} images to {} into {}'.format(len(jobs), len(files), tuple(resize_size), cache_dir))
+        precompute.run_generation_stages([jobs], n_workers)
+    new_manifest = {
+        'version': CACHE_VERSION,
+        'transformer_tag': transformer_tag,
+        'resize_size': list(resize_size),
+        'identifiers': list(identifiers),
+        'sources': sources,
+    }
+    if new_manifest != manifest:
+        write_manifest(cache_dir, new_manifest)
+    return len(jobs)
+
+
+class ResizedDatasetCache(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @classmethod
+    def open_or_build(cls, cache_dir, identifiers, files, load_files, resize_size, transformer_tag='', n_workers=None):
+        build_resized_cache(cache_dir, identifiers, files, load_files, resize_size, transformer_tag, n_workers)
+        return cls(cache_dir)
+
+    def get_datapoint_from_identifier(self, identifier):
+        return load_resized_datapoint(get_datapoint_file(self.cache_dir, identifier))
@@ -1,6 +1,10 @@
-from instanceseg.utils import datasets
+from instanceseg.utils import datasets, label_remap
+from instanceseg.datasets import dataset_statistics
 import inspect
 
+import numpy as np
+import torch
+
 
 DEBUG_ASSERT = True
 
@@ -15,9 +19,24 @@ class RuntimeDatasetTransformerBase(object):
     def untransform(self, img, lbl):
         raise NotImplementedError
 
+    def __setattr__(self, name, value):
+        # Assigning any attribute invalidates the cached get_attribute_items (attribute values are otherwise treated
+        # as immutable)
+        object.__setattr__(self, '_attribute_items', None)
+        object.__setattr__(self, name, value)
+
     def get_attribute_items(self):
+        """
+        Inspected once, not per item (they make up the dataset's transformation_tag)
+        """
+        if getattr(self, '_attribute_items', None) is None:
+            object.__setattr__(self, '_attribute_items', self.compute_attribute_items())
+        return self._attribute_items
+
+    def compute_attribute_items(self):
         attributes = inspect.getmembers(self, lambda a: not(inspect.isroutine(a)))
-        attributes = [a for a in attributes if not(a[0].startswith('__') and a[0].endswith('__')) and not callable(a)]
+        attributes = [a for a in attributes if not(a[0].startswith('__') and a[0].endswith('__')) and not callable(a)
+                      and a[0] != '_attribute_items']
         return attributes
 
 
@@ -26,14 +45,14 @@ def runtime_transformer_factory(resize=None, resize_size=None, mean_bgr=None, re
                                 map_other_classes_to_bground=True, map_to_single_instance_problem=False,
                                 n_inst_cap_per_class=None, instance_id_for_excluded_instances=None,
                                 thing_values_without_id_0=(), thing_values_with_id_0=(), stuff_values=(0,),
-                                void_val=-1):
+                                void_val=-1, n_inst_size_cap_per_class=None, compact_transport=False):
     # Basic transformation (numpy array to torch tensor; resizing and centering)
     transformer_sequence = []
 
     if resize:
         transformer_sequence.append(ResizeRuntimeDatasetTransformer(resize_size=resize_size if resize else None))
 
-    transformer_sequence.append(BasicRuntimeDatasetTransformer(mean_bgr=mean_bgr))
+    transformer_sequence.append(BasicRuntimeDatasetTransformer(mean_bgr=mean_bgr, compact_transport=compact_transport))
 
     # Image transformations
 
@@ -43,6 +62,9 @@ def runtime_transformer_factory(resize=None, resize_size=None, mean_bgr=None, re
             reduced_class_idxs=reduced_class_idxs, map_other_classes_to_bground=map_other_classes_to_bground))
 
     # Instance label transformations
+    if n_inst_size_cap_per_class is not None:
+        transformer_sequence.append(InstanceSizeCapRuntimeDatasetTransformer(
+            n_inst_size_cap_per_class=n_inst_size_cap_per_class, void_val=void_val))
 
     if n_inst_cap_per_class is not None:
         transformer_sequence.append(InstanceNumberCapRuntimeDatasetTransformer(
@@ -96,6 +118,28 @@ class SemanticAgreementForInstanceLabelsRuntimeDatasetTransformer(RuntimeDataset
         print(Warning('It\'s not possible to recover the initial instance labels.  Returning the existing ones.'))
         return img, lbl
 
+    def transform_label_pairs(self, sem_lbl, inst_lbl):
+        """
+        transform, one (semantic, instance) value pair at a time (see FusedLabelRuntimeDatasetTransformer).  Returns
+        (sem_lbl, inst_lbl, valid); valid is False where transform would raise.
+        """
+        valid = torch.ones_like(sem_lbl, dtype=torch.bool)
+        is_thing_without_id_0 = isin(sem_lbl, self.thing_values_without_id_0) & (inst_lbl == 0)
+        if self.error_on_thing_constraint:
+            valid &= ~is_thing_without_id_0
+        else:
+            inst_lbl = torch.where(is_thing_without_id_0, torch.full_like(inst_lbl, self.void_val), inst_lbl)
+        for sv in self.stuff_values:
+            if self.error_on_stuff_constraint:
+                valid &= ~((sem_lbl == sv) & (inst_lbl != 0))
+            else:
+                inst_lbl = torch.where(sem_lbl == sv, torch.zeros_like(inst_lbl), inst_lbl)
+        is_void_inst = inst_lbl == self.void_val
+        if self.error_on_void_constraint:
+            valid &= ~(is_void_inst & (sem_lbl != self.void_val))
+        sem_lbl = torch.where(is_void_inst, torch.full_like(sem_lbl, self.sem_val_of_void_inst), sem_lbl)
+        return sem_lbl, inst_lbl, valid
+
     def impose_semantic_constraints_on_instance_label(self, sem_lbl, inst_lbl):
         # right now, we do this because we're not using instance id 0 for
         # object classes.
@@ -130,6 +174,8 @@ class ResizeRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
         self.resize_size = resize_size
 
     def transform(self, img, lbl):
+        if self.is_resized(img, lbl):  # e.g. - read from TransformedCityscapes' resized cache
+            return img, lbl
         img = datasets.resize_img(img, self.resize_size)
         if isinstance(lbl, tuple):
             assert len(lbl) == 2, 'Should be semantic, instance label tuple'
@@ -142,6 +188,16 @@ class ResizeRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
     def untransform(self, img, lbl):
         raise NotImplementedError('Possible to implement (assuming we store original sizes? Haven\'t yet.')
 
+    def is_resized(self, img, lbl):
+        """
+        Already at resize_size (resizing to the same size changes nothing but the labels' dtype)
+        """
+        if self.resize_size is None:
+            return False
+        size = tuple(self.resize_size[:2])
+        lbls = lbl if isinstance(lbl, tuple) else (lbl,)
+        return img.shape[:2] == size and all(l.shape[:2] == size for l in lbls)
+
 
 class InstanceNumberCapRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
     def __init__(self, n_inst_cap_per_class: int, instance_id_for_excluded_instances=-1):
@@ -170,6 +226,35 @@ class InstanceNumberCapRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
             new_inst_lbl[new_inst_lbl > self.n_inst_cap_per_class] = self.instance_id_for_excluded_instances
         return img, (lbl[0], new_inst_lbl)
 
+    def transform_label_pairs(self, sem_lbl, inst_lbl):
+        above_cap = inst_lbl > self.n_inst_cap_per_class
+        if self.instance_id_for_excluded_instances is None:
+            return sem_lbl, inst_lbl, ~above_cap
+        inst_lbl = torch.where(above_cap, torch.full_like(inst_lbl, self.instance_id_for_excluded_instances),
+                               inst_lbl)
+        return sem_lbl, inst_lbl, torch.ones_like(above_cap)
+
+    def untransform(self, img, lbl):
+        print(Warning('It\'s not possible to recover the initial instance labels (many-to-one mapping).  Returning the '
+                      'existing ones.'))
+        return img, lbl
+
+
+class InstanceSizeCapRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
+    def __init__(self, n_inst_size_cap_per_class, void_val=-1):
+        """
+        Keeps the n_inst_size_cap_per_class largest instances of each semantic class and sets the rest to void_val
+        (Trainer.compute_loss's cap_sizes, run in the DataLoader workers instead of the training loop).
+        :param n_inst_size_cap_per_class: int, or {semantic value: cap} (see dataset_statistics.cap_instance_sizes)
+        """
+        self.n_inst_size_cap_per_class = n_inst_size_cap_per_class
+        self.void_val = void_val
+
+    def transform(self, img, lbl):
+        new_inst_lbl, _ = dataset_statistics.cap_instance_sizes(lbl[0], lbl[1], self.n_inst_size_cap_per_class,
+                                                                self.void_val)
+        return img, (lbl[0], new_inst_lbl)
+
     def untransform(self, img, lbl):
         print(Warning('It\'s not possible to recover the initial instance labels (many-to-one mapping).  Returning the '
                       'existing ones.'))
@@ -192,6 +277,13 @@ class ThingsToStuffRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
         new_inst_lbl[new_inst_lbl > 1] = 1
         return img, (lbl[0], new_inst_lbl)
 
+    def transform_label_pairs(self, sem_lbl, inst_lbl):
+        valid = torch.ones_like(sem_lbl, dtype=torch.bool)
+        if DEBUG_ASSERT:
+            valid &= ~isin(sem_lbl, self.stuff_values) | (inst_lbl == 0) | (inst_lbl == -1)
+        inst_lbl = torch.where(inst_lbl > 1, torch.ones_like(inst_lbl), inst_lbl)
+        return sem_lbl, inst_lbl, valid
+
     def untransform(self, img, lbl):
         print(Warning('It\'s not possible to recover the initial instance labels (many-to-one mapping).  Returning the '
                       'existing ones.'))
@@ -215,6 +307,15 @@ class SemanticSubsetRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
     def untransform(self, img, lbl):
         raise NotImplementedError('Implement here if needed.')
 
+    def transform_label_pairs(self, sem_lbl, inst_lbl):
+        valid = (sem_lbl != 0) | (inst_lbl == 0)
+        if not self.map_other_classes_to_bground:
+            valid &= (sem_lbl == -1) | isin(sem_lbl, self.reduced_class_idxs)
+        sem_lbl = label_remap.remap_values(sem_lbl, [-1] + list(self.reduced_class_idxs),
+                                           [-1] + list(range(len(self.reduced_class_idxs))), default=0)
+        inst_lbl = torch.where(sem_lbl == 0, torch.zeros_like(inst_lbl), inst_lbl)
+        return sem_lbl, inst_lbl, valid
+
     def transform_semantic_class_names(self, original_semantic_class_names):
         self.original_semantic_class_names = original_semantic_class_names
         return [self.original_semantic_class_names[idx] for idx in self.reduced_class_idxs]
@@ -229,11 +330,11 @@ class SemanticSubsetRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
     def untransform_labels_table(self):
         return self.original_labels_table
 
-    def get_attribute_items(self):
+    def compute_attribute_items(self):
         ignored_attributes = ['original_labels_table']
         attributes = inspect.getmembers(self, lambda a: not(inspect.isroutine(a)))
         attributes = [a for a in attributes if not(a[0].startswith('__') and a[0].endswith('__')) and not callable(a)
-                      and a not in ignored_attributes]
+                      and a not in ignored_attributes and a[0] != '_attribute_items']
         return attributes
 
 
@@ -242,8 +343,14 @@ class BasicRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
     centers and converts to torch tensor
     """
 
-    def __init__(self, mean_bgr=None):
+    def __init__(self, mean_bgr=None, compact_transport=False):
+        """
+        :param compact_transport: images stay uint8 and labels int16 through the DataLoader; centering (mean_bgr) and
+        widening happen batched, on the batch's device (datasets.decompact_batch, see
+        Trainer.prepare_data_for_forward_pass)
+        """
         self.mean_bgr = mean_bgr
+        self.compact_transport = compact_transport
 
     def transform(self, img, lbl):
         return self.transform_img(img), self.transform_lbl(lbl)
@@ -252,14 +359,18 @@ class BasicRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
         return self.untransform_img(img), self.untransform_lbl(lbl)
 
     def transform_img(self, img):
+        if self.compact_transport:
+            return datasets.convert_img_to_compact_torch_tensor(img)
         return datasets.convert_img_to_torch_tensor(img, mean_bgr=self.mean_bgr)
 
     def transform_lbl(self, lbl):
+        convert = datasets.convert_lbl_to_compact_torch_tensor if self.compact_transport else \
+            datasets.convert_lbl_to_torch_tensor
         if isinstance(lbl, tuple):
             assert len(lbl) == 2, 'Should be semantic, instance label tuple'
-            lbl = tuple(datasets.convert_lbl_to_torch_tensor(l) for l in lbl)
+            lbl = tuple(convert(l) for l in lbl)
         else:
-            lbl = datasets.convert_lbl_to_torch_tensor(lbl)
+            lbl = convert(lbl)
         return lbl
 
     def untransform_lbl(self, lbl):
@@ -273,20 +384,176 @@ class BasicRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
         return lbl
 
     def untransform_img(self, img):
-        img = datasets.convert_torch_img_to_numpy(img, self.mean_bgr)
+        # Compact images were never centered (uint8 if they come straight from the loader)
+        mean_bgr = None if self.compact_transport else self.mean_bgr
+        img = datasets.convert_torch_img_to_numpy(img, mean_bgr)
         return img
 
 
-class GenericSequenceRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
+def get_compact_transport_mean_bgr(runtime_transformation):
+    """
+    The mean the consumer of a compact-transport loader subtracts (datasets.decompact_batch)
+    """
+    transformer_sequence = runtime_transformation.transformer_sequence if \
+        isinstance(runtime_transformation, GenericSequenceRuntimeDatasetTransformer) else [runtime_transformation]
+    for transformer in transformer_sequence:
+        if isinstance(transformer, BasicRuntimeDatasetTransformer) and transformer.compact_transport:
+            return transformer.mean_bgr
+    return None
+
+
+def isin(lbl, values):
+    return torch.isin(lbl, torch.tensor(list(values), dtype=lbl.dtype, device=lbl.device))
+
+
+def is_fusable(transformer):
+    """
+    Label-only transformers that act on each (semantic, instance) value pair independently
+    """
+    return isinstance(transformer, RuntimeDatasetTransformerBase) and hasattr(transformer, 'transform_label_pairs')
+
+
+class FusedLabelRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
+    """
+    A run of label-only transformers compiled into one lookup table over (semantic, instance) value pairs: the pairs
+    in the label (a grid spanning their ranges) are pushed through each transformer's transform_label_pairs once, and
+    every item is then remapped with one gather per label, instead of each transformer's passes over the labels.
+
+    Labels with a pair one of the transformers would raise on are run through the transformers themselves, so errors
+    (and anything else transform does with them) stay exactly as they were.  untransform is theirs too.
+    """
+
     def __init__(self, transformer_sequence):
+        assert all(is_fusable(transformer) for transformer in transformer_sequence)
+        self.transformer_sequence = transformer_sequence
+        self.sem_range, self.inst_range = (0, 0), (0, 0)  # both include 0, see get_table_index
+        self.new_sem_lbls, self.new_inst_lbls, self.valid = self.build_tables(self.sem_range, self.inst_range)
+        self._wrapped_tables = {}  # (device, dtype) -> (new sem, new inst, valid) tables, see get_table_index
+
+    def build_tables(self, sem_range, inst_range):
+        """
+        (new sem, new inst, valid) tables over the grid of pairs, shape (n sem values, n inst values)
+        """
+        sem_lbl, inst_lbl = torch.meshgrid(torch.arange(sem_range[0], sem_range[1] + 1),
+                                           torch.arange(inst_range[0], inst_range[1] + 1), indexing='ij')
+        valid = torch.ones_like(sem_lbl, dtype=torch.bool)
+        for transformer in self.transformer_sequence:
+            # A pair is invalid if any of the transformers would raise on it (as it looks by then)
+            sem_lbl, inst_lbl, transformer_valid = transformer.transform_label_pairs(sem_lbl, inst_lbl)
+            valid &= transformer_valid
+        return sem_lbl, inst_lbl, valid
+
+    def cover(self, sem_range, inst_range):
+        """
+        Grows the tables (geometrically) to cover the ranges.  Returns False if that would exceed
+        label_remap.MAX_DENSE_TABLE_SIZE pairs.
+        """
+        ranges = []
+        for (lo, hi), (table_lo, table_hi) in zip((sem_range, inst_range), (self.sem_range, self.inst_range)):
+            span = table_hi - table_lo + 1
+            ranges.append((min(lo, table_lo - span) if lo < table_lo else table_lo,
+                           max(hi, table_hi + span) if hi > table_hi else table_hi))
+        if ranges == [self.sem_range, self.inst_range]:
+            return True
+        if (ranges[0][1] - ranges[0][0] + 1) * (ranges[1][1] - ranges[1][0] + 1) > label_remap.MAX_DENSE_TABLE_SIZE:
+            return False
+        self.sem_range, self.inst_range = ranges
+        self.new_sem_lbls, self.new_inst_lbls, self.valid = self.build_tables(self.sem_range, self.inst_range)
+        self._wrapped_tables = {}
+        return True
+
+    def get_wrapped_tables(self, dtype, device):
+        """
+        The flattened tables rotated so that get_table_index indexes them directly (negative indices from the end)
+        """
+        key = (device, dtype)
+        if key not in self._wrapped_tables:
+            offset = self.sem_range[0] * self.n_inst_values + self.inst_range[0]
+            self._wrapped_tables[key] = tuple(
+                torch.roll(table.reshape(-1), offset).to(device=device, dtype=table_dtype) for table, table_dtype in
+                ((self.new_sem_lbls, dtype), (self.new_inst_lbls, dtype), (self.valid, torch.bool)))
+        return self._wrapped_tables[key]
+
+    @property
+    def n_inst_values(self):
+        return self.inst_range[1] - self.inst_range[0] + 1
+
+    def get_table_index(self, sem_lbl, inst_lbl):
+        """
+        sem * n_inst_values + inst: unique per pair, and within [-table size, table size) since both ranges
+        include 0
+        """
+        if sem_lbl.dtype not in (torch.int64, torch.int32):
+            sem_lbl, inst_lbl = sem_lbl.long(), inst_lbl.long()
+        return torch.add(inst_lbl, sem_lbl, alpha=self.n_inst_values)
+
+    def transform(self, img, lbl):
+        sem_lbl, inst_lbl = lbl
+        if not (torch.is_tensor(sem_lbl) and torch.is_tensor(inst_lbl)) or sem_lbl.dtype != inst_lbl.dtype or \
+                sem_lbl.is_floating_point() or sem_lbl.numel() == 0:
+            return self.transform_unfused(img, lbl)
+        sem_range, inst_range = [tuple(int(v) for v in torch.aminmax(l)) for l in (sem_lbl, inst_lbl)]
+        if not self.cover(sem_range, inst_range):
+            return self.transform_unfused(img, lbl)
+        idx = self.get_table_index(sem_lbl, inst_lbl)
+        new_sem_lbls, new_inst_lbls, valid = self.get_wrapped_tables(sem_lbl.dtype, sem_lbl.device)
+        block = self.valid[sem_range[0] - self.sem_range[0]:sem_range[1] - self.sem_range[0] + 1,
+                           inst_range[0] - self.inst_range[0]:inst_range[1] - self.inst_range[0] + 1]
+        # Only if some pair in the ranges is invalid do we check the pairs actually present
+        if not bool(block.all()) and not bool(valid[idx].all()):
+            return self.transform_unfused(img, lbl)
+        return img, (new_sem_lbls[idx], new_inst_lbls[idx])
+
+    def transform_unfused(self, img, lbl):
+        for transformer in self.transformer_sequence:
+            img, lbl = transformer.transform(img, lbl)
+        return img, lbl
+
+    def untransform(self, img, lbl):
+        for transformer in self.transformer_sequence[::-1]:
+            img, lbl = transformer.untransform(img, lbl)
+        return img, lbl
+
+    def get_attribute_items(self):
+        return [item for transformer in self.transformer_sequence for item in transformer.get_attribute_items()]
+
+
+class GenericSequenceRuntimeDatasetTransformer(RuntimeDatasetTransformerBase):
+    def __init__(self, transformer_sequence, fuse_label_transformers=True):
         """
         :param transformer_sequence:   list of functions of type transform(img, lbl)
                                                 or RuntimeDatasetTransformerBase objects
+        :param fuse_label_transformers: transform runs each run of consecutive label-only transformers as one
+        FusedLabelRuntimeDatasetTransformer (same results; transformer_sequence, untransform and the attribute
+        items are unchanged)
         """
         self.transformer_sequence = transformer_sequence
+        self.fuse_label_transformers = fuse_label_transformers
+        self._transform_stages = None  # (transformer_sequence it was compiled from, stages)
+
+    def get_transform_stages(self):
+        """
+        transformer_sequence with its runs of fusable transformers compiled (recompiled if the sequence changed)
+        """
+        compiled = getattr(self, '_transform_stages', None)
+        if compiled is None or len(compiled[0]) != len(self.transformer_sequence) or \
+                any(a is not b for a, b in zip(compiled[0], self.transformer_sequence)):
+            stages, run = [], []
+            for transformer in list(self.transformer_sequence) + [None]:
+                if getattr(self, 'fuse_label_transformers', True) and is_fusable(transformer):
+                    run.append(transformer)
+                    continue
+                if run:
+                    stages.append(FusedLabelRuntimeDatasetTransformer(run))
+                    run = []
+                if transformer is not None:
+                    stages.append(transformer)
+            compiled = (list(self.transformer_sequence), stages)
+            object.__setattr__(self, '_transform_stages', compiled)
+        return compiled[1]
 
     def transform(self, img, lbl):
-        for transformer in self.transformer_sequence:
+        for transformer in self.get_transform_stages():
             if callable(transformer):
                 img, lbl = transformer(img, lbl)
             elif isinstance(transformer, RuntimeDatasetTransformerBase):
@@ -1,16 +1,18 @@
 import numpy as np
 import torch
+import torch.distributed
 from torch.utils.data import sampler
 
 
 class SamplerConfigWithoutValues(object):
 
     def __init__(self, n_images=None, sem_cls_filter_names=None, n_instances_ranges=None,
-                 n_occlusions_range=None):
+                 n_occlusions_range=None, bucket_batches=False):
         self.n_images = n_images
         self.sem_cls_filter_names = sem_cls_filter_names
         self.n_instances_ranges = n_instances_ranges
         self.n_occlusions_range = n_occlusions_range
+        self.bucket_batches = bucket_batches  # train: BucketedBatchSampler over the filtered images
 
         if self.n_instances_ranges is not None:  # Check if just one range
             # provided (should be list of tuples, one per class)
@@ -76,11 +78,12 @@ class SamplerConfigWithoutValues(object):
 
 class SamplerConfig(SamplerConfigWithoutValues):
     def __init__(self, n_images=None, sem_cls_filter_names=None, n_instances_ranges=None,
-                 semantic_class_names=None, n_occlusions_range=None):
+                 semantic_class_names=None, n_occlusions_range=None, bucket_batches=False):
         super(SamplerConfig, self).__init__(n_images=n_images,
                                             sem_cls_filter_names=sem_cls_filter_names,
                                             n_instances_ranges=n_instances_ranges,
-                                            n_occlusions_range=n_occlusions_range)
+                                            n_occlusions_range=n_occlusions_range,
+                                            bucket_batches=bucket_batches)
         self.sem_cls_filter_values = convert_sem_cls_filter_from_names_to_values(
             self.sem_cls_filter_names, semantic_class_names)
 
@@ -90,7 +93,8 @@ class SamplerConfig(SamplerConfigWithoutValues):
         return cls(n_images=old_inst.n_images, sem_cls_filter_names=old_inst.sem_cls_filter_names,
                    n_instances_ranges=old_inst.n_instances_ranges,
                    semantic_class_names=semantic_class_names,
-                   n_occlusions_range=old_inst.n_occlusions_range)
+                   n_occlusions_range=old_inst.n_occlusions_range,
+                   bucket_batches=getattr(old_inst, 'bucket_batches', False))
 
 
 def get_pytorch_sampler(sequential, index_weights=None, bool_index_subset=None):
@@ -134,7 +138,9 @@ def get_pytorch_sampler(sequential, index_weights=None, bool_index_subset=None):
             if index_weights is not None:
                 raise NotImplementedError
             if bool_index_subset is not None:
-                new_indices = [index for index in initial_indices if bool_index_subset[index]]
+                initial_indices_array = np.asarray(initial_indices, dtype=np.int64)
+                new_indices = initial_indices_array[
+                    np.asarray(bool_index_subset, dtype=bool)[initial_indices_array]].tolist()
             else:
                 new_indices = initial_indices
             return new_indices
@@ -142,6 +148,177 @@ def get_pytorch_sampler(sequential, index_weights=None, bool_index_subset=None):
     return SubsetWeightedSampler
 
 
+class ResumableSampler(sampler.Sampler):
+    """
+    Samples indices (each epoch in a new random order, unless sequential) from a checkpointable position: state_dict
+    saves the current epoch's order and how many of its indices were consumed, and after load_state_dict the next
+    epoch starts at the following index -- so on resume, the DataLoader doesn't load (and the trainer doesn't skip)
+    the batches that were already trained on.  __len__ is always the full epoch.
+    """
+
+    def __init__(self, indices, sequential=False):
+        if len(indices) == 0:
+            raise Exception('indices must be nonempty')
+        self.indices = list(indices)
+        self.sequential = sequential
+        self.order = None  # this epoch's order
+        self.start_position = 0
+
+    def __iter__(self):
+        if self.order is None or self.start_position == 0:
+            self.order = self.get_epoch_order()
+        start_position, self.start_position = self.start_position, 0
+        return iter(self.order[start_position:])
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get_epoch_order(self):
+        return list(self.indices) if self.sequential else \
+            [self.indices[x] for x in torch.randperm(len(self.indices)).tolist()]
+
+    @staticmethod
+    def get_order_indices(order):
+        return order
+
+    def state_dict(self, n_consumed):
+        """
+        n_consumed: how many of this epoch's indices were consumed (the DataLoader's workers prefetch ahead of it)
+        """
+        return {
+            'order': list(self.order) if self.order is not None else None,
+            'position': min(n_consumed, len(self)) if self.order is not None else 0
+        }
+
+    def load_state_dict(self, state_dict):
+        if state_dict['order'] is not None and \
+                sorted(self.get_order_indices(state_dict['order'])) != sorted(self.indices):
+            raise ValueError('The checkpointed sampler order is over different indices than this sampler\'s')
+        self.order = state_dict['order']
+        self.start_position = state_dict['position']
+
+    def copy(self, sequential_override=None, cut_n_images=None):
+        copy_of_self = ResumableSampler(self.indices[:cut_n_images] if cut_n_images else self.indices,
+                                        sequential=sequential_override or self.sequential)
+        return copy_of_self
+
+
+class ShardedSampler(ResumableSampler):
+    """
+    One process's shard of indices (e.g. - the valid indices of a ValidIndexFilter), for multi-process training and
+    validation: every rank orders all the indices the same way -- sequentially, or shuffled with seed + epoch (call
+    set_epoch at the start of each epoch) -- and takes every num_replicas-th one from its rank, so the shards are
+    disjoint and differ in size by at most one.  With pad, the order is padded (from its start) to a multiple of
+    num_replicas so every rank has the same number of batches, as data-parallel training needs; validation shouldn't
+    pad, so no image is counted twice.
+    num_replicas, rank: default to the torch.distributed process group's, if it's initialized (else 1, 0)
+    """
+
+    def __init__(self, indices, num_replicas=None, rank=None, sequential=False, seed=0, pad=None):
+        super(ShardedSampler, self).__init__(indices, sequential=sequential)
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        self.num_replicas = num_replicas if num_replicas is not None else \
+            (torch.distributed.get_world_size() if distributed else 1)
+        self.rank = rank if rank is not None else (torch.distributed.get_rank() if distributed else 0)
+        assert 0 <= self.rank < self.num_replicas, 'rank {} of {}'.format(self.rank, self.num_replicas)
+        self.seed = seed
+        self.pad = pad if pad is not None else not sequential
+        self.epoch = 0
+
+    def __len__(self):
+        n_indices = len(self.indices)
+        if self.pad:
+            return -(-n_indices // self.num_replicas)
+        return n_indices // self.num_replicas + (1 if self.rank < n_indices % self.num_replicas else 0)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_epoch_order(self):
+        if self.sequential:
+            order = list(self.indices)
+        else:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            order = [self.indices[x] for x in torch.randperm(len(self.indices), generator=generator).tolist()]
+        if self.pad:
+            n_padded = len(self) * self.num_replicas
+            order = (order * -(-n_padded // len(order)))[:n_padded]
+        return order[self.rank::self.num_replicas]
+
+    def load_state_dict(self, state_dict):
+        if state_dict['order'] is not None and not set(state_dict['order']).issubset(self.indices):
+            raise ValueError('The checkpointed sampler order is over different indices than this sampler\'s')
+        self.order = state_dict['order']
+        self.start_position = state_dict['position']
+
+    def copy(self, sequential_override=None, cut_n_images=None):
+        sequential = sequential_override or self.sequential
+        return ShardedSampler(self.indices[:cut_n_images] if cut_n_images else self.indices,
+                              num_replicas=self.num_replicas, rank=self.rank, sequential=sequential, seed=self.seed)
+
+
+def get_matching_costs(instance_counts):
+    """
+    Relative cost of matching each image's instances (instance_counts: (N, S)): the sizes of its per-class assignment
+    problems
+    """
+    instance_counts = np.asarray(instance_counts, dtype=np.int64)
+    return (instance_counts ** 2).sum(axis=1)
+
+
+class BucketedBatchSampler(ResumableSampler):
+    """
+    Batch sampler (use as the DataLoader's batch_sampler): each batch has images of one spatial size, so they collate
+    without cropping or padding, and of similar instance counts per semantic class, so no image in it sets a much
+    larger assignment problem than the rest (the matching pads a batch's problems to its largest).  Each epoch, the
+    images of each size are sorted by matching cost (random order among equal costs), cut into consecutive batches
+    and the batches are shuffled.  Checkpointable like ResumableSampler, with batches as the items.
+
+    image_sizes: (N, 2) (height, width) and instance_counts: (N, S) of every image of the dataset (e.g. - the
+        ImageSizes and NumberofInstancesPerSemanticClass statistics)
+    """
+
+    def __init__(self, indices, image_sizes, instance_counts, batch_size, sequential=False):
+        super(BucketedBatchSampler, self).__init__(indices, sequential=sequential)
+        self.image_sizes = np.asarray(image_sizes)
+        self.instance_counts = np.asarray(instance_counts)
+        self.matching_costs = get_matching_costs(self.instance_counts)
+        self.batch_size = batch_size
+        _, n_images_per_size = np.unique(self.image_sizes[self.indices], axis=0, return_counts=True)
+        self.n_batches = int(np.sum(-(-n_images_per_size // batch_size)))
+
+    def __len__(self):
+        return self.n_batches
+
+    def get_epoch_order(self):
+        indices = np.asarray(self.indices, dtype=np.int64)
+        if not self.sequential:
+            indices = indices[torch.randperm(len(indices)).numpy()]
+        sizes, costs = self.image_sizes[indices], self.matching_costs[indices]
+        indices = indices[np.lexsort((costs, sizes[:, 1], sizes[:, 0]))]  # stable: random among ties
+        sizes = self.image_sizes[indices]
+        size_starts = np.flatnonzero(np.r_[True, np.any(sizes[1:] != sizes[:-1], axis=1)])
+        batches = [indices[start:min(start + self.batch_size, end)].tolist()
+                   for size_start, end in zip(size_starts, np.r_[size_starts[1:], len(indices)])
+                   for start in range(size_start, end, self.batch_size)]
+        if not self.sequential:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return batches
+
+    @staticmethod
+    def get_order_indices(order):
+        return [index for batch in order for index in batch]
+
+    def copy(self, sequential_override=None, cut_n_images=None, batch_size=None):
+        """
+        batch_size: of the copy (e.g. - the val batch size, for evaluation); defaults to this sampler's
+        """
+        return BucketedBatchSampler(self.indices[:cut_n_images] if cut_n_images else self.indices, self.image_sizes,
+                                    self.instance_counts, batch_size or self.batch_size,
+                                    sequential=sequential_override or self.sequential)
+
+
 def convert_sem_cls_filter_from_names_to_values(sem_cls_filter, semantic_class_names):
     if sem_cls_filter is None:
         return None
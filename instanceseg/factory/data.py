@@ -1,7 +1,7 @@
 import torch
 import torch.utils.data
 
-from instanceseg.datasets import dataset_generator_registry
+from instanceseg.datasets import dataset_generator_registry, dataset_registry, loader_autotune, sampler
 from instanceseg.factory import samplers as sampler_factory
 
 DEBUG_ASSERTS = True
@@ -12,7 +12,26 @@ def get_dataset_with_transformations(dataset_type, cfg, split, transform=True):
     return dataset
 
 
-def get_dataloaders(cfg, dataset_type, cuda, sampler_cfg=None, splits=('train', 'val', 'train_for_val')):
+def get_tuned_loader_kwargs(dataset_type, dataset, my_sampler, batch_size, cuda, num_replicas=None, rank=None):
+    """
+    The fastest DataLoader settings for the train dataset on this host (see loader_autotune), timed over the images
+    its sampler draws from (by rank 0 only, when sharded across num_replicas processes)
+    """
+    transformer_tag = dataset_generator_registry.get_transformer_identifier_tag(
+        getattr(dataset, 'precomputed_file_transformation', None), getattr(dataset, 'runtime_transformation', None))
+    dataset_tag = '{}_{}_{}'.format(dataset_type, len(dataset), transformer_tag)
+    indices = getattr(my_sampler, 'indices', None)
+    return loader_autotune.get_tuned_loader_kwargs(dataset, dataset_tag, batch_size,
+                                                   dataset_registry.REGISTRY[dataset_type].cache_path, cuda,
+                                                   indices=indices, batch_sizes=[batch_size, 2 * batch_size],
+                                                   num_replicas=num_replicas, rank=rank)
+
+
+def get_dataloaders(cfg, dataset_type, cuda, sampler_cfg=None, splits=('train', 'val', 'train_for_val'),
+                    num_replicas=None, rank=None):
+    """
+    num_replicas, rank: this process's rank of num_replicas, for multi-process training (each split is sharded)
+    """
     non_derivative_splits = (s for s in splits if s != 'train_for_val')
     build_train_for_val = splits != non_derivative_splits
 
@@ -29,15 +48,25 @@ def get_dataloaders(cfg, dataset_type, cuda, sampler_cfg=None, splits=('train',
             sampler_cfg['val'] == 'copy_train':
         assert 'train' in splits
         datasets['val'] = datasets['train']
-    samplers = sampler_factory.get_samplers(dataset_type, sampler_cfg, datasets, splits=splits)
-
-    # Create dataloaders from datasets and samplers
-    loader_kwargs = {'num_workers': 4, 'pin_memory': True} if cuda else {}
     batch_sizes = {split: cfg['val_batch_size'] if split == 'train_for_val' else cfg['{}_batch_size'.format(split)]
                    for split in splits}
+    samplers = sampler_factory.get_samplers(dataset_type, sampler_cfg, datasets, splits=splits,
+                                            train_batch_size=batch_sizes.get('train', None),
+                                            num_replicas=num_replicas, rank=rank,
+                                            statistics_num_workers=cfg.get('statistics_num_workers', None),
+                                            val_batch_size=cfg.get('val_batch_size', None))
+
+    # Create dataloaders from datasets and samplers
+    if cfg.get('dataloader_autotune', False) and 'train' in splits:
+        loader_kwargs = get_tuned_loader_kwargs(dataset_type, datasets['train'], samplers['train'],
+                                                batch_sizes['train'], cuda, num_replicas=num_replicas, rank=rank)
+    else:
+        loader_kwargs = loader_autotune.get_default_loader_kwargs(cuda)
     dataloaders = {
-        split: torch.utils.data.DataLoader(datasets[split], batch_size=batch_sizes[split],
-                                           sampler=samplers[split], **loader_kwargs) for split in splits
+        split: torch.utils.data.DataLoader(datasets[split], batch_sampler=samplers[split], **loader_kwargs)
+        if isinstance(samplers[split], sampler.BucketedBatchSampler) else
+        torch.utils.data.DataLoader(datasets[split], batch_size=batch_sizes[split], sampler=samplers[split],
+                                    **loader_kwargs) for split in splits
     }
 
     if DEBUG_ASSERTS:
@@ -6,7 +6,7 @@ import logging
 from torch.utils.data import SequentialSampler, RandomSampler
 
 from instanceseg.datasets import sampler, dataset_statistics, indexfilter, dataset_registry, \
-    dataset_generator_registry
+    dataset_generator_registry, image_statistics_store
 from instanceseg.utils.misc import pop_without_del
 
 logger = logging.getLogger(__name__)
@@ -15,7 +15,12 @@ logger = logging.getLogger(__name__)
 def get_valid_indices_given_dataset(dataset_configured_for_stats,
                                     sampler_config_with_vals: sampler.SamplerConfig,
                                     instance_count_file=None, semantic_pixel_count_file=None,
-                                    occlusion_counts_file=None):
+                                    occlusion_counts_file=None, image_statistics_file=None, num_workers=None):
+    """
+    image_statistics_file: if set, statistics are kept per image in this ImageStatisticsStore, so only new or changed
+        images are computed (the whole-split count files are assembled from it)
+    num_workers: DataLoader workers of the statistics pass (None: loader_autotune.DEFAULT_NUM_WORKERS)
+    """
     semantic_class_pixel_counts_cache = dataset_statistics.PixelsPerSemanticClass(
         range(len(dataset_configured_for_stats.semantic_class_names)),
         cache_file=semantic_pixel_count_file)
@@ -25,21 +30,25 @@ def get_valid_indices_given_dataset(dataset_configured_for_stats,
     occlusion_counts_cache = dataset_statistics.OcclusionsOfSameClass(range(len(
         dataset_configured_for_stats.semantic_class_names)), cache_file=occlusion_counts_file)
 
-    if sampler_config_with_vals.requires_instance_counts:
-        instance_counts_cache.compute_or_retrieve(dataset_configured_for_stats)
-        instance_counts = instance_counts_cache.stat_tensor
-    else:
-        instance_counts = None
-    if sampler_config_with_vals.requires_semantic_pixel_counts:
-        semantic_class_pixel_counts_cache.compute_or_retrieve(dataset_configured_for_stats)
-        semantic_pixel_counts = semantic_class_pixel_counts_cache.stat_tensor
-    else:
-        semantic_pixel_counts = None
-    if sampler_config_with_vals.requires_occlusion_counts:
-        occlusion_counts_cache.compute_or_retrieve(dataset_configured_for_stats)
-        occlusion_counts = occlusion_counts_cache.stat_tensor
-    else:
-        occlusion_counts = None
+    # The statistics that aren't cached yet are computed together, in one pass over the dataset
+    statistics = dataset_statistics.FusedDatasetStatistics(
+        num_workers=num_workers,
+        image_statistics_store=image_statistics_store.ImageStatisticsStore(image_statistics_file)
+        if image_statistics_file is not None else None)
+    for required, statistic_cache in ((sampler_config_with_vals.requires_instance_counts, instance_counts_cache),
+                                      (sampler_config_with_vals.requires_semantic_pixel_counts,
+                                       semantic_class_pixel_counts_cache),
+                                      (sampler_config_with_vals.requires_occlusion_counts, occlusion_counts_cache)):
+        if required:
+            statistics.register(statistic_cache)
+    statistics.compute_or_retrieve(dataset_configured_for_stats)
+
+    instance_counts = instance_counts_cache.stat_tensor if sampler_config_with_vals.requires_instance_counts \
+        else None
+    semantic_pixel_counts = semantic_class_pixel_counts_cache.stat_tensor \
+        if sampler_config_with_vals.requires_semantic_pixel_counts else None
+    occlusion_counts = occlusion_counts_cache.stat_tensor if sampler_config_with_vals.requires_occlusion_counts \
+        else None
     index_filter = indexfilter.ValidIndexFilter(n_original_images=len(dataset_configured_for_stats),
                                                 sampler_config=sampler_config_with_vals,
                                                 instance_counts=instance_counts,
@@ -51,7 +60,8 @@ def get_valid_indices_given_dataset(dataset_configured_for_stats,
 
 def get_configured_sampler(dataset, dataset_configured_for_stats, sequential,
                            sampler_config_with_vals, instance_count_file,
-                           semantic_pixel_count_file, occlusion_counts_file):
+                           semantic_pixel_count_file, occlusion_counts_file, image_statistics_file=None,
+                           statistics_num_workers=None):
     """
     Builds a sampler of a dataset, which requires a list of valid indices and whether it's random/sequential,
     as well as the dataset itself.
@@ -69,7 +79,9 @@ def get_configured_sampler(dataset, dataset_configured_for_stats, sequential,
         dataset_configured_for_stats, sampler_config_with_vals,
         instance_count_file=instance_count_file,
         semantic_pixel_count_file=semantic_pixel_count_file,
-        occlusion_counts_file=occlusion_counts_file)
+        occlusion_counts_file=occlusion_counts_file,
+        image_statistics_file=image_statistics_file,
+        num_workers=statistics_num_workers)
 
     my_sampler = sampler.get_pytorch_sampler(sequential, bool_index_subset=valid_indices)(dataset)
     if len(my_sampler) == 0:
@@ -78,28 +90,90 @@ def get_configured_sampler(dataset, dataset_configured_for_stats, sequential,
 
 
 def sampler_generator_helper(dataset_type, dataset, default_dataset, sampler_config, sampler_split_type,
-                             transformer_tag):
+                             transformer_tag, statistics_num_workers=None):
     instance_count_filename = \
         dataset_registry.REGISTRY[dataset_type].get_instance_count_filename(sampler_split_type, transformer_tag)
     semantic_pixel_count_filename = dataset_registry.REGISTRY[dataset_type].get_semantic_pixel_count_filename(
         sampler_split_type, transformer_tag)
     occlusion_counts_filename = dataset_registry.REGISTRY[dataset_type].get_occlusion_counts_filename(
         sampler_split_type, transformer_tag)
+    image_statistics_filename = dataset_registry.REGISTRY[dataset_type].get_image_statistics_filename(transformer_tag)
     filter_config = sampler.SamplerConfig.create_from_cfg_without_vals(
         sampler_config[sampler_split_type], default_dataset.semantic_class_names)
     my_sampler = get_configured_sampler(
         dataset, default_dataset, sequential=True, sampler_config_with_vals=filter_config,
         instance_count_file=instance_count_filename,
         semantic_pixel_count_file=semantic_pixel_count_filename,
-        occlusion_counts_file=occlusion_counts_filename)
+        occlusion_counts_file=occlusion_counts_filename,
+        image_statistics_file=image_statistics_filename,
+        statistics_num_workers=statistics_num_workers)
     return my_sampler
 
 
-def get_samplers(dataset_type, sampler_cfg, datasets, splits=('train', 'val', 'train_for_val')):
+def get_bucketed_batch_sampler(dataset_type, dataset, indices, batch_size, sequential=False,
+                               statistics_num_workers=None):
+    """
+    BucketedBatchSampler over indices of dataset, with the image sizes and instance counts of dataset itself (after
+    its transformations -- what the batches are collated and matched from), kept in its ImageStatisticsStore
+    """
+    image_statistics_filename = None
+    if dataset_type != 'synthetic':
+        transformer_tag = dataset_generator_registry.get_transformer_identifier_tag(
+            dataset.precomputed_file_transformation, dataset.runtime_transformation)
+        image_statistics_filename = dataset_registry.REGISTRY[dataset_type].get_image_statistics_filename(
+            transformer_tag)
+    statistics = dataset_statistics.FusedDatasetStatistics(
+        num_workers=statistics_num_workers,
+        image_statistics_store=image_statistics_store.ImageStatisticsStore(image_statistics_filename)
+        if image_statistics_filename is not None else None)
+    image_sizes = statistics.register(dataset_statistics.ImageSizes())
+    instance_counts = statistics.register(dataset_statistics.NumberofInstancesPerSemanticClass(
+        range(len(dataset.semantic_class_names))))
+    statistics.compute_or_retrieve(dataset)
+    return sampler.BucketedBatchSampler(indices, image_sizes.stat_tensor.numpy(), instance_counts.stat_tensor.numpy(),
+                                        batch_size, sequential=sequential)
+
+
+def shard_samplers(samplers, datasets, num_replicas=None, rank=None, seed=0):
+    """
+    Each split's sampler, as this process's shard of its indices (sampler.ShardedSampler): shuffled (with the same seed
+    on every rank) if it was random, in order if it was sequential.
+    """
+    sharded_samplers = {}
+    for split, my_sampler in samplers.items():
+        if isinstance(my_sampler, sampler.BucketedBatchSampler):
+            raise NotImplementedError('Bucketed batches can\'t be sharded across processes yet')
+        indices = my_sampler.indices if hasattr(my_sampler, 'indices') else range(len(datasets[split]))
+        sequential = getattr(my_sampler, 'sequential', isinstance(my_sampler, SequentialSampler))
+        sharded_samplers[split] = sampler.ShardedSampler(indices, num_replicas=num_replicas, rank=rank,
+                                                         sequential=sequential, seed=seed)
+    return sharded_samplers
+
+
+def copy_train_sampler(train_sampler, val_batch_size=None, cut_n_images=None):
+    """
+    Sequential copy of the train sampler for evaluation; a bucketed one batches by val_batch_size (if given)
+    """
+    if isinstance(train_sampler, sampler.BucketedBatchSampler):
+        return train_sampler.copy(sequential_override=True, cut_n_images=cut_n_images, batch_size=val_batch_size)
+    return train_sampler.copy(sequential_override=True, cut_n_images=cut_n_images)
+
+
+def get_samplers(dataset_type, sampler_cfg, datasets, splits=('train', 'val', 'train_for_val'), train_batch_size=None,
+                 num_replicas=None, rank=None, statistics_num_workers=None, val_batch_size=None):
+    """
+    train_batch_size: required if the train sampler config buckets batches (the train sampler is then a batch sampler)
+    val_batch_size: batch size of the samplers copied from a bucketed train sampler (train_for_val, and val if it is
+        'copy_train'); defaults to train_batch_size
+    statistics_num_workers: DataLoader workers of the dataset statistics passes the samplers are filtered / bucketed by
+        (cfg['statistics_num_workers']; None: loader_autotune.DEFAULT_NUM_WORKERS)
+    num_replicas, rank: for multi-process training / validation, each split's sampler is sharded across num_replicas
+        processes (see shard_samplers)
+    """
     samplers = {}
     if sampler_cfg is None:
         SamplerTypes = {
-            'train': sampler.sampler.RandomSampler,
+            'train': lambda dataset: sampler.ResumableSampler(range(len(dataset)), sequential=False),
             'val': sampler.sampler.SequentialSampler,
             'train_for_val': sampler.sampler.SequentialSampler
         }
@@ -122,23 +196,37 @@ def get_samplers(dataset_type, sampler_cfg, datasets, splits=('train', 'val', 't
             if split == 'val':
                 if isinstance(sampler_cfg[split], str) and sampler_cfg[split] == 'copy_train':
                     assert 'train' in splits, 'train must be in split if val needs to copy sampler from train'
-                    samplers[split] = samplers['train'].copy(sequential_override=True)
+                    samplers[split] = copy_train_sampler(samplers['train'], val_batch_size)
                 else:
                     samplers[split] = sampler_generator_helper(dataset_type, datasets[split], default_datasets[split],
                                                                sampler_cfg, sampler_split_type=split,
-                                                               transformer_tag=transformer_tag)
+                                                               transformer_tag=transformer_tag,
+                                                               statistics_num_workers=statistics_num_workers)
 
             # train_for_val sampler
             elif split == 'train_for_val':
                 assert 'train' in splits
                 sampler_cfg['train_for_val'] = pop_without_del(sampler_cfg, 'train_for_val', None)
-                cut_n_images = sampler_cfg['train_for_val'].n_images or len(datasets['train'])
-                samplers['train_for_val'] = samplers['train'].copy(sequential_override=True,
-                                                                   cut_n_images=None if cut_n_images is None
-                                                                   else min(cut_n_images, len(samplers['train'])))
+                # Cut by images, not len(): a batch sampler's length is its number of batches
+                cut_n_images = min(sampler_cfg['train_for_val'].n_images or len(datasets['train']),
+                                   len(samplers['train'].indices))
+                samplers['train_for_val'] = copy_train_sampler(samplers['train'], val_batch_size,
+                                                               cut_n_images=cut_n_images)
             else:
                 samplers[split] = sampler_generator_helper(dataset_type, datasets[split], default_datasets[split],
                                                            sampler_cfg, sampler_split_type=split,
-                                                           transformer_tag=transformer_tag)
-
+                                                           transformer_tag=transformer_tag,
+                                                           statistics_num_workers=statistics_num_workers)
+                if split == 'train' and sampler_cfg[split].bucket_batches:
+                    assert train_batch_size is not None, 'train_batch_size is required to bucket batches'
+                    samplers[split] = get_bucketed_batch_sampler(dataset_type, datasets[split],
+                                                                 samplers[split].indices, train_batch_size,
+                                                                 sequential=samplers[split].sequential,
+                                                                 statistics_num_workers=statistics_num_workers)
+                elif split == 'train':  # So its position can be checkpointed
+                    samplers[split] = sampler.ResumableSampler(samplers[split].indices,
+                                                               sequential=samplers[split].sequential)
+
+    if num_replicas is not None and num_replicas > 1:
+        samplers = shard_samplers(samplers, datasets, num_replicas=num_replicas, rank=rank)
     return samplers
@@ -1,15 +1,31 @@
 from tensorboardX import SummaryWriter
 
+from instanceseg.losses.sinkhorn import SinkhornConfig
 from instanceseg.train.trainer import Trainer
 
 
+def get_sinkhorn_config(cfg):
+    return SinkhornConfig(temperature=cfg.get('sinkhorn_temperature', 0.1),
+                          n_iters=cfg.get('sinkhorn_n_iters', 20),
+                          temperature_decay=cfg.get('sinkhorn_temperature_decay', 1.0),
+                          min_temperature=cfg.get('sinkhorn_min_temperature', 0.01),
+                          diagnostic_interval=cfg.get('sinkhorn_diagnostic_interval', 0))
+
+
 def get_trainer(cfg, cuda, model, dataloaders, problem_config, out_dir, optim, scheduler=None):
     writer = SummaryWriter(log_dir=out_dir)
     trainer = Trainer(cuda=cuda, model=model, optimizer=optim, dataloaders=dataloaders,
                       out_dir=out_dir, max_iter=cfg['max_iteration'],
                       instance_problem=problem_config, size_average=cfg['size_average'],
                       interval_validate=cfg.get('interval_validate', len(dataloaders['train'])),
-                      loss_type=cfg['loss_type'], matching_loss=cfg['matching'], tensorboard_writer=writer,
+                      loss_type=cfg['loss_type'], matching_loss=cfg['matching'],
+                      cost_matrix_engine=cfg.get('cost_matrix_engine', 'loop'),
+                      cost_matrix_chunk_bytes=cfg.get('cost_matrix_chunk_bytes', None),
+                      assignment_cache=cfg.get('assignment_cache', False),
+                      matching_solver_workers=cfg.get('matching_solver_workers', 0),
+                      matching_solver_backend=cfg.get('matching_solver_backend', 'scipy'),
+                      matching_mode=cfg.get('matching_mode', 'hungarian'), sinkhorn_config=get_sinkhorn_config(cfg),
+                      tensorboard_writer=writer,
                       augment_input_with_semantic_masks=cfg['augment_semantic'],
                       export_activations=cfg['export_activations'],
                       activation_layers_to_export=cfg['activation_layers_to_export'],
@@ -27,7 +43,14 @@ def get_validator(cfg, cuda, model, dataloaders, problem_config, out_dir):
                         out_dir=out_dir, max_iter=cfg['max_iteration'],
                         instance_problem=problem_config, size_average=cfg['size_average'],
                         interval_validate=cfg.get('interval_validate', len(dataloaders['train'])),
-                        loss_type=cfg['loss_type'], matching_loss=cfg['matching'], tensorboard_writer=writer,
+                        loss_type=cfg['loss_type'], matching_loss=cfg['matching'],
+                        cost_matrix_engine=cfg.get('cost_matrix_engine', 'loop'),
+                        cost_matrix_chunk_bytes=cfg.get('cost_matrix_chunk_bytes', None),
+                        assignment_cache=cfg.get('assignment_cache', False),
+                        matching_solver_workers=cfg.get('matching_solver_workers', 0),
+                        matching_solver_backend=cfg.get('matching_solver_backend', 'scipy'),
+                        matching_mode=cfg.get('matching_mode', 'hungarian'), sinkhorn_config=get_sinkhorn_config(cfg),
+                        tensorboard_writer=writer,
                         augment_input_with_semantic_masks=cfg['augment_semantic'],
                         export_activations=cfg['export_activations'],
                         activation_layers_to_export=cfg['activation_layers_to_export'],
@@ -0,0 +1,84 @@
+"""
+Batched linear assignment in pure torch: the shortest augmenting path (Hungarian / Jonker-Volgenant style) algorithm
+with row and column potentials, vectorized over a batch of cost matrices.  Runs on whatever device the cost tensors
+live on, so the matching step doesn't have to round-trip through numpy.
+
+Cost matrices are rectangular (n_pred x n_gt, n_pred <= n_gt -- guaranteed by the GT_VALUE_FOR_FALSE_POSITIVE
+padding in match.py).  Problems of different sizes are padded to a common size; padded columns are marked as
+permanently visited so they are never assigned.
+"""
+import torch
+
+
+def batched_linear_sum_assignment(cost_tensors, dtype=torch.float64):
+    """
+    cost_tensors: list of (n_pred_i, n_gt_i) cost tensors with n_pred_i <= n_gt_i, or a (B, n_pred, n_gt) tensor.
+    Returns a list of (n_pred_i,) LongTensors (on the cost tensors' device): the column assigned to each row.  The
+    assignments minimize the total cost (same optimum as scipy.optimize.linear_sum_assignment).
+    """
+    if torch.is_tensor(cost_tensors):
+        assert cost_tensors.dim() == 3
+        cost_tensors = list(cost_tensors)
+    if len(cost_tensors) == 0:
+        return []
+    shapes = [tuple(c.shape) for c in cost_tensors]
+    for n_pred, n_gt in shapes:
+        assert n_pred <= n_gt, 'Need at least as many columns as rows (pad with false positive columns first)'
+    device = cost_tensors[0].device
+    batch_sz = len(cost_tensors)
+    n = max(n_pred for n_pred, _ in shapes)
+    m = max(n_gt for _, n_gt in shapes)
+
+    # 1-indexed rows and columns; row 0 / column 0 are the algorithm's virtual start node
+    costs = torch.zeros((batch_sz, n + 1, m + 1), dtype=dtype, device=device)
+    for b, c in enumerate(cost_tensors):
+        costs[b, 1:(c.shape[0] + 1), 1:(c.shape[1] + 1)] = c.detach().to(dtype)
+    n_rows = torch.tensor([s[0] for s in shapes], device=device)
+    col_idxs = torch.arange(m + 1, device=device)
+    padded_cols = col_idxs[None, :] > torch.tensor([s[1] for s in shapes], device=device)[:, None]
+    batch_idxs = torch.arange(batch_sz, device=device)
+    inf = torch.tensor(float('inf'), dtype=dtype, device=device)
+
+    u = torch.zeros((batch_sz, n + 1), dtype=dtype, device=device)  # row potentials
+    v = torch.zeros((batch_sz, m + 1), dtype=dtype, device=device)  # column potentials
+    p = torch.zeros((batch_sz, m + 1), dtype=torch.long, device=device)  # row assigned to each column
+    way = torch.zeros((batch_sz, m + 1), dtype=torch.long, device=device)
+
+    for i in range(1, n + 1):
+        active = n_rows >= i  # problems that still have a row i to assign
+        p[:, 0] = i
+        j0 = torch.zeros((batch_sz,), dtype=torch.long, device=device)
+        minv = inf.expand(batch_sz, m + 1).clone()
+        used = padded_cols.clone()
+        searching = active.clone()
+        while searching.any():
+            used[batch_idxs[searching], j0[searching]] = True
+            i0 = p[batch_idxs, j0]
+            reduced_costs = costs[batch_idxs, i0, :] - u[batch_idxs, i0][:, None] - v
+            improves = searching[:, None] & ~used & (reduced_costs < minv)
+            minv = torch.where(improves, reduced_costs, minv)
+            way = torch.where(improves, j0[:, None].expand_as(way), way)
+            delta, j1 = torch.where(used, inf, minv).min(dim=1)
+            delta = torch.where(searching, delta, torch.zeros_like(delta))
+
+            # Update potentials along the visited tree
+            visited_delta = torch.where(used & searching[:, None], delta[:, None], torch.zeros_like(v))
+            u.scatter_add_(1, p, visited_delta)
+            v -= visited_delta
+            minv = torch.where(~used & searching[:, None], minv - delta[:, None], minv)
+
+            j0 = torch.where(searching, j1, j0)
+            searching = searching & (p[batch_idxs, j0] != 0)
+
+        # Augment along the path found for each problem
+        augmenting = active.clone()
+        while augmenting.any():
+            j1 = way[batch_idxs, j0]
+            p[batch_idxs[augmenting], j0[augmenting]] = p[batch_idxs[augmenting], j1[augmenting]]
+            j0 = torch.where(augmenting, j1, j0)
+            augmenting = augmenting & (j0 != 0)
+
+    col_ind = torch.zeros((batch_sz, n + 1), dtype=torch.long, device=device)
+    assigned_b, assigned_j = torch.nonzero(p[:, 1:] != 0, as_tuple=True)
+    col_ind[assigned_b, p[assigned_b, assigned_j + 1]] = assigned_j
+    return [col_ind[b, 1:(n_pred + 1)] for b, (n_pred, _) in enumerate(shapes)]
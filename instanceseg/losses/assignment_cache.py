@@ -0,0 +1,119 @@
+"""
+Reuses the assignment of an (image, semantic class) problem from an earlier iteration when it is still optimal.
+
+On a miss, we store the optimal assignment together with column potentials v that certify it: with
+u_i = c[i, col(i)] - v[col(i)], the reduced costs c[i, j] - u_i - v_j are all >= 0 (dual feasibility; the assignment
+satisfies complementary slackness by construction).  The next time the same image comes around, checking that the
+reduced costs of the *new* cost matrix are still >= 0 is O(n_pred * n_gt) -- if so, the cached assignment is optimal
+and the problem is not solved again.  The potentials are the midpoint of the extreme dual solutions, so they keep as
+much slack as possible for the costs to drift between epochs.
+
+Entries are keyed by (image id, semantic value), so the cache holds at most one entry per problem of the dataset; the
+hash of the image's labels is kept in the entry, and an entry stored for other labels (e.g. - another random crop) is a
+miss and is replaced.
+"""
+import hashlib
+
+import numpy as np
+
+
+def label_hash(sem_lbl, inst_lbl):
+    """
+    Content hash of one image's labels (tensors or arrays, on the host)
+    """
+    h = hashlib.md5()
+    for lbl in (sem_lbl, inst_lbl):
+        lbl = lbl.numpy() if hasattr(lbl, 'numpy') else np.asarray(lbl)
+        h.update(str(lbl.shape).encode())
+        h.update(np.ascontiguousarray(lbl).tobytes())
+    return h.hexdigest()
+
+
+def _column_difference_constraints(cost_array, col_ind):
+    """
+    Optimality of col_ind <=> there are column potentials v with v[b] - v[a] <= w[a, b] for all columns a, b:
+        reassigning row i from column a = col_ind[i] to b: w[a, b] = c[i, b] - c[i, a]
+        unassigned columns a (taken by zero-cost slack rows): w[a, b] = 0
+    """
+    n_pred, n_gt = cost_array.shape
+    w = np.full((n_gt, n_gt), np.inf)
+    col_ind = np.asarray(col_ind)
+    w[col_ind, :] = cost_array - cost_array[np.arange(n_pred), col_ind][:, None]
+    unassigned = np.ones(n_gt, dtype=bool)
+    unassigned[col_ind] = False
+    w[unassigned, :] = 0
+    np.fill_diagonal(w, 0)
+    return w
+
+
+def get_central_column_potentials(cost_array, col_ind):
+    """
+    Midpoint of the largest (<= 0) and smallest (>= 0) solutions of the difference constraints, both found with
+    Bellman-Ford.  Returns None if col_ind is not optimal (negative cycle).
+    """
+    w = _column_difference_constraints(cost_array.astype(np.float64), col_ind)
+    n_gt = w.shape[0]
+    upper, lower = np.zeros(n_gt), np.zeros(n_gt)
+    for potentials, relax in ((upper, lambda p: np.min(p[:, None] + w, axis=0)),
+                              (lower, lambda p: np.max(p[None, :] - w, axis=1))):
+        for _ in range(n_gt + 1):
+            relaxed = relax(potentials)
+            updated = np.minimum(potentials, relaxed) if potentials is upper else np.maximum(potentials, relaxed)
+            if np.array_equal(updated, potentials):
+                break
+            potentials[...] = updated
+        else:
+            return None
+    return (upper + lower) / 2
+
+
+def is_still_optimal(cost_array, col_ind, column_potentials, rtol=1e-6):
+    """
+    Reduced-cost dual feasibility check of col_ind on cost_array with the cached column potentials.
+    """
+    n_pred, n_gt = cost_array.shape
+    if column_potentials is None or len(column_potentials) != n_gt or len(col_ind) != n_pred:
+        return False
+    tol = rtol * max(1.0, float(np.abs(cost_array).max()))
+    col_ind = np.asarray(col_ind)
+    v = column_potentials
+    u = cost_array[np.arange(n_pred), col_ind] - v[col_ind]
+    if np.min(cost_array - u[:, None] - v[None, :]) < -tol:
+        return False
+    unassigned = np.ones(n_gt, dtype=bool)
+    unassigned[col_ind] = False
+    # Slack rows (cost 0) sit on the unassigned columns: their potentials must be the largest
+    return not unassigned.any() or np.max(v) <= np.min(v[unassigned]) + tol
+
+
+class AssignmentCache(object):
+    def __init__(self):
+        self.entries = {}  # (image id, sem_val) -> (label hash, col_ind, column_potentials)
+        self.n_hits = 0
+        self.n_misses = 0
+        self.time_saved = 0.0  # estimated seconds of solving skipped (net of the time spent checking)
+        self.last_n_hits = 0
+        self.last_n_misses = 0
+
+    def lookup(self, key, lbl_hash, cost_array):
+        """
+        Returns the cached assignment if it was stored for the same labels and is still optimal for cost_array, else
+        None
+        """
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == lbl_hash and is_still_optimal(cost_array, *entry[1:]):
+            return entry[1]
+        return None
+
+    def store(self, key, lbl_hash, cost_array, col_ind):
+        self.entries[key] = (lbl_hash, list(col_ind), get_central_column_potentials(cost_array, col_ind))
+
+    def record_batch(self, n_hits, n_misses, time_saved):
+        self.last_n_hits, self.last_n_misses = n_hits, n_misses
+        self.n_hits += n_hits
+        self.n_misses += n_misses
+        self.time_saved += time_saved
+
+    def get_stats(self):
+        return {'hits': self.last_n_hits, 'misses': self.last_n_misses, 'total_hits': self.n_hits,
+                'total_misses': self.n_misses, 'time_saved': self.time_saved}
@@ -0,0 +1,148 @@
+"""
+One pass over an image's labels and predictions that every loss term reads from.  The image is split into segments,
+one per (semantic value, instance value) pair present (void included), and we accumulate
+    areas (n_seg,): number of pixels in each segment
+    segment_sums (C, n_seg): sum of each prediction channel inside each segment
+    totals (C,): sum of each prediction channel over the image
+The matching cost matrices, the semantic aggregate term and the non-matching loss are all functions of these sums (see
+ComponentMatchingLossBase.component_loss_from_segment_sums), so the full-resolution work happens once per image
+instead of once per (channel, instance) pair, and the only host sync is reading back the list of segments.
+"""
+import torch
+
+from instanceseg.losses.match import GT_VALUE_FOR_FALSE_POSITIVE, pad_false_positive_columns
+
+VOID_VALS = (255, -1)
+# Dense (bincount) segment keys are used while the key range is at most this many times the number of pixels;
+# beyond that (e.g. - raw instance ids), torch.unique is cheaper than allocating the bins.
+MAX_KEY_BINS_PER_PIXEL = 4
+
+
+def get_pixel_segment_keys(flat_sem_lbl, flat_inst_lbl):
+    """
+    Returns the segment index of each pixel, and the semantic value, instance value and area of each segment.
+    Segments are sorted by (semantic value, instance value).
+    """
+    sem_min, sem_max, inst_min, inst_max = torch.stack([
+        flat_sem_lbl.min().long(), flat_sem_lbl.max().long(), flat_inst_lbl.min().long(), flat_inst_lbl.max().long()
+    ]).tolist()
+    inst_range = inst_max - inst_min + 1
+    n_bins = (sem_max - sem_min + 1) * inst_range
+    keys = (flat_sem_lbl.long() - sem_min) * inst_range + (flat_inst_lbl.long() - inst_min)
+    if n_bins <= MAX_KEY_BINS_PER_PIXEL * keys.numel():
+        counts = torch.bincount(keys, minlength=n_bins)
+        present = counts > 0
+        pixel_segment_idx = (torch.cumsum(present, dim=0) - 1)[keys]
+        segment_keys, areas = torch.nonzero(present)[:, 0], counts[present]
+    else:
+        segment_keys, pixel_segment_idx, areas = torch.unique(keys, return_inverse=True, return_counts=True)
+    return pixel_segment_idx, segment_keys // inst_range + sem_min, segment_keys % inst_range + inst_min, areas
+
+
+class InstanceStatistics(object):
+    def __init__(self, segment_sem_vals, segment_inst_vals, areas, segment_sums, totals):
+        self.areas = areas
+        self.segment_sums = segment_sums
+        self.totals = totals
+        # The one host sync: which segments are present (and their areas, for the normalizer)
+        self.segment_sem_vals, self.segment_inst_vals, area_list = \
+            torch.stack([segment_sem_vals, segment_inst_vals, areas.long()]).tolist()
+        self.segment_idx = {(s, i): idx for idx, (s, i) in enumerate(zip(self.segment_sem_vals,
+                                                                          self.segment_inst_vals))}
+        self.n_non_void_pixels = sum(a for i, a in zip(self.segment_inst_vals, area_list) if i >= 0)
+
+    @property
+    def n_segments(self):
+        return len(self.segment_sem_vals)
+
+    def get_normalizer(self, size_average):
+        """
+        Same as match.get_cost_normalizer
+        """
+        return self.n_non_void_pixels if size_average else 1
+
+    def get_gt_inst_vals(self, sem_val, void_vals=VOID_VALS):
+        """
+        Sorted instance values present in sem_val (void excluded) and their segment indices
+        """
+        idxs = [idx for idx, (s, i) in enumerate(zip(self.segment_sem_vals, self.segment_inst_vals))
+                if s == sem_val and i not in void_vals]
+        return [self.segment_inst_vals[idx] for idx in idxs], idxs
+
+    def get_cost_matrix_sums(self, model_channels, sem_val, void_vals=VOID_VALS):
+        """
+        segment_sums (n_pred, n_gt), areas (n_gt,), totals (n_pred,) for the cost matrix of sem_val (see
+        match.compute_segment_sums), and the padded ground truth instance values of its columns.
+        """
+        gt_inst_vals_present, idxs = self.get_gt_inst_vals(sem_val, void_vals)
+        n_pred = len(model_channels)
+        if len(gt_inst_vals_present) < n_pred:
+            gt_inst_vals_present += [GT_VALUE_FOR_FALSE_POSITIVE] * (n_pred - len(gt_inst_vals_present))
+        channels = torch.tensor(model_channels, dtype=torch.long, device=self.segment_sums.device)
+        segment_idxs = torch.tensor(idxs, dtype=torch.long, device=self.segment_sums.device)
+        segment_sums = self.segment_sums[channels][:, segment_idxs]
+        areas = self.areas[segment_idxs].to(segment_sums.dtype)
+        segment_sums, areas = pad_false_positive_columns(segment_sums, areas, len(gt_inst_vals_present))
+        return segment_sums, areas, self.totals[channels], gt_inst_vals_present
+
+    def get_semantic_sums(self, channel_to_semantic_matrix, semantic_vals):
+        """
+        (S,) sums of the semantic predictions (channels summed by channel_to_semantic_matrix) inside their own semantic
+        mask, (S,) semantic mask areas and (S,) semantic prediction totals
+        """
+        sem_idx = {sem_val: s for s, sem_val in enumerate(semantic_vals)}
+        n_sem_cls = len(semantic_vals)
+        # Segments of other classes / void go to a dump row n_sem_cls
+        segment_sem_idx = torch.tensor([sem_idx.get(s, n_sem_cls) for s in self.segment_sem_vals], dtype=torch.long,
+                                       device=self.segment_sums.device)
+        channel_to_semantic_matrix = channel_to_semantic_matrix.to(self.segment_sums)
+        sem_segment_sums = torch.matmul(channel_to_semantic_matrix, self.segment_sums)  # (S, n_seg)
+        own_sem_sums = sem_segment_sums.gather(0, segment_sem_idx.clamp(max=n_sem_cls - 1)[None, :])[0, :]
+        segment_sums = own_sem_sums.new_zeros((n_sem_cls + 1,)).index_add(0, segment_sem_idx, own_sem_sums)
+        areas = self.areas.new_zeros((n_sem_cls + 1,)).index_add(0, segment_sem_idx, self.areas)
+        totals = torch.matmul(channel_to_semantic_matrix, self.totals)
+        return segment_sums[:n_sem_cls], areas[:n_sem_cls].to(segment_sums.dtype), totals
+
+    def get_channel_sums(self, channel_sem_vals, channel_inst_vals):
+        """
+        (C,) sum of each channel inside the segment of its own (semantic value, instance value), (C,) areas of those
+        segments (0 if absent) and (C,) totals
+        """
+        idxs = [self.segment_idx.get((s, i), self.n_segments) for s, i in zip(channel_sem_vals, channel_inst_vals)]
+        idxs = torch.tensor(idxs, dtype=torch.long, device=self.segment_sums.device)
+        padded_sums = torch.cat([self.segment_sums, self.segment_sums.new_zeros((self.segment_sums.size(0), 1))],
+                                dim=1)
+        padded_areas = torch.cat([self.areas, self.areas.new_zeros((1,))]).to(padded_sums.dtype)
+        return padded_sums.gather(1, idxs[:, None])[:, 0], padded_areas[idxs], self.totals
+
+
+def compute_instance_statistics(predictions, sem_lbl, inst_lbl):
+    """
+    predictions: (C, H, W); sem_lbl, inst_lbl: (H, W)
+    """
+    n_channels = predictions.size(0)
+    flat_predictions = predictions.reshape(n_channels, -1)
+    pixel_segment_idx, segment_sem_vals, segment_inst_vals, areas = get_pixel_segment_keys(
+        sem_lbl.reshape(-1), inst_lbl.reshape(-1))
+    segment_sums = flat_predictions.new_zeros((n_channels, len(areas))).index_add(1, pixel_segment_idx,
+                                                                                  flat_predictions)
+    return InstanceStatistics(segment_sem_vals, segment_inst_vals, areas, segment_sums, flat_predictions.sum(dim=1))
+
+
+def create_pytorch_cost_matrix_from_instance_statistics(segment_component_loss_fcn, instance_stats,
+                                                        model_channel_semantic_ids, sem_val, size_average=True,
+                                                        void_vals=VOID_VALS):
+    """
+    Same cost matrix as match.create_pytorch_cost_matrix_from_segment_sums, read from the image's shared
+    InstanceStatistics instead of another pass over the image.
+    """
+    model_channels_for_this_cls = [i for i, s in enumerate(model_channel_semantic_ids) if s == sem_val]
+    segment_sums, areas, totals, gt_inst_vals_present = instance_stats.get_cost_matrix_sums(
+        model_channels_for_this_cls, sem_val, void_vals)
+    normalizer = instance_stats.get_normalizer(size_average)
+    if normalizer == 0:
+        cost_tensor = torch.zeros(segment_sums.shape, device=segment_sums.device)
+        print(Warning('WARNING: image contained all void class. Setting error to 0 for all channels.'))
+    else:
+        cost_tensor = segment_component_loss_fcn(segment_sums, areas, totals).float() / normalizer
+    return cost_tensor, model_channels_for_this_cls, gt_inst_vals_present
@@ -18,13 +18,10 @@ except ImportError:  # py3k
 
 def my_soft_iou_loss(predictions_as_probabilities, binary_target):
     num_nonzero_pixels = binary_target.sum()
-    # if num_nonzero_pixels.data.item() == 0:
     assert torch.numel(num_nonzero_pixels) == 1
-    if num_nonzero_pixels.item() == 0:
-        return num_nonzero_pixels
-        # return Variable(type(predictions_as_probabilities)([0]))  # 0 in the correct format (tensor, variable)
-    else:
-        return 1.0 - my_soft_iou(predictions_as_probabilities, binary_target)
+    # Empty targets have a loss of 0; selected on the device (no .item() sync per instance)
+    return torch.where(num_nonzero_pixels > 0, 1.0 - my_soft_iou(predictions_as_probabilities, binary_target),
+                       torch.zeros_like(num_nonzero_pixels, dtype=predictions_as_probabilities.dtype))
 
 
 def my_soft_iou(predictions_as_probabilities, binary_target):
@@ -38,7 +35,20 @@ def my_soft_iou(predictions_as_probabilities, binary_target):
     union_per_pixel = (pp + bt) - intersection_per_pixel
     ## Sum over all pixels N x C x H x W => N x C
     union = union_per_pixel.sum()
-    return intersection / union
+    return intersection / union.clamp(min=torch.finfo(union.dtype).tiny)
+
+
+def my_soft_iou_loss_from_segment_sums(intersections, areas, totals):
+    """
+    Vectorized my_soft_iou_loss for every (prediction, ground truth) pair at once.
+    intersections: (..., n_pred, n_gt) sum of predicted probabilities inside each gt mask
+    areas: (..., n_gt) number of pixels in each gt mask
+    totals: (..., n_pred) sum of predicted probabilities over the image
+    """
+    unions = totals[..., :, None] + areas[..., None, :] - intersections
+    losses = 1.0 - intersections / unions.clamp(min=torch.finfo(unions.dtype).tiny)
+    # Empty ground truth masks have a loss of 0 (matches my_soft_iou_loss)
+    return torch.where(areas[..., None, :] > 0, losses, torch.zeros_like(losses))
 
 
 def lovasz_grad(gt_sorted):
@@ -2,7 +2,10 @@ import numpy as np
 import torch
 from torch.nn import functional as F
 
-from instanceseg.losses import match
+from instanceseg.losses import match, sinkhorn
+from instanceseg.losses.assignment_cache import AssignmentCache
+from instanceseg.losses.instance_statistics import compute_instance_statistics, \
+    create_pytorch_cost_matrix_from_instance_statistics
 from instanceseg.losses import xentropy, iou
 from instanceseg.losses.xentropy import DEBUG_ASSERTS
 
@@ -21,14 +24,27 @@ def get_subclasses(cls):
 #                                     for loss_class in get_subclasses(ComponentMatchingLossBase)}
 
 
-def loss_object_factory(loss_type, model_channel_semantic_ids, instance_id_count_list, matching, size_average):
+def loss_object_factory(loss_type, model_channel_semantic_ids, instance_id_count_list, matching, size_average,
+                        cost_matrix_engine='loop', matching_solver_workers=0, matching_solver_backend='scipy',
+                        matching_mode='hungarian', sinkhorn_config=None, cost_matrix_chunk_bytes=None,
+                        assignment_cache=False):
     assert loss_type in LOSS_TYPES, 'Loss type must be one of {}; not {}'.format(LOSS_TYPES, loss_type)
     if loss_type == 'cross_entropy' or loss_type == 'xent':
         loss_object = CrossEntropyComponentMatchingLoss(model_channel_semantic_ids, instance_id_count_list, matching,
-                                                        size_average)
+                                                        size_average, cost_matrix_engine=cost_matrix_engine,
+                                                        matching_solver_workers=matching_solver_workers,
+                                                        matching_solver_backend=matching_solver_backend,
+                                                        matching_mode=matching_mode, sinkhorn_config=sinkhorn_config,
+                                                        cost_matrix_chunk_bytes=cost_matrix_chunk_bytes,
+                                                        assignment_cache=assignment_cache)
     elif loss_type == 'soft_iou':
         loss_object = SoftIOUComponentMatchingLoss(model_channel_semantic_ids, instance_id_count_list, matching,
-                                                   size_average)
+                                                   size_average, cost_matrix_engine=cost_matrix_engine,
+                                                   matching_solver_workers=matching_solver_workers,
+                                                   matching_solver_backend=matching_solver_backend,
+                                                   matching_mode=matching_mode, sinkhorn_config=sinkhorn_config,
+                                                   cost_matrix_chunk_bytes=cost_matrix_chunk_bytes,
+                                                   assignment_cache=assignment_cache)
     else:
         raise NotImplementedError
     return loss_object
@@ -41,12 +57,13 @@ class ComponentLossAbstractInterface(object):
     An agreed upon interface -- the minimum requirements for creating a loss function that works with our trainer.
     """
 
-    def loss_fcn(self, scores, sem_lbl, inst_lbl):
+    def loss_fcn(self, scores, sem_lbl, inst_lbl, image_keys=None):
         """
         inputs:
          scores: NxCxHxW
          sem_lbl: NxHxW
          inst_lbl: NxHxW
+         image_keys: optional, one (image id, label hash) pair per image (see assignment_cache.label_hash)
 
         return:
          LossMatchAssignments
@@ -62,53 +79,154 @@ class ComponentLossAbstractInterface(object):
 
 
 class LossMatchAssignments(AttrDict):
-    def __init__(self, model_channels, assigned_gt_inst_vals, sem_values, unassigned_gt_sem_inst_tuples):
-        # super(LossMatchAssignments, self).__init__(self)
-        n_channels = model_channels.shape[1]
-        assert assigned_gt_inst_vals.shape[1] == n_channels
-        assert sem_values.shape[1] == n_channels
-        self.model_channels = model_channels.long()  # torch.empty((0, n_channels))
-        self.assigned_gt_inst_vals = assigned_gt_inst_vals  # torch.empty((0, n_channels))
-        self.sem_values = sem_values  # torch.empty((0, n_channels))
-        self.unassigned_gt_sem_inst_tuples = unassigned_gt_sem_inst_tuples
+    """
+    Packed (struct-of-arrays) assignments of a batch -- or a whole split -- of images.  Assignment k belongs to image
+    i for offsets[i] <= k < offsets[i + 1], sorted by channel within each image:
+        channels[k] (int16): model channel
+        gt_inst_vals[k] (int32): ground truth instance value assigned to it (GT_VALUE_FOR_FALSE_POSITIVE if none)
+        sem_vals[k] (int16): its semantic value
+        costs[k] (float32): its loss component (detached)
+    Ground truth instances that were left unassigned (unmatched, or removed by cap_sizes) are packed the same way in
+    unassigned_sem_vals, unassigned_gt_inst_vals and unassigned_offsets.  All arrays are cpu tensors, so numpy() and
+    get_image() return views that share their memory.
+    """
+    def __init__(self, channels, gt_inst_vals, sem_vals, costs, offsets, unassigned_sem_vals, unassigned_gt_inst_vals,
+                 unassigned_offsets):
+        assert channels.shape == gt_inst_vals.shape == sem_vals.shape == costs.shape
+        assert offsets[-1] == channels.shape[0] and unassigned_offsets[-1] == unassigned_sem_vals.shape[0]
+        assert len(offsets) == len(unassigned_offsets)
+        self.channels = channels.to(torch.int16)
+        self.gt_inst_vals = gt_inst_vals.to(torch.int32)
+        self.sem_vals = sem_vals.to(torch.int16)
+        self.costs = costs.to(torch.float32)
+        self.offsets = offsets.long()
+        self.unassigned_sem_vals = unassigned_sem_vals.to(torch.int16)
+        self.unassigned_gt_inst_vals = unassigned_gt_inst_vals.to(torch.int32)
+        self.unassigned_offsets = unassigned_offsets.long()
+
+    @staticmethod
+    def _pack_by_image(n_images, image_idxs, sort_keys, *arrays):
+        """
+        Sorts the flat arrays by (image, sort_keys) and returns them with the per-image offsets.
+        """
+        image_idxs = torch.as_tensor(image_idxs, dtype=torch.long)
+        order = torch.from_numpy(np.lexsort((np.asarray(sort_keys), image_idxs.numpy())))
+        offsets = torch.zeros(n_images + 1, dtype=torch.long)
+        offsets[1:] = torch.cumsum(torch.bincount(image_idxs, minlength=n_images), dim=0)
+        return [offsets] + [torch.as_tensor(a)[order] for a in arrays]
 
     @classmethod
-    def allocate(cls, n_images, n_channels):
-        model_channels = torch.empty((n_images, n_channels), dtype=torch.long)
-        assigned_gt_inst_vals = torch.empty((n_images, n_channels))  # torch.empty((0, n_channels))
-        sem_values = torch.empty((n_images, n_channels))
-        unassigned_gt_sem_inst_tuples = [[] for _ in range(n_images)]
-        return cls(model_channels=model_channels,
-                   assigned_gt_inst_vals=assigned_gt_inst_vals,
-                   sem_values=sem_values,
-                   unassigned_gt_sem_inst_tuples=unassigned_gt_sem_inst_tuples)
+    def pack(cls, n_images, image_idxs, channels, gt_inst_vals, sem_vals, costs, unassigned_image_idxs=(),
+             unassigned_sem_vals=(), unassigned_gt_inst_vals=()):
+        """
+        Vectorized insertion: builds the packed assignments from flat (unsorted) per-assignment arrays.
+        """
+        offsets, channels, gt_inst_vals, sem_vals, costs = cls._pack_by_image(
+            n_images, image_idxs, channels, torch.as_tensor(channels, dtype=torch.int16),
+            torch.as_tensor(gt_inst_vals, dtype=torch.int32), torch.as_tensor(sem_vals, dtype=torch.int16),
+            torch.as_tensor(costs, dtype=torch.float32))
+        unassigned_offsets, unassigned_sem_vals, unassigned_gt_inst_vals = cls._pack_by_image(
+            n_images, unassigned_image_idxs, np.zeros(len(unassigned_image_idxs)),
+            torch.as_tensor(unassigned_sem_vals, dtype=torch.int16),
+            torch.as_tensor(unassigned_gt_inst_vals, dtype=torch.int32))
+        return cls(channels, gt_inst_vals, sem_vals, costs, offsets, unassigned_sem_vals, unassigned_gt_inst_vals,
+                   unassigned_offsets)
 
     @classmethod
     def assemble(cls, list_of_loss_match_assignments):
-        model_channels = torch.cat([lma.model_channels for lma in list_of_loss_match_assignments], dim=0)
-        assigned_gt_inst_vals = torch.cat([lma.assigned_gt_inst_vals for lma in list_of_loss_match_assignments], dim=0)
-        sem_values = torch.cat([lma.sem_values for lma in list_of_loss_match_assignments], dim=0)
-        unassigned_gt_sem_inst_tuples = []
-        for lma in list_of_loss_match_assignments:
-            unassigned_gt_sem_inst_tuples.extend(lma.unassigned_gt_sem_inst_tuples)
-        assembled_assignments = cls(model_channels=model_channels,
-                                    assigned_gt_inst_vals=assigned_gt_inst_vals,
-                                    sem_values=sem_values,
-                                    unassigned_gt_sem_inst_tuples=unassigned_gt_sem_inst_tuples)
-        return assembled_assignments
-
-    def insert_assignment_for_image(self, image_index, model_channels, assigned_gt_inst_vals, sem_values,
-                                    unassigned_gt_sem_inst_tuples):
-        self.model_channels[image_index, :] = model_channels  # torch.empty((0, n_channels))
-        self.assigned_gt_inst_vals[image_index, :] = assigned_gt_inst_vals  # torch.empty((0, n_channels))
-        self.sem_values[image_index, :] = sem_values  # torch.empty((0, n_channels))
-        self.unassigned_gt_sem_inst_tuples[image_index] = unassigned_gt_sem_inst_tuples
+        def cat_offsets(name):
+            offsets, shift = [torch.zeros(1, dtype=torch.long)], 0
+            for lma in list_of_loss_match_assignments:
+                offsets.append(getattr(lma, name)[1:] + shift)
+                shift += int(getattr(lma, name)[-1])
+            return torch.cat(offsets)
+
+        def cat(name):
+            return torch.cat([getattr(lma, name) for lma in list_of_loss_match_assignments])
+
+        return cls(cat('channels'), cat('gt_inst_vals'), cat('sem_vals'), cat('costs'), cat_offsets('offsets'),
+                   cat('unassigned_sem_vals'), cat('unassigned_gt_inst_vals'), cat_offsets('unassigned_offsets'))
+
+    @property
+    def n_images(self):
+        return len(self.offsets) - 1
+
+    def slice_images(self, start, stop):
+        """
+        Assignments of images start, ..., stop - 1 (views, no copies)
+        """
+        a0, a1 = int(self.offsets[start]), int(self.offsets[stop])
+        u0, u1 = int(self.unassigned_offsets[start]), int(self.unassigned_offsets[stop])
+        return self.__class__(self.channels[a0:a1], self.gt_inst_vals[a0:a1], self.sem_vals[a0:a1],
+                              self.costs[a0:a1], self.offsets[start:stop + 1] - a0, self.unassigned_sem_vals[u0:u1],
+                              self.unassigned_gt_inst_vals[u0:u1], self.unassigned_offsets[start:stop + 1] - u0)
+
+    def add_unassigned(self, image_idxs, sem_vals, gt_inst_vals):
+        """
+        Vectorized insertion of more unassigned ground truth instances (e.g. - those removed by cap_sizes)
+        """
+        n_per_image = self.unassigned_offsets[1:] - self.unassigned_offsets[:-1]
+        existing_image_idxs = torch.repeat_interleave(torch.arange(self.n_images), n_per_image)
+        image_idxs = torch.cat([existing_image_idxs, torch.as_tensor(image_idxs, dtype=torch.long)])
+        self.unassigned_offsets, self.unassigned_sem_vals, self.unassigned_gt_inst_vals = self._pack_by_image(
+            self.n_images, image_idxs, np.arange(len(image_idxs)),
+            torch.cat([self.unassigned_sem_vals, torch.as_tensor(sem_vals, dtype=torch.int16)]),
+            torch.cat([self.unassigned_gt_inst_vals, torch.as_tensor(gt_inst_vals, dtype=torch.int32)]))
+
+    def numpy(self):
+        """
+        Zero-copy numpy views of the packed arrays
+        """
+        return {name: getattr(self, name).numpy() for name in (
+            'channels', 'gt_inst_vals', 'sem_vals', 'costs', 'offsets', 'unassigned_sem_vals',
+            'unassigned_gt_inst_vals', 'unassigned_offsets')}
+
+    def get_image(self, image_idx):
+        """
+        numpy views of one image's assignments (channels, gt_inst_vals, sem_vals, costs, unassigned_sem_vals,
+        unassigned_gt_inst_vals)
+        """
+        a0, a1 = int(self.offsets[image_idx]), int(self.offsets[image_idx + 1])
+        u0, u1 = int(self.unassigned_offsets[image_idx]), int(self.unassigned_offsets[image_idx + 1])
+        return AttrDict({'channels': self.channels[a0:a1].numpy(), 'gt_inst_vals': self.gt_inst_vals[a0:a1].numpy(),
+                         'sem_vals': self.sem_vals[a0:a1].numpy(), 'costs': self.costs[a0:a1].numpy(),
+                         'unassigned_sem_vals': self.unassigned_sem_vals[u0:u1].numpy(),
+                         'unassigned_gt_inst_vals': self.unassigned_gt_inst_vals[u0:u1].numpy()})
+
+    def _as_image_by_channel(self, packed):
+        n_per_image = self.offsets[1:] - self.offsets[:-1]
+        assert self.n_images == 0 or bool(torch.all(n_per_image == n_per_image[0])), \
+            'Images have different numbers of channels; use get_image instead'
+        return packed.reshape(self.n_images, -1)
+
+    # N x C views (every image has one assignment per model channel)
+    @property
+    def model_channels(self):
+        return self._as_image_by_channel(self.channels).long()
+
+    @property
+    def assigned_gt_inst_vals(self):
+        return self._as_image_by_channel(self.gt_inst_vals)
+
+    @property
+    def sem_values(self):
+        return self._as_image_by_channel(self.sem_vals)
+
+    @property
+    def unassigned_gt_sem_inst_tuples(self):
+        """
+        Unpacked: a list of (sem_val, inst_val) tuples per image
+        """
+        sem_vals, inst_vals = self.unassigned_sem_vals.tolist(), self.unassigned_gt_inst_vals.tolist()
+        offsets = self.unassigned_offsets.tolist()
+        return [list(zip(sem_vals[o0:o1], inst_vals[o0:o1])) for o0, o1 in zip(offsets[:-1], offsets[1:])]
 
 
 class MatchingLossResult(AttrDict):
     def __init__(self, total_channel_loss=None, assignments: LossMatchAssignments = None,
                  loss_components_by_channel=None, sem_agg_loss=None,
-                 loss_components_by_sem_cls=None, avg_loss=None, total_loss=None, semantic_vals=None):
+                 loss_components_by_sem_cls=None, avg_loss=None, total_loss=None, semantic_vals=None,
+                 matching_solve_time=None, matching_diagnostics=None, assignment_cache_stats=None):
         self.avg_loss = avg_loss
         self.total_channel_loss = total_channel_loss
         self.assignments = assignments
@@ -119,6 +237,9 @@ class MatchingLossResult(AttrDict):
         self.loss_components_by_sem_cls = loss_components_by_sem_cls
         self.semantic_vals = semantic_vals
         self.loss_components_by_channel = loss_components_by_channel
+        self.matching_solve_time = matching_solve_time  # seconds spent solving the assignment problems for the batch
+        self.matching_diagnostics = matching_diagnostics  # soft matching vs. exact assignment (see sinkhorn.py)
+        self.assignment_cache_stats = assignment_cache_stats  # see AssignmentCache.get_stats
 
 
 class ComponentMatchingLossBase(ComponentLossAbstractInterface):
@@ -129,18 +250,51 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
     loss_type = None
 
     def __init__(self, model_channel_semantic_ids=None, model_channel_instance_ids=None, matching=True,
-                 size_average=True, semantic_agg_multiplier=DEFAULT_SEM_AGG_MULT):
+                 size_average=True, semantic_agg_multiplier=DEFAULT_SEM_AGG_MULT, cost_matrix_engine='loop',
+                 matching_solver_workers=0, matching_solver_backend='scipy', matching_mode='hungarian',
+                 sinkhorn_config=None, cost_matrix_chunk_bytes=None, assignment_cache=False):
+        """
+        cost_matrix_engine: 'loop' calls component_loss once per (prediction, ground truth) pair; 'segment' builds
+            the whole cost matrix from per-instance segment sums, read from the InstanceStatistics pass shared with
+            the other loss terms (see instance_statistics.py)
+        matching_solver_workers: number of threads solving the assignment problems of a batch (0: serial)
+        matching_solver_backend: 'scipy' or 'torch' (see match.MatchingSolverPool)
+        matching_mode: 'hungarian' assigns each prediction channel to one ground truth instance; 'sinkhorn' weights
+            the cost matrix with an entropy-regularized soft assignment (see sinkhorn.py)
+        sinkhorn_config: sinkhorn.SinkhornConfig (temperature, iterations, annealing, diagnostics)
+        cost_matrix_chunk_bytes: bounds the temporaries of the 'segment' cost matrix engine by accumulating over pixel
+            chunks (see match.compute_segment_sums_chunked); None: whole image at once
+        assignment_cache: reuse an image's assignment from earlier iterations when it is provably still optimal
+            (see assignment_cache.py); needs image_keys in loss_fcn
+        """
+        assert cost_matrix_engine in match.COST_MATRIX_ENGINES, \
+            'Cost matrix engine must be one of {}; not {}'.format(match.COST_MATRIX_ENGINES, cost_matrix_engine)
+        assert matching_mode in match.MATCHING_MODES, \
+            'Matching mode must be one of {}; not {}'.format(match.MATCHING_MODES, matching_mode)
+        assert cost_matrix_chunk_bytes is None or cost_matrix_engine == 'segment', \
+            'cost_matrix_chunk_bytes is only supported by the segment cost matrix engine'
         if matching:
             assert model_channel_semantic_ids is not None and model_channel_instance_ids is not None, ValueError(
                 'We need semantic and instance ids to perform matching')
         self.matching = matching
         self.model_channel_semantic_ids = model_channel_semantic_ids
         self.unique_semantic_values = sorted([s for s in np.unique(model_channel_semantic_ids)])
+        # channel_to_semantic_matrix[s, c] = 1 if channel c belongs to semantic class unique_semantic_values[s]
+        self.channel_to_semantic_matrix = torch.tensor(
+            [[float(s == sem_val) for s in model_channel_semantic_ids] for sem_val in self.unique_semantic_values]) \
+            if model_channel_semantic_ids is not None else None
         self.model_channel_instance_ids = model_channel_instance_ids
         self.size_average = size_average
         if self.loss_type is None:
             raise NotImplementedError('Loss type should be defined in subclass of {}'.format(__class__))
         self.semantic_agg_multiplier = semantic_agg_multiplier
+        self.cost_matrix_engine = cost_matrix_engine
+        self.cost_matrix_chunk_bytes = cost_matrix_chunk_bytes
+        self.matching_solver = match.MatchingSolverPool(
+            n_workers=matching_solver_workers, backend=matching_solver_backend,
+            assignment_cache=AssignmentCache() if assignment_cache else None)
+        self.matching_mode = matching_mode
+        self.soft_matcher = sinkhorn.SinkhornMatcher(sinkhorn_config) if matching_mode == 'sinkhorn' else None
 
     def transform_scores_to_predictions(self, scores):
         """
@@ -155,55 +309,94 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
     def component_loss(self, single_channel_prediction, binary_target):
         raise NotImplementedError
 
-    def compute_agg_semantic_component(self, predictions, sem_lbl, inst_lbl):
+    def component_loss_from_segment_sums(self, segment_sums, areas, totals):
+        """
+        Vectorized component_loss for all (prediction, ground truth) pairs of a semantic class.
+        segment_sums: (n_pred, n_gt) sum of each prediction channel inside each gt mask
+        areas: (n_gt,) number of pixels in each gt mask
+        totals: (n_pred,) sum of each prediction channel over the image
+        All three may have leading batch dimensions.
+        """
+        raise NotImplementedError
+
+    def compute_agg_semantic_component(self, predictions, sem_lbl, inst_lbl, instance_stats=None):
         """
         Note: predictions should be 'preprocessed' -- take softmax / log as needed for whatever form
             single_class_component_loss_fcn expects.
         Note: returned loss components indexed by ground truth order
+
+        Channels are summed into their semantic class with one matmul (channel_to_semantic_matrix), and the component
+        loss of every (image, semantic class) pair is evaluated at once from segment sums (see
+        component_loss_from_segment_sums).  instance_stats: per-image InstanceStatistics to read the sums from
+        (see get_instance_statistics) instead of another pass over the images.
         """
         sem_vals = self.unique_semantic_values
-        batch_sz = predictions.size(0)
-        loss_components_per_sem_cls = torch.empty((batch_sz, len(sem_vals)))
-        for batch_idx in range(batch_sz):
+        batch_sz, n_sem_cls = predictions.size(0), len(sem_vals)
+        if instance_stats is not None:
+            segment_sums, areas, totals = [torch.stack(sums) for sums in zip(*[
+                stats.get_semantic_sums(self.channel_to_semantic_matrix, sem_vals) for stats in instance_stats])]
+            loss_components_per_sem_cls = self.component_loss_from_segment_sums(
+                segment_sums[:, :, None, None], areas[:, :, None], totals[:, :, None]).reshape(batch_sz, n_sem_cls)
             if self.size_average:
-                # TODO(allie): Verify this is correct (and not sem_lbl >=0, or some combo)
-                normalizer = (inst_lbl[batch_idx, ...] >= 0).data.sum()
-            else:
-                normalizer = 1.0
-            for sem_idx, sem_val in enumerate(sem_vals):
-                assert int(sem_val) == sem_val
-                sem_val = int(sem_val)
-                model_channels_for_this_cls = [i for i, sem_inst_val in enumerate(self.model_channel_semantic_ids)
-                                               if sem_inst_val == sem_val]
-
-                loss_components_per_sem_cls[batch_idx, sem_idx] = self.component_loss(
-                    (predictions[batch_idx, model_channels_for_this_cls, ...].sum(dim=0)).float(),
-                    (sem_lbl[batch_idx, ...] == sem_val).float()) / normalizer
+                normalizer = torch.tensor([stats.get_normalizer(self.size_average) for stats in instance_stats],
+                                          device=loss_components_per_sem_cls.device)
+                loss_components_per_sem_cls = loss_components_per_sem_cls / normalizer[:, None].float()
+            return loss_components_per_sem_cls.sum(), loss_components_per_sem_cls, sem_vals
+
+        sem_predictions = torch.matmul(self.channel_to_semantic_matrix.to(predictions.device),
+                                       predictions.float().reshape(batch_sz, predictions.size(1), -1))
+
+        # Pixel -> index of its semantic class; pixels of other classes / void go to an extra 'dump' column n_sem_cls
+        flat_sem_lbl = sem_lbl.reshape(batch_sz, -1)
+        if sem_vals == list(range(sem_vals[0], sem_vals[0] + n_sem_cls)):
+            pixel_sem_idx = flat_sem_lbl.long() - int(sem_vals[0])
+            in_sem_cls = (pixel_sem_idx >= 0) & (pixel_sem_idx < n_sem_cls)
+        else:
+            vals = torch.tensor(sem_vals, dtype=flat_sem_lbl.dtype, device=flat_sem_lbl.device)
+            pixel_sem_idx = torch.searchsorted(vals, flat_sem_lbl.contiguous()).clamp(max=n_sem_cls - 1)
+            in_sem_cls = vals[pixel_sem_idx] == flat_sem_lbl
+        pixel_sem_idx = torch.where(in_sem_cls, pixel_sem_idx, torch.full_like(pixel_sem_idx, n_sem_cls))
+
+        # Sum of each semantic prediction inside its own semantic mask; every (image, class) pair is a 1x1 problem
+        segment_sums = torch.zeros((batch_sz, n_sem_cls + 1), dtype=sem_predictions.dtype,
+                                   device=sem_predictions.device)
+        segment_sums = segment_sums.scatter_add(1, pixel_sem_idx,
+                                                sem_predictions.gather(1, pixel_sem_idx.clamp(
+                                                    max=n_sem_cls - 1)[:, None, :])[:, 0, :])
+        areas = torch.zeros_like(segment_sums).scatter_add(
+            1, pixel_sem_idx, torch.ones_like(pixel_sem_idx, dtype=segment_sums.dtype))
+        totals = sem_predictions.sum(dim=2)
+        loss_components_per_sem_cls = self.component_loss_from_segment_sums(
+            segment_sums[:, :n_sem_cls, None, None], areas[:, :n_sem_cls, None], totals[:, :, None]).reshape(
+            batch_sz, n_sem_cls)
+        if self.size_average:
+            # TODO(allie): Verify this is correct (and not sem_lbl >=0, or some combo)
+            normalizer = (inst_lbl.reshape(batch_sz, -1) >= 0).sum(dim=1)
+            loss_components_per_sem_cls = loss_components_per_sem_cls / normalizer[:, None].float()
 
         total_agg_sem_loss = loss_components_per_sem_cls.sum()
         return total_agg_sem_loss, loss_components_per_sem_cls, sem_vals
 
-    def compute_matching_channel_loss(self, predictions, sem_lbl, inst_lbl):
+    def get_instance_statistics(self, predictions, sem_lbl, inst_lbl):
+        """
+        One InstanceStatistics pass per image, shared by all loss terms (see instance_statistics.py).  None with
+        cost_matrix_chunk_bytes, which bounds memory by never holding whole-image temporaries.
+        """
+        if self.cost_matrix_chunk_bytes is not None:
+            return None
+        return [compute_instance_statistics(predictions[i, ...], sem_lbl[i, ...], inst_lbl[i, ...])
+                for i in range(predictions.size(0))]
+
+    def compute_matching_channel_loss(self, predictions, sem_lbl, inst_lbl, image_keys=None, instance_stats=None):
         """
         Note: predictions should be 'preprocessed' -- take softmax / log as needed for whatever form
             single_class_component_loss_fcn expects.
         Note: returned loss components indexed by ground truth order
+        instance_stats: see get_instance_statistics; used by the 'segment' cost matrix engine
         """
-        # Allocate memory
-        batch_sz, n_channels = predictions.size(0), predictions.size(1)
-
-        loss_components_per_channel = torch.empty((batch_sz, n_channels))
-        # []  # dataset_utils.zeros_like(log_predictions, (n, c))
-        assignments = LossMatchAssignments.allocate(n_images=batch_sz, n_channels=n_channels)
-
-        # Compute optimal match & costs for each image in the batch
-        for i in range(batch_sz):
-            assignment_values, costs = \
-                self._compute_optimal_match_loss_single_img(predictions[i, ...], sem_lbl[i, ...], inst_lbl[i, ...])
-            assignments.insert_assignment_for_image(i, **assignment_values)
-            loss_components_per_channel[i, :] = costs
-            # all_costs.append(costs)
-        # all_costs = torch.cat([c[None, :] for c in all_costs], dim=0).float()
+        # Compute optimal match & costs for each image in the batch (assignment problems are solved together)
+        assignments, loss_components_per_channel = self._compute_optimal_match_loss_batch(
+            predictions, sem_lbl, inst_lbl, image_keys, instance_stats)
         total_train_loss = loss_components_per_channel.sum()
         if DEBUG_ASSERTS:
             if loss_components_per_channel.size(1) != len(self.model_channel_semantic_ids):
@@ -216,9 +409,21 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
         sem_val, inst_val = self.model_channel_semantic_ids[channel_idx], self.model_channel_instance_ids[channel_idx]
         return ((sem_lbl == sem_val) * (inst_lbl == inst_val)).float()
 
-    def compute_nonmatching_loss(self, predictions, sem_lbl, inst_lbl):
+    def compute_nonmatching_loss(self, predictions, sem_lbl, inst_lbl, instance_stats=None):
         # Allocate memory
         batch_sz, n_channels = predictions.size(0), predictions.size(1)
+        if instance_stats is not None:
+            # Each channel against the segment of its own (semantic, instance) value, all channels at once
+            normalizer = sum(stats.get_normalizer(self.size_average) for stats in instance_stats) \
+                if self.size_average else 1.0
+            loss_components_per_channel = []
+            for stats in instance_stats:
+                own_segment_sums, own_areas, totals = stats.get_channel_sums(self.model_channel_semantic_ids,
+                                                                             self.model_channel_instance_ids)
+                loss_components_per_channel.append(self.component_loss_from_segment_sums(
+                    own_segment_sums[:, None, None], own_areas[:, None], totals[:, None]).reshape(n_channels))
+            loss_components_per_channel = torch.stack(loss_components_per_channel) / normalizer
+            return None, loss_components_per_channel.sum(), loss_components_per_channel
         unassigned_val = -10
         loss_components_per_channel = unassigned_val * torch.empty((batch_sz, n_channels))
         n_channels = len(self.model_channel_semantic_ids)
@@ -237,7 +442,7 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
             assert torch.all(loss_components_per_channel != unassigned_val)
         return None, loss_components_per_channel.sum(), loss_components_per_channel
 
-    def loss_fcn(self, scores, sem_lbl, inst_lbl):
+    def loss_fcn(self, scores, sem_lbl, inst_lbl, image_keys=None):
         """
         # component_channels: NxC  we expect channels[i, ...] = range(C), but we put this here to be sure.
         # component_sem_vals: NxC  corresponding semantic values for each pred/gt channel
@@ -249,19 +454,37 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
         """
 
         predictions = self.transform_scores_to_predictions(scores)
+        instance_stats = self.get_instance_statistics(predictions, sem_lbl, inst_lbl)
         if self.matching:
             assignments, total_channel_loss, loss_components_by_channel = \
-                self.compute_matching_channel_loss(predictions, sem_lbl, inst_lbl)
+                self.compute_matching_channel_loss(predictions, sem_lbl, inst_lbl, image_keys, instance_stats)
         else:
             assignments, total_channel_loss, loss_components_by_channel = \
-                self.compute_nonmatching_loss(predictions, sem_lbl, inst_lbl)
+                self.compute_nonmatching_loss(predictions, sem_lbl, inst_lbl, instance_stats)
         total_agg_sem_loss, loss_components_per_sem_cls, sem_vals = \
-            self.compute_agg_semantic_component(predictions, sem_lbl, inst_lbl)
+            self.compute_agg_semantic_component(predictions, sem_lbl, inst_lbl, instance_stats)
         total_loss = total_channel_loss + self.semantic_agg_multiplier * total_agg_sem_loss
         return MatchingLossResult(sem_agg_loss=total_agg_sem_loss, total_channel_loss=total_channel_loss,
                                   total_loss=total_loss, assignments=assignments, semantic_vals=sem_vals,
                                   loss_components_by_channel=loss_components_by_channel,
-                                  loss_components_by_sem_cls=loss_components_per_sem_cls)
+                                  loss_components_by_sem_cls=loss_components_per_sem_cls,
+                                  matching_solve_time=self.get_matching_solve_time() if self.matching else None,
+                                  matching_diagnostics=self.soft_matcher.last_diagnostics
+                                  if self.matching and self.soft_matcher is not None else None,
+                                  assignment_cache_stats=self.matching_solver.assignment_cache.get_stats()
+                                  if self.matching and image_keys is not None and
+                                  self.matching_solver.assignment_cache is not None else None)
+
+    def step(self):
+        """
+        Call once per training iteration: advances the soft matching's annealing schedule
+        """
+        if self.soft_matcher is not None:
+            self.soft_matcher.step()
+
+    def get_matching_solve_time(self):
+        matcher = self.soft_matcher if self.matching_mode == 'sinkhorn' else self.matching_solver
+        return matcher.last_solve_time
 
     def _compute_optimal_match_loss_single_img(self, predictions, sem_lbl, inst_lbl):
         """
@@ -274,39 +497,85 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
          matches.
         costs -- cost of each of the matches (also length C)
         """
-        # print('APD: inside compute_optimal_match_loss_single_img')
-        model_channel_semantic_ids = self.model_channel_semantic_ids
-        C = predictions.size(0)
-        assert len(model_channel_semantic_ids) == C, \
+        assert len(self.model_channel_semantic_ids) == predictions.size(0), \
             'first dimension of predictions should be the number of channels.  It is {} instead. ' \
             'Are you trying to pass an entire batch into the loss function?'.format(predictions.size(0))
-        costs = -1 * torch.ones((C,))
-        model_channels = torch.empty((C,), dtype=torch.long)
-        sem_values = torch.empty((C,))
-        assigned_gt_inst_values = torch.empty((C,))
-        unassigned_gt_sem_inst_tuples = []
-        for sem_val in self.unique_semantic_values:
-            assert int(sem_val) == sem_val
-            sem_val = int(sem_val)
-            # print('APD: Running on sem_val {}'.format(sem_val))
-            costs_this_cls, model_channels_for_this_cls, assigned_gt_inst_vals_this_cls, \
-            unassigned_gt_inst_vals_this_cls = \
-                self._compute_optimal_match_loss_for_one_sem_cls(predictions, sem_lbl, inst_lbl, sem_val)
-            channel_idxs = torch.LongTensor(model_channels_for_this_cls)
-            model_channels[channel_idxs] = channel_idxs
-            costs[channel_idxs] = costs_this_cls
-            assigned_gt_inst_values[channel_idxs] = torch.FloatTensor(assigned_gt_inst_vals_this_cls)
-            sem_values[channel_idxs] = sem_val
-            unassigned_gt_sem_inst_tuples.extend([(sem_val, iv) for iv in unassigned_gt_inst_vals_this_cls])
+        assignments, costs = self._compute_optimal_match_loss_batch(predictions[None, ...], sem_lbl[None, ...],
+                                                                    inst_lbl[None, ...])
+        return assignments, costs[0, :]
+
+    def _compute_optimal_match_loss_batch(self, predictions, sem_lbl, inst_lbl, image_keys=None, instance_stats=None):
+        """
+        predictions: N,C,H,W
+        Returns the packed LossMatchAssignments of the batch and the costs (N,C) of each channel.
+        Cost matrices for every (image, semantic class) pair are built first and handed to the matching solver as
+        one batch.  In 'sinkhorn' mode, each channel's cost is its row of the cost matrix weighted by the soft
+        assignment, and the reported assignment is the hardened (row argmax) one.
+        image_keys: see loss_fcn; lets the matching solver reuse cached assignments.
+        instance_stats: see get_instance_statistics
+        """
+        batch_sz, C = predictions.size(0), predictions.size(1)
+        assert len(self.model_channel_semantic_ids) == C, \
+            'second dimension of predictions should be the number of channels.  It is {} instead.'.format(C)
+        # When chunking, select channels with one unbind per image, so the backward pass of each semantic class only
+        # produces gradients for its own channels (instead of a full-size gradient per image and class)
+        image_predictions = [p.unbind(0) for p in predictions.unbind(0)] if self.cost_matrix_chunk_bytes is not None \
+            else predictions
+        matching_problems = []
+        for i in range(batch_sz):
+            for sem_val in self.unique_semantic_values:
+                assert int(sem_val) == sem_val
+                sem_val = int(sem_val)
+                cost_tensor, model_channels_for_this_cls, gt_inst_vals_present = \
+                    self.build_cost_tensor_for_one_sem_cls(image_predictions[i], sem_lbl[i, ...], inst_lbl[i, ...],
+                                                           sem_val, None if instance_stats is None else
+                                                           instance_stats[i])
+                requires_assignment = self.requires_assignment(sem_val, cost_tensor, model_channels_for_this_cls,
+                                                               gt_inst_vals_present)
+                matching_problems.append((i, sem_val, cost_tensor, model_channels_for_this_cls,
+                                          gt_inst_vals_present, requires_assignment))
+        cost_tensors_to_solve = [p[2] for p in matching_problems if p[-1]]
+        if self.matching_mode == 'sinkhorn':
+            soft_assignments, solved_col_inds = self.soft_matcher.solve(cost_tensors_to_solve)
+            soft_assignments = iter(soft_assignments)
+        else:
+            cache_keys, label_hashes = None, None
+            if image_keys is not None:
+                cache_keys = [(image_keys[p[0]][0], p[1]) for p in matching_problems if p[-1]]
+                label_hashes = [image_keys[p[0]][1] for p in matching_problems if p[-1]]
+            solved_col_inds = self.matching_solver.solve(cost_tensors_to_solve, cache_keys=cache_keys,
+                                                         label_hashes=label_hashes)
+        solved_col_inds = iter(solved_col_inds)
+
+        costs = -1 * torch.ones((batch_sz, C), device=predictions.device)
+        assigned_costs_by_problem = []
+        image_idxs, channels, assigned_gt_inst_vals, sem_values = [], [], [], []
+        unassigned_image_idxs, unassigned_sem_vals, unassigned_gt_inst_vals = [], [], []
+        for i, sem_val, cost_tensor, model_channels_for_this_cls, gt_inst_vals_present, requires_assignment in \
+                matching_problems:
+            assigned_col_inds = next(solved_col_inds) if requires_assignment else None
+            costs_this_cls, assigned_gt_inst_vals_this_cls, unassigned_gt_inst_vals_this_cls = \
+                self._get_assigned_costs(cost_tensor, gt_inst_vals_present, assigned_col_inds)
+            if requires_assignment and self.matching_mode == 'sinkhorn':
+                costs_this_cls = (next(soft_assignments) * cost_tensor).sum(dim=1)
+            assigned_costs_by_problem.append(costs_this_cls.reshape(-1))
+            image_idxs += [i] * len(model_channels_for_this_cls)
+            channels += model_channels_for_this_cls
+            assigned_gt_inst_vals += [int(v) for v in assigned_gt_inst_vals_this_cls]
+            sem_values += [sem_val] * len(model_channels_for_this_cls)
+            unassigned_image_idxs += [i] * len(unassigned_gt_inst_vals_this_cls)
+            unassigned_sem_vals += [sem_val] * len(unassigned_gt_inst_vals_this_cls)
+            unassigned_gt_inst_vals += [int(v) for v in unassigned_gt_inst_vals_this_cls]
+        flat_idxs = torch.tensor(image_idxs, dtype=torch.long) * C + torch.tensor(channels, dtype=torch.long)
+        costs = costs.reshape(-1).index_put((flat_idxs.to(costs.device),),
+                                            torch.cat(assigned_costs_by_problem).to(costs.dtype)).reshape(batch_sz, C)
         assert torch.all(costs != -1)  # costs for all channels were filled
-        assignment_values = {
-            'model_channels': model_channels,
-            'assigned_gt_inst_vals': assigned_gt_inst_values,
-            'sem_values': sem_values,
-            'unassigned_gt_sem_inst_tuples': unassigned_gt_sem_inst_tuples
-        }
 
-        return assignment_values, costs
+        assignments = LossMatchAssignments.pack(
+            batch_sz, image_idxs, channels, assigned_gt_inst_vals, sem_values,
+            costs.detach().reshape(-1)[flat_idxs.to(costs.device)].cpu(), unassigned_image_idxs=unassigned_image_idxs,
+            unassigned_sem_vals=unassigned_sem_vals, unassigned_gt_inst_vals=unassigned_gt_inst_vals)
+        return assignments, costs
 
     def has_channel0(self, sem_val):
         instance_ids_this_sem_val = [ch_id for ch_id, sv in zip(self.model_channel_instance_ids,
@@ -324,6 +593,18 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
     def _compute_optimal_match_loss_for_one_sem_cls(self, predictions, sem_lbl, inst_lbl, sem_val):
         cost_tensor, model_channels_for_this_cls, gt_inst_vals_present = self.build_cost_tensor_for_one_sem_cls(
             predictions, sem_lbl, inst_lbl, sem_val)
+        if self.requires_assignment(sem_val, cost_tensor, model_channels_for_this_cls, gt_inst_vals_present):
+            assigned_col_inds = match.solve_matching_problem(cost_tensor, backend=self.matching_solver.backend)
+        else:
+            assigned_col_inds = None
+        costs, assigned_gt_inst_vals, unassigned_gt_inst_vals = self._get_assigned_costs(
+            cost_tensor, gt_inst_vals_present, assigned_col_inds)
+        return costs, model_channels_for_this_cls, assigned_gt_inst_vals, unassigned_gt_inst_vals
+
+    def requires_assignment(self, sem_val, cost_tensor, model_channels_for_this_cls, gt_inst_vals_present):
+        """
+        False if the class is semantic according to the model (a single channel/instance, nothing to match)
+        """
         if self.is_semantic(sem_val):  # Only one channel each -- instance values are 0 for both
             assert len(gt_inst_vals_present) == 1
             assert gt_inst_vals_present[0] == 0 or gt_inst_vals_present[0] == match.GT_VALUE_FOR_FALSE_POSITIVE, \
@@ -331,35 +612,56 @@ class ComponentMatchingLossBase(ComponentLossAbstractInterface):
             assert len(model_channels_for_this_cls) == 1, 'Debug error'
             assert self.model_channel_instance_ids[model_channels_for_this_cls[0]] == 0, 'Debug error'
             assert cost_tensor.shape == torch.Size((1, 1)), 'Cost tensor should have been 1x1 for semantic class'
-            # costs = cost_tensor[0:1, 0:1]  # :1 to maintain shape
-            costs = cost_tensor
-            assigned_gt_inst_vals = gt_inst_vals_present
-            unassigned_gt_inst_vals = []
+            return False
         elif self.has_channel0(sem_val):
             raise NotImplementedError
         elif 0 in gt_inst_vals_present:
             raise Exception('Did not expect gt to have inst value 0 when I dont have a channel 0')
+        return True
+
+    @staticmethod
+    def _get_assigned_costs(cost_tensor, gt_inst_vals_present, assigned_col_inds):
+        """
+        assigned_col_inds: column of the cost tensor assigned to each row, or None for a semantic class.
+        """
+        if assigned_col_inds is None:
+            # costs = cost_tensor[0:1, 0:1]  # :1 to maintain shape
+            costs = cost_tensor
+            assigned_gt_inst_vals = gt_inst_vals_present
+            unassigned_gt_inst_vals = []
         else:
-            assigned_col_inds = match.solve_matching_problem(cost_tensor)
             assigned_gt_inst_vals = [gt_inst_vals_present[col_ind] for col_ind in assigned_col_inds]
             if len(assigned_col_inds) == len(gt_inst_vals_present):
                 unassigned_gt_inst_vals = []
             else:
                 unassigned_gt_inst_vals = [v for v in gt_inst_vals_present if v not in assigned_gt_inst_vals]
-                assert (len(unassigned_gt_inst_vals) + len(assigned_gt_inst_vals)) == len(gt_inst_vals_present), \
-                    'Debug error'
+                if len(set(assigned_col_inds)) == len(assigned_col_inds):  # hardened soft assignments may collide
+                    assert (len(unassigned_gt_inst_vals) + len(assigned_gt_inst_vals)) == len(gt_inst_vals_present), \
+                        'Debug error'
 
             costs = cost_tensor[range(cost_tensor.shape[0]), assigned_col_inds]
+        return costs, assigned_gt_inst_vals, unassigned_gt_inst_vals
 
-        return costs, model_channels_for_this_cls, assigned_gt_inst_vals, unassigned_gt_inst_vals
-
-    def build_cost_tensor_for_one_sem_cls(self, predictions, sem_lbl, inst_lbl, sem_val):
+    def build_cost_tensor_for_one_sem_cls(self, predictions, sem_lbl, inst_lbl, sem_val, instance_stats=None):
         """
         Creates cost_tensor[prediction, ground_truth]
+        instance_stats: the image's InstanceStatistics; the 'segment' engine reads from it when given
         """
-        cost_tensor, model_channels_for_this_cls, gt_inst_vals_present = match.create_pytorch_cost_matrix(
-            self.component_loss, predictions, sem_lbl, inst_lbl,
-            self.model_channel_semantic_ids, sem_val, size_average=self.size_average)
+        if self.cost_matrix_engine == 'segment' and instance_stats is not None:
+            cost_tensor, model_channels_for_this_cls, gt_inst_vals_present = \
+                create_pytorch_cost_matrix_from_instance_statistics(
+                    self.component_loss_from_segment_sums, instance_stats, self.model_channel_semantic_ids, sem_val,
+                    size_average=self.size_average)
+        elif self.cost_matrix_engine == 'segment':
+            cost_tensor, model_channels_for_this_cls, gt_inst_vals_present = \
+                match.create_pytorch_cost_matrix_from_segment_sums(
+                    self.component_loss_from_segment_sums, predictions, sem_lbl, inst_lbl,
+                    self.model_channel_semantic_ids, sem_val, size_average=self.size_average,
+                    max_chunk_bytes=self.cost_matrix_chunk_bytes)
+        else:
+            cost_tensor, model_channels_for_this_cls, gt_inst_vals_present = match.create_pytorch_cost_matrix(
+                self.component_loss, predictions, sem_lbl, inst_lbl,
+                self.model_channel_semantic_ids, sem_val, size_average=self.size_average)
         return cost_tensor, model_channels_for_this_cls, gt_inst_vals_present
 
 
@@ -367,9 +669,13 @@ class CrossEntropyComponentMatchingLoss(ComponentMatchingLossBase):
     loss_type = 'cross_entropy'
 
     def __init__(self, model_channel_semantic_ids=None, model_channel_instance_ids=None, matching=True,
-                 size_average=True, semantic_agg_multiplier=DEFAULT_SEM_AGG_MULT):
+                 size_average=True, semantic_agg_multiplier=DEFAULT_SEM_AGG_MULT, cost_matrix_engine='loop',
+                 matching_solver_workers=0, matching_solver_backend='scipy', matching_mode='hungarian',
+                 sinkhorn_config=None, cost_matrix_chunk_bytes=None, assignment_cache=False):
         super().__init__(model_channel_semantic_ids, model_channel_instance_ids, matching, size_average,
-                         semantic_agg_multiplier)
+                         semantic_agg_multiplier, cost_matrix_engine, matching_solver_workers,
+                         matching_solver_backend, matching_mode, sinkhorn_config, cost_matrix_chunk_bytes,
+                         assignment_cache)
 
     def transform_scores_to_predictions(self, scores):
         assert len(scores.size()) == 4
@@ -378,16 +684,23 @@ class CrossEntropyComponentMatchingLoss(ComponentMatchingLossBase):
     def component_loss(self, single_channel_prediction, binary_target):
         return xentropy.nll2d_single_class_term(single_channel_prediction, binary_target)
 
+    def component_loss_from_segment_sums(self, segment_sums, areas, totals):
+        return xentropy.nll2d_from_segment_sums(segment_sums)
+
 
 class SoftIOUComponentMatchingLoss(ComponentMatchingLossBase):
     loss_type = 'soft_iou'
 
     def __init__(self, model_channel_semantic_ids=None, model_channel_instance_ids=None, matching=True,
-                 size_average=False, semantic_agg_multiplier=DEFAULT_SEM_AGG_MULT):
+                 size_average=False, semantic_agg_multiplier=DEFAULT_SEM_AGG_MULT, cost_matrix_engine='loop',
+                 matching_solver_workers=0, matching_solver_backend='scipy', matching_mode='hungarian',
+                 sinkhorn_config=None, cost_matrix_chunk_bytes=None, assignment_cache=False):
         if size_average:
             raise Exception('Pretty sure you didn\'t want size_average to be True since it\'s already embedded in iou.')
         super().__init__(model_channel_semantic_ids, model_channel_instance_ids, matching, size_average,
-                         semantic_agg_multiplier)
+                         semantic_agg_multiplier, cost_matrix_engine, matching_solver_workers,
+                         matching_solver_backend, matching_mode, sinkhorn_config, cost_matrix_chunk_bytes,
+                         assignment_cache)
 
     def transform_scores_to_predictions(self, scores):
         assert len(scores.size()) == 4
@@ -395,3 +708,6 @@ class SoftIOUComponentMatchingLoss(ComponentMatchingLossBase):
 
     def component_loss(self, single_channel_prediction, binary_target):
         return iou.my_soft_iou_loss(single_channel_prediction, binary_target)
+
+    def component_loss_from_segment_sums(self, segment_sums, areas, totals):
+        return iou.my_soft_iou_loss_from_segment_sums(segment_sums, areas, totals)
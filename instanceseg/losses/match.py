@@ -1,6 +1,10 @@
+import concurrent.futures
+import time
+
 import numpy as np
 from scipy import optimize
 
+from instanceseg.losses import assignment
 from instanceseg.losses.xentropy import DEBUG_ASSERTS
 from instanceseg.models.model_utils import is_nan
 from instanceseg.utils.misc import get_logger
@@ -15,25 +19,167 @@ logger = get_logger(name='match', file='/tmp/debug_match.txt')
 
 GT_VALUE_FOR_FALSE_POSITIVE = -2
 
+COST_MATRIX_ENGINES = ['loop', 'segment']
+MATCHING_SOLVER_BACKENDS = ['scipy', 'torch']
+MATCHING_MODES = ['hungarian', 'sinkhorn']
+
 # TODO(allie): Test different normalization schemes
 # TODO(allie): Allow for more target (gt) channels than prediction channels
 
 
-def solve_matching_problem(cost_tensor: torch.Tensor):
+def solve_matching_problem(cost_tensor: torch.Tensor, backend='scipy'):
     """
     Returns matching assignment, sorted by row index.
+    backend: 'scipy' (linear_sum_assignment on the host) or 'torch' (assignment.batched_linear_sum_assignment on the
+        cost tensor's device)
     """
+    assert backend in MATCHING_SOLVER_BACKENDS, \
+        'Matching solver backend must be one of {}; not {}'.format(MATCHING_SOLVER_BACKENDS, backend)
     if torch is not None:
         assert type(cost_tensor) is np.ndarray or torch.is_tensor(cost_tensor)
     else:
         assert type(cost_tensor) is np.ndarray
-    cost_tensor_for_assignment = cost_tensor.detach() if cost_tensor.requires_grad else cost_tensor
-    row_ind, col_ind = optimize.linear_sum_assignment(cost_tensor_for_assignment)
+    if backend == 'torch':
+        cost_tensor = torch.from_numpy(cost_tensor) if type(cost_tensor) is np.ndarray else cost_tensor
+        return assignment.batched_linear_sum_assignment([cost_tensor])[0].tolist()
+    cost_tensor_for_assignment = cost_tensor if type(cost_tensor) is np.ndarray else cost_tensor.detach().cpu().numpy()
+    return _solve_numpy_matching_problem(cost_tensor_for_assignment)
+
+
+def _solve_numpy_matching_problem(cost_array):
+    row_ind, col_ind = optimize.linear_sum_assignment(cost_array)
     ind_idxs_sorted_by_row = np.argsort(row_ind)
     col_ind = [col_ind[idx] for idx in ind_idxs_sorted_by_row]
     return col_ind
 
 
+def cost_tensors_to_numpy(cost_tensors):
+    """
+    Moves a list of (possibly differently-sized) cost tensors to the host with a single device-to-host copy.
+    """
+    if len(cost_tensors) == 0:
+        return []
+    flat_costs = torch.cat([c.detach().reshape(-1).float() for c in cost_tensors]).cpu().numpy()
+    cost_arrays, start = [], 0
+    for c in cost_tensors:
+        n_rows, n_cols = c.shape
+        cost_arrays.append(flat_costs[start:(start + n_rows * n_cols)].reshape(n_rows, n_cols))
+        start += n_rows * n_cols
+    return cost_arrays
+
+
+def assignment_tensors_to_lists(col_ind_tensors):
+    """
+    Copies a list of assignment index tensors to the host with a single transfer.
+    """
+    if len(col_ind_tensors) == 0:
+        return []
+    flat_col_inds = torch.cat(col_ind_tensors).cpu().tolist()
+    col_inds, start = [], 0
+    for c in col_ind_tensors:
+        col_inds.append(flat_col_inds[start:(start + c.numel())])
+        start += c.numel()
+    return col_inds
+
+
+class MatchingSolverPool(object):
+    """
+    Solves a batch of assignment problems (e.g. - every (image, semantic class) pair in a minibatch) at once.
+    backend == 'scipy': n_workers == 0 solves serially in the calling thread; otherwise a persistent thread pool is
+        used (scipy's linear_sum_assignment releases the GIL while solving).
+    backend == 'torch': all problems are solved together on the cost tensors' device; only the assignments are copied
+        to the host.
+    """
+
+    def __init__(self, n_workers=0, backend='scipy', assignment_cache=None):
+        """
+        assignment_cache: assignment_cache.AssignmentCache; problems solved with cache_keys reuse the cached assignment
+            when it is still optimal
+        """
+        assert backend in MATCHING_SOLVER_BACKENDS, \
+            'Matching solver backend must be one of {}; not {}'.format(MATCHING_SOLVER_BACKENDS, backend)
+        self.n_workers = n_workers
+        self.backend = backend
+        self.assignment_cache = assignment_cache
+        self._executor = None
+        self.last_solve_time = None
+        self.total_solve_time = 0.0
+        self.n_batches_solved = 0
+        self.mean_problem_solve_time = None  # running average, used to estimate the time saved by the cache
+
+    @property
+    def executor(self):
+        if self._executor is None and self.n_workers > 0:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.n_workers)
+        return self._executor
+
+    def solve(self, cost_tensors, cache_keys=None, label_hashes=None):
+        """
+        Returns a list of matching assignments (see solve_matching_problem), one per cost tensor.
+        cache_keys: one hashable key per cost tensor (e.g. - (image id, semantic value)); only used with an
+            assignment_cache
+        label_hashes: one hash per cost tensor of the labels it was built from (see assignment_cache.label_hash)
+        """
+        t_start = time.time()
+        if self.assignment_cache is None or cache_keys is None:
+            col_inds = self._solve_uncached(cost_tensors)
+        else:
+            col_inds = self._solve_with_cache(cost_tensors, cache_keys, label_hashes)
+        self._record_solve_time(time.time() - t_start)
+        return col_inds
+
+    def _solve_uncached(self, cost_tensors, cost_arrays=None):
+        if len(cost_tensors) == 0:
+            return []
+        if self.backend == 'torch':
+            return assignment_tensors_to_lists(assignment.batched_linear_sum_assignment(cost_tensors))
+        cost_arrays = cost_tensors_to_numpy(cost_tensors) if cost_arrays is None else cost_arrays
+        if self.executor is None or len(cost_arrays) < 2:
+            return [_solve_numpy_matching_problem(c) for c in cost_arrays]
+        return list(self.executor.map(_solve_numpy_matching_problem, cost_arrays))
+
+    def _solve_with_cache(self, cost_tensors, cache_keys, label_hashes=None):
+        assert len(cache_keys) == len(cost_tensors)
+        label_hashes = label_hashes if label_hashes is not None else [None] * len(cache_keys)
+        t_start = time.time()
+        cost_arrays = cost_tensors_to_numpy(cost_tensors)
+        col_inds = [self.assignment_cache.lookup(key, lbl_hash, c)
+                    for key, lbl_hash, c in zip(cache_keys, label_hashes, cost_arrays)]
+        misses = [idx for idx, col_ind in enumerate(col_inds) if col_ind is None]
+        t_solve_start = time.time()
+        solved = self._solve_uncached([cost_tensors[idx] for idx in misses], [cost_arrays[idx] for idx in misses])
+        solve_time = time.time() - t_solve_start
+        for idx, col_ind in zip(misses, solved):
+            col_inds[idx] = col_ind
+            self.assignment_cache.store(cache_keys[idx], label_hashes[idx], cost_arrays[idx], col_ind)
+
+        if len(misses) > 0:
+            problem_solve_time = solve_time / len(misses)
+            self.mean_problem_solve_time = problem_solve_time if self.mean_problem_solve_time is None else \
+                0.9 * self.mean_problem_solve_time + 0.1 * problem_solve_time
+        n_hits = len(cost_tensors) - len(misses)
+        overhead = (time.time() - t_start) - solve_time  # lookups, certificates for the new entries
+        self.assignment_cache.record_batch(n_hits, len(misses),
+                                           n_hits * (self.mean_problem_solve_time or 0.0) - overhead)
+        return col_inds
+
+    def _record_solve_time(self, solve_time):
+        self.last_solve_time = solve_time
+        self.total_solve_time += solve_time
+        self.n_batches_solved += 1
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __getstate__(self):
+        # Executors can't be pickled (e.g. - when the loss is sent to DataParallel replicas or saved)
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return state
+
+
 def create_pytorch_cost_matrix(single_class_component_loss_fcn, predictions, sem_lbl, inst_lbl,
                                model_channel_semantic_ids, sem_val, size_average=True, void_vals=(255,-1)):
     """
@@ -61,26 +207,11 @@ def create_pytorch_cost_matrix(single_class_component_loss_fcn, predictions, sem
     if DEBUG_ASSERTS:
         assert inst_lbl.size() == sem_lbl.size()
         assert predictions.size()[1:] == inst_lbl.size()
-    if size_average:
-        # TODO(allie): Verify this is correct (and not sem_lbl >=0, or some combo)
-        normalizer = (inst_lbl >= 0).data.sum()
-    else:
-        normalizer = 1
-    model_channels_for_this_cls = [i for i, sem_inst_val in enumerate(model_channel_semantic_ids)
-                                   if sem_inst_val == sem_val]
-    # inst_id_lbls_for_this_class = [instance_id_labels[i] for i in sem_inst_idxs_for_this_class]
-    # can speed up by using range(torch.max())
-    gt_inst_vals_present = sorted([x.detach().item() for x in torch.unique(inst_lbl[sem_lbl == sem_val])])
-    gt_inst_vals_present = [x for x in gt_inst_vals_present if x not in void_vals]
-    n_pred = len(model_channels_for_this_cls)
-    n_gt = len(gt_inst_vals_present)  # unique takes a long time..
-    if n_gt < n_pred:
-        n_false_extra_predictions = n_pred - n_gt
-        inst_value_not_in_gt = GT_VALUE_FOR_FALSE_POSITIVE  # -2?
-        assert inst_value_not_in_gt not in gt_inst_vals_present
-        gt_inst_vals_present.extend([GT_VALUE_FOR_FALSE_POSITIVE for _ in range(n_false_extra_predictions)])
-        n_gt = n_pred
-    cost_tensor = torch.empty((n_pred, n_gt))
+    normalizer = get_cost_normalizer(inst_lbl, size_average)
+    model_channels_for_this_cls, gt_inst_vals_present = get_channels_and_padded_gt_inst_vals(
+        model_channel_semantic_ids, sem_val, sem_lbl, inst_lbl, void_vals)
+    n_pred, n_gt = len(model_channels_for_this_cls), len(gt_inst_vals_present)
+    cost_tensor = torch.empty((n_pred, n_gt), device=predictions.device)
 
     if normalizer == 0:
         cost_tensor[:, :] = normalizer.detach()
@@ -102,6 +233,184 @@ def create_pytorch_cost_matrix(single_class_component_loss_fcn, predictions, sem
     return cost_tensor, model_channels_for_this_cls, gt_inst_vals_present
 
 
+def create_pytorch_cost_matrix_from_segment_sums(segment_component_loss_fcn, predictions, sem_lbl, inst_lbl,
+                                                 model_channel_semantic_ids, sem_val, size_average=True,
+                                                 void_vals=(255, -1), max_chunk_bytes=None):
+    """
+    Same cost matrix as create_pytorch_cost_matrix, built in one pass instead of one loss call per (prediction,
+    ground truth) pair.  Every pixel gets the index of the ground truth instance it belongs to, and the per-channel
+    score sums inside each instance are accumulated with a single index_add.
+
+    :param segment_component_loss_fcn: f(segment_sums, areas, totals) -> (n_pred, n_gt) losses, where segment_sums is
+        (n_pred, n_gt) sum of predictions inside each gt mask, areas is (n_gt,) and totals is (n_pred,)
+    :param predictions: (C, H, W); with max_chunk_bytes, may also be a sequence of C (H, W) tensors
+    :param max_chunk_bytes: if set, segment sums are accumulated over pixel chunks sized to stay within this many
+        bytes of temporaries (see compute_segment_sums_chunked)
+    :return: see create_pytorch_cost_matrix
+    """
+    if DEBUG_ASSERTS:
+        assert inst_lbl.size() == sem_lbl.size()
+        assert predictions[0].size() == inst_lbl.size()
+    normalizer = get_cost_normalizer(inst_lbl, size_average)
+    model_channels_for_this_cls, gt_inst_vals_present = get_channels_and_padded_gt_inst_vals(
+        model_channel_semantic_ids, sem_val, sem_lbl, inst_lbl, void_vals)
+    n_pred, n_gt = len(model_channels_for_this_cls), len(gt_inst_vals_present)
+
+    if normalizer == 0:
+        cost_tensor = torch.zeros((n_pred, n_gt), device=predictions[0].device)
+        print(Warning('WARNING: image contained all void class. Setting error to 0 for all channels.'))
+    else:
+        if max_chunk_bytes is None:
+            segment_sums, areas, totals = compute_segment_sums(predictions[model_channels_for_this_cls, ...],
+                                                               sem_lbl, inst_lbl, sem_val, gt_inst_vals_present)
+        else:
+            channel_predictions = predictions.unbind(0) if torch.is_tensor(predictions) else predictions
+            segment_sums, areas, totals = compute_segment_sums_chunked(
+                [channel_predictions[c] for c in model_channels_for_this_cls], sem_lbl, inst_lbl, sem_val,
+                gt_inst_vals_present, max_chunk_bytes)
+        cost_tensor = segment_component_loss_fcn(segment_sums, areas, totals).float() / normalizer
+
+    if DEBUG_ASSERTS:
+        assert not torch.any(torch.isnan(cost_tensor)), 'costs reached nan in segment cost matrix'
+    return cost_tensor, model_channels_for_this_cls, gt_inst_vals_present
+
+
+def get_pixel_segment_idx(flat_sem_lbl, flat_inst_lbl, sem_val, real_gt_inst_vals):
+    """
+    Pixel -> column of its gt instance (index into the sorted real_gt_inst_vals tensor); pixels outside all instances
+    go to an extra 'dump' column len(real_gt_inst_vals)
+    """
+    n_real = len(real_gt_inst_vals)
+    pixel_segment_idx = torch.searchsorted(real_gt_inst_vals, flat_inst_lbl) if n_real > 0 else \
+        torch.zeros_like(flat_inst_lbl, dtype=torch.long)
+    clamped_idx = pixel_segment_idx.clamp(max=max(n_real - 1, 0))
+    in_segment = (flat_sem_lbl == sem_val)
+    if n_real > 0:
+        in_segment = in_segment * (real_gt_inst_vals[clamped_idx] == flat_inst_lbl)
+    return torch.where(in_segment, clamped_idx, torch.full_like(clamped_idx, n_real))
+
+
+def pad_false_positive_columns(segment_sums, areas, n_gt):
+    n_pred, n_real = segment_sums.shape
+    if n_gt > n_real:  # false positive columns
+        segment_sums = torch.cat([segment_sums, segment_sums.new_zeros((n_pred, n_gt - n_real))], dim=1)
+        areas = torch.cat([areas, areas.new_zeros((n_gt - n_real,))])
+    return segment_sums, areas
+
+
+def compute_segment_sums(predictions_for_this_cls, sem_lbl, inst_lbl, sem_val, gt_inst_vals):
+    """
+    predictions_for_this_cls: (n_pred, H, W)
+    gt_inst_vals: sorted ground truth instance values, optionally followed by GT_VALUE_FOR_FALSE_POSITIVE padding.
+        Padded columns get zero area and zero sums.
+    Returns segment_sums (n_pred, n_gt), areas (n_gt,), totals (n_pred,)
+    """
+    n_pred = predictions_for_this_cls.size(0)
+    real_gt_inst_vals = [v for v in gt_inst_vals if v != GT_VALUE_FOR_FALSE_POSITIVE]
+    n_real = len(real_gt_inst_vals)
+    flat_predictions = predictions_for_this_cls.reshape(n_pred, -1)
+    vals = torch.tensor(real_gt_inst_vals, dtype=inst_lbl.dtype, device=inst_lbl.device)
+    pixel_segment_idx = get_pixel_segment_idx(sem_lbl.reshape(-1), inst_lbl.reshape(-1), sem_val, vals)
+
+    segment_sums = torch.zeros((n_pred, n_real + 1), dtype=flat_predictions.dtype, device=flat_predictions.device)
+    segment_sums = segment_sums.index_add(1, pixel_segment_idx, flat_predictions)[:, :n_real]
+    areas = torch.bincount(pixel_segment_idx, minlength=n_real + 1)[:n_real].to(flat_predictions.dtype)
+    totals = flat_predictions.sum(dim=1)
+    segment_sums, areas = pad_false_positive_columns(segment_sums, areas, len(gt_inst_vals))
+    return segment_sums, areas, totals
+
+
+def get_pixel_chunk_size(n_pred, element_size, max_chunk_bytes):
+    # Per pixel: the chunk of predictions (or of their gradient), plus ~4 int64 index temporaries
+    bytes_per_pixel = n_pred * element_size + 4 * 8
+    return max(1, int(max_chunk_bytes // bytes_per_pixel))
+
+
+class ChunkedSegmentSums(torch.autograd.Function):
+    """
+    Segment sums accumulated over pixel chunks.  Unlike index_add, nothing pixel-sized is saved for backward: the
+    pixel -> segment indices are recomputed chunk by chunk from the labels.  Takes one (H, W) tensor per channel, so
+    the gradient it returns is only as large as the channels of this semantic class.
+    """
+
+    @staticmethod
+    def forward(ctx, flat_sem_lbl, flat_inst_lbl, sem_val, real_gt_inst_vals, chunk_size, *channel_predictions):
+        n_pred, n_real, n_pixels = len(channel_predictions), len(real_gt_inst_vals), flat_sem_lbl.numel()
+        segment_sums = channel_predictions[0].new_zeros((n_pred, n_real + 1))
+        areas = channel_predictions[0].new_zeros((n_real + 1,))
+        totals = channel_predictions[0].new_zeros((n_pred,))
+        for start in range(0, n_pixels, chunk_size):
+            end = min(start + chunk_size, n_pixels)
+            pixel_segment_idx = get_pixel_segment_idx(flat_sem_lbl[start:end], flat_inst_lbl[start:end], sem_val,
+                                                      real_gt_inst_vals)
+            chunk = torch.stack([c.reshape(-1)[start:end] for c in channel_predictions])
+            segment_sums.index_add_(1, pixel_segment_idx, chunk)
+            areas += torch.bincount(pixel_segment_idx, minlength=n_real + 1).to(areas.dtype)
+            totals += chunk.sum(dim=1)
+        ctx.save_for_backward(flat_sem_lbl, flat_inst_lbl, real_gt_inst_vals)
+        ctx.sem_val, ctx.chunk_size, ctx.channel_shape = sem_val, chunk_size, channel_predictions[0].shape
+        ctx.mark_non_differentiable(areas)
+        return segment_sums[:, :n_real], areas[:n_real], totals
+
+    @staticmethod
+    def backward(ctx, grad_segment_sums, grad_areas, grad_totals):
+        flat_sem_lbl, flat_inst_lbl, real_gt_inst_vals = ctx.saved_tensors
+        n_pred, n_pixels = grad_segment_sums.size(0), flat_sem_lbl.numel()
+        grad_channels = grad_segment_sums.new_empty((n_pred, n_pixels))
+        # The dump column gets no gradient
+        grad_segment_sums = torch.cat([grad_segment_sums, grad_segment_sums.new_zeros((n_pred, 1))], dim=1)
+        for start in range(0, n_pixels, ctx.chunk_size):
+            end = min(start + ctx.chunk_size, n_pixels)
+            pixel_segment_idx = get_pixel_segment_idx(flat_sem_lbl[start:end], flat_inst_lbl[start:end], ctx.sem_val,
+                                                      real_gt_inst_vals)
+            grad_channels[:, start:end] = grad_segment_sums[:, pixel_segment_idx] + grad_totals[:, None]
+        return (None, None, None, None, None) + tuple(g.reshape(ctx.channel_shape) for g in grad_channels)
+
+
+def compute_segment_sums_chunked(channel_predictions, sem_lbl, inst_lbl, sem_val, gt_inst_vals, max_chunk_bytes):
+    """
+    compute_segment_sums over pixel chunks, with the temporaries of each chunk bounded by max_chunk_bytes.
+    channel_predictions: sequence of n_pred (H, W) tensors.  Selecting them with one unbind per image (see
+        ComponentMatchingLossBase._compute_optimal_match_loss_batch) avoids a full-size gradient per semantic class.
+    """
+    real_gt_inst_vals = [v for v in gt_inst_vals if v != GT_VALUE_FOR_FALSE_POSITIVE]
+    vals = torch.tensor(real_gt_inst_vals, dtype=inst_lbl.dtype, device=inst_lbl.device)
+    chunk_size = get_pixel_chunk_size(len(channel_predictions), channel_predictions[0].element_size(), max_chunk_bytes)
+    segment_sums, areas, totals = ChunkedSegmentSums.apply(sem_lbl.reshape(-1), inst_lbl.reshape(-1), sem_val, vals,
+                                                           chunk_size, *channel_predictions)
+    segment_sums, areas = pad_false_positive_columns(segment_sums, areas, len(gt_inst_vals))
+    return segment_sums, areas, totals
+
+
+def get_cost_normalizer(inst_lbl, size_average):
+    if size_average:
+        # TODO(allie): Verify this is correct (and not sem_lbl >=0, or some combo)
+        return (inst_lbl >= 0).data.sum()
+    else:
+        return 1
+
+
+def get_channels_and_padded_gt_inst_vals(model_channel_semantic_ids, sem_val, sem_lbl, inst_lbl, void_vals):
+    """
+    Returns the prediction channels for sem_val and the sorted gt instance values present, padded with
+    GT_VALUE_FOR_FALSE_POSITIVE so there are at least as many columns as rows.
+    """
+    model_channels_for_this_cls = [i for i, sem_inst_val in enumerate(model_channel_semantic_ids)
+                                   if sem_inst_val == sem_val]
+    # inst_id_lbls_for_this_class = [instance_id_labels[i] for i in sem_inst_idxs_for_this_class]
+    # can speed up by using range(torch.max())
+    gt_inst_vals_present = sorted([x.detach().item() for x in torch.unique(inst_lbl[sem_lbl == sem_val])])
+    gt_inst_vals_present = [x for x in gt_inst_vals_present if x not in void_vals]
+    n_pred = len(model_channels_for_this_cls)
+    n_gt = len(gt_inst_vals_present)  # unique takes a long time..
+    if n_gt < n_pred:
+        n_false_extra_predictions = n_pred - n_gt
+        inst_value_not_in_gt = GT_VALUE_FOR_FALSE_POSITIVE  # -2?
+        assert inst_value_not_in_gt not in gt_inst_vals_present
+        gt_inst_vals_present.extend([GT_VALUE_FOR_FALSE_POSITIVE for _ in range(n_false_extra_predictions)])
+    return model_channels_for_this_cls, gt_inst_vals_present
+
+
 def convert_pytorch_costs_to_ints(cost_list_2d_variables, multiplier=None, infinity_cap=1e15):
     log_infinity_cap = np.log10(infinity_cap)
     if multiplier is None:
@@ -0,0 +1,130 @@
+"""
+Entropy-regularized (Sinkhorn) soft matching: an alternative to the exact Hungarian assignment in match.py that runs
+as batched tensor ops on the cost tensors' device.  Cuturi, 'Sinkhorn Distances: Lightspeed Computation of Optimal
+Transport' (2013).
+
+Cost matrices are rectangular (n_pred x n_gt, n_pred <= n_gt -- guaranteed by the GT_VALUE_FOR_FALSE_POSITIVE
+padding in match.py).  Each is completed to a square problem with zero-cost slack rows (ground truth that stays
+unmatched), so every prediction row of the soft assignment sums to 1 and every column to at most 1.
+"""
+import time
+
+import numpy as np
+import torch
+
+from instanceseg.losses import match
+
+DEFAULT_TEMPERATURE = 0.1
+DEFAULT_N_ITERS = 20
+
+
+def batched_sinkhorn(cost_tensors, temperature=DEFAULT_TEMPERATURE, n_iters=DEFAULT_N_ITERS):
+    """
+    Returns a list of (n_pred_i, n_gt_i) soft assignments (on the cost tensors' device).  Costs are rescaled to [0, 1]
+    per problem, so temperature is relative to each problem's cost range.  The soft assignments are computed from
+    detached costs -- like the hard assignment, they are treated as constants by the loss.
+    """
+    soft_assignments = [None for _ in cost_tensors]
+    problems_by_shape = {}
+    for idx, c in enumerate(cost_tensors):
+        assert c.shape[0] <= c.shape[1], 'Need at least as many columns as rows (pad with false positive columns first)'
+        problems_by_shape.setdefault(tuple(c.shape), []).append(idx)
+
+    for (n_pred, n_gt), idxs in problems_by_shape.items():
+        costs = torch.stack([cost_tensors[i].detach() for i in idxs]).float()
+        c_min = costs.reshape(len(idxs), -1).min(dim=1)[0][:, None, None]
+        c_range = costs.reshape(len(idxs), -1).max(dim=1)[0][:, None, None] - c_min
+        costs = (costs - c_min) / torch.where(c_range > 0, c_range, torch.ones_like(c_range))
+        if n_gt > n_pred:
+            costs = torch.cat([costs, costs.new_zeros((len(idxs), n_gt - n_pred, n_gt))], dim=1)
+        log_kernel = -costs / temperature
+        f = costs.new_zeros((len(idxs), n_gt))
+        g = costs.new_zeros((len(idxs), n_gt))
+        for _ in range(n_iters):
+            f = -torch.logsumexp(log_kernel + g[:, None, :], dim=2)
+            g = -torch.logsumexp(log_kernel + f[:, :, None], dim=1)
+        transport = torch.exp(log_kernel + f[:, :, None] + g[:, None, :])[:, :n_pred, :]
+        for i, idx in enumerate(idxs):
+            soft_assignments[idx] = transport[i, ...]
+    return soft_assignments
+
+
+class SinkhornConfig(object):
+    def __init__(self, temperature=DEFAULT_TEMPERATURE, n_iters=DEFAULT_N_ITERS, temperature_decay=1.0,
+                 min_temperature=0.01, diagnostic_interval=0):
+        """
+        temperature_decay: temperature is multiplied by this every step (training iteration; see SinkhornMatcher.step)
+            -- annealing, down to min_temperature
+        diagnostic_interval: every diagnostic_interval steps, harden the soft assignment and compare it to the exact
+            Hungarian result (0: never)
+        """
+        self.temperature = temperature
+        self.n_iters = n_iters
+        self.temperature_decay = temperature_decay
+        self.min_temperature = min_temperature
+        self.diagnostic_interval = diagnostic_interval
+
+
+class SinkhornMatcher(object):
+    """
+    The annealing schedule and diagnostics interval count steps -- advanced once per training iteration with step(),
+    however many times the loss is computed in it -- not solve calls.
+    """
+
+    def __init__(self, sinkhorn_config: SinkhornConfig = None):
+        self.config = sinkhorn_config or SinkhornConfig()
+        self.n_steps = 0
+        self.diagnosed_step = None
+        self.last_solve_time = None
+        self.last_diagnostics = None
+
+    @property
+    def temperature(self):
+        return max(self.config.min_temperature,
+                   self.config.temperature * self.config.temperature_decay ** self.n_steps)
+
+    def step(self):
+        self.n_steps += 1
+
+    def solve(self, cost_tensors):
+        """
+        Returns soft assignments (see batched_sinkhorn) and the hardened (row argmax) assignments as lists.
+        """
+        t_start = time.time()
+        soft_assignments = batched_sinkhorn(cost_tensors, temperature=self.temperature, n_iters=self.config.n_iters)
+        hardened_col_inds = match.assignment_tensors_to_lists([s.argmax(dim=1) for s in soft_assignments])
+        self.last_solve_time = time.time() - t_start
+        self.last_diagnostics = None
+        if self.config.diagnostic_interval and (self.n_steps + 1) % self.config.diagnostic_interval == 0 and \
+                self.diagnosed_step != self.n_steps:
+            self.diagnosed_step = self.n_steps
+            self.last_diagnostics = self.compare_to_exact_assignment(cost_tensors, soft_assignments,
+                                                                     hardened_col_inds)
+        return soft_assignments, hardened_col_inds
+
+    @staticmethod
+    def compare_to_exact_assignment(cost_tensors, soft_assignments, hardened_col_inds):
+        """
+        'Harden and compare': how far the soft assignment is from the exact Hungarian result.
+        """
+        if len(cost_tensors) == 0:
+            return None
+        cost_arrays = match.cost_tensors_to_numpy(cost_tensors)
+        soft_arrays = match.cost_tensors_to_numpy(soft_assignments)
+        n_rows, n_agree, exact_cost, hardened_cost, soft_cost, n_conflicts = 0, 0, 0.0, 0.0, 0.0, 0
+        for cost_array, soft_array, hardened in zip(cost_arrays, soft_arrays, hardened_col_inds):
+            exact = match._solve_numpy_matching_problem(cost_array)
+            rows = np.arange(cost_array.shape[0])
+            n_rows += len(rows)
+            n_agree += int(np.sum(np.array(exact) == np.array(hardened)))
+            n_conflicts += len(hardened) - len(set(hardened))
+            exact_cost += cost_array[rows, exact].sum()
+            hardened_cost += cost_array[rows, hardened].sum()
+            soft_cost += (soft_array * cost_array).sum()
+        normalizer = max(abs(exact_cost), np.finfo(float).eps)
+        return {
+            'hardened_agreement': n_agree / n_rows,
+            'hardened_conflicts': n_conflicts,
+            'hardened_relative_cost_gap': (hardened_cost - exact_cost) / normalizer,
+            'soft_relative_cost_gap': (soft_cost - exact_cost) / normalizer,
+        }
@@ -67,3 +67,11 @@ def nll2d_single_class_term(log_predictions_single_instance_cls, binary_target_s
     bt = binary_target_single_instance_cls
     res = -torch.sum(lp.view(-1, ) * bt.view(-1, ))
     return res
+
+
+def nll2d_from_segment_sums(log_prediction_sums):
+    """
+    Vectorized nll2d_single_class_term: log_prediction_sums[r, c] is the sum of channel r's log predictions inside
+    ground truth mask c.
+    """
+    return -log_prediction_sums
@@ -3,6 +3,8 @@ import tqdm
 from torch.autograd import Variable
 from torch.utils.data import sampler
 
+from instanceseg.datasets import runtime_transformations
+from instanceseg.utils import datasets
 from instanceseg.utils.torch_utils import softmax_scores, argmax_scores, center_crop_to_reduced_size
 
 
@@ -265,6 +267,16 @@ def cat_dictionaries(dictionary, dictionary_to_add):
     return dictionary
 
 
+def get_n_images(data_loader):
+    """
+    Number of images data_loader yields (its batch_size is None if it was built with a batch_sampler)
+    """
+    batch_sampler = data_loader.batch_sampler
+    if hasattr(batch_sampler, 'indices'):
+        return len(batch_sampler.indices)
+    return len(batch_sampler.sampler)
+
+
 def compile_scores_and_losses(model, data_loader, component_loss_function,
                               augment_function_img_sem=None):
     """
@@ -273,10 +285,12 @@ def compile_scores_and_losses(model, data_loader, component_loss_function,
     assert component_loss_function is not None
     training = model.training
     model.eval()
-    n_images = data_loader.batch_size * len(data_loader)
+    n_images = get_n_images(data_loader)
     n_channels = model.n_output_channels
-    batch_size = data_loader.batch_size
-    min_image_size, max_image_size = (torch.np.inf, torch.np.inf), (0, 0)
+    min_image_size, max_image_size = (float('inf'), float('inf')), (0, 0)
+    runtime_transformation = getattr(data_loader.dataset, 'runtime_transformation', None)
+    mean_bgr = runtime_transformations.get_compact_transport_mean_bgr(runtime_transformation) \
+        if runtime_transformation is not None else None
     for batch_idx, data_dict in tqdm.tqdm(
             enumerate(data_loader), total=len(data_loader), desc='Running dataset through model', ncols=80,
             leave=False):
@@ -287,6 +301,7 @@ def compile_scores_and_losses(model, data_loader, component_loss_function,
     compiled_scores = torch.ones(n_images, n_channels, *list(min_image_size))
     compiled_losses = torch.ones(n_images) if component_loss_function is not None else None
     compiled_loss_components = torch.ones(n_images, n_channels) if component_loss_function is not None else None
+    batch_start = 0  # Batches of a batch sampler (e.g. - sampler.BucketedBatchSampler) vary in size
     for batch_idx, data_dict in tqdm.tqdm(
             enumerate(data_loader), total=len(data_loader), desc='Running dataset through model', ncols=80,
             leave=False):
@@ -294,17 +309,19 @@ def compile_scores_and_losses(model, data_loader, component_loss_function,
             data_dict['image'], (data_dict['sem_lbl'], data_dict['inst_lbl'])
         if next(model.parameters()).is_cuda:
             img_data, sem_lbl, inst_lbl = img_data.cuda(), sem_lbl.cuda(), inst_lbl.cuda()
+        img_data, sem_lbl, inst_lbl = datasets.decompact_batch(img_data, sem_lbl, inst_lbl, mean_bgr=mean_bgr)
         if augment_function_img_sem is not None:
             full_data = augment_function_img_sem(img_data, sem_lbl)
         else:
             full_data = img_data
         full_data, sem_lbl, inst_lbl = Variable(full_data, volatile=True), Variable(sem_lbl), Variable(inst_lbl)
         scores = model(full_data)
+        batch_end = batch_start + scores.size(0)
         try:
-            compiled_scores[(batch_idx * batch_size):((batch_idx + 1) * batch_size), ...] = scores.data
+            compiled_scores[batch_start:batch_end, ...] = scores.data
         except:
             if all([s1 > s2 for s1, s2 in zip(
-                    compiled_scores[(batch_idx * batch_size):((batch_idx + 1) * batch_size), ...].size(),
+                    compiled_scores[batch_start:batch_end, ...].size(),
                     scores.size())]):
                 import ipdb;
                 ipdb.set_trace()
@@ -316,16 +333,17 @@ def compile_scores_and_losses(model, data_loader, component_loss_function,
                 cropped_scores = center_crop_to_reduced_size(scores, cropped_size, rc_axes=(2, 3))
                 try:
                     assert cropped_scores.size() == \
-                           compiled_scores[(batch_idx * batch_size):((batch_idx + 1) * batch_size), ...].size()
+                           compiled_scores[batch_start:batch_end, ...].size()
                 except:
                     import ipdb;
                     ipdb.set_trace()
                     raise
-                compiled_scores[(batch_idx * batch_size):((batch_idx + 1) * batch_size), ...] = cropped_scores.data
+                compiled_scores[batch_start:batch_end, ...] = cropped_scores.data
         if component_loss_function is not None:
             pred_permutations_batch, loss_batch, loss_components = component_loss_function(scores, sem_lbl, inst_lbl)
-            compiled_loss_components[(batch_idx * batch_size):((batch_idx + 1) * batch_size), :] = loss_components.data
-            compiled_losses[(batch_idx * batch_size):((batch_idx + 1) * batch_size)] = loss_batch.data
+            compiled_loss_components[batch_start:batch_end, :] = loss_components.data
+            compiled_losses[batch_start:batch_end] = loss_batch.data
+        batch_start = batch_end
 
     if training:
         model.train()
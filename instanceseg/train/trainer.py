@@ -11,7 +11,8 @@ from torch.optim.optimizer import Optimizer
 import instanceseg
 import instanceseg.losses.loss
 import instanceseg.utils.export
-from instanceseg.datasets import dataset_statistics
+from instanceseg.datasets import dataset_statistics, runtime_transformations, sampler
+from instanceseg.losses.assignment_cache import label_hash
 from instanceseg.models.fcn8s_instance import FCN8sInstance
 from instanceseg.models.model_utils import is_nan, any_nan
 from instanceseg.train import metrics, trainer_exporter
@@ -106,7 +107,9 @@ class Trainer(object):
                  out_dir, max_iter,
                  instance_problem: InstanceProblemConfig,
                  size_average=True, interval_validate=None, loss_type='cross_entropy',
-                 matching_loss=True,
+                 matching_loss=True, cost_matrix_engine='loop', matching_solver_workers=0,
+                 matching_solver_backend='scipy', matching_mode='hungarian', sinkhorn_config=None,
+                 cost_matrix_chunk_bytes=None, assignment_cache=False,
                  tensorboard_writer=None, loader_semantic_lbl_only=False,
                  use_semantic_loss=False, augment_input_with_semantic_masks=False,
                  write_instance_metrics=True,
@@ -141,6 +144,13 @@ class Trainer(object):
         self.size_average = size_average
         self.matching_loss = matching_loss
         self.loss_type = loss_type
+        self.cost_matrix_engine = cost_matrix_engine
+        self.matching_solver_workers = matching_solver_workers
+        self.matching_solver_backend = matching_solver_backend
+        self.matching_mode = matching_mode
+        self.sinkhorn_config = sinkhorn_config
+        self.cost_matrix_chunk_bytes = cost_matrix_chunk_bytes
+        self.assignment_cache = assignment_cache
 
         # Data loading parameters
         self.loader_semantic_lbl_only = loader_semantic_lbl_only
@@ -153,6 +163,10 @@ class Trainer(object):
 
         # Stored values
         self.last_val_loss = None
+        self.last_val_assignments = None  # packed assignments of the whole split (see LossMatchAssignments)
+
+        # Mean subtracted from compact (uint8) batches -- see BasicRuntimeDatasetTransformer(compact_transport=True)
+        self.compact_transport_mean_bgr = self.get_compact_transport_mean_bgr()
 
         self.interval_validate = interval_validate or (
             len(self.dataloaders['train']) if 'train' in self.dataloaders else None)
@@ -213,10 +227,27 @@ class Trainer(object):
     def eval_loss_fcn_with_matching(self):
         return None if self.loss_type is None else self.eval_loss_object_with_matching.loss_fcn
 
+    @property
+    def n_instances_by_thing_sem_val(self):
+        """
+        Number of channels allocated to each thing class: cap_sizes keeps at most this many of its instances
+        """
+        problem = self.instance_problem
+        return {sem_val: n_channels
+                for sem_val, n_channels in zip(problem.semantic_ids, problem.model_n_instances_by_semantic_id)
+                if sem_val in problem.thing_class_ids}
+
     def loss_fcn(self, *args, **kwargs):
         loss_result = self.loss_object.loss_fcn(*args, **kwargs)
         return loss_result
 
+    def get_compact_transport_mean_bgr(self):
+        for dataloader in self.dataloaders.values():
+            runtime_transformation = getattr(getattr(dataloader, 'dataset', None), 'runtime_transformation', None)
+            if runtime_transformation is not None:
+                return runtime_transformations.get_compact_transport_mean_bgr(runtime_transformation)
+        return None
+
     def prepare_data_for_forward_pass(self, img_data, target, requires_grad=True):
         """
         Loads data and transforms it into Variable based on GPUs, input augmentations, and loader
@@ -237,6 +268,9 @@ class Trainer(object):
 
         if self.cuda:
             img_data, (sem_lbl, inst_lbl) = img_data.cuda(), (sem_lbl.cuda(), inst_lbl.cuda())
+        # Compact batches are copied to the GPU as uint8 / int16, then centered and widened there
+        img_data, sem_lbl, inst_lbl = datasets.decompact_batch(img_data, sem_lbl, inst_lbl,
+                                                               mean_bgr=self.compact_transport_mean_bgr)
         full_input = img_data if not self.augment_input_with_semantic_masks \
             else self.augment_image(img_data, sem_lbl)
         if requires_grad:
@@ -262,18 +296,26 @@ class Trainer(object):
         # permutations, loss, loss_components = f(scores, sem_lbl, inst_lbl)
 
         matching = matching_override if matching_override is not None else self.matching_loss
+        # Soft matching is a training objective; evaluation always reports the exact assignment
+        matching_mode = self.matching_mode if matching_override is None else 'hungarian'
 
         my_loss_object = instanceseg.losses.loss.loss_object_factory(
             self.loss_type,
             self.instance_problem.model_channel_semantic_ids,
             self.instance_problem.instance_count_id_list,
-            matching, self.size_average)
+            matching, self.size_average, cost_matrix_engine=self.cost_matrix_engine,
+            matching_solver_workers=self.matching_solver_workers,
+            matching_solver_backend=self.matching_solver_backend,
+            matching_mode=matching_mode, sinkhorn_config=self.sinkhorn_config,
+            cost_matrix_chunk_bytes=self.cost_matrix_chunk_bytes,
+            assignment_cache=self.assignment_cache and matching_override is None)
         return my_loss_object
 
     def compute_loss(self, score, sem_lbl, inst_lbl, cap_sizes=True,
-                     val_matching_override=False) -> instanceseg.losses.loss.MatchingLossResult:
+                     val_matching_override=False, image_keys=None) -> instanceseg.losses.loss.MatchingLossResult:
         """
         Returns assignments, total_loss, loss_components_by_channel
+        image_keys: see get_assignment_cache_keys
         """
         # permutations, loss, loss_components = f(scores, sem_lbl, inst_lbl)
         map_to_semantic = self.instance_problem.map_to_semantic
@@ -285,47 +327,22 @@ class Trainer(object):
             for sem_val in unique_sem_vals:
                 assert sem_val in self.instance_problem.semantic_ids or sem_val == self.instance_problem.void_value
 
-        train_inst_lbl = None
         if cap_sizes:
-            removed_gt_inst_tuples = []
-            assert len(sem_lbl.shape) == 3
-            for i in range(sem_lbl.shape[0]):
-                removed_gt_inst_tuples_img_i = []
-                for sem_val, n_channels_allocated in zip(
-                        self.instance_problem.semantic_ids,
-                        self.instance_problem.model_n_instances_by_semantic_id):
-                    if sem_val in self.instance_problem.thing_class_ids:
-                        inst_vals, inst_sizes = dataset_statistics.get_instance_sizes(sem_lbl[i, ...],
-                                                                                      inst_lbl[i, ...], sem_val)
-                        sorted_inst_vals = [inst_vals[i] for i in np.argsort(inst_sizes)][::-1]
-                        bad_inst_vals = sorted_inst_vals[n_channels_allocated:]
-                        if DEBUG_ASSERTS:
-                            assert (len(bad_inst_vals) == max(0, len(inst_vals) - n_channels_allocated))
-                        for inst_val in bad_inst_vals:
-                            if train_inst_lbl is None:  # allocate new inst lbl if we need to
-                                train_inst_lbl = torch.clone(inst_lbl)
-                            train_inst_lbl[(sem_lbl == sem_val) * (inst_lbl == inst_val)] = \
-                                self.instance_problem.void_value
-                        removed_gt_inst_tuples_img_i.extend([(sem_val, iv) for iv in bad_inst_vals])
-                    else:
-                        assert sem_val in self.instance_problem.stuff_class_ids
-                removed_gt_inst_tuples.append(removed_gt_inst_tuples_img_i)
+            train_inst_lbl, removed_gt_inst_tuples = dataset_statistics.cap_instance_sizes(
+                sem_lbl, inst_lbl, self.n_instances_by_thing_sem_val, self.instance_problem.void_value)
         else:
-            removed_gt_inst_tuples = None
-        if train_inst_lbl is None:
-            train_inst_lbl = inst_lbl
+            train_inst_lbl, removed_gt_inst_tuples = inst_lbl, None
         if map_to_semantic:
             train_inst_lbl[train_inst_lbl > 1] = 1
         # print('APD: Running loss fcn')
         if val_matching_override:
             loss_result = self.eval_loss_fcn_with_matching(score, sem_lbl, train_inst_lbl)
         else:
-            loss_result = self.loss_fcn(score, sem_lbl, train_inst_lbl)
+            loss_result = self.loss_fcn(score, sem_lbl, train_inst_lbl, image_keys=image_keys)
         loss_result.avg_loss = loss_result.total_loss / score.size(0)
 
-        if cap_sizes:
-            for i, l in enumerate(loss_result.assignments.unassigned_gt_sem_inst_tuples):
-                loss_result.assignments.unassigned_gt_sem_inst_tuples[i].extend(removed_gt_inst_tuples[i])
+        if cap_sizes and len(removed_gt_inst_tuples[0]) > 0:
+            loss_result.assignments.add_unassigned(*[t.cpu() for t in removed_gt_inst_tuples])
         return loss_result
 
     def augment_image(self, img, sem_lbl):
@@ -335,8 +352,9 @@ class Trainer(object):
                                          (0.5 if BINARY_AUGMENT_CENTERED else 0), dim=1)
 
     def save_checkpoint_and_update_if_best(self, mean_iu):
-        current_checkpoint_file = self.exporter.save_checkpoint(self.state.epoch, self.state.iteration, self.model,
-                                                                self.optim, self.best_mean_iu, mean_iu)
+        current_checkpoint_file = self.exporter.save_checkpoint(
+            self.state.epoch, self.state.iteration, self.model, self.optim, self.best_mean_iu, mean_iu,
+            train_sampler_state_dict=self.get_train_sampler_state_dict())
         if mean_iu > self.best_mean_iu or self.best_mean_iu == 0:
             self.best_mean_iu = mean_iu
             self.exporter.copy_checkpoint_as_best(current_checkpoint_file)
@@ -522,6 +540,8 @@ class Trainer(object):
                                                     basename='score_' + split, tile=False)
         val_loss /= len(data_loader)
         self.last_val_loss = val_loss
+        self.last_val_assignments = instanceseg.losses.loss.LossMatchAssignments.assemble(assignments) \
+            if assignments else None
 
         if should_compute_basic_metrics:
             if write_basic_metrics:
@@ -584,8 +604,15 @@ class Trainer(object):
             self.dataloaders['train_for_val'].dataset.raw_dataset.initialize_locations_per_image(
                 seed)
 
+        train_sampler = self.get_resumable_train_sampler()
+        if isinstance(train_sampler, sampler.ShardedSampler):
+            train_sampler.set_epoch(self.state.epoch)  # Same shuffle on every rank
+        # A resumed sampler starts at the batch after the checkpointed iteration, so those before it aren't loaded
+        start_batch_idx = int(math.ceil(1. * train_sampler.start_position / self.get_train_sampler_items_per_batch())) \
+            if train_sampler is not None else 0
+        train_loader = self.dataloaders['train']
         t = tqdm.tqdm(  # tqdm: progress bar
-            enumerate(self.dataloaders['train']), total=len(self.dataloaders['train']),
+            enumerate(train_loader, start_batch_idx), total=len(train_loader), initial=start_batch_idx,
             desc='Train epoch=%d' % self.state.epoch, ncols=80, leave=False)
 
         for batch_idx, data_dict in t:
@@ -609,9 +636,9 @@ class Trainer(object):
                     if not self.skip_validation:
                         self.validate_all_splits()
                     elif not self.skip_model_checkpoint_saving:
-                        current_checkpoint_file = self.exporter.save_checkpoint(self.state.epoch, self.state.iteration,
-                                                                                self.model, self.optim,
-                                                                                self.best_mean_iu, None)
+                        current_checkpoint_file = self.exporter.save_checkpoint(
+                            self.state.epoch, self.state.iteration, self.model, self.optim, self.best_mean_iu, None,
+                            train_sampler_state_dict=self.get_train_sampler_state_dict())
 
             # Run training iteration
             self.train_iteration(data_dict)
@@ -620,15 +647,41 @@ class Trainer(object):
                 self.validate_all_splits()
                 break
 
+    def get_train_sampler_state_dict(self):
+        """
+        State of the train sampler (if it's resumable) to continue from the iteration after this one, as train_epoch
+        does when resuming
+        """
+        train_sampler = self.get_resumable_train_sampler()
+        if train_sampler is None:
+            return None
+        n_batches_consumed = 0 if self.state.iteration == 0 else \
+            self.state.iteration + 1 - self.state.epoch * len(self.dataloaders['train'])
+        return train_sampler.state_dict(n_consumed=max(0, n_batches_consumed) *
+                                        self.get_train_sampler_items_per_batch())
+
+    def get_resumable_train_sampler(self):
+        train_loader = self.dataloaders['train']
+        for train_sampler in (train_loader.batch_sampler, train_loader.sampler):
+            if isinstance(train_sampler, sampler.ResumableSampler):
+                return train_sampler
+        return None
+
+    def get_train_sampler_items_per_batch(self):
+        # Batch samplers yield whole batches
+        return 1 if isinstance(self.dataloaders['train'].batch_sampler, sampler.ResumableSampler) \
+            else self.dataloaders['train'].batch_size
+
     def train_iteration(self, data_dict):
         assert self.model.training
         img_data = data_dict['image']
         target = (data_dict['sem_lbl'], data_dict['inst_lbl'])
+        image_keys = self.get_assignment_cache_keys(data_dict) if self.assignment_cache else None
         full_input, sem_lbl, inst_lbl = self.prepare_data_for_forward_pass(img_data, target,
                                                                            requires_grad=True)
         self.optim.zero_grad()
         score = self.model(full_input)
-        loss_result = self.compute_loss(score, sem_lbl, inst_lbl, cap_sizes=True)
+        loss_result = self.compute_loss(score, sem_lbl, inst_lbl, cap_sizes=True, image_keys=image_keys)
         avg_loss, loss_components_by_channel = loss_result.avg_loss, loss_result.loss_components_by_channel
         debug_check_values_are_valid(avg_loss, score, self.state.iteration)
 
@@ -642,6 +695,7 @@ class Trainer(object):
             self.model.train()
         else:
             new_loss_result = None
+        self.loss_object.step()
 
         group_lrs = []
         for grp_idx, param_group in enumerate(self.optim.param_groups):
@@ -654,6 +708,18 @@ class Trainer(object):
             if isinstance(self.model, torch.nn.DataParallel) else self.model.get_activations,
             lrs_by_group=group_lrs, semantic_names_by_val=self.instance_problem.semantic_class_names_by_model_id)
 
+    @staticmethod
+    def get_assignment_cache_keys(data_dict):
+        """
+        One (image id, label hash) pair per image for the assignment cache, which keys its entries by image id and
+        semantic value and keeps the label hash to detect changed labels (hashed on the host, before the labels are
+        moved to the GPU)
+        """
+        image_ids = data_dict['image_id']
+        image_ids = image_ids.tolist() if torch.is_tensor(image_ids) else list(image_ids)
+        return [(image_id, label_hash(sem_lbl, inst_lbl))
+                for image_id, sem_lbl, inst_lbl in zip(image_ids, data_dict['sem_lbl'], data_dict['inst_lbl'])]
+
     def train(self):
         max_epoch = int(math.ceil(1. * self.state.max_iteration / len(self.dataloaders['train'])))
         if self.t_val is None:
@@ -665,7 +731,8 @@ class Trainer(object):
             self.train_epoch()
             if self.state.training_complete():
                 self.exporter.save_checkpoint(self.state.epoch, self.state.iteration, self.model, self.optim,
-                                              self.best_mean_iu, None)
+                                              self.best_mean_iu, None,
+                                              train_sampler_state_dict=self.get_train_sampler_state_dict())
                 break
         if self.t_val is not None:
             self.t_val.close()
@@ -399,7 +399,7 @@ class TrainerExporter(object):
                            new_assignments: LossMatchAssignments, iteration):
         loss_improvement = old_loss - new_loss
         num_reassignments = float(
-            (new_assignments.assigned_gt_inst_vals != old_assignments.assigned_gt_inst_vals).sum())
+            (new_assignments.gt_inst_vals != old_assignments.gt_inst_vals).sum())
         self.tensorboard_writer.add_scalar('A_eval_metrics/train_minibatch_loss_improvement', loss_improvement,
                                            iteration)
         self.tensorboard_writer.add_scalar('A_eval_metrics/reassignment', num_reassignments, iteration)
@@ -435,7 +435,8 @@ class TrainerExporter(object):
                             raise ValueError('I\'m not sure how to write {} to tensorboard_writer (name is '
                                              '{}'.format(type(metric), name))
 
-    def save_checkpoint(self, epoch, iteration, model, optimizer, best_mean_iu, mean_iu, out_dir=None):
+    def save_checkpoint(self, epoch, iteration, model, optimizer, best_mean_iu, mean_iu, out_dir=None,
+                        train_sampler_state_dict=None):
         out_name = 'checkpoint.pth.tar'
         out_dir = out_dir or os.path.join(self.out_dir)
         checkpoint_file = osp.join(out_dir, out_name)
@@ -450,7 +451,8 @@ class TrainerExporter(object):
             'optim_state_dict': optimizer.state_dict(),
             'model_state_dict': model_state_dict,
             'best_mean_iu': best_mean_iu,
-            'mean_iu': mean_iu
+            'mean_iu': mean_iu,
+            'train_sampler_state_dict': train_sampler_state_dict
         }, checkpoint_file)
 
         self.model_history_saver.save_model_to_history(iteration, checkpoint_file,
@@ -498,6 +500,17 @@ class TrainerExporter(object):
             # TODO(allie): Check dimensionality of loss to prevent potential bugs
             self.tensorboard_writer.add_scalar('A_eval_metrics/train_minibatch_loss',
                                                loss_result.avg_loss.detach().sum(), iteration)
+            if loss_result.matching_solve_time is not None:
+                self.tensorboard_writer.add_scalar('Z_timing/train_matching_solve_time',
+                                                   loss_result.matching_solve_time, iteration)
+            if loss_result.matching_diagnostics is not None:
+                for name, value in loss_result.matching_diagnostics.items():
+                    self.tensorboard_writer.add_scalar('Z_matching_diagnostics/train_{}'.format(name), value,
+                                                       iteration)
+            if loss_result.assignment_cache_stats is not None:
+                for name in ('hits', 'misses', 'time_saved'):
+                    self.tensorboard_writer.add_scalar('Z_timing/train_assignment_cache_{}'.format(name),
+                                                       loss_result.assignment_cache_stats[name], iteration)
 
         if self.export_config.write_lr:
             for group_idx, lr in enumerate(lrs_by_group):
@@ -547,11 +560,12 @@ class TrainerExporter(object):
             sem_lbl_np, inst_lbl_np = lbl_untransformed
             assert max_n_insts_per_thing >= inst_lbl.max()
             if should_visualize:
+                image_assignments = assignments.get_image(idx)
                 segmentation_viz = visualization_utils.visualize_segmentations_as_rgb_imgs(
                     gt_sem_inst_lbl_tuple=(sem_lbl_np, inst_lbl_np),
                     pred_channelwise_lbl=pred_l,
-                    channel_inst_vals=assignments.assigned_gt_inst_vals[idx, ...].numpy(),
-                    channel_sem_vals=assignments.sem_values[idx, ...].numpy(),
+                    channel_inst_vals=image_assignments.gt_inst_vals,
+                    channel_sem_vals=image_assignments.sem_vals,
                     unmatched_val=GT_VALUE_FOR_FALSE_POSITIVE,
                     instance_count_id_list=self.instance_problem.instance_count_id_list,
                     img=img_untransformed, overlay=False,
@@ -559,9 +573,10 @@ class TrainerExporter(object):
                 score_viz = self.visualize_one_img_prediction_score(
                     img_untransformed=img_untransformed, softmax_scores=softmax_scores[idx, ...],
                     gt_sem_inst_tuple=(sem_lbl_np, inst_lbl_np),
-                    channel_sem_values=assignments.sem_values[idx, ...],
-                    channel_inst_vals=assignments.assigned_gt_inst_vals[idx, ...],
-                    unassigned_gt_sem_inst_tuples=assignments.unassigned_gt_sem_inst_tuples[idx])
+                    channel_sem_values=image_assignments.sem_vals,
+                    channel_inst_vals=image_assignments.gt_inst_vals,
+                    unassigned_gt_sem_inst_tuples=list(zip(image_assignments.unassigned_sem_vals.tolist(),
+                                                           image_assignments.unassigned_gt_inst_vals.tolist())))
                 score_visualizations.append(score_viz)
                 segmentation_visualizations.append(segmentation_viz)
         return segmentation_visualizations, score_visualizations
@@ -37,6 +37,7 @@ CONFIG_KEY_REPLACEMENTS_FOR_FILENAME = {'max_iteration': 'itr',
                                         'export_activations': 'exp_act',
                                         'write_instance_metrics': 'instmet',
                                         'loss_type': 'loss',
+                                        'cost_matrix_engine': 'cme',
                                         'ordering': 'order',
                                         'reset_optim': 'ropt'
                                         }
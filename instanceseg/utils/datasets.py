@@ -1,3 +1,4 @@
+import hashlib
 import shutil
 
 import PIL.Image
@@ -5,7 +6,7 @@ import numpy as np
 import torch
 from torch.autograd import Variable
 
-from instanceseg.utils import imgutils
+from instanceseg.utils import imgutils, label_remap, misc
 
 # TODO(allie): Allow for augmentations
 from instanceseg.utils.imgutils import load_img_as_dtype
@@ -13,6 +14,23 @@ from instanceseg.utils.imgutils import load_img_as_dtype
 DEBUG_ASSERT = True
 
 
+def stable_value_string(value):
+    """
+    value_as_string, except images (e.g. - the mode P palettes) are described by their content rather than a repr that
+    contains their address
+    """
+    if isinstance(value, PIL.Image.Image):
+        h = hashlib.md5(value.tobytes())
+        h.update(bytes(value.getpalette() or []))
+        return '{}:{}:{}'.format(value.mode, value.size, h.hexdigest())
+    return misc.value_as_string(value)
+
+
+def get_transformation_tag(file_transformers):
+    return '__'.join(['{}-{}'.format(k, stable_value_string(v))
+                      for tr in file_transformers if tr is not None for k, v in tr.get_attribute_items()])
+
+
 def prep_input_for_scoring(input_tensor, cuda):
     """
     n_semantic_classes only needed for augmenting.
@@ -61,6 +79,41 @@ def convert_lbl_to_torch_tensor(lbl):
     return lbl
 
 
+# Compact transport: what the DataLoader workers send when BasicRuntimeDatasetTransformer(compact_transport=True).
+# Labels are signed (the runtime transformations write -1 for void) and widened to long by decompact_batch.
+COMPACT_LBL_DTYPE = np.int16
+
+
+def convert_img_to_compact_torch_tensor(img):
+    """
+    convert_img_to_torch_tensor without the mean subtraction: (3, H, W) BGR uint8 (see decompact_batch)
+    """
+    img = img[:, :, ::-1]  # RGB -> BGR
+    img = np.ascontiguousarray(img.transpose(2, 0, 1), dtype=np.uint8)
+    return torch.from_numpy(img)
+
+
+def convert_lbl_to_compact_torch_tensor(lbl):
+    lbl = np.asarray(lbl)
+    if lbl.dtype != COMPACT_LBL_DTYPE and lbl.size > 0:
+        info = np.iinfo(COMPACT_LBL_DTYPE)
+        assert info.min <= lbl.min() and lbl.max() <= info.max, \
+            'Label values in [{}, {}] do not fit in {}'.format(lbl.min(), lbl.max(), COMPACT_LBL_DTYPE)
+    return torch.from_numpy(np.ascontiguousarray(lbl, dtype=COMPACT_LBL_DTYPE))
+
+
+def decompact_batch(img_data, sem_lbl, inst_lbl, mean_bgr=None):
+    """
+    Batched counterpart of the compact conversions, run after the batch is on its device: (N, 3, H, W) uint8 images
+    become float with mean_bgr subtracted; labels become long.  Batches that weren't compacted pass through.
+    """
+    if img_data.dtype == torch.uint8:
+        img_data = img_data.float()
+        if mean_bgr is not None:
+            img_data -= torch.as_tensor(mean_bgr, dtype=img_data.dtype, device=img_data.device).view(1, -1, 1, 1)
+    return img_data, sem_lbl.long(), inst_lbl.long()
+
+
 def convert_torch_lbl_to_numpy(lbl):
     lbl = lbl.numpy()
     return lbl
@@ -76,16 +129,20 @@ def convert_torch_img_to_numpy(img, mean_bgr=None):
     return img
 
 
+IMG_RESIZE_MODE = 'bilinear'
+LBL_RESIZE_MODE = 'nearest'
+
+
 def resize_lbl(lbl, resized_sz):
     if resized_sz is not None:
         lbl = lbl.astype(float)
-        lbl = imgutils.resize_np_img(lbl, (resized_sz[0], resized_sz[1]), resample_mode='nearest')
+        lbl = imgutils.resize_np_img(lbl, (resized_sz[0], resized_sz[1]), resample_mode=LBL_RESIZE_MODE)
     return lbl
 
 
 def resize_img(img, resized_sz):
     if resized_sz is not None:
-        img = imgutils.resize_np_img(img, (resized_sz[0], resized_sz[1]), resample_mode='bilinear')
+        img = imgutils.resize_np_img(img, (resized_sz[0], resized_sz[1]), resample_mode=IMG_RESIZE_MODE)
     return img
 
 
@@ -148,20 +205,12 @@ def permute_instance_order(inst_lbl, n_max_per_class):
 
 
 def remap(lbl, new_idxs):
-    if torch.is_tensor(lbl):
-        old_lbl = lbl.clone()
-    else:
-        old_lbl = lbl.copy()
-    lbl[...] = -2
-    lbl[old_lbl == -1] = -1
-    for old_class_idx, new_idx in enumerate(new_idxs):
-        lbl[old_lbl == old_class_idx] = new_idx
-
+    new_lbl = label_remap.remap_values(lbl, [-1] + list(range(len(new_idxs))), [-1] + list(new_idxs), default=-2)
     if DEBUG_ASSERT:
-        if any(lbl == -2):
-            untouched_values = old_lbl[lbl == -2]
-            import ipdb; ipdb.set_trace()
+        if (new_lbl == -2).any():
+            untouched_values = lbl[new_lbl == -2]
             raise Exception('mapping was not thorough.  No value specified for {}'.format(untouched_values[0]))
+    lbl[...] = new_lbl
 
 
 def remap_to_reduced_semantic_classes(sem_lbl, inst_lbl, reduced_class_idxs, map_other_classes_to_bground=True,
@@ -171,8 +220,8 @@ def remap_to_reduced_semantic_classes(sem_lbl, inst_lbl, reduced_class_idxs, map
     """
     # Make sure all lbl classes can be mapped appropriately.
     if not map_other_classes_to_bground:
-        original_classes_in_this_img = [i for i in range(sem_lbl.min(), sem_lbl.max() + 1)
-                                        if torch.sum(sem_lbl == i) > 0]
+        original_classes_in_this_img = [int(i) for i in (torch.unique(sem_lbl) if torch.is_tensor(sem_lbl)
+                                                         else np.unique(sem_lbl))]
         bool_unique_class_in_reduced_classes = [lbl_cls in reduced_class_idxs
                                                 for lbl_cls in original_classes_in_this_img
                                                 if lbl_cls != -1]
@@ -183,15 +232,10 @@ def remap_to_reduced_semantic_classes(sem_lbl, inst_lbl, reduced_class_idxs, map
             raise Exception('Image has class labels outside the subset.\n Subset: {}\n'
                             'Classes in the image:{}'.format(reduced_class_idxs,
                                                              original_classes_in_this_img))
-    if torch.is_tensor(sem_lbl):
-        old_sem_lbl = sem_lbl.clone()
-    else:
-        old_sem_lbl = sem_lbl.copy()
-    assert inst_lbl[old_sem_lbl == 0].sum() == 0
-    sem_lbl[...] = 0  # background class
-    sem_lbl[old_sem_lbl == -1] = -1
-    for new_idx, old_class_idx in enumerate(reduced_class_idxs):
-        sem_lbl[old_sem_lbl == old_class_idx] = new_idx
+    assert inst_lbl[sem_lbl == 0].sum() == 0
+    # Other classes -> background (0); void stays void
+    label_remap.remap_values(sem_lbl, [-1] + list(reduced_class_idxs), [-1] + list(range(len(reduced_class_idxs))),
+                             default=0, inplace=True)
     inst_lbl[sem_lbl == 0] = 0  # background class
     return sem_lbl
 
@@ -236,10 +280,11 @@ def write_np_array_as_img_with_borrowed_colormap_palette(arr, filename, filename
     colormap_src = PIL.Image.open(filename_for_colormap)
     if colormap_src.mode == 'P':
         write_np_array_as_img_with_colormap_palette(arr, filename, palette=colormap_src)
-    elif colormap_src.mode in ['I', 'L']:
+    elif colormap_src.mode in ['I', 'I;16', 'L']:
         new_lbl_img = PIL.Image.fromarray(arr)
         new_lbl_img.convert(mode=colormap_src.mode)
-        new_lbl_img.save(filename)
+        with misc.atomic_output_file(filename) as tmp_filename:
+            new_lbl_img.save(tmp_filename)
     else:
         raise NotImplementedError
 
@@ -247,7 +292,8 @@ def write_np_array_as_img_with_borrowed_colormap_palette(arr, filename, filename
 def write_np_array_as_img_with_colormap_palette(arr, filename, palette):
     im = PIL.Image.fromarray(arr.astype(np.uint8))
     converted = im.quantize(palette=palette)
-    converted.save(filename)
+    with misc.atomic_output_file(filename) as tmp_filename:
+        converted.save(tmp_filename)
 
 
 def generate_per_sem_instance_file(inst_absolute_lbl_file, sem_lbl_file, inst_lbl_file):
@@ -6,7 +6,7 @@ import numpy as np
 def resize_np_img(img, sz_hw, resample_mode='nearest'):
     resample_opts = {
             'nearest': Image.NEAREST,
-            'antialias': Image.ANTIALIAS,
+            'antialias': Image.LANCZOS,  # ANTIALIAS: an alias of LANCZOS, removed in Pillow 10
             'bilinear': Image.BILINEAR
         }
     try:
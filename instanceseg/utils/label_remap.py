@@ -0,0 +1,172 @@
+"""
+Label remapping through lookup tables.  A mapping (old value -> new value) is compiled once into a dense table over
+[lo, hi] (lo <= 0 <= hi), stored rotated by lo so negative (void) values index it from the end, as negative indices do;
+applying it is a single gather over the label, for numpy arrays and torch tensors alike, instead of one full-label
+mask write per mapped value.  Compiled tables are cached per mapping (get_lookup_table).
+
+Values the mapping doesn't list map to default (None: unchanged).  A table grows to cover the values it is applied to;
+8- and 16-bit labels use a table over their whole dtype, indexed by the label's unsigned view, so they don't even need a
+min / max pass.  Values too spread out for a dense table (see MAX_DENSE_TABLE_SIZE) are remapped through np.unique.
+"""
+import functools
+
+import numpy as np
+import torch
+
+MAX_DENSE_TABLE_SIZE = 2 ** 24
+SMALL_INT_ITEMSIZE = 2  # labels of this many bytes or fewer index a table over their whole dtype
+
+
+def get_numpy_dtype(torch_dtype):
+    return torch.empty(0, dtype=torch_dtype).numpy().dtype
+
+
+class LabelLookupTable(object):
+    def __init__(self, mapping, default=None):
+        """
+        :param mapping: [(old_value, new_value)]; a value listed twice maps to its last new value
+        :param default: new value of everything mapping doesn't list (None: unchanged)
+        """
+        self.mapping = {int(old_val): int(new_val) for old_val, new_val in mapping}
+        self.default = None if default is None else int(default)
+        self.old_vals = np.array(list(self.mapping.keys()), dtype=np.int64)
+        self.new_vals = np.array(list(self.mapping.values()), dtype=np.int64)
+        self.lo, self.hi = min(list(self.mapping.keys()) + [0]), max(list(self.mapping.keys()) + [0])
+        self.table = self.build_table(self.lo, self.hi) if self.hi - self.lo < MAX_DENSE_TABLE_SIZE else None
+        self._dtype_tables = {}  # dtype -> table over the whole (8- or 16-bit) dtype, indexed by the unsigned view
+        self._wrapped_tables = {}  # (device, dtype) -> get_wrapped_table (torch tables on device; numpy: device None)
+
+    def build_table(self, lo, hi):
+        table = np.arange(lo, hi + 1, dtype=np.int64)
+        if self.default is not None:
+            table[:] = self.default
+        in_range = (self.old_vals >= lo) & (self.old_vals <= hi)
+        table[self.old_vals[in_range] - lo] = self.new_vals[in_range]
+        return table
+
+    def cover(self, lo, hi):
+        """
+        Grows the table (geometrically, so a stream of labels rebuilds it a handful of times) to cover [lo, hi].
+        Returns False if that would take more than MAX_DENSE_TABLE_SIZE entries.
+        """
+        if self.table is None:
+            return False
+        if lo >= self.lo and hi <= self.hi:
+            return True
+        exact_lo, exact_hi = min(lo, self.lo), max(hi, self.hi)
+        if exact_hi - exact_lo >= MAX_DENSE_TABLE_SIZE:
+            return False
+        span = self.hi - self.lo + 1
+        new_lo = min(lo, self.lo - span) if lo < self.lo else self.lo
+        new_hi = max(hi, self.hi + span) if hi > self.hi else self.hi
+        if new_hi - new_lo >= MAX_DENSE_TABLE_SIZE:
+            new_lo, new_hi = exact_lo, exact_hi
+        self.lo, self.hi = new_lo, new_hi
+        self.table = self.build_table(self.lo, self.hi)
+        self._wrapped_tables = {}
+        return True
+
+    def get_output_dtype(self, dtype):
+        """
+        dtype if every new value fits in it (values left unchanged do), else int64
+        """
+        info = np.iinfo(dtype)
+        new_vals = self.new_vals.tolist() + ([self.default] if self.default is not None else [])
+        return np.dtype(dtype) if all(info.min <= v <= info.max for v in new_vals) else np.dtype(np.int64)
+
+    def get_dtype_table(self, dtype):
+        """
+        None if the mapping is too spread out for a dense table
+        """
+        dtype = np.dtype(dtype)
+        if dtype not in self._dtype_tables:
+            info = np.iinfo(dtype)
+            if not self.cover(int(info.min), int(info.max)):
+                return None
+            # Value of each unsigned view index: 0..max, then min..-1 for signed dtypes
+            values = np.arange(2 ** (8 * dtype.itemsize), dtype='u{}'.format(dtype.itemsize)).view(dtype)
+            self._dtype_tables[dtype] = self.table[values.astype(np.int64) - self.lo].astype(
+                self.get_output_dtype(dtype))
+        return self._dtype_tables[dtype]
+
+    def get_wrapped_table(self, dtype, device=None):
+        """
+        self.table rotated so that wrapped_table[v] is the new value of v, for v in [lo, hi] (v < 0 from the end)
+        """
+        key = (device, dtype)
+        if key not in self._wrapped_tables:
+            wrapped_table = np.roll(self.table, self.lo)
+            self._wrapped_tables[key] = wrapped_table.astype(dtype) if device is None else \
+                torch.from_numpy(wrapped_table).to(device=device, dtype=dtype)
+        return self._wrapped_tables[key]
+
+    def map_values(self, values):
+        """
+        The new value of each of a few values (no table)
+        """
+        return np.array([self.mapping.get(v, v if self.default is None else self.default) for v in values.tolist()],
+                        dtype=np.int64)
+
+    def apply(self, lbl):
+        """
+        Returns a remapped copy of lbl (numpy array or torch tensor), of lbl's dtype unless a new value needs int64
+        """
+        if torch.is_tensor(lbl):
+            return self.apply_torch(lbl)
+        return self.apply_numpy(np.asarray(lbl))
+
+    def apply_numpy(self, lbl):
+        assert lbl.dtype.kind in 'iu', 'Labels must be integers (got {})'.format(lbl.dtype)
+        if lbl.dtype.itemsize <= SMALL_INT_ITEMSIZE and self.get_dtype_table(lbl.dtype) is not None:
+            return np.take(self.get_dtype_table(lbl.dtype), lbl.view('u{}'.format(lbl.dtype.itemsize)))
+        if lbl.size == 0:
+            return lbl.astype(self.get_output_dtype(lbl.dtype))
+        if not self.cover(int(lbl.min()), int(lbl.max())):
+            values, inverse = np.unique(lbl, return_inverse=True)
+            return self.map_values(values).astype(self.get_output_dtype(lbl.dtype))[inverse].reshape(lbl.shape)
+        return np.take(self.get_wrapped_table(self.get_output_dtype(lbl.dtype)), lbl, mode='wrap')
+
+    def apply_torch(self, lbl):
+        assert not (lbl.is_floating_point() or lbl.is_complex()), 'Labels must be integers (got {})'.format(lbl.dtype)
+        output_dtype = lbl.dtype if self.get_output_dtype(get_numpy_dtype(lbl.dtype)) == \
+            get_numpy_dtype(lbl.dtype) else torch.int64
+        if lbl.numel() == 0:
+            return lbl.to(output_dtype, copy=True)
+        if lbl.element_size() <= SMALL_INT_ITEMSIZE:
+            info = torch.iinfo(lbl.dtype)
+            lo, hi = info.min, info.max
+        else:
+            lo, hi = [int(v) for v in torch.aminmax(lbl)]
+        if not self.cover(lo, hi):
+            values, inverse = torch.unique(lbl, return_inverse=True)
+            new_values = torch.from_numpy(self.map_values(values.cpu().numpy())).to(device=lbl.device,
+                                                                                  dtype=output_dtype)
+            return new_values[inverse]
+        return self.get_wrapped_table(output_dtype, device=lbl.device)[
+            lbl if lbl.dtype in (torch.int64, torch.int32) else lbl.long()]
+
+
+@functools.lru_cache(maxsize=256)
+def _get_lookup_table(mapping, default):
+    return LabelLookupTable(mapping, default)
+
+
+def get_lookup_table(old_vals, new_vals, default=None):
+    """
+    The compiled table of old_vals[i] -> new_vals[i] (cached per mapping)
+    """
+    old_vals, new_vals = [int(v) for v in old_vals], [int(v) for v in new_vals]
+    assert len(old_vals) == len(new_vals), 'old_vals and new_vals must have the same length'
+    return _get_lookup_table(tuple(zip(old_vals, new_vals)), None if default is None else int(default))
+
+
+def remap_values(lbl, old_vals, new_vals, default=None, inplace=False):
+    """
+    Replaces every old_vals[i] in lbl (numpy array or torch tensor) with new_vals[i], and every other value with default
+    (None: unchanged).  inplace: writes the result into lbl (and returns lbl)
+    """
+    remapped = get_lookup_table(old_vals, new_vals, default).apply(lbl)
+    if not inplace:
+        return remapped
+    lbl[...] = remapped
+    return lbl
@@ -1,5 +1,6 @@
 import argparse
 import collections
+import contextlib
 import logging
 import os
 try:
@@ -261,6 +262,22 @@ def symlink(target, link_name, overwrite=False):
         raise
 
 
+@contextlib.contextmanager
+def atomic_output_file(filename):
+    """
+    Yields a temporary filename (same directory and extension) to write to; renamed to filename on success, so readers
+    -- e.g. - other DataLoader workers generating the same file -- never see a partial file.
+    """
+    root, ext = os.path.splitext(filename)
+    tmp_filename = '{}.tmp{}{}'.format(root, os.getpid(), ext)
+    try:
+        yield tmp_filename
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.lexists(tmp_filename):
+            os.remove(tmp_filename)
+
+
 def rgb2hex(r, g, b):
     assert 0 <= r <= 255
     assert 0 <= g <= 255
@@ -89,11 +89,26 @@ def setup_train(dataset_type, cfg, out_dir, sampler_cfg, gpu=(0,), checkpoint_pa
 
     trainer = instanceseg.factory.trainers.get_trainer(cfg, cuda, model, dataloaders, problem_config, out_dir, optim,
                                                        scheduler=scheduler)
-    trainer.epoch = start_epoch
-    trainer.iteration = start_iteration
+    trainer.state.epoch = start_epoch
+    trainer.state.iteration = start_iteration
+    if checkpoint is not None and checkpoint.get('train_sampler_state_dict') is not None:
+        load_train_sampler_state_dict(trainer, checkpoint['train_sampler_state_dict'])
     return trainer
 
 
+def load_train_sampler_state_dict(trainer, train_sampler_state_dict):
+    """
+    Resumes the train sampler from its checkpointed position.  If it isn't resumable (e.g. - the sampler config changed
+    since the checkpoint), the trainer skips the batches before the checkpointed iteration instead.
+    """
+    train_sampler = trainer.get_resumable_train_sampler()
+    if train_sampler is None:
+        print(Warning('The checkpoint has a train sampler position, but the train sampler isn\'t resumable.  Skipping '
+                      'to the checkpointed iteration instead.'))
+        return
+    train_sampler.load_state_dict(train_sampler_state_dict)
+
+
 def setup_test(dataset_type, cfg, out_dir, sampler_cfg, model_checkpoint_path, gpu=(0,), splits=('test',)):
     checkpoint, cuda, dataloaders, model, problem_config, start_epoch, start_iteration = \
         setup_common(dataset_type, cfg, gpu, model_checkpoint_path, sampler_cfg, semantic_init=None, splits=splits)
@@ -3,7 +3,7 @@ import torch
 from torch.autograd import Variable
 from torch.nn import functional as F
 
-from . import misc
+from . import label_remap, misc
 
 
 def generate_mem_report_dict():
@@ -78,7 +78,7 @@ def center_crop_to_reduced_size(tensor, cropped_size_rc, rc_axes=(1, 2)):
 
 
 def fast_remap(arr, old_vals, new_vals):
-    arr_old = arr.copy()
-    for old_val, new_val in zip(old_vals, new_vals):
-        arr[arr_old == old_val] = new_val
-    return arr
\ No newline at end of file
+    """
+    In place: old_vals[i] -> new_vals[i], other values unchanged (one lookup table gather, see label_remap)
+    """
+    return label_remap.remap_values(arr, old_vals, new_vals, inplace=True)
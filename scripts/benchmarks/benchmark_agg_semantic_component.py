@@ -0,0 +1,71 @@
+"""
+Times ComponentMatchingLossBase.compute_agg_semantic_component (one batched pass over all semantic classes) against the
+per-image, per-class loop it replaced, on random scores and labels.
+
+python scripts/benchmarks/benchmark_agg_semantic_component.py --n_semantic_classes 20 --batch_size 4
+"""
+import argparse
+import time
+
+import torch
+
+from instanceseg.losses import loss
+
+
+def compute_agg_semantic_component_loop(loss_object, predictions, sem_lbl, inst_lbl):
+    sem_vals = loss_object.unique_semantic_values
+    loss_components_per_sem_cls = torch.empty((predictions.size(0), len(sem_vals)))
+    for batch_idx in range(predictions.size(0)):
+        normalizer = (inst_lbl[batch_idx, ...] >= 0).data.sum() if loss_object.size_average else 1.0
+        for sem_idx, sem_val in enumerate(sem_vals):
+            model_channels_for_this_cls = [i for i, sem_inst_val in enumerate(loss_object.model_channel_semantic_ids)
+                                           if sem_inst_val == sem_val]
+            loss_components_per_sem_cls[batch_idx, sem_idx] = loss_object.component_loss(
+                (predictions[batch_idx, model_channels_for_this_cls, ...].sum(dim=0)).float(),
+                (sem_lbl[batch_idx, ...] == sem_val).float()) / normalizer
+    return loss_components_per_sem_cls.sum(), loss_components_per_sem_cls, sem_vals
+
+
+def time_fcn(fcn, n_repeats):
+    fcn()  # warm up
+    t_start = time.time()
+    for _ in range(n_repeats):
+        fcn()
+    return (time.time() - t_start) / n_repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_semantic_classes', type=int, default=20)
+    parser.add_argument('--n_instances_per_class', type=int, default=4)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--height', type=int, default=256)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--n_repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    n_sem_cls, n_inst_per_cls = args.n_semantic_classes, args.n_instances_per_class
+    model_channel_semantic_ids = [0] + [s for s in range(1, n_sem_cls) for _ in range(n_inst_per_cls)]
+    model_channel_instance_ids = [0] + [i for _ in range(1, n_sem_cls) for i in range(1, n_inst_per_cls + 1)]
+    size = (args.batch_size, args.height, args.width)
+    scores = torch.randn(args.batch_size, len(model_channel_semantic_ids), args.height, args.width)
+    sem_lbl = torch.randint(0, n_sem_cls, size)
+    inst_lbl = torch.randint(1, n_inst_per_cls + 1, size)
+    inst_lbl[sem_lbl == 0] = 0
+
+    print('{:14s}{:>12s}{:>12s}{:>10s}'.format('loss', 'loop ms', 'batched ms', 'speedup'))
+    for loss_type, size_average in (('cross_entropy', True), ('soft_iou', False)):
+        loss_object = loss.loss_object_factory(loss_type, model_channel_semantic_ids, model_channel_instance_ids,
+                                               matching=True, size_average=size_average)
+        predictions = loss_object.transform_scores_to_predictions(scores)
+        seconds_loop = time_fcn(lambda: compute_agg_semantic_component_loop(loss_object, predictions, sem_lbl,
+                                                                            inst_lbl), args.n_repeats)
+        seconds_batched = time_fcn(lambda: loss_object.compute_agg_semantic_component(predictions, sem_lbl, inst_lbl),
+                                   args.n_repeats)
+        print('{:14s}{:>12.1f}{:>12.1f}{:>9.1f}x'.format(loss_type, 1000 * seconds_loop, 1000 * seconds_batched,
+                                                         seconds_loop / seconds_batched))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Compares an epoch of train batches from BucketedBatchSampler with batches from the random sampler, on random image
+sizes and instance counts: the time to match each batch (match.py pads a batch's assignment problems of each semantic
+class to its largest one), and the fraction of pixels lost to center-cropping each batch to its smallest image.
+
+python scripts/benchmarks/benchmark_bucketed_sampler.py --n_images 512 --batch_size 8
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from instanceseg.datasets import sampler
+from instanceseg.losses import assignment
+
+IMAGE_SIZES = [(256, 512), (512, 1024), (1024, 2048)]
+
+
+def match_batch(batch, instance_counts, rng):
+    """
+    One assignment problem per (image, semantic class) of the batch, padded to the batch's largest for that class
+    """
+    for class_counts in instance_counts[batch].T:
+        n = max(int(class_counts.max()), 1)
+        cost_tensors = [torch.from_numpy(rng.rand(n, n)) for _ in batch]
+        assignment.batched_linear_sum_assignment(cost_tensors)
+
+
+def run_epoch(batches, image_sizes, instance_counts):
+    rng = np.random.RandomState(0)
+    n_pixels, n_pixels_kept = 0, 0
+    t_start = time.time()
+    for batch in batches:
+        match_batch(batch, instance_counts, rng)
+        sizes = image_sizes[batch]
+        n_pixels += int(np.prod(sizes, axis=1).sum())
+        n_pixels_kept += len(batch) * int(sizes[:, 0].min()) * int(sizes[:, 1].min())
+    return time.time() - t_start, 1 - n_pixels_kept / n_pixels
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_images', type=int, default=512)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--n_semantic_classes', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    image_sizes = np.array(IMAGE_SIZES)[rng.randint(0, len(IMAGE_SIZES), args.n_images)]
+    instance_counts = rng.poisson(rng.choice([1, 4, 16], (args.n_images, 1)),
+                                  (args.n_images, args.n_semantic_classes))
+    indices = range(args.n_images)
+
+    torch.manual_seed(0)
+    random_sampler = sampler.ResumableSampler(indices)
+    random_batches = torch.utils.data.BatchSampler(random_sampler, args.batch_size, drop_last=False)
+    bucketed_batches = sampler.BucketedBatchSampler(indices, image_sizes, instance_counts, args.batch_size)
+
+    print('{:12s}{:>10s}{:>16s}{:>16s}'.format('sampler', 'batches', 'images/s', 'pixels cropped'))
+    for name, batches in (('random', random_batches), ('bucketed', bucketed_batches)):
+        batches = list(batches)
+        seconds, fraction_cropped = run_epoch(batches, image_sizes, instance_counts)
+        print('{:12s}{:>10d}{:>16.1f}{:>15.1f}%'.format(name, len(batches), args.n_images / seconds,
+                                                        100 * fraction_cropped))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Peak memory of building (and backpropagating through) the matching cost matrices of one image, with and without
+cost_matrix_chunk_bytes.  Each measurement runs in a fresh process: torch's CPU allocator is invisible to tracemalloc,
+so we read the process' peak resident set size instead (reset after the inputs are allocated where the kernel allows
+it -- /proc/self/clear_refs -- otherwise relative to the peak so far).
+
+python scripts/benchmarks/benchmark_cost_matrix_memory.py --height 1024 --width 2048
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+
+import torch
+
+# Cityscapes-like: 8 thing classes x n_inst_per_cls channels, plus 11 stuff channels
+N_THING_CLASSES, N_STUFF_CLASSES = 8, 11
+CHUNK_BYTES_TO_COMPARE = [None, 2 ** 28, 2 ** 26, 2 ** 24]
+
+
+def get_peak_rss_bytes():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kB on linux
+
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+
+def make_full_resolution_problem(height, width, n_inst_per_cls, seed=0):
+    torch.manual_seed(seed)
+    model_channel_semantic_ids = list(range(N_STUFF_CLASSES)) + \
+        [s for s in range(N_STUFF_CLASSES, N_STUFF_CLASSES + N_THING_CLASSES) for _ in range(n_inst_per_cls)]
+    model_channel_instance_ids = [0] * N_STUFF_CLASSES + \
+        [i for _ in range(N_THING_CLASSES) for i in range(1, n_inst_per_cls + 1)]
+    scores = torch.randn(1, len(model_channel_semantic_ids), height, width)
+    sem_lbl = torch.randint(0, N_STUFF_CLASSES + N_THING_CLASSES, (1, height, width))
+    inst_lbl = torch.randint(1, n_inst_per_cls + 1, (1, height, width))
+    inst_lbl[sem_lbl < N_STUFF_CLASSES] = 0
+    return model_channel_semantic_ids, model_channel_instance_ids, scores, sem_lbl, inst_lbl
+
+
+def _measure(queue, max_chunk_bytes, height, width, n_inst_per_cls, backward):
+    from instanceseg.losses import loss
+    torch.set_num_threads(1)
+    model_channel_semantic_ids, model_channel_instance_ids, scores, sem_lbl, inst_lbl = \
+        make_full_resolution_problem(height, width, n_inst_per_cls)
+    loss_object = loss.loss_object_factory('cross_entropy', model_channel_semantic_ids, model_channel_instance_ids,
+                                           matching=True, size_average=True, cost_matrix_engine='segment',
+                                           cost_matrix_chunk_bytes=max_chunk_bytes)
+    scores.requires_grad_(True)
+    predictions = loss_object.transform_scores_to_predictions(scores)
+    reset_peak_rss()
+    baseline = get_peak_rss_bytes()
+    t_start = time.time()
+    assignments, total_loss, _ = loss_object.compute_matching_channel_loss(predictions, sem_lbl, inst_lbl)
+    if backward:
+        total_loss.backward()
+    queue.put((get_peak_rss_bytes() - baseline, time.time() - t_start, total_loss.item()))
+
+
+def measure_peak_memory(max_chunk_bytes, height, width, n_inst_per_cls=4, backward=True):
+    """
+    Returns (peak memory above the inputs in bytes, seconds, loss value), measured in a fresh process.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_measure, args=(queue, max_chunk_bytes, height, width, n_inst_per_cls, backward))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--n_inst_per_cls', type=int, default=4)
+    args = parser.parse_args()
+
+    print('{:25s}{:>20s}{:>15s}{:>15s}'.format('cost_matrix_chunk_bytes', 'peak above inputs', 'time', 'loss'))
+    for max_chunk_bytes in CHUNK_BYTES_TO_COMPARE:
+        peak, seconds, loss_value = measure_peak_memory(max_chunk_bytes, args.height, args.width,
+                                                        args.n_inst_per_cls)
+        print('{:25s}{:>17.1f} MB{:>13.2f} s{:>15.6f}'.format(str(max_chunk_bytes), peak / 2 ** 20, seconds,
+                                                               loss_value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Times CityscapesWithOurBasicTrainIds construction (glob, isfile checks, precomputed file transformer) against loading
+the cached file index (see instanceseg/datasets/file_index_cache.py):
+    cold: the cache file is removed before each construction
+    warm: the cache is valid (a handful of directory stats and one json load)
+Run the precomputed file generation first (scripts/precompute.py, or one construction), so cold times don't include
+generating files.
+
+python scripts/benchmarks/benchmark_dataset_startup.py --dataset_path data/cityscapes --split train
+"""
+import argparse
+import os
+import os.path as osp
+import time
+
+import numpy as np
+
+from instanceseg.datasets import cityscapes, file_index_cache
+
+
+def time_construction(root, split, use_file_index_cache, remove_cache, n_repeats):
+    cache_file = file_index_cache.get_cache_file(osp.expanduser(osp.realpath(root)), split,
+                                                 cityscapes.CityscapesWithOurBasicTrainIds.precomputed_file_transformer)
+    seconds = []
+    for _ in range(n_repeats):
+        if remove_cache and osp.isfile(cache_file):
+            os.remove(cache_file)
+        t_start = time.time()
+        dataset = cityscapes.CityscapesWithOurBasicTrainIds(root, split, use_file_index_cache=use_file_index_cache)
+        seconds.append(time.time() - t_start)
+    return np.median(seconds), len(dataset)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_path', default=cityscapes.CITYSCAPES_ROOT)
+    parser.add_argument('--split', default='train')
+    parser.add_argument('--n_repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    cityscapes.CityscapesWithOurBasicTrainIds(args.dataset_path, args.split)  # generate files, warm the page cache
+    print('{:40s}{:>12s}{:>10s}'.format('construction', 'median', 'images'))
+    for name, use_cache, remove_cache in (('no cache', False, False), ('cold cache (rebuilt + written)', True, True),
+                                          ('warm cache', True, False)):
+        seconds, n_images = time_construction(args.dataset_path, args.split, use_cache, remove_cache, args.n_repeats)
+        print('{:40s}{:>10.1f}ms{:>10d}'.format(name, 1000 * seconds, n_images))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Times the cold start of the sampler statistics (get_valid_indices_given_dataset with pixel, instance and occlusion
+counts and no cache files): one pass over the dataset per statistic (compute_or_retrieve on each) against the single
+pass of FusedDatasetStatistics (instanceseg/datasets/dataset_statistics.py).
+
+python scripts/benchmarks/benchmark_dataset_statistics.py --dataset_path data/cityscapes --n_images 50
+"""
+import argparse
+import time
+
+import torch.utils.data
+
+from instanceseg.datasets import cityscapes, dataset_statistics
+from instanceseg.datasets.runtime_transformations import BasicRuntimeDatasetTransformer
+
+
+def get_statistic_caches(dataset):
+    semantic_class_vals = range(len(dataset.semantic_class_names))
+    return [dataset_statistics.PixelsPerSemanticClass(semantic_class_vals),
+            dataset_statistics.NumberofInstancesPerSemanticClass(semantic_class_vals),
+            dataset_statistics.OcclusionsOfSameClass(semantic_class_vals)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_path', default=cityscapes.CITYSCAPES_ROOT)
+    parser.add_argument('--split', default='train')
+    parser.add_argument('--n_images', type=int, default=50)
+    parser.add_argument('--num_workers', type=int, default=4)
+    args = parser.parse_args()
+
+    dataset = cityscapes.TransformedCityscapes(args.dataset_path, args.split,
+                                               runtime_transformation=BasicRuntimeDatasetTransformer())
+    dataset = torch.utils.data.Subset(dataset, range(min(args.n_images, len(dataset))))
+    dataset.semantic_class_names = dataset.dataset.semantic_class_names
+
+    t_start = time.time()
+    separate_caches = get_statistic_caches(dataset)
+    for statistic_cache in separate_caches:
+        statistic_cache.compute_or_retrieve(dataset)
+    separate_seconds = time.time() - t_start
+
+    t_start = time.time()
+    statistics = dataset_statistics.FusedDatasetStatistics(num_workers=args.num_workers)
+    fused_caches = [statistics.register(s) for s in get_statistic_caches(dataset)]
+    statistics.compute_or_retrieve(dataset)
+    fused_seconds = time.time() - t_start
+    for separate_cache, fused_cache in zip(separate_caches, fused_caches):
+        assert separate_cache.stat_tensor.equal(fused_cache.stat_tensor)
+
+    print('{:30s}{:>12s}{:>12s}{:>10s}'.format('images', 'separate', 'fused', 'speedup'))
+    print('{:30s}{:>11.1f}s{:>11.1f}s{:>9.1f}x'.format('{} ({} workers)'.format(len(dataset), args.num_workers),
+                                                       separate_seconds, fused_seconds,
+                                                       separate_seconds / fused_seconds))
+
+
+if __name__ == '__main__':
+    main()
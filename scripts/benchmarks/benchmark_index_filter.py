@@ -0,0 +1,47 @@
+"""
+Times building a filtered sampler from cached statistics (ValidIndexFilter + get_pytorch_sampler, as
+get_configured_sampler does once the statistics are loaded) on random statistics for a large number of images.
+
+python scripts/benchmarks/benchmark_index_filter.py --n_images 100000
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from instanceseg.datasets import indexfilter, sampler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_images', type=int, default=100000)
+    parser.add_argument('--n_semantic_classes', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    shape = (args.n_images, args.n_semantic_classes)
+    instance_counts = torch.from_numpy(rng.randint(0, 10, shape).astype(np.float32))
+    semantic_pixel_counts = torch.from_numpy(rng.randint(0, 3, shape) * rng.randint(1, 10000, shape)).int()
+    occlusion_counts = torch.from_numpy(rng.randint(0, 4, shape)).int()
+    semantic_class_names = ['{}'.format(v) for v in range(args.n_semantic_classes)]
+    sampler_config = sampler.SamplerConfig(n_images=args.n_images // 10, sem_cls_filter_names=['11', '13', '14'],
+                                           n_instances_ranges=[(2, None), None, (None, 5)],
+                                           semantic_class_names=semantic_class_names, n_occlusions_range=(1, None))
+
+    t_start = time.time()
+    index_filter = indexfilter.ValidIndexFilter(sampler_config, n_original_images=args.n_images,
+                                                instance_counts=instance_counts,
+                                                semantic_class_pixel_counts=semantic_pixel_counts,
+                                                occlusion_counts=occlusion_counts)
+    valid_indices = index_filter.valid_indices
+    filter_seconds = time.time() - t_start
+    t_start = time.time()
+    my_sampler = sampler.get_pytorch_sampler(False, bool_index_subset=valid_indices)(range(args.n_images))
+    sampler_seconds = time.time() - t_start
+    print('{} images -> {} valid: filter {:.1f}ms, sampler {:.1f}ms'.format(
+        args.n_images, len(my_sampler), 1000 * filter_seconds, 1000 * sampler_seconds))
+
+
+if __name__ == '__main__':
+    main()
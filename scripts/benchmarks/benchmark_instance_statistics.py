@@ -0,0 +1,100 @@
+"""
+Profiles the loss terms on synthetic blob images (synthetic.py's painters), before and after sharing one
+InstanceStatistics pass per image between them (see instanceseg/losses/instance_statistics.py):
+    before: each semantic class' cost matrix and the semantic aggregate term make their own pass over the image
+    after: one pass per image; all loss terms read from it
+For each, we report wall time (forward + backward), the profiled CPU time, and the number of host syncs
+(aten::_local_scalar_dense, i.e. - .item() / .tolist()).
+
+python scripts/benchmarks/benchmark_instance_statistics.py --n_instances_per_img 8 --device cuda
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch import profiler
+
+from instanceseg.datasets import synthetic
+from instanceseg.losses import loss
+
+HOST_SYNC_EVENTS = ('aten::_local_scalar_dense', 'aten::item')
+
+
+def make_synthetic_batch(batch_sz, n_instances_per_img, img_size=synthetic.Defaults.img_size,
+                         blob_size=synthetic.Defaults.blob_size, seed=0):
+    """
+    Semantic classes: background (0), square (1), circle (2), like BlobExampleGenerator
+    """
+    rng = np.random.RandomState(seed)
+    sem_lbl = np.zeros((batch_sz,) + img_size, dtype=int)
+    inst_lbl = np.zeros((batch_sz,) + img_size, dtype=int)
+    for i in range(batch_sz):
+        for instance_id in range(1, n_instances_per_img + 1):
+            for sem_val, painter in ((1, synthetic.paint_square), (2, synthetic.paint_circle)):
+                r, c = rng.randint(0, img_size[0] - blob_size[0]), rng.randint(0, img_size[1] - blob_size[1])
+                mask = painter(np.zeros(img_size), r, c, blob_size[0], blob_size[1], 1, color_dim=None) > 0
+                sem_lbl[i][mask], inst_lbl[i][mask] = sem_val, instance_id
+    model_channel_semantic_ids = [0] + [1] * n_instances_per_img + [2] * n_instances_per_img
+    model_channel_instance_ids = [0] + list(range(1, n_instances_per_img + 1)) * 2
+    return model_channel_semantic_ids, model_channel_instance_ids, torch.from_numpy(sem_lbl), \
+        torch.from_numpy(inst_lbl)
+
+
+def run_loss(loss_object, scores, sem_lbl, inst_lbl, shared_statistics):
+    predictions = loss_object.transform_scores_to_predictions(scores)
+    instance_stats = loss_object.get_instance_statistics(predictions, sem_lbl, inst_lbl) if shared_statistics \
+        else None
+    _, total_channel_loss, _ = loss_object.compute_matching_channel_loss(predictions, sem_lbl, inst_lbl,
+                                                                         instance_stats=instance_stats)
+    total_agg_sem_loss, _, _ = loss_object.compute_agg_semantic_component(predictions, sem_lbl, inst_lbl,
+                                                                          instance_stats)
+    total_loss = total_channel_loss + loss_object.semantic_agg_multiplier * total_agg_sem_loss
+    total_loss.backward()
+    return total_loss.item()
+
+
+def profile_loss(loss_object, scores, sem_lbl, inst_lbl, shared_statistics, n_repeats):
+    run_loss(loss_object, scores, sem_lbl, inst_lbl, shared_statistics)  # warm up
+    t_start = time.time()
+    for _ in range(n_repeats):
+        run_loss(loss_object, scores, sem_lbl, inst_lbl, shared_statistics)
+    if scores.is_cuda:
+        torch.cuda.synchronize()
+    seconds = (time.time() - t_start) / n_repeats
+    with profiler.profile(activities=[profiler.ProfilerActivity.CPU]) as prof:
+        loss_value = run_loss(loss_object, scores, sem_lbl, inst_lbl, shared_statistics)
+    events = prof.key_averages()
+    cpu_time = sum(e.self_cpu_time_total for e in events) / 1e6
+    n_host_syncs = sum(e.count for e in events if e.key in HOST_SYNC_EVENTS) - 1  # minus the reported loss value
+    return seconds, cpu_time, n_host_syncs, loss_value
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sz', type=int, default=2)
+    parser.add_argument('--n_instances_per_img', type=int, default=8)
+    parser.add_argument('--n_repeats', type=int, default=5)
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    model_channel_semantic_ids, model_channel_instance_ids, sem_lbl, inst_lbl = \
+        make_synthetic_batch(args.batch_sz, args.n_instances_per_img)
+    sem_lbl, inst_lbl = sem_lbl.to(args.device), inst_lbl.to(args.device)
+    torch.manual_seed(0)
+    scores = torch.randn((args.batch_sz, len(model_channel_semantic_ids)) + tuple(sem_lbl.shape[1:]),
+                         device=args.device, requires_grad=True)
+
+    print('{:40s}{:>12s}{:>12s}{:>12s}{:>12s}'.format('loss', 'wall', 'cpu', 'host syncs', 'value'))
+    for loss_type, size_average in (('cross_entropy', True), ('soft_iou', False)):
+        loss_object = loss.loss_object_factory(loss_type, model_channel_semantic_ids, model_channel_instance_ids,
+                                               matching=True, size_average=size_average, cost_matrix_engine='segment')
+        for name, shared_statistics in (('before (one pass per term)', False), ('after (shared pass)', True)):
+            seconds, cpu_time, n_host_syncs, loss_value = profile_loss(loss_object, scores, sem_lbl, inst_lbl,
+                                                                       shared_statistics, args.n_repeats)
+            print('{:40s}{:>10.1f}ms{:>10.1f}ms{:>12d}{:>12.5f}'.format(
+                '{}, {}'.format(loss_type, name), 1000 * seconds, 1000 * cpu_time, n_host_syncs, loss_value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Times label remapping with one mask write per mapped value (the loops the call sites used) against the cached lookup
+tables of instanceseg/utils/label_remap.py, from synthetic.py's image size up to full Cityscapes, for:
+    raw_to_train_ids: Cityscapes raw ids (-1..33) -> train ids, numpy
+        (CityscapesMapRawtoTrainIdPrecomputedFileDatasetTransformer)
+    semantic_subset: train ids -> a 4-class subset, other classes to background, torch
+        (remap_to_reduced_semantic_classes / SemanticSubsetRuntimeDatasetTransformer)
+
+python scripts/benchmarks/benchmark_label_remap.py --n_repeats 10
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from instanceseg.datasets import labels_table_cityscapes, synthetic
+from instanceseg.utils import label_remap
+
+LABEL_SIZES = (('synthetic', synthetic.Defaults.img_size), ('cityscapes_half', (512, 1024)),
+               ('cityscapes', (1024, 2048)))
+
+
+def loop_remap(lbl, old_vals, new_vals, default=None):
+    old_lbl = lbl.clone() if torch.is_tensor(lbl) else lbl.copy()
+    if default is not None:
+        lbl[...] = default
+    for old_val, new_val in zip(old_vals, new_vals):
+        lbl[old_lbl == old_val] = new_val
+    return lbl
+
+
+def lut_remap(lbl, old_vals, new_vals, default=None):
+    return label_remap.remap_values(lbl, old_vals, new_vals, default=default, inplace=True)
+
+
+def get_cases(size, rng):
+    raw_ids = sorted(labels_table_cityscapes.ID_TO_TRAIN_ID.keys())
+    train_ids = [labels_table_cityscapes.ID_TO_TRAIN_ID[i] for i in raw_ids]
+    raw_sem_lbl = rng.choice(raw_ids, size=size).astype(np.int32)
+    reduced_class_idxs = [0, 11, 13, 24]
+    sem_lbl = torch.from_numpy(rng.randint(-1, 19, size=size)).long()
+    return [('raw_to_train_ids', raw_sem_lbl, (raw_ids, train_ids, None)),
+            ('semantic_subset', sem_lbl, ([-1] + reduced_class_idxs, [-1, 0, 1, 2, 3], 0))]
+
+
+def time_remap(remap_fcn, lbl, mapping, n_repeats):
+    seconds = []
+    for _ in range(n_repeats):
+        lbl_copy = lbl.clone() if torch.is_tensor(lbl) else lbl.copy()
+        t_start = time.time()
+        remap_fcn(lbl_copy, *mapping)
+        seconds.append(time.time() - t_start)
+    return np.median(seconds), lbl_copy
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    print('{:18s}{:18s}{:>12s}{:>12s}{:>10s}'.format('case', 'size', 'loop', 'lut', 'speedup'))
+    for size_name, size in LABEL_SIZES:
+        for case_name, lbl, mapping in get_cases(size, rng):
+            loop_seconds, loop_lbl = time_remap(loop_remap, lbl, mapping, args.n_repeats)
+            lut_seconds, lut_lbl = time_remap(lut_remap, lbl, mapping, args.n_repeats)
+            assert (np.asarray(loop_lbl) == np.asarray(lut_lbl)).all()
+            print('{:18s}{:18s}{:>10.2f}ms{:>10.2f}ms{:>9.1f}x'.format(
+                case_name, '{}x{}'.format(*size), 1000 * loop_seconds, 1000 * lut_seconds, loop_seconds / lut_seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Times a DataLoader over synthetic Cityscapes-sized datapoints with the regular runtime transformation (float32 images,
+int64 labels out of the workers) against compact transport (uint8 images, int16 labels; centered and widened batched
+afterwards, see BasicRuntimeDatasetTransformer(compact_transport=True) and datasets.decompact_batch).  Reports
+images / second through the loader -- including the batched decompaction, on --device -- and the bytes each batch
+carries between the worker processes and the main process.
+
+python scripts/benchmarks/benchmark_loader_transport.py --height 1024 --width 2048 --batch_size 2 --num_workers 4
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from instanceseg.datasets import runtime_transformations
+from instanceseg.utils import datasets
+
+MEAN_BGR = np.array([104.00698793, 116.66876762, 122.67891434])
+
+
+class SyntheticDataset(Dataset):
+    def __init__(self, n_images, height, width, runtime_transformation, n_raw_images=4):
+        self.n_images = n_images
+        self.runtime_transformation = runtime_transformation
+        rng = np.random.RandomState(0)
+        self.raw_datapoints = []
+        for _ in range(n_raw_images):
+            img = rng.randint(0, 256, size=(height, width, 3)).astype(np.uint8)
+            sem_lbl = rng.randint(-1, 19, size=(height, width)).astype(np.int32)
+            inst_lbl = rng.randint(0, 20, size=(height, width)).astype(np.int32)
+            self.raw_datapoints.append((img, sem_lbl, inst_lbl))
+
+    def __len__(self):
+        return self.n_images
+
+    def __getitem__(self, index):
+        img, sem_lbl, inst_lbl = self.raw_datapoints[index % len(self.raw_datapoints)]
+        img, (sem_lbl, inst_lbl) = self.runtime_transformation.transform(img.copy(), (sem_lbl.copy(), inst_lbl.copy()))
+        return {'image': img, 'sem_lbl': sem_lbl, 'inst_lbl': inst_lbl}
+
+
+def time_loader(args, compact_transport):
+    runtime_transformation = runtime_transformations.runtime_transformer_factory(mean_bgr=MEAN_BGR,
+                                                                                 compact_transport=compact_transport)
+    dataset = SyntheticDataset(args.n_images, args.height, args.width, runtime_transformation)
+    loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers,
+                        pin_memory=args.device == 'cuda')
+    mean_bgr = runtime_transformations.get_compact_transport_mean_bgr(runtime_transformation)
+    batch_bytes = None
+    t_start = time.time()
+    for batch in loader:
+        if batch_bytes is None:
+            batch_bytes = sum(batch[k].element_size() * batch[k].nelement() for k in ('image', 'sem_lbl', 'inst_lbl'))
+        img, sem_lbl, inst_lbl = [batch[k].to(args.device, non_blocking=True) for k in ('image', 'sem_lbl', 'inst_lbl')]
+        img, sem_lbl, inst_lbl = datasets.decompact_batch(img, sem_lbl, inst_lbl, mean_bgr=mean_bgr)
+    if args.device == 'cuda':
+        torch.cuda.synchronize()
+    return args.n_images / (time.time() - t_start), batch_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_images', type=int, default=64)
+    parser.add_argument('--height', type=int, default=1024)
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    print('{:12s}{:>14s}{:>14s}'.format('transport', 'images/s', 'MB/batch'))
+    for name, compact_transport in (('regular', False), ('compact', True)):
+        images_per_second, batch_bytes = time_loader(args, compact_transport)
+        print('{:12s}{:>14.1f}{:>14.1f}'.format(name, images_per_second, batch_bytes / 1e6))
+
+
+if __name__ == '__main__':
+    main()
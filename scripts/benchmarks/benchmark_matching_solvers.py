@@ -0,0 +1,62 @@
+"""
+Times the assignment solvers behind match.MatchingSolverPool on random cost matrices of the (n_pred, n_gt) sizes we
+see in training.  Each 'batch' is the set of assignment problems for one minibatch (images x semantic classes).
+
+python scripts/benchmarks/benchmark_matching_solvers.py --device cuda
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from instanceseg.losses import match
+
+# (name, n_pred, n_gt, n_problems_per_batch)
+PROBLEM_SIZES = [
+    ('synthetic (3 inst/cls)', 3, 3, 2),
+    ('synthetic, more gt than channels', 3, 5, 2),
+    ('cityscapes person', 20, 25, 8),
+    ('cityscapes car', 40, 60, 8),
+    ('cityscapes, all thing classes', 20, 30, 8 * 8),
+]
+
+
+def time_solver(solver, cost_tensors, n_repeats):
+    solver.solve(cost_tensors)  # warm up (thread pool creation, cuda kernels)
+    if cost_tensors[0].is_cuda:
+        torch.cuda.synchronize()
+    t_start = time.time()
+    for _ in range(n_repeats):
+        solver.solve(cost_tensors)
+    if cost_tensors[0].is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - t_start) / n_repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--n_repeats', type=int, default=10)
+    parser.add_argument('--n_workers', type=int, default=4)
+    args = parser.parse_args()
+
+    solvers = {
+        'scipy, serial': match.MatchingSolverPool(n_workers=0, backend='scipy'),
+        'scipy, {} threads'.format(args.n_workers): match.MatchingSolverPool(n_workers=args.n_workers,
+                                                                            backend='scipy'),
+        'torch': match.MatchingSolverPool(backend='torch'),
+    }
+    rng = np.random.RandomState(0)
+    print('{:45s}'.format('problem (n_pred x n_gt, n/batch)') + ''.join('{:>20s}'.format(s) for s in solvers))
+    for name, n_pred, n_gt, n_problems in PROBLEM_SIZES:
+        cost_tensors = [torch.from_numpy(rng.rand(n_pred, n_gt)).float().to(args.device) for _ in range(n_problems)]
+        times_ms = [1000 * time_solver(solver, cost_tensors, args.n_repeats) for solver in solvers.values()]
+        print('{:45s}'.format('{} ({}x{}, {})'.format(name, n_pred, n_gt, n_problems)) +
+              ''.join('{:>17.2f} ms'.format(t) for t in times_ms))
+    for solver in solvers.values():
+        solver.close()
+
+
+if __name__ == '__main__':
+    main()
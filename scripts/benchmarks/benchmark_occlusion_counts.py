@@ -0,0 +1,66 @@
+"""
+Times the occlusion counts of one image against its number of instances: the pairwise dilate-and-intersect loop of
+OcclusionsOfSameClass.compute_occlusions_from_batch_of_one_semantic_cls (one full-image mask operation per pair of
+instances) against the single label-adjacency pass of count_occlusions_per_semantic_class
+(instanceseg/datasets/dataset_statistics.py).  Instances are synthetic squares and circles (synthetic.py's painters).
+
+python scripts/benchmarks/benchmark_occlusion_counts.py --img_size 512 1024 --n_instances 4 16 64
+"""
+import argparse
+import time
+
+import numpy as np
+
+from instanceseg.datasets import dataset_statistics, synthetic
+
+
+def make_synthetic_labels(img_size, n_instances_per_cls, blob_size, seed=0):
+    """
+    Semantic classes: background (0), square (1), circle (2), like BlobExampleGenerator
+    """
+    rng = np.random.RandomState(seed)
+    sem_lbl = np.zeros(img_size, dtype=np.uint8)
+    inst_lbl = np.zeros(img_size, dtype=np.uint8)
+    for instance_id in range(1, n_instances_per_cls + 1):
+        for sem_val, painter in ((1, synthetic.paint_square), (2, synthetic.paint_circle)):
+            r, c = rng.randint(0, img_size[0] - blob_size[0]), rng.randint(0, img_size[1] - blob_size[1])
+            mask = painter(np.zeros(img_size), r, c, blob_size[0], blob_size[1], 1, color_dim=None) > 0
+            sem_lbl[mask], inst_lbl[mask] = sem_val, instance_id
+    return sem_lbl, inst_lbl
+
+
+def time_call(fcn, n_repeats):
+    t_start = time.time()
+    for _ in range(n_repeats):
+        result = fcn()
+    return result, (time.time() - t_start) / n_repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--img_size', type=int, nargs=2, default=(512, 1024))
+    parser.add_argument('--blob_size', type=int, nargs=2, default=(60, 60))
+    parser.add_argument('--n_instances', type=int, nargs='+', default=(2, 4, 8, 16, 32, 64))
+    parser.add_argument('--n_repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    semantic_class_vals = [0, 1, 2]
+    print('{:>12s}{:>14s}{:>14s}{:>10s}'.format('instances', 'pairwise', 'adjacency', 'speedup'))
+    for n_instances in args.n_instances:
+        sem_lbl, inst_lbl = make_synthetic_labels(tuple(args.img_size), n_instances, tuple(args.blob_size))
+
+        def pairwise():
+            return [dataset_statistics.OcclusionsOfSameClass.compute_occlusions_from_batch_of_one_semantic_cls(
+                sem_lbl[:, :, None], inst_lbl[:, :, None], sem_val)[0][0] for sem_val in semantic_class_vals]
+
+        expected_counts, pairwise_seconds = time_call(pairwise, args.n_repeats)
+        counts, adjacency_seconds = time_call(lambda: dataset_statistics.count_occlusions_per_semantic_class(
+            sem_lbl, inst_lbl, semantic_class_vals), args.n_repeats)
+        assert counts.tolist() == expected_counts
+        print('{:>12d}{:>12.1f}ms{:>12.1f}ms{:>9.1f}x'.format(2 * n_instances, 1000 * pairwise_seconds,
+                                                             1000 * adjacency_seconds,
+                                                             pairwise_seconds / adjacency_seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Times reading Cityscapes items at a reduced resolution: decoding the full-size files and resizing them
+(ResizeRuntimeDatasetTransformer, every epoch) against loading the pre-resized copies of a ResizedDatasetCache
+(instanceseg/datasets/resized_cache.py), and how long building the cache takes.
+
+python scripts/benchmarks/benchmark_resized_cache.py --dataset_path data/cityscapes --resize_size 512 1024
+"""
+import argparse
+import shutil
+import tempfile
+import time
+
+from instanceseg.datasets import cityscapes
+from instanceseg.datasets.runtime_transformations import ResizeRuntimeDatasetTransformer
+
+
+def get_dataset(dataset_path, resize_size, resized_cache_dir=None, n_workers=None):
+    return cityscapes.TransformedCityscapes(dataset_path, 'train',
+                                            runtime_transformation=ResizeRuntimeDatasetTransformer(resize_size),
+                                            resized_cache_dir=resized_cache_dir, resized_cache_workers=n_workers)
+
+
+def time_items(dataset, n_items):
+    t_start = time.time()
+    for index in range(n_items):
+        dataset[index]
+    return (time.time() - t_start) / n_items
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_path', default=cityscapes.CITYSCAPES_ROOT)
+    parser.add_argument('--resize_size', type=int, nargs=2, default=[512, 1024])
+    parser.add_argument('--n_items', type=int, default=50)
+    parser.add_argument('--n_workers', type=int, default=None, help='building the cache. None: one per cpu')
+    args = parser.parse_args()
+
+    resize_size = tuple(args.resize_size)
+    dataset = get_dataset(args.dataset_path, resize_size)
+    n_items = min(args.n_items, len(dataset))
+    cache_root = tempfile.mkdtemp()
+    try:
+        t_start = time.time()
+        cached_dataset = get_dataset(args.dataset_path, resize_size, cache_root, args.n_workers)
+        build_seconds = time.time() - t_start
+        runtime_seconds = time_items(dataset, n_items)
+        cached_seconds = time_items(cached_dataset, n_items)
+    finally:
+        shutil.rmtree(cache_root)
+
+    print('Built the cache of {} images at {} in {:.1f}s'.format(len(dataset), resize_size, build_seconds))
+    print('{:24s}{:>14s}{:>14s}{:>10s}'.format('size', 'load+resize', 'cached', 'speedup'))
+    print('{:24s}{:>12.1f}ms{:>12.1f}ms{:>9.1f}x'.format('{}x{}'.format(*resize_size), 1000 * runtime_seconds,
+                                                         1000 * cached_seconds, runtime_seconds / cached_seconds))
+
+
+if __name__ == '__main__':
+    main()
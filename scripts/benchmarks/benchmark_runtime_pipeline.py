@@ -0,0 +1,98 @@
+"""
+Times the per-sample runtime transformation a DataLoader worker runs (runtime_transformer_factory's chain: to tensor,
+semantic subset, instance number cap, things to stuff) with each transformer making its own passes over the labels
+against the fused pipeline (GenericSequenceRuntimeDatasetTransformer(fuse_label_transformers=True): the label-only
+transformers as one (semantic, instance) lookup table, see FusedLabelRuntimeDatasetTransformer), and the per-item
+transformation_tag rebuilt from the transformers' attributes against the cached one.
+
+python scripts/benchmarks/benchmark_runtime_pipeline.py --height 1024 --width 2048
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from instanceseg.datasets import runtime_transformations
+from instanceseg.datasets.panoptic_dataset_base import TransformedPanopticDataset, get_transformer_identifier_tag
+
+
+def get_transformer_sequence(single_instance):
+    return runtime_transformations.runtime_transformer_factory(
+        reduced_class_idxs=[0, 11, 12, 13, 14, 15, 16, 17, 18], n_inst_cap_per_class=20,
+        instance_id_for_excluded_instances=-1, map_to_single_instance_problem=single_instance).transformer_sequence
+
+
+def get_datapoint(height, width, seed=0):
+    """
+    Cityscapes-like: train ids (-1..18), and instance ids of things (11..18), some past the cap
+    """
+    rng = np.random.RandomState(seed)
+    sem_lbl = rng.randint(-1, 19, size=(height, width))
+    inst_lbl = rng.randint(1, 30, size=(height, width))
+    inst_lbl[sem_lbl < 11] = 0
+    inst_lbl[sem_lbl == -1] = -1
+    img = rng.randint(0, 256, size=(height, width, 3)).astype(np.uint8)
+    return img, sem_lbl, inst_lbl
+
+
+def copy(datapoint):
+    return [x.clone() if torch.is_tensor(x) else x.copy() for x in datapoint]
+
+
+def time_transform(transformer, datapoint, n_repeats):
+    img, sem_lbl, inst_lbl = copy(datapoint)
+    transformer.transform(img, (sem_lbl, inst_lbl))  # compile
+    seconds = []
+    for _ in range(n_repeats):
+        img, sem_lbl, inst_lbl = copy(datapoint)
+        inputs = (img, (sem_lbl, inst_lbl))
+        t_start = time.time()
+        transformer.transform(*inputs)
+        seconds.append(time.time() - t_start)
+    return np.median(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--height', type=int, default=1024)
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--n_repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    img, sem_lbl, inst_lbl = get_datapoint(args.height, args.width)
+    print('{:40s}{:>12s}{:>12s}{:>10s}'.format('pipeline', 'sequence', 'fused', 'speedup'))
+    for single_instance in (False, True):
+        transformer_sequence = get_transformer_sequence(single_instance)
+        # The whole chain, and its label-only transformers on their own (after the conversion to tensors)
+        basic_transformer, label_transformers = transformer_sequence[0], transformer_sequence[1:]
+        tensor_img, (tensor_sem_lbl, tensor_inst_lbl) = basic_transformer.transform(img, (sem_lbl, inst_lbl))
+        for name, sequence, datapoint in (
+                ('to tensor + {} label transformers', transformer_sequence, (img, sem_lbl, inst_lbl)),
+                ('{} label transformers', label_transformers, (tensor_img, tensor_sem_lbl, tensor_inst_lbl))):
+            seconds = [time_transform(runtime_transformations.GenericSequenceRuntimeDatasetTransformer(
+                sequence, fuse_label_transformers=fuse), datapoint, args.n_repeats) for fuse in (False, True)]
+            print('{:40s}{:>10.1f}ms{:>10.1f}ms{:>9.1f}x'.format(
+                name.format(len(label_transformers)), 1000 * seconds[0], 1000 * seconds[1], seconds[0] / seconds[1]))
+
+    runtime_transformation = runtime_transformations.GenericSequenceRuntimeDatasetTransformer(
+        get_transformer_sequence(True))
+    dataset = TransformedPanopticDataset(None, raw_dataset_returns_images=True,
+                                         runtime_transformation=runtime_transformation)
+    n_tags = 1000
+    t_start = time.time()
+    for _ in range(n_tags):
+        for transformer in runtime_transformation.transformer_sequence:  # as before: inspected every item
+            transformer._attribute_items = None
+        get_transformer_identifier_tag(None, runtime_transformation)
+    rebuilt_seconds = (time.time() - t_start) / n_tags
+    t_start = time.time()
+    for _ in range(n_tags):
+        dataset.transformation_tag
+    cached_seconds = (time.time() - t_start) / n_tags
+    print('{:40s}{:>10.3f}ms{:>10.3f}ms{:>9.1f}x'.format('transformation_tag', 1000 * rebuilt_seconds,
+                                                         1000 * cached_seconds, rebuilt_seconds / cached_seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,16 @@ class PARAM_CLASSIFICATIONS(object):
     optim = {'optim', 'max_iteration', 'lr', 'momentum', 'weight_decay', 'reset_optim'}
     export = {'interval_validate', 'export_activations', 'activation_layers_to_export', 'write_instance_metrics',
               'n_model_checkpoints', 'skip_validation', 'validation_gpu'}
-    loss = {'matching', 'size_average', 'loss_type', 'lr_scheduler'}
+    loss = {'matching', 'size_average', 'loss_type', 'lr_scheduler', 'cost_matrix_engine', 'cost_matrix_chunk_bytes',
+            'matching_solver_workers', 'matching_solver_backend', 'matching_mode', 'sinkhorn_temperature',
+            'sinkhorn_n_iters', 'sinkhorn_temperature_decay', 'sinkhorn_min_temperature',
+            'sinkhorn_diagnostic_interval', 'assignment_cache'}
     data = {'semantic_only_labels', 'set_extras_to_void', 'semantic_subset', 'ordering', 'sampler', 'dataset',
             'dataset_instance_cap', 'resize', 'resize_size', 'dataset_path', 'train_batch_size',
             'val_batch_size', 'test_batch_size', 'instance_id_for_excluded_instances', 'blob_size',
-            'debug_dataloader_only', 'n_debug_images'}
+            'debug_dataloader_only', 'n_debug_images', 'cap_sizes_in_workers', 'compiled_store_dir',
+            'compact_transport', 'resized_cache_dir', 'dataloader_autotune', 'statistics_num_workers',
+            'file_index_cache_dir'}
     problem_config = {'n_instances_per_class', 'single_instance', 'map_to_semantic', 'augment_semantic'}
     model = {'backbone', 'initialize_from_semantic', 'bottleneck_channel_capacity', 'score_multiplier', 'freeze_vgg',
              'map_to_semantic', 'augment_semantic', 'use_conv8', 'use_attn_layer', 'clip'}
@@ -25,6 +30,17 @@ _default_train_config = dict(
     matching=True,
     size_average=True,
     loss_type='cross_entropy',  # 'cross_entropy' ('xent'), 'softiou'
+    cost_matrix_engine='loop',  # 'loop' (one component loss call per prediction/gt pair), 'segment' (one pass per class)
+    cost_matrix_chunk_bytes=None,  # e.g. 2 ** 26: bound segment-engine temporaries (full-resolution training)
+    matching_solver_workers=0,  # threads for solving the batch's assignment problems; 0: serial
+    matching_solver_backend='scipy',  # 'scipy', 'torch' (solves on the scores' device)
+    matching_mode='hungarian',  # 'hungarian', 'sinkhorn' (soft assignment; training loss only)
+    sinkhorn_temperature=0.1,  # relative to each cost matrix's range
+    sinkhorn_n_iters=20,
+    sinkhorn_temperature_decay=1.0,  # per iteration; anneals toward sinkhorn_min_temperature
+    sinkhorn_min_temperature=0.01,
+    sinkhorn_diagnostic_interval=0,  # compare hardened soft assignment to the exact one every N iterations; 0: never
+    assignment_cache=False,  # skip re-solving an image's assignment while it provably stays optimal
 
     # optim
     optim='sgd',
@@ -64,6 +80,13 @@ _default_train_config = dict(
     val_batch_size=1,
     test_batch_size=1,
     instance_id_for_excluded_instances=None,  # -1 for void
+    cap_sizes_in_workers=False,  # drop instances beyond n_instances_per_class (smallest first) in the DataLoader
+    compiled_store_dir=None,  # e.g. 'data/cityscapes_compiled': decode each split once into memory-mapped arrays
+    compact_transport=False,  # uint8 images / int16 labels through the DataLoader; centered, widened in the trainer
+    resized_cache_dir=None,  # e.g. 'data/cityscapes_resized': with resize, resize each split once and train from that
+    dataloader_autotune=False,  # DataLoader workers / prefetch from a timed sweep, cached per host and dataset
+    statistics_num_workers=None,  # DataLoader workers of the sampler's dataset statistics pass (None: 4)
+    file_index_cache_dir=None,  # e.g. 'cache/file_index': keep the Cityscapes file index here, not in the dataset root
     # semantic_only_labels=False,
     # set_extras_to_void=True,
 
@@ -5,11 +5,11 @@ from instanceseg.datasets.sampler import SamplerConfigWithoutValues
 
 def create_sampler_cfg_set(n_images_train=None, n_images_val=None, n_images_train_for_val=None,
                            sem_cls_filter_names=None, n_instances_ranges=None,
-                           n_occlusions_range=None, val_copy_train=False):
+                           n_occlusions_range=None, val_copy_train=False, bucket_batches=False):
     sampler_cfg_kwargs = dict(sem_cls_filter_names=sem_cls_filter_names,
                               n_instances_ranges=n_instances_ranges,
                               n_occlusions_range=n_occlusions_range)
-    train_sampler_cfg_kwargs = dict(n_images=n_images_train)
+    train_sampler_cfg_kwargs = dict(n_images=n_images_train, bucket_batches=bucket_batches)
     val_sampler_cfg_kwargs = dict(n_images=n_images_val)
     assert val_copy_train is False or n_images_val is None
     train_sampler_cfg = SamplerConfigWithoutValues(**train_sampler_cfg_kwargs, **sampler_cfg_kwargs)
@@ -26,6 +26,7 @@ def create_sampler_cfg_set(n_images_train=None, n_images_val=None, n_images_trai
 sampler_cfgs = {
     None: create_sampler_cfg_set(),
     'default': create_sampler_cfg_set(),
+    'bucketed': create_sampler_cfg_set(bucket_batches=True),
     '2019-08-01-below_capacity_3': create_sampler_cfg_set(n_images_train=1, val_copy_train=True,
                                                           sem_cls_filter_names=['car', 'person'],
                                                           n_instances_ranges=[(2, 2 + 1), (1, 1 + 1)]),
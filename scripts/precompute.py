@@ -0,0 +1,37 @@
+"""
+Generates every precomputed file the Cityscapes datasets need, in parallel, before training (see
+instanceseg/datasets/precompute.py): the train id / mode P labels of CityscapesWithOurBasicTrainIds, then the instance
+ordering files of TransformedCityscapes; with --resized_cache_dir, the resized copies of each split too (see
+instanceseg/datasets/resized_cache.py).
+
+python scripts/precompute.py --dataset_path data/cityscapes --splits train val --ordering lr --n_workers 8
+python scripts/precompute.py --resize_size 512 1024 --resized_cache_dir data/cityscapes_resized
+"""
+import argparse
+
+from instanceseg.datasets import cityscapes
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_path', default=cityscapes.CITYSCAPES_ROOT)
+    parser.add_argument('--splits', nargs='+', default=['train', 'val'])
+    parser.add_argument('--ordering', default=None, help='e.g. lr, big_to_small (cfg[\'ordering\'])')
+    parser.add_argument('--n_workers', type=int, default=None, help='None: one per cpu; 0: serial')
+    parser.add_argument('--resize_size', type=int, nargs=2, default=None, help='H W (cfg[\'resize_size\'])')
+    parser.add_argument('--resized_cache_dir', default=None, help='cfg[\'resized_cache_dir\']')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    for split in args.splits:
+        cityscapes.precompute_cityscapes_split(args.dataset_path, split, args.ordering, args.n_workers)
+        if args.resized_cache_dir is not None:
+            assert args.resize_size is not None, '--resized_cache_dir needs --resize_size'
+            cityscapes.build_resized_cityscapes_split(args.dataset_path, split, tuple(args.resize_size),
+                                                      args.resized_cache_dir, args.ordering, args.n_workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+import os
+import os.path as osp
+import shutil
+
+import pytest
+
+from instanceseg.datasets import cityscapes
+
+UNITTEST_CITYSCAPES_DATASET_ROOT = osp.join(osp.dirname(osp.abspath(__file__)), 'test_data', 'cityscapesunittest')
+N_UNITTEST_IMAGES = 3
+
+
+@pytest.fixture
+def copy_unittest_raw_dataset(tmp_path):
+    """
+    Copies leftImg8bit / labelIds / instanceIds of the first n_images unittest images (None: all of them), in the
+    Cityscapes directory structure, to tmp_path / name (so the test can generate files in it); returns that root
+    """
+    def copy(name='cityscapes', n_images=N_UNITTEST_IMAGES):
+        dest_root = tmp_path / name
+        for data_files in cityscapes.get_raw_cityscapes_files(UNITTEST_CITYSCAPES_DATASET_ROOT, 'train')[:n_images]:
+            for f in data_files.values():
+                new_file = osp.join(str(dest_root), osp.relpath(f, UNITTEST_CITYSCAPES_DATASET_ROOT))
+                os.makedirs(osp.dirname(new_file), exist_ok=True)
+                shutil.copyfile(f, new_file)
+        return str(dest_root)
+    return copy
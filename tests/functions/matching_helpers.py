@@ -0,0 +1,38 @@
+"""
+Random matching problems shared by the loss / matching tests
+"""
+import numpy as np
+import torch
+
+from instanceseg.losses import loss
+
+# 3 semantic classes: background (stuff, 1 channel), two thing classes with 3 and 2 channels
+MODEL_CHANNEL_SEMANTIC_IDS = [0, 1, 1, 1, 2, 2]
+MODEL_CHANNEL_INSTANCE_IDS = [0, 1, 2, 3, 1, 2]
+
+
+def make_random_batch(batch_sz=2, h=24, w=32, seed=0):
+    torch.manual_seed(seed)
+    scores = torch.randn(batch_sz, len(MODEL_CHANNEL_SEMANTIC_IDS), h, w)
+    sem_lbl = torch.randint(0, 3, (batch_sz, h, w))
+    inst_lbl = torch.randint(1, 5, (batch_sz, h, w))  # more gt instances than channels for sem 2
+    inst_lbl[sem_lbl == 0] = 0
+    inst_lbl[0, :2, :] = -1  # void
+    inst_lbl[1][sem_lbl[1] == 1] = 2  # single instance -> false positive columns
+    return scores, sem_lbl, inst_lbl
+
+
+def get_loss_objects(loss_type, size_average):
+    return [loss.loss_object_factory(loss_type, MODEL_CHANNEL_SEMANTIC_IDS, MODEL_CHANNEL_INSTANCE_IDS,
+                                     matching=True, size_average=size_average, cost_matrix_engine=engine)
+            for engine in ('loop', 'segment')]
+
+
+def get_random_cost_tensors(n_problems=20, max_n_pred=8, seed=0):
+    rng = np.random.RandomState(seed)
+    cost_tensors = []
+    for _ in range(n_problems):
+        n_pred = rng.randint(1, max_n_pred + 1)
+        n_gt = n_pred + rng.randint(0, 4)
+        cost_tensors.append(torch.from_numpy(rng.rand(n_pred, n_gt)).float())
+    return cost_tensors
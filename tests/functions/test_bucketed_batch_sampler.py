@@ -0,0 +1,117 @@
+import numpy as np
+import torch
+import torch.utils.data
+
+from instanceseg.datasets import sampler
+from instanceseg.factory import samplers as sampler_factory
+from instanceseg.train import metrics
+from scripts.configurations import sampler_cfg_registry
+
+
+class VariableSizeDataset(torch.utils.data.Dataset):
+    semantic_class_names = ['background', 'car', 'person']
+
+    def __init__(self, n_images, seed=0):
+        rng = np.random.RandomState(seed)
+        self.sizes = [((8, 16), (16, 8), (12, 12))[i] for i in rng.randint(0, 3, n_images)]
+        self.n_instances = rng.randint(0, 6, (n_images, 2))
+
+    def __getitem__(self, index):
+        sem_lbl = torch.zeros(self.sizes[index], dtype=torch.long)
+        inst_lbl = torch.zeros(self.sizes[index], dtype=torch.long)
+        for sem_val, n_instances in zip((1, 2), self.n_instances[index]):
+            for inst_val in range(1, n_instances + 1):
+                sem_lbl[sem_val - 1, inst_val] = sem_val
+                inst_lbl[sem_val - 1, inst_val] = inst_val
+        return {'image': torch.zeros((3,) + self.sizes[index]), 'sem_lbl': sem_lbl, 'inst_lbl': inst_lbl}
+
+    def __len__(self):
+        return len(self.sizes)
+
+
+def test_bucketed_batches_have_one_size_and_similar_costs():
+    rng = np.random.RandomState(0)
+    n_images, batch_size = 100, 4
+    image_sizes = np.array([(8, 16), (16, 8), (12, 12)])[rng.randint(0, 3, n_images)]
+    instance_counts = rng.randint(0, 10, (n_images, 3))
+    indices = list(range(0, n_images, 2)) + [1]
+    torch.manual_seed(0)
+    batch_sampler = sampler.BucketedBatchSampler(indices, image_sizes, instance_counts, batch_size)
+    batches = list(batch_sampler)
+    assert len(batches) == len(batch_sampler)
+    assert sorted(i for batch in batches for i in batch) == sorted(indices)
+    costs = sampler.get_matching_costs(instance_counts)
+    for batch in batches:
+        assert 0 < len(batch) <= batch_size
+        assert len(set(map(tuple, image_sizes[batch]))) == 1
+    # Sorted by cost within each size: far less spread per batch than random batches
+    bucketed_spread = np.mean([np.ptp(costs[batch]) for batch in batches])
+    random_spread = np.mean([np.ptp(costs[indices[i:i + batch_size]]) for i in range(0, len(indices), batch_size)])
+    assert bucketed_spread < random_spread / 3
+
+    # Resumable by batch
+    state_dict = batch_sampler.state_dict(n_consumed=5)
+    resumed_sampler = sampler.BucketedBatchSampler(indices, image_sizes, instance_counts, batch_size)
+    resumed_sampler.load_state_dict(state_dict)
+    assert list(resumed_sampler) == batches[5:]
+
+
+def test_bucketed_batch_sampler_from_dataset_statistics():
+    dataset = VariableSizeDataset(30)
+    batch_sampler = sampler_factory.get_bucketed_batch_sampler('synthetic', dataset, range(len(dataset)),
+                                                               batch_size=3)
+    assert batch_sampler.image_sizes.tolist() == [list(size) for size in dataset.sizes]
+    assert batch_sampler.matching_costs.tolist() == (dataset.n_instances ** 2).sum(axis=1).tolist()
+    loader = torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler)
+    assert sum(len(data_dict['image']) for data_dict in loader) == len(dataset)
+
+
+def test_get_samplers_with_bucketed_config():
+    dataset = VariableSizeDataset(30)
+    samplers = sampler_factory.get_samplers('synthetic', sampler_cfg_registry.get_sampler_cfg_set('bucketed'),
+                                            {'train': dataset, 'val': dataset}, train_batch_size=4,
+                                            statistics_num_workers=0, val_batch_size=2)
+    assert isinstance(samplers['train'], sampler.BucketedBatchSampler)
+    assert sorted(i for batch in samplers['train'] for i in batch) == list(range(len(dataset)))
+
+    # train_for_val: every train image (not one per train batch), in bucketed batches of the val batch size, in the same
+    # order each time
+    train_for_val_sampler = samplers['train_for_val']
+    assert isinstance(train_for_val_sampler, sampler.BucketedBatchSampler) and train_for_val_sampler.sequential
+    assert train_for_val_sampler.batch_size == 2 and samplers['train'].batch_size == 4
+    assert sorted(i for batch in train_for_val_sampler for i in batch) == list(range(len(dataset)))
+    assert list(train_for_val_sampler) == list(train_for_val_sampler)
+    assert all(len(set(dataset.sizes[i] for i in batch)) == 1 for batch in train_for_val_sampler)
+    loader = torch.utils.data.DataLoader(dataset, batch_sampler=train_for_val_sampler)
+    assert sum(len(data_dict['image']) for data_dict in loader) == len(dataset)
+    assert list(samplers['val']) == list(range(len(dataset)))
+
+
+class MeanScoresModel(torch.nn.Module):
+    n_output_channels = 3
+
+    def __init__(self):
+        super(MeanScoresModel, self).__init__()
+        self.weight = torch.nn.Parameter(torch.ones(1))
+
+    def forward(self, x):
+        return self.weight * x
+
+
+def test_compile_scores_and_losses_over_bucketed_loader():
+    dataset = VariableSizeDataset(11)
+    batch_sampler = sampler_factory.get_bucketed_batch_sampler('synthetic', dataset, range(len(dataset)),
+                                                               batch_size=3, sequential=True)
+    loader = torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler)
+    assert loader.batch_size is None and metrics.get_n_images(loader) == len(dataset)
+
+    def component_loss_function(scores, sem_lbl, inst_lbl):
+        n_images = scores.size(0)
+        return None, (sem_lbl > 0).view(n_images, -1).float().sum(dim=1), scores.new_ones(n_images, scores.size(1))
+
+    compiled_scores, compiled_losses, compiled_loss_components = metrics.compile_scores_and_losses(
+        MeanScoresModel(), loader, component_loss_function)
+    assert compiled_scores.size(0) == compiled_losses.size(0) == compiled_loss_components.size(0) == len(dataset)
+    # Each image's loss, in loader order, though batches differ in size
+    loader_order = batch_sampler.get_order_indices(batch_sampler.get_epoch_order())
+    assert compiled_losses.tolist() == [float(dataset.n_instances[i].sum()) for i in loader_order]
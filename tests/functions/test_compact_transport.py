@@ -0,0 +1,74 @@
+import numpy as np
+import torch
+from torch.utils.data import default_collate
+
+from instanceseg.datasets import runtime_transformations
+from instanceseg.utils import datasets
+
+MEAN_BGR = np.array([104.00698793, 116.66876762, 122.67891434])
+
+
+def get_transformer(compact_transport, **kwargs):
+    return runtime_transformations.runtime_transformer_factory(
+        mean_bgr=MEAN_BGR, reduced_class_idxs=[0, 2, 3], n_inst_cap_per_class=2,
+        instance_id_for_excluded_instances=-1, compact_transport=compact_transport, **kwargs)
+
+
+def get_datapoints(n_images=3, shape=(24, 32), seed=0):
+    rng = np.random.RandomState(seed)
+    datapoints = []
+    for _ in range(n_images):
+        img = rng.randint(0, 256, size=shape + (3,)).astype(np.uint8)
+        sem_lbl = rng.randint(-1, 5, size=shape).astype(np.int32)
+        inst_lbl = rng.randint(0, 4, size=shape).astype(np.int32)
+        inst_lbl[sem_lbl == 0] = 0
+        inst_lbl[sem_lbl == -1] = -1
+        datapoints.append((img, (sem_lbl, inst_lbl)))
+    return datapoints
+
+
+def collate(transformer, datapoints):
+    transformed = []
+    for img, (sem_lbl, inst_lbl) in datapoints:
+        img, (sem_lbl, inst_lbl) = transformer.transform(img.copy(), (sem_lbl.copy(), inst_lbl.copy()))
+        transformed.append({'image': img, 'sem_lbl': sem_lbl, 'inst_lbl': inst_lbl})
+    return default_collate(transformed)
+
+
+def test_compact_transport_matches_regular_pipeline():
+    datapoints = get_datapoints()
+    regular, compact_transformer = get_transformer(False), get_transformer(True)
+    expected = collate(regular, datapoints)
+    batch = collate(compact_transformer, datapoints)
+    assert batch['image'].dtype == torch.uint8
+    assert batch['sem_lbl'].dtype == torch.int16 and batch['inst_lbl'].dtype == torch.int16
+
+    mean_bgr = runtime_transformations.get_compact_transport_mean_bgr(compact_transformer)
+    assert mean_bgr is MEAN_BGR
+    img, sem_lbl, inst_lbl = datasets.decompact_batch(batch['image'], batch['sem_lbl'], batch['inst_lbl'],
+                                                      mean_bgr=mean_bgr)
+    assert img.dtype == expected['image'].dtype and sem_lbl.dtype == expected['sem_lbl'].dtype
+    assert torch.allclose(img, expected['image'], atol=1e-4)
+    assert torch.equal(sem_lbl, expected['sem_lbl']) and torch.equal(inst_lbl, expected['inst_lbl'])
+
+    # Regular batches pass through
+    img, sem_lbl, inst_lbl = datasets.decompact_batch(expected['image'], expected['sem_lbl'], expected['inst_lbl'],
+                                                      mean_bgr=mean_bgr)
+    assert img is expected['image'] and torch.equal(sem_lbl, expected['sem_lbl'])
+    assert runtime_transformations.get_compact_transport_mean_bgr(regular) is None
+
+
+def test_compact_transport_untransform():
+    datapoints = get_datapoints(n_images=1)
+    img, (sem_lbl, inst_lbl) = datapoints[0]
+    for compact_transport in (False, True):
+        transformer = runtime_transformations.BasicRuntimeDatasetTransformer(mean_bgr=MEAN_BGR,
+                                                                            compact_transport=compact_transport)
+        transformed_img, transformed_lbl = transformer.transform(img.copy(), (sem_lbl.copy(), inst_lbl.copy()))
+        untransformed_img, (untransformed_sem_lbl, untransformed_inst_lbl) = \
+            transformer.untransform(transformed_img, transformed_lbl)
+        if compact_transport:
+            assert np.array_equal(untransformed_img, img)
+        else:  # the float round trip may truncate by one
+            assert np.abs(untransformed_img.astype(int) - img.astype(int)).max() <= 1
+        assert np.array_equal(untransformed_sem_lbl, sem_lbl) and np.array_equal(untransformed_inst_lbl, inst_lbl)
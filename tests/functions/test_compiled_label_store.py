@@ -0,0 +1,91 @@
+import os
+import os.path as osp
+import pickle
+import shutil
+
+import numpy as np
+
+from instanceseg.datasets import cityscapes, compiled_label_store
+
+UNITTEST_CITYSCAPES_DATASET_ROOT = './tests/test_data/cityscapesunittest/'
+N_IMAGES = 3
+
+
+def copy_unittest_files(dest_root, n_images=N_IMAGES):
+    """
+    Raw (leftImg8bit, labelIds, instanceIds) files of the first n_images, copied so the test can modify them
+    """
+    raw_files = cityscapes.get_raw_cityscapes_files(UNITTEST_CITYSCAPES_DATASET_ROOT, 'train')[:n_images]
+    files = []
+    for data_files in raw_files:
+        new_files = []
+        for key in ('img', 'sem_lbl', 'inst_lbl'):
+            new_file = osp.join(str(dest_root), osp.basename(data_files[key]))
+            shutil.copyfile(data_files[key], new_file)
+            new_files.append(new_file)
+        files.append(tuple(new_files))
+    identifiers = [osp.basename(f[0]).replace('_leftImg8bit.png', '') for f in files]
+    return identifiers, files
+
+
+def open_store(store_dir, identifiers, files, tag='tag'):
+    return compiled_label_store.CompiledLabelStore.open_or_compile(store_dir, identifiers, files,
+                                                                   cityscapes.load_cityscapes_files, tag)
+
+
+def test_compiled_store_matches_files(tmp_path):
+    identifiers, files = copy_unittest_files(tmp_path)
+    store = open_store(osp.join(str(tmp_path), 'store'), identifiers, files)
+    assert len(store) == len(files)
+    # labelIds fit in uint8; raw instanceIds (id * 1000 + instance) reach 33xxx, past int16
+    assert store.manifest['dtypes'] == {'image': 'uint8', 'sem_lbl': 'uint8', 'inst_lbl': 'int32'}
+    for identifier, data_files in zip(identifiers, files):
+        img, (sem_lbl, inst_lbl) = cityscapes.load_cityscapes_files(*data_files)
+        stored_img, (stored_sem_lbl, stored_inst_lbl) = store.get_datapoint_from_identifier(identifier)
+        assert np.array_equal(stored_img, img) and np.array_equal(stored_sem_lbl, sem_lbl) and \
+            np.array_equal(stored_inst_lbl, inst_lbl)
+        # Zero-copy views into the maps, writable without touching the store
+        assert not stored_img.flags.owndata and not stored_inst_lbl.flags.owndata
+        stored_inst_lbl[...] = -1
+    assert np.array_equal(open_store(store.store_dir, identifiers, files).get_datapoint(0)[1][1],
+                          cityscapes.load_cityscapes_files(*files[0])[1][1])
+    # Workers map the files themselves
+    unpickled = pickle.loads(pickle.dumps(store))
+    assert unpickled._arrays is None
+    assert np.array_equal(unpickled.get_datapoint(1)[0], store.get_datapoint(1)[0])
+
+
+def test_compiled_store_invalidation(tmp_path):
+    identifiers, files = copy_unittest_files(tmp_path)
+    store_dir = osp.join(str(tmp_path), 'store')
+    open_store(store_dir, identifiers, files)
+    manifest = compiled_label_store.load_manifest(store_dir)
+
+    # Same content, new mtime: still valid, and the new signature is recorded
+    source_file = files[0][2]
+    os.utime(source_file, ns=(0, 0))
+    assert compiled_label_store.get_stale_reason(manifest, identifiers, files, 'tag') == (None, True)
+    open_store(store_dir, identifiers, files)
+    assert compiled_label_store.load_manifest(store_dir)['sources'][0][2]['mtime_ns'] == 0
+
+    # Transformation tag or identifiers changed
+    assert compiled_label_store.get_stale_reason(manifest, identifiers, files, 'other_tag')[0] is not None
+    assert compiled_label_store.get_stale_reason(manifest, identifiers[::-1], files[::-1], 'tag')[0] is not None
+
+    # New content: recompiled
+    shutil.copyfile(files[1][2], source_file)
+    manifest = compiled_label_store.load_manifest(store_dir)
+    assert compiled_label_store.get_stale_reason(manifest, identifiers, files, 'tag')[0] is not None
+    store = open_store(store_dir, identifiers, files)
+    assert np.array_equal(store.get_datapoint(0)[1][1], store.get_datapoint(1)[1][1])
+    assert [f for f in os.listdir(str(tmp_path)) if f.startswith('.store')] == []
+
+
+def test_label_dtype_promotion(tmp_path):
+    lbls = [np.array([[0, 3]]), np.array([[-1, 200]]), np.array([[40000, 1]])]
+    writer = compiled_label_store._LabelArrayWriter(osp.join(str(tmp_path), 'lbl.bin'))
+    for lbl in lbls:
+        writer.append(lbl)
+    writer.close()
+    assert writer.dtype == np.int32
+    assert np.array_equal(np.fromfile(writer.filename, dtype=writer.dtype), np.concatenate(lbls, axis=1)[0])
@@ -0,0 +1,100 @@
+import torch
+
+from instanceseg.losses import instance_statistics, loss
+from tests.functions.matching_helpers import MODEL_CHANNEL_SEMANTIC_IDS, MODEL_CHANNEL_INSTANCE_IDS, \
+    make_random_batch, get_loss_objects
+
+
+def check_engines_match(loss_type, size_average):
+    scores, sem_lbl, inst_lbl = make_random_batch()
+    loop_loss, segment_loss = get_loss_objects(loss_type, size_average)
+    predictions = loop_loss.transform_scores_to_predictions(scores)
+    for sem_val in loop_loss.unique_semantic_values:
+        for i in range(scores.size(0)):
+            cost_loop, channels_loop, gt_loop = loop_loss.build_cost_tensor_for_one_sem_cls(
+                predictions[i, ...], sem_lbl[i, ...], inst_lbl[i, ...], sem_val)
+            cost_seg, channels_seg, gt_seg = segment_loss.build_cost_tensor_for_one_sem_cls(
+                predictions[i, ...], sem_lbl[i, ...], inst_lbl[i, ...], sem_val)
+            assert channels_loop == channels_seg
+            assert gt_loop == gt_seg
+            assert torch.allclose(cost_loop, cost_seg, atol=1e-5, rtol=1e-4)
+
+    scores_loop = scores.clone().requires_grad_(True)
+    scores_seg = scores.clone().requires_grad_(True)
+    result_loop = loop_loss.loss_fcn(scores_loop, sem_lbl, inst_lbl)
+    result_seg = segment_loss.loss_fcn(scores_seg, sem_lbl, inst_lbl)
+    assert torch.equal(result_loop.assignments.assigned_gt_inst_vals, result_seg.assignments.assigned_gt_inst_vals)
+    assert torch.allclose(result_loop.total_loss, result_seg.total_loss, atol=1e-5, rtol=1e-4)
+    result_loop.total_loss.backward()
+    result_seg.total_loss.backward()
+    assert torch.allclose(scores_loop.grad, scores_seg.grad, atol=1e-6, rtol=1e-4)
+
+
+def test_segment_engine_matches_loop_cross_entropy():
+    check_engines_match('cross_entropy', size_average=True)
+    check_engines_match('cross_entropy', size_average=False)
+
+
+def test_segment_engine_matches_loop_soft_iou():
+    check_engines_match('soft_iou', size_average=False)
+
+
+def test_chunked_segment_engine_matches_unchunked():
+    scores, sem_lbl, inst_lbl = make_random_batch()
+    for loss_type, size_average in [('cross_entropy', True), ('soft_iou', False)]:
+        results, grads = [], []
+        for max_chunk_bytes in (None, 1000):
+            loss_object = loss.loss_object_factory(loss_type, MODEL_CHANNEL_SEMANTIC_IDS, MODEL_CHANNEL_INSTANCE_IDS,
+                                                   matching=True, size_average=size_average,
+                                                   cost_matrix_engine='segment',
+                                                   cost_matrix_chunk_bytes=max_chunk_bytes)
+            scores_copy = scores.clone().requires_grad_(True)
+            result = loss_object.loss_fcn(scores_copy, sem_lbl, inst_lbl)
+            result.total_loss.backward()
+            results.append(result)
+            grads.append(scores_copy.grad)
+        assert torch.equal(results[0].assignments.assigned_gt_inst_vals, results[1].assignments.assigned_gt_inst_vals)
+        assert torch.allclose(results[0].loss_components_by_channel, results[1].loss_components_by_channel,
+                              atol=1e-6, rtol=1e-5)
+        assert torch.allclose(grads[0], grads[1], atol=1e-7, rtol=1e-5)
+
+
+def test_instance_statistics_match_direct_passes():
+    scores, sem_lbl, inst_lbl = make_random_batch()
+    for loss_type, size_average in [('cross_entropy', True), ('soft_iou', False)]:
+        loop_loss, segment_loss = get_loss_objects(loss_type, size_average)
+        predictions = segment_loss.transform_scores_to_predictions(scores)
+        instance_stats = segment_loss.get_instance_statistics(predictions, sem_lbl, inst_lbl)
+        for i in range(scores.size(0)):
+            for sem_val in segment_loss.unique_semantic_values:
+                direct = loop_loss.build_cost_tensor_for_one_sem_cls(predictions[i, ...], sem_lbl[i, ...],
+                                                                     inst_lbl[i, ...], sem_val)
+                shared = segment_loss.build_cost_tensor_for_one_sem_cls(predictions[i, ...], sem_lbl[i, ...],
+                                                                        inst_lbl[i, ...], sem_val, instance_stats[i])
+                assert direct[1:] == shared[1:]
+                assert torch.allclose(direct[0], shared[0], atol=1e-5, rtol=1e-4)
+
+        agg_direct = segment_loss.compute_agg_semantic_component(predictions, sem_lbl, inst_lbl)
+        agg_shared = segment_loss.compute_agg_semantic_component(predictions, sem_lbl, inst_lbl, instance_stats)
+        assert torch.allclose(agg_direct[1], agg_shared[1], atol=1e-5, rtol=1e-4)
+
+        # The per-channel (non-matching) loop only supports one image at a time
+        nonmatching_loss = loss.loss_object_factory(loss_type, MODEL_CHANNEL_SEMANTIC_IDS, MODEL_CHANNEL_INSTANCE_IDS,
+                                                    matching=False, size_average=size_average)
+        _, total_direct, components_direct = nonmatching_loss.compute_nonmatching_loss(
+            predictions[:1], sem_lbl[:1], inst_lbl[:1])
+        _, total_shared, components_shared = nonmatching_loss.compute_nonmatching_loss(
+            predictions[:1], sem_lbl[:1], inst_lbl[:1], instance_stats[:1])
+        assert torch.allclose(components_direct, components_shared, atol=1e-5, rtol=1e-4)
+
+
+def test_segment_keys_dense_and_sparse_agree():
+    _, sem_lbl, inst_lbl = make_random_batch()
+    for inst_offset in (0, 26000):  # raw cityscapes-style instance ids take the torch.unique path
+        flat_sem, flat_inst = sem_lbl[0].reshape(-1), inst_lbl[0].reshape(-1) + inst_offset
+        pixel_segment_idx, sem_vals, inst_vals, areas = instance_statistics.get_pixel_segment_keys(flat_sem, flat_inst)
+        assert torch.equal(sem_vals[pixel_segment_idx], flat_sem)
+        assert torch.equal(inst_vals[pixel_segment_idx], flat_inst)
+        assert torch.equal(areas, torch.bincount(pixel_segment_idx))
+        pairs = list(zip(sem_vals.tolist(), inst_vals.tolist()))
+        assert pairs == sorted(set(zip(flat_sem.tolist(), flat_inst.tolist())))
@@ -1,10 +1,13 @@
 import os
+
+import numpy as np
 import torch
 
 from instanceseg.datasets import dataset_statistics
 from instanceseg.datasets import cityscapes
+from instanceseg.datasets import dataset_generator_registry
+from instanceseg.datasets.runtime_transformations import BasicRuntimeDatasetTransformer
 
-UNITTEST_CITYSCAPES_DATASET_ROOT = './tests/test_data/cityscapesunittest/'
 
 # noinspection PyArgumentList
 OCCLUSION_COUNT_GT = {
@@ -45,15 +48,15 @@ def is_dataset_for_stored_occlusions(unittest_cityscapes_dataset):
     return True
 
 
-def get_unittest_cityscapes_dataset(root=UNITTEST_CITYSCAPES_DATASET_ROOT):
+def get_unittest_cityscapes_dataset(root):
     unittest_cityscapes = cityscapes.TransformedCityscapes(root=root,
                                                            split='train')
     return unittest_cityscapes
 
 
-def test_occlusions_on_select_cityscapes_car_images():
+def test_occlusions_on_select_cityscapes_car_images(copy_unittest_raw_dataset):
     debug = True
-    unittest_cityscapes_dataset = get_unittest_cityscapes_dataset()
+    unittest_cityscapes_dataset = get_unittest_cityscapes_dataset(copy_unittest_raw_dataset(n_images=None))
     assert is_dataset_for_stored_occlusions(unittest_cityscapes_dataset)
     occlusion_cache = dataset_statistics.OcclusionsOfSameClass(
         range(len(unittest_cityscapes_dataset.semantic_class_names)),
@@ -78,9 +81,10 @@ def test_occlusions_on_select_cityscapes_car_images():
     return occlusion_counts
 
 
-def test_occlusion_finder():
-    unittest_cityscapes_dataset = get_unittest_cityscapes_dataset()
-    i, (sl, il) = unittest_cityscapes_dataset[0]
+def test_occlusion_finder(copy_unittest_raw_dataset):
+    unittest_cityscapes_dataset = get_unittest_cityscapes_dataset(copy_unittest_raw_dataset(n_images=None))
+    data_dict = unittest_cityscapes_dataset[0]
+    sl, il = data_dict['sem_lbl'], data_dict['inst_lbl']
     n_occlusion_pairings_per_sem_cls, arr_of_occlusion_locations_per_cls = \
         dataset_statistics.get_occlusions_hws_from_labels(
             sl, il, range(unittest_cityscapes_dataset.n_semantic_classes))
@@ -98,6 +102,153 @@ def test_occlusion_finder():
     print('Test images written to {}'.format(test_export_dir))
 
 
+def cap_instance_sizes_loop(sem_lbl, inst_lbl, n_instances_by_sem_val, void_value):
+    """
+    Reference: the per-image, per-class loop over get_instance_sizes that cap_instance_sizes replaces
+    """
+    capped_inst_lbl, removed = inst_lbl.clone(), []
+    for i in range(sem_lbl.shape[0]):
+        for sem_val, n_instances in n_instances_by_sem_val.items():
+            inst_vals, inst_sizes = dataset_statistics.get_instance_sizes(sem_lbl[i, ...], inst_lbl[i, ...], sem_val)
+            sorted_inst_vals = [inst_vals[j] for j in np.argsort(inst_sizes, kind='stable')][::-1]
+            for inst_val in sorted_inst_vals[n_instances:]:
+                capped_inst_lbl[i][(sem_lbl[i] == sem_val) * (inst_lbl[i] == inst_val)] = void_value
+                removed.append((i, sem_val, inst_val))
+    return capped_inst_lbl, removed
+
+
+def test_cap_instance_sizes_matches_loop():
+    torch.manual_seed(0)
+    sem_lbl = torch.randint(0, 4, (3, 40, 50))
+    inst_lbl = torch.randint(1, 7, (3, 40, 50))
+    inst_lbl[sem_lbl == 0] = 0
+    inst_lbl[:, :3, :] = -1
+    inst_lbl[1][(sem_lbl[1] == 2) & (inst_lbl[1] == 4)] = 3  # uneven sizes
+    n_instances_by_sem_val = {1: 2, 2: 3, 3: 6}
+    for inst_offset in (0, 30000):  # dense bincount keys / torch.unique keys
+        offset_inst_lbl = torch.where(inst_lbl > 0, inst_lbl + inst_offset, inst_lbl)
+        expected_inst_lbl, expected_removed = cap_instance_sizes_loop(sem_lbl, offset_inst_lbl,
+                                                                      n_instances_by_sem_val, -1)
+        capped_inst_lbl, removed = dataset_statistics.cap_instance_sizes(sem_lbl, offset_inst_lbl,
+                                                                         n_instances_by_sem_val, -1)
+        assert torch.equal(capped_inst_lbl, expected_inst_lbl)
+        assert sorted(zip(*[t.tolist() for t in removed])) == sorted(expected_removed)
+
+    # Nothing to cap: the labels come back untouched
+    capped_inst_lbl, removed = dataset_statistics.cap_instance_sizes(sem_lbl, inst_lbl, {1: 10, 2: 10}, -1)
+    assert capped_inst_lbl is inst_lbl and len(removed[0]) == 0
+
+
+def get_statistic_caches(dataset, cache_dir=None):
+    semantic_class_vals = range(len(dataset.semantic_class_names))
+    cache_files = [None] * 3 if cache_dir is None else \
+        [os.path.join(str(cache_dir), '{}.npy'.format(name)) for name in ('pixels', 'instances', 'occlusions')]
+    return [dataset_statistics.PixelsPerSemanticClass(semantic_class_vals, cache_file=cache_files[0]),
+            dataset_statistics.NumberofInstancesPerSemanticClass(semantic_class_vals, cache_file=cache_files[1]),
+            dataset_statistics.OcclusionsOfSameClass(semantic_class_vals, cache_file=cache_files[2])]
+
+
+def test_fused_statistics_match_separate_passes(tmp_path, copy_unittest_raw_dataset):
+    dataset = cityscapes.TransformedCityscapes(copy_unittest_raw_dataset(n_images=10),
+                                               'train', runtime_transformation=BasicRuntimeDatasetTransformer())
+    assert tuple(os.path.basename(dataset.raw_dataset.files[i]['img']) for i in dataset.raw_dataset.id_list) == \
+        OCCLUSION_COUNT_GT['img_basenames']
+    expected = []
+    for statistic_cache in get_statistic_caches(dataset):
+        statistic_cache.compute_or_retrieve(dataset)
+        expected.append(statistic_cache.stat_tensor)
+    assert expected[2].equal(OCCLUSION_COUNT_GT['occlusion_counts'])
+
+    os.makedirs(str(tmp_path / 'stats'))
+    statistics = dataset_statistics.FusedDatasetStatistics(num_workers=2)
+    statistic_caches = [statistics.register(s) for s in get_statistic_caches(dataset, tmp_path / 'stats')]
+    statistics.compute_or_retrieve(dataset)
+    for statistic_cache, expected_stat_tensor in zip(statistic_caches, expected):
+        assert statistic_cache.stat_tensor.equal(expected_stat_tensor)
+        assert os.path.isfile(statistic_cache.cache_file)
+    assert sorted(os.listdir(str(tmp_path / 'stats'))) == ['instances.npy', 'occlusions.npy', 'pixels.npy']
+
+    # Cached: no pass over the dataset
+    statistics = dataset_statistics.FusedDatasetStatistics(num_workers=0)
+    statistic_caches = [statistics.register(s) for s in get_statistic_caches(dataset, tmp_path / 'stats')]
+    statistics.compute_or_retrieve(None)
+    for statistic_cache, expected_stat_tensor in zip(statistic_caches, expected):
+        assert statistic_cache.stat_tensor.equal(expected_stat_tensor)
+
+
+def test_label_histogram():
+    sem_lbl = np.array([[0, 0, 1, 1], [2, 2, 1, -1]])
+    inst_lbl = np.array([[0, 0, 1, 3], [30000, 2, 1, -1]])
+    for inst_offset in (0, 30000):  # dense bincount keys / np.unique keys
+        label_histogram = dataset_statistics.LabelHistogram(sem_lbl, np.where(inst_lbl > 0, inst_lbl + inst_offset,
+                                                                               inst_lbl))
+        assert label_histogram.get_semantic_pixel_counts([0, 1, 2, 5]).tolist() == [2, 3, 2, 0]
+        assert [v.tolist() for v in label_histogram.get_instance_values([1, 2])] == \
+            [[1 + inst_offset, 3 + inst_offset], [2 + inst_offset, 30000 + inst_offset]]
+        assert label_histogram.get_max_instance_values([-1, 0, 1, 7]).tolist() == [-1, 0, 3 + inst_offset, 0]
+
+
+def occlusions_by_pairwise_dilation(sem_lbl, inst_lbl, semantic_class_vals):
+    """
+    Reference: the per-class dilate-and-intersect-every-pair loop get_occlusion_pairings replaces
+    """
+    counts, locations = [], []
+    for sem_val in semantic_class_vals:
+        n_occlusion_pairings, occlusion_locations = \
+            dataset_statistics.OcclusionsOfSameClass.compute_occlusions_from_batch_of_one_semantic_cls(
+                sem_lbl[:, :, None], inst_lbl[:, :, None], sem_val)
+        counts.append(n_occlusion_pairings[0])
+        locations.append(occlusion_locations[:, :, 0])
+    return np.array(counts), np.stack(locations, axis=2)
+
+
+def test_occlusion_engine_matches_pairwise_dilation_on_cityscapes(copy_unittest_raw_dataset):
+    dataset = cityscapes.TransformedCityscapes(copy_unittest_raw_dataset(n_images=10),
+                                               'train', runtime_transformation=BasicRuntimeDatasetTransformer())
+    semantic_class_vals = range(len(dataset.semantic_class_names))
+    for idx in range(len(dataset)):
+        data_dict = dataset[idx]
+        sem_lbl, inst_lbl = data_dict['sem_lbl'].numpy().astype(np.uint8), data_dict['inst_lbl'].numpy().astype(np.uint8)
+        expected_counts, expected_locations = occlusions_by_pairwise_dilation(sem_lbl, inst_lbl, semantic_class_vals)
+        counts, locations = dataset_statistics.get_occlusions_hws_from_labels(sem_lbl, inst_lbl, semantic_class_vals)
+        assert counts.tolist() == expected_counts.tolist() == OCCLUSION_COUNT_GT['occlusion_counts'][idx].tolist()
+        assert np.array_equal(locations, expected_locations)
+
+
+def test_occlusion_pairings_at_the_dilation_distance():
+    sem_lbl = np.zeros((12, 14), dtype=int)
+    inst_lbl = np.zeros((12, 14), dtype=int)
+    sem_lbl[:, :] = 1
+    inst_lbl[0, 0], inst_lbl[2, 2] = 1, 2  # chessboard distance 2: occlusion
+    inst_lbl[0, 11], inst_lbl[0, 8] = 3, 4  # distance 3: no occlusion
+    inst_lbl[11, 13], inst_lbl[9, 12] = 30000, 5  # raw-id sized instance values
+    sem_lbl[11, 0], inst_lbl[11, 0], inst_lbl[10, 1] = 2, 6, 7  # touching, different semantic classes
+    inst_lbl[5, 5:7], sem_lbl[5, 6] = -1, 1  # not instances
+    sem_vals, inst_vals1, inst_vals2 = dataset_statistics.get_occlusion_pairings(sem_lbl, inst_lbl)
+    assert sorted(zip(sem_vals.tolist(), inst_vals1.tolist(), inst_vals2.tolist())) == \
+        [(1, 1, 2), (1, 5, 30000)]
+    assert dataset_statistics.count_occlusions_per_semantic_class(sem_lbl, inst_lbl, [0, 1, 2]).tolist() == [0, 2, 0]
+
+    torch.manual_seed(0)
+    sem_lbl = torch.randint(0, 3, (30, 40)).numpy()
+    inst_lbl = torch.randint(0, 9, (30, 40)).numpy()
+    expected_counts, expected_locations = occlusions_by_pairwise_dilation(sem_lbl.astype(np.uint8),
+                                                                          inst_lbl.astype(np.uint8), [0, 1, 2, 3])
+    counts, locations = dataset_statistics.get_occlusions_hws_from_labels(sem_lbl, inst_lbl, [0, 1, 2, 3])
+    assert counts.tolist() == expected_counts.tolist()
+    assert np.array_equal(locations, expected_locations)
+    assert dataset_statistics.count_occlusions_per_semantic_class(np.zeros((4, 4)), np.zeros((4, 4)), [0, 1]).tolist() \
+        == [0, 0]
+
+
+def test_instance_size_caps_cover_thing_classes_only():
+    semantic_class_names, thing_class_names = ['background', 'road', 'car', 'person'], ['car', 'person']
+    assert dataset_generator_registry.get_instance_size_caps(semantic_class_names, thing_class_names, 3) == \
+        {2: 3, 3: 3}
+    assert dataset_generator_registry.get_instance_size_caps(semantic_class_names, thing_class_names, 3,
+                                                             map_to_semantic=True) == {2: 1, 3: 1}
+
+
 if __name__ == '__main__':
     occlusion_cache = test_occlusions_on_select_cityscapes_car_images()
     # test_occlusion_finder()
@@ -0,0 +1,45 @@
+import os.path as osp
+import shutil
+
+from instanceseg.datasets import cityscapes, file_index_cache
+
+
+def test_file_index_cache(copy_unittest_raw_dataset, monkeypatch):
+    root = osp.realpath(copy_unittest_raw_dataset())
+    # Generates the train id files, which changes the directories: not cached as valid yet
+    cityscapes.CityscapesWithOurBasicTrainIds(root, 'train')
+    cache_file = file_index_cache.get_cache_file(root, 'train',
+                                                 cityscapes.CityscapesWithOurBasicTrainIds.precomputed_file_transformer)
+    assert file_index_cache.load_file_index(cache_file) is None
+    uncached = cityscapes.CityscapesWithOurBasicTrainIds(root, 'train', use_file_index_cache=False)
+    cityscapes.CityscapesWithOurBasicTrainIds(root, 'train')
+    assert file_index_cache.load_file_index(cache_file) is not None
+
+    # Warm: nothing is globbed, checked or transformed
+    def fail(*args, **kwargs):
+        raise AssertionError('Should have loaded the cached file index')
+    with monkeypatch.context() as m:
+        m.setattr(cityscapes.CityscapesWithOurBasicTrainIds, 'get_files_and_identifiers', fail)
+        cached = cityscapes.CityscapesWithOurBasicTrainIds(root, 'train')
+    assert cached.files == uncached.files and cached.id_list == uncached.id_list
+
+    # A new image changes its city directory's mtime
+    img_dir = osp.join(root, 'leftImg8bit', 'train', 'aachen')
+    img_file = osp.join(img_dir, cached.id_list[0].replace('gtFine_instanceCustomTrainIdsWithBground0',
+                                                           'leftImg8bit') + '.png')
+    shutil.copyfile(img_file, osp.join(img_dir, 'aachen_999999_000019_leftImg8bit.png'))
+    assert file_index_cache.load_file_index(cache_file) is None
+
+
+def test_file_index_cache_outside_the_dataset_root(copy_unittest_raw_dataset, tmp_path):
+    root = osp.realpath(copy_unittest_raw_dataset())
+    cache_dir = str(tmp_path / 'file_index')
+    uncached = cityscapes.CityscapesWithOurBasicTrainIds(root, 'train', use_file_index_cache=False)
+    cityscapes.CityscapesWithOurBasicTrainIds(root, 'train', file_index_cache_dir=cache_dir)
+    cache_file = file_index_cache.get_cache_file(root, 'train',
+                                                 cityscapes.CityscapesWithOurBasicTrainIds.precomputed_file_transformer,
+                                                 cache_dir=cache_dir)
+    assert osp.dirname(cache_file) == cache_dir and file_index_cache.load_file_index(cache_file) is not None
+    assert not osp.exists(osp.join(root, file_index_cache.CACHE_DIR))
+    cached = cityscapes.CityscapesWithOurBasicTrainIds(root, 'train', file_index_cache_dir=cache_dir)
+    assert cached.files == uncached.files
@@ -0,0 +1,108 @@
+import os
+import os.path as osp
+
+import PIL.Image
+import numpy as np
+
+from instanceseg.datasets import cityscapes, dataset_statistics, image_statistics_store, runtime_transformations
+
+
+def get_dataset(root):
+    runtime_transformation = runtime_transformations.runtime_transformer_factory(resize=True, resize_size=(64, 128))
+    return cityscapes.TransformedCityscapes(root, 'train', runtime_transformation=runtime_transformation)
+
+
+def get_statistics(dataset, store_file=None, cache_dir=None):
+    semantic_class_vals = range(len(dataset.semantic_class_names))
+    cache_files = [None] * 3 if cache_dir is None else \
+        [osp.join(str(cache_dir), '{}.npy'.format(name)) for name in ('pixels', 'instances', 'occlusions')]
+    statistics = dataset_statistics.FusedDatasetStatistics(
+        num_workers=0, image_statistics_store=image_statistics_store.ImageStatisticsStore(store_file)
+        if store_file is not None else None)
+    for statistic in (dataset_statistics.PixelsPerSemanticClass(semantic_class_vals, cache_file=cache_files[0]),
+                      dataset_statistics.NumberofInstancesPerSemanticClass(semantic_class_vals,
+                                                                           cache_file=cache_files[1]),
+                      dataset_statistics.OcclusionsOfSameClass(semantic_class_vals, cache_file=cache_files[2])):
+        statistics.register(statistic)
+    return statistics
+
+
+def compute_counting_images(dataset, store_file, monkeypatch, cache_dir=None):
+    """
+    The statistics' tensors, and the number of images the pass went over
+    """
+    n_images_computed = []
+    compute_rows = dataset_statistics.FusedDatasetStatistics.compute_rows
+
+    def counting_compute_rows(subset, statistics, num_workers=4):
+        n_images_computed.append(len(subset))
+        return compute_rows(subset, statistics, num_workers)
+
+    monkeypatch.setattr(dataset_statistics.FusedDatasetStatistics, 'compute_rows', staticmethod(counting_compute_rows))
+    statistics = get_statistics(dataset, store_file, cache_dir)
+    statistics.compute_or_retrieve(dataset)
+    monkeypatch.undo()
+    return [statistic.stat_tensor for statistic in statistics.statistics], sum(n_images_computed)
+
+
+def assert_stat_tensors_equal(stat_tensors, expected_stat_tensors):
+    assert len(stat_tensors) == len(expected_stat_tensors)
+    for stat_tensor, expected_stat_tensor in zip(stat_tensors, expected_stat_tensors):
+        assert stat_tensor.equal(expected_stat_tensor)
+
+
+def get_expected_stat_tensors(dataset):
+    statistics = get_statistics(dataset)
+    statistics.compute_or_retrieve(dataset)
+    return [statistic.stat_tensor for statistic in statistics.statistics]
+
+
+def test_image_statistics_store_computes_only_missing_and_stale_rows(tmp_path, copy_unittest_raw_dataset,
+                                                                     monkeypatch):
+    store_file = str(tmp_path / 'cache' / 'image_statistics.npz')
+    root = copy_unittest_raw_dataset(n_images=2)
+    dataset = get_dataset(root)
+    stat_tensors, n_computed = compute_counting_images(dataset, store_file, monkeypatch, cache_dir=tmp_path)
+    assert n_computed == 2 and osp.isfile(store_file)
+    assert_stat_tensors_equal(stat_tensors, get_expected_stat_tensors(dataset))
+    assert all(osp.isfile(str(tmp_path / '{}.npy'.format(name))) for name in ('pixels', 'instances', 'occlusions'))
+
+    # Unchanged: assembled from the store
+    stat_tensors, n_computed = compute_counting_images(get_dataset(root), store_file, monkeypatch)
+    assert n_computed == 0
+    assert_stat_tensors_equal(stat_tensors, get_expected_stat_tensors(dataset))
+
+    # More images: only the new ones
+    copy_unittest_raw_dataset(n_images=4)
+    dataset = get_dataset(root)
+    assert len(dataset) == 4
+    stat_tensors, n_computed = compute_counting_images(dataset, store_file, monkeypatch)
+    assert n_computed == 2
+    assert_stat_tensors_equal(stat_tensors, get_expected_stat_tensors(dataset))
+
+    # Touched, same content: not recomputed
+    sem_lbl_file, inst_lbl_file = image_statistics_store.get_dataset_label_files(dataset)[0]
+    os.utime(sem_lbl_file, ns=(0, 0))
+    stat_tensors, n_computed = compute_counting_images(dataset, store_file, monkeypatch)
+    assert n_computed == 0
+    assert_stat_tensors_equal(stat_tensors, get_expected_stat_tensors(dataset))
+
+    # Changed content: recomputed
+    inst_lbl_img = PIL.Image.open(inst_lbl_file)
+    inst_lbl = np.array(inst_lbl_img)
+    inst_lbl[inst_lbl == inst_lbl.max()] = 0
+    changed_inst_lbl_img = PIL.Image.fromarray(inst_lbl, mode=inst_lbl_img.mode)
+    if inst_lbl_img.mode == 'P':
+        changed_inst_lbl_img.putpalette(inst_lbl_img.getpalette())
+    changed_inst_lbl_img.save(inst_lbl_file)
+    stat_tensors, n_computed = compute_counting_images(dataset, store_file, monkeypatch)
+    assert n_computed == 1
+    expected_stat_tensors = get_expected_stat_tensors(dataset)
+    assert_stat_tensors_equal(stat_tensors, expected_stat_tensors)
+
+    # A statistic with other parameters is a new column: computed for every image
+    statistics = dataset_statistics.FusedDatasetStatistics(
+        num_workers=0, image_statistics_store=image_statistics_store.ImageStatisticsStore(store_file))
+    pixel_counts = statistics.register(dataset_statistics.PixelsPerSemanticClass([0, 1]))
+    statistics.compute_or_retrieve(dataset)
+    assert pixel_counts.stat_tensor.equal(expected_stat_tensors[0][:, :2])
@@ -0,0 +1,130 @@
+import numpy as np
+import torch
+
+from instanceseg.datasets import indexfilter, sampler
+
+
+def get_random_statistics(n_images=200, n_semantic_classes=5, seed=0):
+    rng = np.random.RandomState(seed)
+    instance_counts = torch.from_numpy(rng.randint(0, 6, (n_images, n_semantic_classes)).astype(np.float32))
+    semantic_pixel_counts = torch.from_numpy(rng.randint(0, 3, (n_images, n_semantic_classes)) *
+                                             rng.randint(1, 1000, (n_images, n_semantic_classes))).int()
+    occlusion_counts = torch.from_numpy(rng.randint(0, 4, (n_images, n_semantic_classes))).int()
+    return instance_counts, semantic_pixel_counts, occlusion_counts
+
+
+def valid_indices_loop(instance_counts, semantic_pixel_counts, occlusion_counts, semantic_class_vals,
+                       n_instance_ranges, n_occlusions_range):
+    """
+    Reference: one image at a time
+    """
+    def in_range(value, valid_range):
+        return (valid_range[0] is None or value >= valid_range[0]) and \
+               (valid_range[1] is None or value < valid_range[1])
+
+    valid_indices = []
+    for image_idx in range(instance_counts.shape[0]):
+        is_valid = True
+        for sem_cls, n_instances_range in zip(semantic_class_vals, n_instance_ranges):
+            if n_instances_range is not None:
+                is_valid = is_valid and in_range(instance_counts[image_idx, sem_cls].item(), n_instances_range)
+            else:
+                is_valid = is_valid and semantic_pixel_counts[image_idx, sem_cls].item() > 0
+        if n_occlusions_range is not None:
+            is_valid = is_valid and in_range(occlusion_counts[image_idx, semantic_class_vals].sum().item(),
+                                             n_occlusions_range)
+        valid_indices.append(is_valid)
+    return valid_indices
+
+
+def test_valid_index_filter_matches_loop():
+    instance_counts, semantic_pixel_counts, occlusion_counts = get_random_statistics()
+    semantic_class_names = ['background', 'a', 'b', 'c', 'd']
+    for sem_cls_filter_names, n_instances_ranges, n_occlusions_range in (
+            (['a', 'c'], [(2, 4), (None, 3)], None),
+            (['a', 'b'], [None, (1, None)], (1, 5)),
+            (['b', 'c', 'd'], None, (2, None)),
+    ):
+        sampler_config = sampler.SamplerConfig(sem_cls_filter_names=sem_cls_filter_names,
+                                               n_instances_ranges=n_instances_ranges,
+                                               semantic_class_names=semantic_class_names,
+                                               n_occlusions_range=n_occlusions_range)
+        index_filter = indexfilter.ValidIndexFilter(sampler_config, n_original_images=len(instance_counts),
+                                                    instance_counts=instance_counts,
+                                                    semantic_class_pixel_counts=semantic_pixel_counts,
+                                                    occlusion_counts=occlusion_counts)
+        expected = valid_indices_loop(instance_counts, semantic_pixel_counts, occlusion_counts,
+                                      sampler_config.sem_cls_filter_values,
+                                      sampler_config.n_instances_ranges or [], n_occlusions_range)
+        assert 0 < sum(expected) < len(expected)
+        assert index_filter.valid_indices.dtype == bool
+        assert index_filter.valid_indices.tolist() == expected
+
+        # Sampler over the valid indices
+        my_sampler = sampler.get_pytorch_sampler(True, bool_index_subset=index_filter.valid_indices)(
+            range(len(instance_counts)))
+        assert list(my_sampler) == [i for i, is_valid in enumerate(expected) if is_valid]
+
+
+def test_valid_index_filter_union():
+    instance_counts, semantic_pixel_counts, occlusion_counts = get_random_statistics()
+    sampler_config = sampler.SamplerConfig(sem_cls_filter_names=['a', 'b'], n_instances_ranges=[(2, 4), None],
+                                           semantic_class_names=['background', 'a', 'b', 'c', 'd'],
+                                           n_occlusions_range=(5, None))
+    index_filter = indexfilter.ValidIndexFilter(sampler_config, n_original_images=len(instance_counts),
+                                                instance_counts=instance_counts,
+                                                semantic_class_pixel_counts=semantic_pixel_counts,
+                                                occlusion_counts=occlusion_counts)
+    # Images that satisfy any one of the conditions
+    expected_by_condition = [valid_indices_loop(instance_counts, semantic_pixel_counts, occlusion_counts,
+                                                sem_cls_vals, n_instance_ranges, n_occlusions_range)
+                             for sem_cls_vals, n_instance_ranges, n_occlusions_range in (([1], [(2, 4)], None),
+                                                                                         ([2], [None], None),
+                                                                                         ([1, 2], [], (5, None)))]
+    expected = [any(is_valid) for is_valid in zip(*expected_by_condition)]
+    valid_indices = index_filter.valid_indices_from_stats_config([1, 2], [(2, 4), None], (5, None), None, union=True)
+    assert valid_indices.tolist() == expected
+    assert sum(index_filter.valid_indices) < sum(expected) < len(expected)
+
+    # Every class in range
+    counts = instance_counts.numpy()
+    assert indexfilter.ValidIndexFilter.filter_images_by_range_from_counts2d(counts, (1, 4), [1, 3]).tolist() == \
+        ((counts[:, 1] >= 1) & (counts[:, 1] < 4) & (counts[:, 3] >= 1) & (counts[:, 3] < 4)).tolist()
+
+
+def test_subsample_n_valid_images():
+    valid_indices = np.random.RandomState(0).rand(100) > 0.3
+    np.random.seed(3)
+    subsampled = indexfilter.ValidIndexFilter.subsample_n_valid_images(valid_indices, 10)
+    assert subsampled.sum() == 10 and not np.any(subsampled & ~valid_indices)
+
+    # Same images as choosing, in permutation order, until there are n_images
+    np.random.seed(3)
+    expected, n_images_chosen = [False] * len(valid_indices), 0
+    for idx in np.random.permutation(len(valid_indices)):
+        if valid_indices[idx] and n_images_chosen < 10:
+            expected[idx], n_images_chosen = True, n_images_chosen + 1
+    assert subsampled.tolist() == expected
+
+
+def test_predicates():
+    instance_counts, semantic_pixel_counts, occlusion_counts = get_random_statistics()
+    table = indexfilter.ImageStatisticsTable(len(instance_counts), instance_counts=instance_counts,
+                                             semantic_pixel_counts=semantic_pixel_counts)
+    many_cars = indexfilter.InRange('instance_counts', [1], (3, None))
+    has_bikes = indexfilter.has_semantic_classes([2])
+    assert table.query(many_cars).tolist() == (instance_counts[:, 1] >= 3).tolist()
+    assert table.query(many_cars & ~has_bikes).tolist() == \
+        ((instance_counts[:, 1] >= 3) & (semantic_pixel_counts[:, 2] == 0)).tolist()
+    assert table.query(many_cars | has_bikes).tolist() == \
+        ((instance_counts[:, 1] >= 3) | (semantic_pixel_counts[:, 2] > 0)).tolist()
+    assert (many_cars & has_bikes).hash == (indexfilter.InRange('instance_counts', [1], (3, None)) &
+                                            indexfilter.has_semantic_classes([2])).hash != (many_cars | has_bikes).hash
+
+    # Cached by hash; callers get their own copy
+    result = table.query(many_cars)
+    result[:] = False
+    assert table.query(many_cars).tolist() == (instance_counts[:, 1] >= 3).tolist()
+
+    non_bground = indexfilter.ValidIndexFilter.filter_images_by_non_bground(semantic_pixel_counts)
+    assert non_bground.tolist() == (semantic_pixel_counts[:, 1:].sum(dim=1) > 0).tolist()
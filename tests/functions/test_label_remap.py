@@ -0,0 +1,62 @@
+import numpy as np
+import torch
+
+from instanceseg.utils import datasets, label_remap
+
+
+def loop_remap(lbl, old_vals, new_vals, default=None):
+    """
+    The per-value mask writes the lookup tables replace
+    """
+    old_lbl = lbl.copy()
+    new_lbl = lbl.copy() if default is None else np.full_like(lbl, default)
+    for old_val, new_val in zip(old_vals, new_vals):
+        new_lbl[old_lbl == old_val] = new_val
+    return new_lbl
+
+
+def test_remap_values_matches_loop():
+    rng = np.random.RandomState(0)
+    old_vals, new_vals = [-1, 0, 3, 7, 7, 250], [-1, 5, 0, 2, 4, 1]  # 7 is listed twice: last one wins
+    for dtype in (np.uint8, np.int8, np.int16, np.uint16, np.int32, np.int64):
+        lo = -3 if np.iinfo(dtype).min < 0 else 0
+        hi = min(np.iinfo(dtype).max, 300)
+        lbl = rng.randint(lo, hi + 1, size=(17, 23)).astype(dtype)
+        for default in (None, 0, -2):
+            valid = [(o, n) for o, n in zip(old_vals, new_vals) if
+                     np.iinfo(dtype).min <= o <= np.iinfo(dtype).max]
+            mapping_old_vals, mapping_new_vals = [o for o, _ in valid], [n for _, n in valid]
+            expected = loop_remap(lbl.astype(np.int64), mapping_old_vals, mapping_new_vals, default)
+            remapped = label_remap.remap_values(lbl, mapping_old_vals, mapping_new_vals, default=default)
+            assert np.array_equal(remapped, expected), (dtype, default)
+            assert remapped.dtype == dtype or (remapped.dtype == np.int64 and expected.min() < 0)
+            for tensor in (torch.from_numpy(lbl.astype(np.int64)), torch.from_numpy(lbl.astype(np.int16))):
+                remapped_tensor = label_remap.remap_values(tensor, mapping_old_vals, mapping_new_vals, default=default)
+                assert np.array_equal(remapped_tensor.numpy(), expected), (dtype, default)
+
+
+def test_remap_values_wide_ranges_and_caching():
+    lbl = np.array([[-5, 26000, 26001], [33001, 0, 2 ** 30]], dtype=np.int32)
+    expected = loop_remap(lbl, [26000, 33001, 2 ** 30], [1, 2, 3])
+    # 2 ** 30: past MAX_DENSE_TABLE_SIZE, remapped through np.unique
+    assert np.array_equal(label_remap.remap_values(lbl, [26000, 33001, 2 ** 30], [1, 2, 3]), expected)
+    assert np.array_equal(label_remap.remap_values(lbl[:, :2], [26000, 33001, 2 ** 30], [1, 2, 3]), expected[:, :2])
+    assert label_remap.get_lookup_table([1, 2], [3, 4]) is label_remap.get_lookup_table((1, 2), np.array([3, 4]))
+    in_place = torch.from_numpy(lbl[:, :2].astype(np.int64))
+    assert label_remap.remap_values(in_place, [-5, 0], [-1, 7], inplace=True) is in_place
+    assert in_place.tolist() == [[-1, 26000], [33001, 7]]
+
+
+def test_remap_to_reduced_semantic_classes_matches_loop():
+    rng = np.random.RandomState(1)
+    reduced_class_idxs = [0, 11, 13, 24]
+    sem_lbl = rng.randint(-1, 34, size=(32, 48))
+    inst_lbl = rng.randint(0, 5, size=sem_lbl.shape)
+    inst_lbl[sem_lbl == 0] = 0
+    expected_sem_lbl = loop_remap(sem_lbl, [-1] + reduced_class_idxs, [-1, 0, 1, 2, 3], default=0)
+    expected_inst_lbl = inst_lbl.copy()
+    expected_inst_lbl[expected_sem_lbl == 0] = 0
+    for to_lbl in (np.array, torch.from_numpy):
+        sem, inst = to_lbl(sem_lbl.copy()), to_lbl(inst_lbl.copy())
+        datasets.remap_to_reduced_semantic_classes(sem, inst, reduced_class_idxs)
+        assert np.array_equal(np.asarray(sem), expected_sem_lbl) and np.array_equal(np.asarray(inst), expected_inst_lbl)
@@ -0,0 +1,89 @@
+import json
+import os.path as osp
+
+import torch
+import torch.distributed
+import torch.multiprocessing
+import torch.utils.data
+
+from instanceseg.datasets import loader_autotune
+
+
+class RangeDataset(torch.utils.data.Dataset):
+    def __getitem__(self, index):
+        return torch.full((3, 8, 8), index)
+
+    def __len__(self):
+        return 64
+
+
+def test_tuned_loader_kwargs_are_swept_once_and_cached(tmp_path, monkeypatch, capsys):
+    n_timed = []
+    time_loader = loader_autotune.time_loader
+
+    def counting_time_loader(dataset, batch_size, loader_kwargs, n_epochs=2):
+        n_timed.append(batch_size)
+        return time_loader(dataset, batch_size, loader_kwargs, n_epochs)
+
+    monkeypatch.setattr(loader_autotune, 'time_loader', counting_time_loader)
+    monkeypatch.setattr(loader_autotune, 'NUM_WORKERS_CANDIDATES', (0, 1))
+    dataset = RangeDataset()
+    loader_kwargs = loader_autotune.get_tuned_loader_kwargs(dataset, 'range', 4, str(tmp_path), cuda=False,
+                                                            indices=range(10, 40), batch_sizes=[8], n_batches=2)
+    n_candidates = len(loader_autotune.get_loader_kwargs_candidates())
+    assert n_candidates == 5 and sorted(n_timed) == [4] * n_candidates + [8] * n_candidates
+    assert 'images/s' in capsys.readouterr().out
+    assert loader_kwargs['num_workers'] in (0, 1) and loader_kwargs['pin_memory'] is False
+    assert len(list(torch.utils.data.DataLoader(dataset, batch_size=4, **loader_kwargs))) == 16
+
+    # Cached per host and dataset: no more timing, for either batch size
+    n_timed.clear()
+    assert loader_autotune.get_tuned_loader_kwargs(dataset, 'range', 4, str(tmp_path), cuda=False) == loader_kwargs
+    loader_autotune.get_tuned_loader_kwargs(dataset, 'range', 8, str(tmp_path), cuda=False)
+    assert n_timed == []
+    with open(str(tmp_path / loader_autotune.SETTINGS_FILE)) as f:
+        settings = json.load(f)
+    key = loader_autotune.get_settings_key(loader_autotune.get_host_tag(), 'range')
+    assert sorted(settings[key]['settings']) == ['4', '8'] and len(settings[key]['table']) == 2 * n_candidates
+
+    # Another dataset is swept again
+    loader_autotune.get_tuned_loader_kwargs(dataset, 'other', 4, str(tmp_path), cuda=False, n_batches=1)
+    assert n_timed == [4] * n_candidates
+
+
+def get_loader_kwargs_in_process(rank, world_size, out_dir):
+    """
+    Run in each process: the loader kwargs it gets, and how many settings it timed itself
+    """
+    torch.distributed.init_process_group('gloo', init_method='file://{}'.format(osp.join(out_dir, 'process_group')),
+                                         rank=rank, world_size=world_size)
+    n_timed = []
+    time_loader = loader_autotune.time_loader
+
+    def counting_time_loader(*args, **kwargs):
+        n_timed.append(1)
+        return time_loader(*args, **kwargs)
+
+    loader_autotune.time_loader = counting_time_loader
+    loader_autotune.NUM_WORKERS_CANDIDATES = (0,)
+    loader_kwargs = loader_autotune.get_tuned_loader_kwargs(RangeDataset(), 'range', 4, out_dir, cuda=False,
+                                                            num_replicas=world_size, n_batches=2)
+    with open(osp.join(out_dir, 'rank_{}.json'.format(rank)), 'w') as f:
+        json.dump({'loader_kwargs': loader_kwargs, 'n_timed': len(n_timed)}, f)
+    torch.distributed.barrier()
+    torch.distributed.destroy_process_group()
+
+
+def test_tuned_loader_kwargs_are_swept_on_rank_0_only(tmp_path, monkeypatch):
+    torch.multiprocessing.spawn(get_loader_kwargs_in_process, args=(2, str(tmp_path)), nprocs=2)
+    results = []
+    for rank in range(2):
+        with open(str(tmp_path / 'rank_{}.json'.format(rank))) as f:
+            results.append(json.load(f))
+    assert results[0]['n_timed'] > 0 and results[1]['n_timed'] == 0
+    assert results[0]['loader_kwargs'] == results[1]['loader_kwargs']
+
+    # No process group to share the settings over: the defaults, untimed
+    monkeypatch.setattr(loader_autotune, 'time_loader', None)
+    assert loader_autotune.get_tuned_loader_kwargs(RangeDataset(), 'other', 4, str(tmp_path), cuda=False,
+                                                   num_replicas=2) == loader_autotune.get_default_loader_kwargs(False)
@@ -0,0 +1,52 @@
+import numpy as np
+import torch
+
+from instanceseg.losses import loss
+from instanceseg.losses.match import GT_VALUE_FOR_FALSE_POSITIVE
+from tests.functions.matching_helpers import MODEL_CHANNEL_SEMANTIC_IDS, MODEL_CHANNEL_INSTANCE_IDS, \
+    make_random_batch
+
+
+def get_assignments(seed=0):
+    scores, sem_lbl, inst_lbl = make_random_batch(seed=seed)
+    loss_object = loss.loss_object_factory('cross_entropy', MODEL_CHANNEL_SEMANTIC_IDS, MODEL_CHANNEL_INSTANCE_IDS,
+                                           matching=True, size_average=True, cost_matrix_engine='segment')
+    return loss_object.loss_fcn(scores, sem_lbl, inst_lbl), sem_lbl, inst_lbl
+
+
+def test_packed_assignments_match_labels():
+    result, sem_lbl, inst_lbl = get_assignments()
+    assignments = result.assignments
+    n_images, n_channels = sem_lbl.shape[0], len(MODEL_CHANNEL_SEMANTIC_IDS)
+    assert assignments.n_images == n_images
+    assert assignments.channels.dtype == torch.int16 and assignments.gt_inst_vals.dtype == torch.int32
+    assert torch.equal(assignments.model_channels, torch.arange(n_channels).repeat(n_images, 1))
+    assert torch.equal(assignments.sem_values, torch.tensor(MODEL_CHANNEL_SEMANTIC_IDS).repeat(n_images, 1).short())
+    assert torch.allclose(assignments.costs.reshape(n_images, n_channels), result.loss_components_by_channel)
+    for i in range(n_images):
+        image_assignments = assignments.get_image(i)
+        not_void = inst_lbl[i] >= 0
+        present = set(zip(sem_lbl[i][not_void].tolist(), inst_lbl[i][not_void].tolist()))
+        assigned = {(s, v) for s, v in zip(image_assignments.sem_vals.tolist(),
+                                           image_assignments.gt_inst_vals.tolist()) if v != GT_VALUE_FOR_FALSE_POSITIVE}
+        assert assigned | set(assignments.unassigned_gt_sem_inst_tuples[i]) == present
+        assert not (assigned & set(assignments.unassigned_gt_sem_inst_tuples[i]))
+
+
+def test_assemble_slice_and_numpy_views():
+    batches = [get_assignments(seed)[0].assignments for seed in range(3)]
+    batches[1].add_unassigned([0, 1, 0], [2, 2, 1], [7, 8, 9])
+    assembled = loss.LossMatchAssignments.assemble(batches)
+    assert assembled.n_images == sum(b.n_images for b in batches)
+    assert assembled.unassigned_gt_sem_inst_tuples == sum([b.unassigned_gt_sem_inst_tuples for b in batches], [])
+    assert batches[1].unassigned_gt_sem_inst_tuples[0][-2:] == [(2, 7), (1, 9)]
+    assert batches[1].unassigned_gt_sem_inst_tuples[1][-1] == (2, 8)
+
+    start = batches[0].n_images
+    sliced = assembled.slice_images(start, start + batches[1].n_images)
+    for name, array in batches[1].numpy().items():
+        assert np.array_equal(sliced.numpy()[name], array)
+    # Slices and numpy arrays are views of the packed storage
+    assert sliced.gt_inst_vals.data_ptr() == assembled.gt_inst_vals[int(assembled.offsets[start]):].data_ptr()
+    assert np.shares_memory(assembled.numpy()['costs'], assembled.costs.numpy())
+    assert np.shares_memory(assembled.get_image(start).gt_inst_vals, sliced.gt_inst_vals.numpy())
@@ -1,5 +1,6 @@
 import os.path as osp
 
+from instanceseg.losses import loss
 from instanceseg.losses.match import GT_VALUE_FOR_FALSE_POSITIVE
 from instanceseg.utils import parse
 from instanceseg.utils.script_setup import setup_train, configure
@@ -125,5 +126,69 @@ def permute_predictions_to_match_gt_inst_vals(assigned_gt_inst_vals, assignments
     return permuted_score_1
 
 
+def compute_agg_semantic_component_loop(loss_object, predictions, sem_lbl, inst_lbl):
+    """
+    Reference (per image, per semantic class) implementation of ComponentMatchingLossBase.compute_agg_semantic_component
+    """
+    sem_vals = loss_object.unique_semantic_values
+    batch_sz = predictions.size(0)
+    loss_components_per_sem_cls = torch.empty((batch_sz, len(sem_vals)))
+    for batch_idx in range(batch_sz):
+        normalizer = (inst_lbl[batch_idx, ...] >= 0).data.sum() if loss_object.size_average else 1.0
+        for sem_idx, sem_val in enumerate(sem_vals):
+            model_channels_for_this_cls = [i for i, sem_inst_val in enumerate(loss_object.model_channel_semantic_ids)
+                                           if sem_inst_val == sem_val]
+            loss_components_per_sem_cls[batch_idx, sem_idx] = loss_object.component_loss(
+                (predictions[batch_idx, model_channels_for_this_cls, ...].sum(dim=0)).float(),
+                (sem_lbl[batch_idx, ...] == sem_val).float()) / normalizer
+    return loss_components_per_sem_cls.sum(), loss_components_per_sem_cls, sem_vals
+
+
+def make_semantic_problem(n_sem_cls=3, n_inst_per_cls=2, batch_sz=2, h=40, w=50, seed=0):
+    torch.manual_seed(seed)
+    model_channel_semantic_ids = [0] + [s for s in range(1, n_sem_cls) for _ in range(n_inst_per_cls)]
+    model_channel_instance_ids = [0] + [i for _ in range(1, n_sem_cls) for i in range(1, n_inst_per_cls + 1)]
+    scores = torch.randn(batch_sz, len(model_channel_semantic_ids), h, w)
+    sem_lbl = torch.randint(0, n_sem_cls, (batch_sz, h, w))
+    sem_lbl[0, :3, :] = 255  # void
+    sem_lbl[-1][sem_lbl[-1] == n_sem_cls - 1] = 0  # a class missing from one image
+    inst_lbl = torch.randint(1, n_inst_per_cls + 1, (batch_sz, h, w))
+    inst_lbl[sem_lbl == 0] = 0
+    inst_lbl[sem_lbl == 255] = -1
+    return model_channel_semantic_ids, model_channel_instance_ids, scores, sem_lbl, inst_lbl
+
+
+def test_agg_semantic_component_matches_loop():
+    for loss_type, size_average in [('cross_entropy', True), ('cross_entropy', False), ('soft_iou', False)]:
+        model_channel_semantic_ids, model_channel_instance_ids, scores, sem_lbl, inst_lbl = make_semantic_problem()
+        loss_object = loss.loss_object_factory(loss_type, model_channel_semantic_ids, model_channel_instance_ids,
+                                               matching=True, size_average=size_average)
+        scores_loop = scores.clone().requires_grad_(True)
+        scores_vectorized = scores.clone().requires_grad_(True)
+        total_loop, components_loop, sem_vals_loop = compute_agg_semantic_component_loop(
+            loss_object, loss_object.transform_scores_to_predictions(scores_loop), sem_lbl, inst_lbl)
+        total_vectorized, components_vectorized, sem_vals_vectorized = loss_object.compute_agg_semantic_component(
+            loss_object.transform_scores_to_predictions(scores_vectorized), sem_lbl, inst_lbl)
+        assert sem_vals_loop == sem_vals_vectorized
+        assert torch.allclose(components_loop, components_vectorized, atol=1e-5, rtol=1e-4)
+        total_loop.backward()
+        total_vectorized.backward()
+        assert torch.allclose(scores_loop.grad, scores_vectorized.grad, atol=1e-6, rtol=1e-4)
+
+
+def test_agg_semantic_component_matches_loop_with_many_classes():
+    # Timing: scripts/benchmarks/benchmark_agg_semantic_component.py
+    model_channel_semantic_ids, model_channel_instance_ids, scores, sem_lbl, inst_lbl = \
+        make_semantic_problem(n_sem_cls=20, n_inst_per_cls=4, batch_sz=4, h=64, w=128)
+    loss_object = loss.loss_object_factory('cross_entropy', model_channel_semantic_ids, model_channel_instance_ids,
+                                           matching=True, size_average=True)
+    predictions = loss_object.transform_scores_to_predictions(scores)
+    total_loop, components_loop, _ = compute_agg_semantic_component_loop(loss_object, predictions, sem_lbl, inst_lbl)
+    total_vectorized, components_vectorized, _ = loss_object.compute_agg_semantic_component(predictions, sem_lbl,
+                                                                                            inst_lbl)
+    assert torch.allclose(components_loop, components_vectorized, atol=1e-5, rtol=1e-4)
+    assert torch.allclose(total_loop, total_vectorized, atol=1e-5, rtol=1e-4)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,85 @@
+import torch
+
+from instanceseg.losses import match
+from tests.functions.matching_helpers import get_random_cost_tensors, make_random_batch, get_loss_objects
+
+
+def test_solver_pool_matches_single_problem_solver():
+    cost_tensors = get_random_cost_tensors()
+    expected = [match.solve_matching_problem(c) for c in cost_tensors]
+    for n_workers in (0, 3):
+        solver = match.MatchingSolverPool(n_workers=n_workers)
+        col_inds = solver.solve(cost_tensors)
+        assert [list(c) for c in col_inds] == [list(c) for c in expected]
+        assert solver.last_solve_time is not None and solver.n_batches_solved == 1
+        solver.close()
+
+
+def get_real_cost_tensors():
+    scores, sem_lbl, inst_lbl = make_random_batch(batch_sz=3)
+    loss_object = get_loss_objects('cross_entropy', size_average=True)[1]
+    predictions = loss_object.transform_scores_to_predictions(scores)
+    return [loss_object.build_cost_tensor_for_one_sem_cls(predictions[i, ...], sem_lbl[i, ...], inst_lbl[i, ...],
+                                                          sem_val)[0]
+            for i in range(scores.size(0)) for sem_val in loss_object.unique_semantic_values]
+
+
+def test_torch_solver_matches_scipy_optimal_cost():
+    for cost_tensors in (get_random_cost_tensors(n_problems=50, max_n_pred=20), get_real_cost_tensors()):
+        scipy_col_inds = match.MatchingSolverPool(backend='scipy').solve(cost_tensors)
+        torch_col_inds = match.MatchingSolverPool(backend='torch').solve(cost_tensors)
+        for cost_tensor, scipy_cols, torch_cols in zip(cost_tensors, scipy_col_inds, torch_col_inds):
+            assert len(set(torch_cols)) == len(torch_cols)
+            rows = range(cost_tensor.shape[0])
+            scipy_cost = cost_tensor.double()[rows, scipy_cols].sum()
+            torch_cost = cost_tensor.double()[rows, torch_cols].sum()
+            assert torch.allclose(scipy_cost, torch_cost, atol=1e-9)
+        assert match.solve_matching_problem(cost_tensors[0], backend='torch') == torch_col_inds[0]
+
+
+def test_cached_assignment_is_certified_optimal():
+    from instanceseg.losses import assignment_cache
+    for cost_tensor in get_random_cost_tensors(n_problems=30):
+        cost_array = cost_tensor.double().numpy()
+        col_ind = match.solve_matching_problem(cost_array)
+        potentials = assignment_cache.get_central_column_potentials(cost_array, col_ind)
+        assert potentials is not None
+        assert assignment_cache.is_still_optimal(cost_array, col_ind, potentials)
+        if len(set(range(cost_array.shape[1])) - set(col_ind)) > 0 or cost_array.shape[0] > 1:
+            # A different assignment with a strictly higher cost can't be certified
+            worse_col_ind = list(reversed(col_ind)) if cost_array.shape[0] > 1 else \
+                [sorted(set(range(cost_array.shape[1])) - set(col_ind))[0]]
+            worse_cost = cost_array[range(len(col_ind)), worse_col_ind].sum()
+            if worse_cost > cost_array[range(len(col_ind)), col_ind].sum() + 1e-9:
+                assert not assignment_cache.is_still_optimal(cost_array, worse_col_ind, potentials)
+                assert assignment_cache.get_central_column_potentials(cost_array, worse_col_ind) is None
+
+
+def test_solver_pool_assignment_cache():
+    from instanceseg.losses.assignment_cache import AssignmentCache
+    cost_tensors = get_random_cost_tensors(n_problems=40)
+    keys = [('img{}'.format(i), 1) for i in range(len(cost_tensors))]
+    label_hashes = ['hash'] * len(keys)
+    solver = match.MatchingSolverPool(assignment_cache=AssignmentCache())
+    expected = solver.solve(cost_tensors, cache_keys=keys, label_hashes=label_hashes)
+    assert solver.assignment_cache.last_n_misses == len(cost_tensors)
+
+    # Same costs: every problem is a hit
+    assert solver.solve(cost_tensors, cache_keys=keys, label_hashes=label_hashes) == expected
+    assert solver.assignment_cache.last_n_hits == len(cost_tensors)
+
+    # Drifting costs: hits and misses both return an optimal assignment
+    torch.manual_seed(0)
+    drifted = [c + 1e-3 * torch.randn_like(c) for c in cost_tensors]
+    col_inds = solver.solve(drifted, cache_keys=keys, label_hashes=label_hashes)
+    for cost_tensor, cols, optimal_cols in zip(drifted, col_inds, match.MatchingSolverPool().solve(drifted)):
+        rows = range(cost_tensor.shape[0])
+        assert torch.allclose(cost_tensor[rows, cols].sum(), cost_tensor[rows, optimal_cols].sum(), atol=1e-5)
+    assert solver.assignment_cache.last_n_hits > 0
+    assert solver.assignment_cache.n_hits + solver.assignment_cache.n_misses == 3 * len(cost_tensors)
+
+    # Changed labels (e.g. - another crop of the same image): misses that replace the entries, one per problem
+    solver.solve(cost_tensors, cache_keys=keys, label_hashes=['other hash'] * len(keys))
+    assert solver.assignment_cache.last_n_misses == len(cost_tensors)
+    assert len(solver.assignment_cache.entries) == len(cost_tensors)
+    assert all(entry[0] == 'other hash' for entry in solver.assignment_cache.entries.values())
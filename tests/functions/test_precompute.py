@@ -0,0 +1,52 @@
+import os
+import os.path as osp
+
+import numpy as np
+
+from instanceseg.datasets import cityscapes, precompute, precomputed_file_transformations
+
+
+def get_ordered_dataset(root):
+    return cityscapes.TransformedCityscapes(
+        root, 'train', precomputed_file_transformation=precomputed_file_transformations.
+        precomputed_file_transformer_factory(ordering='lr'))
+
+
+def test_precompute_matches_lazy_generation(copy_unittest_raw_dataset, monkeypatch):
+    lazy_root = copy_unittest_raw_dataset('lazy')
+    eager_root = copy_unittest_raw_dataset('eager')
+    lazy_dataset = get_ordered_dataset(lazy_root)
+    lazy_items = [lazy_dataset.get_item_from_files(identifier, lazy_dataset.precomputed_file_transformation)
+                  for identifier in lazy_dataset.raw_dataset.id_list]
+
+    cityscapes.precompute_cityscapes_split(eager_root, 'train', ordering='lr', n_workers=2)
+    assert sorted(os.listdir(osp.join(eager_root, 'gtFine', 'train', 'aachen'))) == \
+        sorted(os.listdir(osp.join(lazy_root, 'gtFine', 'train', 'aachen')))
+    # Nothing left to generate
+    raw_files = [(f['img'], f['sem_lbl'], f['inst_lbl'])
+                 for f in cityscapes.get_raw_cityscapes_files(osp.realpath(eager_root), 'train')]
+    assert precompute.plan_generation_stages(
+        cityscapes.CityscapesWithOurBasicTrainIds.precomputed_file_transformer, raw_files) == [[], []]
+
+    # The datasets trust the manifests: no file is checked or generated
+    def fail(*args, **kwargs):
+        raise AssertionError('Should have trusted the precompute manifest')
+    monkeypatch.setattr(precomputed_file_transformations.PrecomputedDatasetFileTransformerBase,
+                        'generate_missing_files', fail)
+    eager_dataset = get_ordered_dataset(eager_root)
+    assert eager_dataset.trusted_files_by_id is not None
+    for identifier, (lazy_img, (lazy_sem_lbl, lazy_inst_lbl)) in zip(eager_dataset.raw_dataset.id_list, lazy_items):
+        img, (sem_lbl, inst_lbl) = eager_dataset.get_item_from_files(identifier,
+                                                                     eager_dataset.precomputed_file_transformation)
+        assert np.array_equal(img, lazy_img) and np.array_equal(sem_lbl, lazy_sem_lbl) and \
+            np.array_equal(inst_lbl, lazy_inst_lbl)
+
+
+def test_manifest_not_trusted_for_other_inputs(copy_unittest_raw_dataset):
+    root = osp.realpath(copy_unittest_raw_dataset())
+    file_transformer = cityscapes.CityscapesWithOurBasicTrainIds.precomputed_file_transformer
+    raw_files = [(f['img'], f['sem_lbl'], f['inst_lbl']) for f in cityscapes.get_raw_cityscapes_files(root, 'train')]
+    output_files = precompute.precompute_files(root, 'train', file_transformer, raw_files, n_workers=0)
+    assert precompute.load_trusted_output_files(root, 'train', file_transformer, raw_files) == output_files
+    assert precompute.load_trusted_output_files(root, 'train', file_transformer, raw_files[:-1]) is None
+    assert precompute.load_trusted_output_files(root, 'val', file_transformer, raw_files) is None
@@ -0,0 +1,78 @@
+import os
+import os.path as osp
+
+import PIL.Image
+import numpy as np
+import torch
+
+from instanceseg.datasets import cityscapes, resized_cache, runtime_transformations
+
+RESIZE_SIZE = (64, 128)
+
+
+def get_dataset(root, resized_cache_dir=None, resize_size=RESIZE_SIZE, n_workers=0):
+    runtime_transformation = runtime_transformations.runtime_transformer_factory(
+        resize=True, resize_size=resize_size, mean_bgr=cityscapes.CITYSCAPES_MEAN_BGR,
+        reduced_class_idxs=[0, 11, 13], n_inst_cap_per_class=5)
+    return cityscapes.TransformedCityscapes(root, 'train', runtime_transformation=runtime_transformation,
+                                            resized_cache_dir=resized_cache_dir, resized_cache_workers=n_workers)
+
+
+def get_cache_files(cache_root):
+    cache_dirs = os.listdir(cache_root)
+    assert len(cache_dirs) == 1
+    cache_dir = osp.join(cache_root, cache_dirs[0])
+    return cache_dir, sorted(f for f in os.listdir(cache_dir) if f.endswith('.npz'))
+
+
+def test_resized_cache_matches_runtime_resize(tmp_path, copy_unittest_raw_dataset):
+    root = copy_unittest_raw_dataset()
+    dataset = get_dataset(root)
+    cached_dataset = get_dataset(root, str(tmp_path / 'resized'), n_workers=2)
+    assert dataset.resized_cache is None and cached_dataset.resized_cache is not None
+    for index in range(len(dataset)):
+        item, cached_item = dataset[index], cached_dataset[index]
+        assert item['image'].shape[1:] == RESIZE_SIZE
+        for key in ('image', 'sem_lbl', 'inst_lbl'):
+            assert torch.equal(item[key], cached_item[key]) and item[key].dtype == cached_item[key].dtype
+    # Untransformed items aren't resized
+    cached_dataset.should_use_runtime_transform = False
+    dataset.should_use_runtime_transform = False
+    assert np.array_equal(cached_dataset[0]['image'], dataset[0]['image'])
+
+
+def test_resized_cache_resumes_and_rebuilds(tmp_path, copy_unittest_raw_dataset, monkeypatch):
+    root = copy_unittest_raw_dataset()
+    cache_root = str(tmp_path / 'resized')
+    dataset = get_dataset(root, cache_root)
+    cache_dir, cache_files = get_cache_files(cache_root)
+    assert len(cache_files) == len(dataset)
+
+    # An interrupted build: one item missing and no manifest.  Only that item is resized again.
+    os.remove(osp.join(cache_dir, cache_files[0]))
+    os.remove(osp.join(cache_dir, resized_cache.MANIFEST_FILE))
+    resized = []
+    write_resized_datapoint = resized_cache.write_resized_datapoint
+
+    def record(out_file, *args):
+        resized.append(osp.basename(out_file))
+        write_resized_datapoint(out_file, *args)
+    monkeypatch.setattr(resized_cache, 'write_resized_datapoint', record)
+    get_dataset(root, cache_root)
+    assert resized == cache_files[:1]
+
+    # Nothing to do; then a source file changes and that item is resized again
+    resized.clear()
+    get_dataset(root, cache_root)
+    assert resized == []
+    img_file = cityscapes.get_raw_cityscapes_files(root, 'train')[1]['img']
+    img = np.array(PIL.Image.open(img_file))
+    PIL.Image.fromarray(255 - img).save(img_file)
+    os.utime(img_file, ns=(0, 0))
+    dataset = get_dataset(root, cache_root)
+    assert resized == cache_files[1:2]
+    assert torch.equal(dataset[1]['image'], get_dataset(root)[1]['image'])
+
+    # Another size: another copy
+    get_dataset(root, cache_root, resize_size=(32, 64))
+    assert len(os.listdir(cache_root)) == 2
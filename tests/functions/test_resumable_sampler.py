@@ -0,0 +1,56 @@
+import torch
+import torch.utils.data
+
+from instanceseg.datasets import sampler
+
+
+class CountingDataset(torch.utils.data.Dataset):
+    def __init__(self, n_images):
+        self.n_images = n_images
+        self.loaded_indices = []
+
+    def __getitem__(self, index):
+        self.loaded_indices.append(index)
+        return index
+
+    def __len__(self):
+        return self.n_images
+
+
+def test_resumable_sampler_continues_from_checkpointed_position():
+    indices = list(range(3, 40, 2))
+    torch.manual_seed(0)
+    my_sampler = sampler.ResumableSampler(indices)
+    epoch_order = list(my_sampler)
+    assert sorted(epoch_order) == indices and epoch_order != indices
+    state_dict = my_sampler.state_dict(n_consumed=8)
+
+    # Resumed: the rest of that epoch, then a new order over all of them
+    resumed_sampler = sampler.ResumableSampler(indices)
+    resumed_sampler.load_state_dict(state_dict)
+    assert len(resumed_sampler) == len(indices)
+    assert list(resumed_sampler) == epoch_order[8:]
+    next_epoch_order = list(resumed_sampler)
+    assert sorted(next_epoch_order) == indices and next_epoch_order != epoch_order
+
+    sequential_sampler = sampler.ResumableSampler(indices, sequential=True)
+    assert list(sequential_sampler) == indices
+    sequential_sampler.load_state_dict(sequential_sampler.state_dict(n_consumed=len(indices) + 5))
+    assert list(sequential_sampler) == []
+    assert list(sequential_sampler) == indices
+
+
+def test_resumed_dataloader_loads_only_the_remaining_images():
+    batch_size, n_batches_consumed = 3, 4
+    dataset = CountingDataset(20)
+    my_sampler = sampler.ResumableSampler(range(len(dataset)))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=my_sampler)
+    batches = [batch.tolist() for batch in loader]
+    state_dict = my_sampler.state_dict(n_consumed=n_batches_consumed * batch_size)
+
+    resumed_dataset = CountingDataset(len(dataset))
+    resumed_sampler = sampler.ResumableSampler(range(len(dataset)))
+    resumed_sampler.load_state_dict(state_dict)
+    resumed_loader = torch.utils.data.DataLoader(resumed_dataset, batch_size=batch_size, sampler=resumed_sampler)
+    assert [batch.tolist() for batch in resumed_loader] == batches[n_batches_consumed:]
+    assert sorted(resumed_dataset.loaded_indices) == sorted(sum(batches[n_batches_consumed:], []))
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+import torch
+
+from instanceseg.datasets import runtime_transformations
+from instanceseg.datasets.panoptic_dataset_base import TransformedPanopticDataset
+from instanceseg.datasets.runtime_transformations import GenericSequenceRuntimeDatasetTransformer
+
+
+def get_transformer_sequence(semantic_agreement_kwargs=None):
+    transformer_sequence = runtime_transformations.runtime_transformer_factory(
+        reduced_class_idxs=[0, 2, 3, 5], n_inst_cap_per_class=3, instance_id_for_excluded_instances=-1,
+        map_to_single_instance_problem=True).transformer_sequence
+    if semantic_agreement_kwargs is not None:
+        transformer_sequence.append(
+            runtime_transformations.SemanticAgreementForInstanceLabelsRuntimeDatasetTransformer(
+                **semantic_agreement_kwargs))
+    return transformer_sequence
+
+
+def get_datapoint(seed, shape=(30, 40), n_sem_values=8, max_inst=6):
+    rng = np.random.RandomState(seed)
+    sem_lbl = rng.randint(-1, n_sem_values, size=shape)
+    inst_lbl = rng.randint(0, max_inst + 1, size=shape)
+    inst_lbl[sem_lbl == 0] = 0
+    inst_lbl[sem_lbl == -1] = -1
+    return rng.randint(0, 256, size=shape + (3,)).astype(np.uint8), sem_lbl, inst_lbl
+
+
+def run(transformer, img, sem_lbl, inst_lbl):
+    return transformer.transform(img.copy(), (sem_lbl.copy(), inst_lbl.copy()))
+
+
+@pytest.mark.parametrize('semantic_agreement_kwargs', [
+    None, dict(stuff_values=(0,), error_on_stuff_constraint=False, error_on_thing_constraint=False,
+               error_on_void_constraint=False)])
+def test_fused_pipeline_matches_sequence(semantic_agreement_kwargs):
+    transformer_sequence = get_transformer_sequence(semantic_agreement_kwargs)
+    fused = GenericSequenceRuntimeDatasetTransformer(transformer_sequence)
+    unfused = GenericSequenceRuntimeDatasetTransformer(transformer_sequence, fuse_label_transformers=False)
+    stages = fused.get_transform_stages()
+    assert isinstance(stages[0], runtime_transformations.BasicRuntimeDatasetTransformer)
+    assert len(stages) == 2 and stages[1].transformer_sequence == transformer_sequence[1:]
+    for seed in range(5):
+        # Wider ranges each time: the tables grow
+        img, sem_lbl, inst_lbl = get_datapoint(seed, n_sem_values=8 + 4 * seed, max_inst=6 + 10 * seed)
+        img_fused, (sem_fused, inst_fused) = run(fused, img, sem_lbl, inst_lbl)
+        img_unfused, (sem_unfused, inst_unfused) = run(unfused, img, sem_lbl, inst_lbl)
+        assert torch.equal(img_fused, img_unfused)
+        assert torch.equal(sem_fused, sem_unfused) and torch.equal(inst_fused, inst_unfused)
+        assert sem_fused.dtype == sem_unfused.dtype and inst_fused.dtype == inst_unfused.dtype
+
+
+def test_fused_pipeline_raises_like_sequence():
+    fused = GenericSequenceRuntimeDatasetTransformer(get_transformer_sequence())
+    img, sem_lbl, inst_lbl = get_datapoint(0)
+    run(fused, img, sem_lbl, inst_lbl)
+    inst_lbl[sem_lbl == 1] = 0  # 1 isn't in the subset: becomes background (0), so this is fine...
+    run(fused, img, sem_lbl, inst_lbl)
+    inst_lbl[0, 0], sem_lbl[0, 0] = 3, 0  # ...but background with an instance id isn't
+    with pytest.raises(AssertionError):
+        run(fused, img, sem_lbl, inst_lbl)
+    # Excluded instances (-1) where the semantic label isn't void
+    fused = GenericSequenceRuntimeDatasetTransformer(get_transformer_sequence(dict(stuff_values=(0,))))
+    with pytest.raises(Exception, match='Instance label was -1 where semantic label was not'):
+        run(fused, *get_datapoint(0))
+
+
+class ImagesDataset(TransformedPanopticDataset):
+    def __init__(self, runtime_transformation):
+        super().__init__(raw_dataset=None, raw_dataset_returns_images=True,
+                         runtime_transformation=runtime_transformation)
+
+
+def test_transformation_tag_is_cached():
+    runtime_transformation = GenericSequenceRuntimeDatasetTransformer(get_transformer_sequence())
+    dataset = ImagesDataset(runtime_transformation)
+    tag = dataset.transformation_tag
+    assert dataset.transformation_tag is tag
+    subset_transformer = runtime_transformation.transformer_sequence[1]
+    assert subset_transformer.get_attribute_items() is subset_transformer.get_attribute_items()
+    assert subset_transformer.get_attribute_items() == subset_transformer.compute_attribute_items()
+    # Assigning an attribute rebuilds it
+    subset_transformer.map_other_classes_to_bground = False
+    assert dataset.transformation_tag != tag
+    assert 'map_other_classes_to_bground-False' in dataset.transformation_tag
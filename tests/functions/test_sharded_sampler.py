@@ -0,0 +1,78 @@
+import json
+import os.path as osp
+
+import numpy as np
+import torch.distributed
+import torch.multiprocessing
+
+from instanceseg.datasets import sampler
+from instanceseg.factory import samplers as sampler_factory
+
+N_PROCESSES = 3
+
+
+def get_valid_indices():
+    return np.random.RandomState(0).rand(50) > 0.3
+
+
+def get_shards_in_process(rank, world_size, out_dir):
+    """
+    Run in each process: its shards of the train (two epochs) and val orders, with the rank from the process group
+    """
+    torch.distributed.init_process_group('gloo', init_method='file://{}'.format(osp.join(out_dir, 'process_group')),
+                                         rank=rank, world_size=world_size)
+    valid_indices = np.flatnonzero(get_valid_indices()).tolist()
+    datasets = {'train': range(len(get_valid_indices())), 'val': range(len(get_valid_indices()))}
+    samplers = sampler_factory.shard_samplers({'train': sampler.ResumableSampler(valid_indices),
+                                               'val': sampler.ResumableSampler(valid_indices, sequential=True)},
+                                              datasets)
+    shards = {}
+    for epoch in (0, 1):
+        samplers['train'].set_epoch(epoch)
+        shards['train_{}'.format(epoch)] = list(samplers['train'])
+    shards['val'] = list(samplers['val'])
+    shards['lengths'] = [len(samplers['train']), len(samplers['val'])]
+    with open(osp.join(out_dir, 'rank_{}.json'.format(rank)), 'w') as f:
+        json.dump(shards, f)
+    torch.distributed.barrier()
+    torch.distributed.destroy_process_group()
+
+
+def test_sharded_sampler_across_processes(tmp_path):
+    torch.multiprocessing.spawn(get_shards_in_process, args=(N_PROCESSES, str(tmp_path)), nprocs=N_PROCESSES)
+    shards_by_rank = []
+    for rank in range(N_PROCESSES):
+        with open(str(tmp_path / 'rank_{}.json'.format(rank))) as f:
+            shards_by_rank.append(json.load(f))
+    valid_indices = np.flatnonzero(get_valid_indices()).tolist()
+
+    # Train: the same shuffle on every rank, padded so each rank has the same number of images
+    for epoch in (0, 1):
+        train_shards = [shards['train_{}'.format(epoch)] for shards in shards_by_rank]
+        assert len(set(len(shard) for shard in train_shards)) == 1
+        all_train_indices = sum(train_shards, [])
+        assert set(all_train_indices) == set(valid_indices)
+        assert len(all_train_indices) - len(valid_indices) < N_PROCESSES
+    assert shards_by_rank[0]['train_0'] != shards_by_rank[0]['train_1']
+
+    # Val: in order, disjoint and balanced
+    val_shards = [shards['val'] for shards in shards_by_rank]
+    assert sorted(sum(val_shards, [])) == valid_indices
+    assert max(map(len, val_shards)) - min(map(len, val_shards)) <= 1
+    assert all(shard == sorted(shard) for shard in val_shards)
+    assert [shards['lengths'] for shards in shards_by_rank] == \
+        [[len(shards['train_0']), len(shards['val'])] for shards in shards_by_rank]
+
+
+def test_sharded_sampler_is_deterministic():
+    indices = list(range(3, 40))
+    shards = [sampler.ShardedSampler(indices, num_replicas=4, rank=rank, seed=7) for rank in range(4)]
+    assert [list(s) for s in shards] == [list(sampler.ShardedSampler(indices, num_replicas=4, rank=rank, seed=7))
+                                         for rank in range(4)]
+    assert set(sum([list(s) for s in shards], [])) == set(indices)
+
+    # Resumable on each rank
+    order = list(shards[2])
+    resumed_sampler = sampler.ShardedSampler(indices, num_replicas=4, rank=2, seed=7)
+    resumed_sampler.load_state_dict(shards[2].state_dict(n_consumed=3))
+    assert list(resumed_sampler) == order[3:]
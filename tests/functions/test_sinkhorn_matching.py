@@ -0,0 +1,47 @@
+import torch
+
+from instanceseg.losses import loss, sinkhorn
+from tests.functions.matching_helpers import MODEL_CHANNEL_SEMANTIC_IDS, MODEL_CHANNEL_INSTANCE_IDS, \
+    make_random_batch, get_random_cost_tensors
+
+
+def test_sinkhorn_marginals_and_hardening():
+    cost_tensors = get_random_cost_tensors(n_problems=30, max_n_pred=8)
+    soft_assignments = sinkhorn.batched_sinkhorn(cost_tensors, temperature=0.005, n_iters=500)
+    for cost_tensor, soft_assignment in zip(cost_tensors, soft_assignments):
+        assert soft_assignment.shape == cost_tensor.shape
+        assert torch.allclose(soft_assignment.sum(dim=1), torch.ones(cost_tensor.shape[0]), atol=1e-2)
+        assert torch.all(soft_assignment.sum(dim=0) <= 1 + 1e-3)
+
+    # At a low temperature, the hardened soft assignment recovers the exact one
+    diagnostics = sinkhorn.SinkhornMatcher.compare_to_exact_assignment(
+        cost_tensors, soft_assignments, [s.argmax(dim=1).tolist() for s in soft_assignments])
+    assert diagnostics['hardened_agreement'] > 0.95
+    assert abs(diagnostics['soft_relative_cost_gap']) < 0.01
+
+
+def test_sinkhorn_matching_loss():
+    scores, sem_lbl, inst_lbl = make_random_batch()
+    sinkhorn_config = sinkhorn.SinkhornConfig(temperature=0.5, temperature_decay=0.5, min_temperature=0.2,
+                                              diagnostic_interval=1)
+    soft_loss = loss.loss_object_factory('cross_entropy', MODEL_CHANNEL_SEMANTIC_IDS, MODEL_CHANNEL_INSTANCE_IDS,
+                                         matching=True, size_average=True, cost_matrix_engine='segment',
+                                         matching_mode='sinkhorn', sinkhorn_config=sinkhorn_config)
+    hard_loss = loss.loss_object_factory('cross_entropy', MODEL_CHANNEL_SEMANTIC_IDS, MODEL_CHANNEL_INSTANCE_IDS,
+                                         matching=True, size_average=True, cost_matrix_engine='segment')
+    scores = scores.requires_grad_(True)
+    soft_result = soft_loss.loss_fcn(scores, sem_lbl, inst_lbl)
+    hard_result = hard_loss.loss_fcn(scores, sem_lbl, inst_lbl)
+    # The exact assignment minimizes the (unregularized) cost, so the soft-weighted cost can only be higher
+    assert soft_result.total_loss.item() >= hard_result.total_loss.item() - 1e-6
+    assert soft_result.matching_diagnostics['hardened_agreement'] <= 1
+    soft_result.total_loss.backward()
+    assert torch.all(torch.isfinite(scores.grad))
+
+    # Annealed per step (training iteration), not per loss computation
+    soft_loss.loss_fcn(scores, sem_lbl, inst_lbl)
+    assert soft_loss.soft_matcher.temperature == 0.5
+    soft_loss.step()
+    assert soft_loss.soft_matcher.temperature == 0.25
+    soft_loss.step()
+    assert soft_loss.soft_matcher.temperature == sinkhorn_config.min_temperature